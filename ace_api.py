@@ -661,6 +661,54 @@ cloudphish_submit_command_parser.add_argument('-c', '--context', default=None,
             If this parameter starts with a @ then it is taken as the name of a JSON file to load.""")
 cloudphish_submit_command_parser.set_defaults(func=_cli_cloudphish_submit)
 
+def cloudphish_wait(url=None, sha256=None, wait_timeout=60, *args, **kwargs):
+    """Wait for Cloudphish to finish analyzing a URL.
+    Note: either the url OR the sha256 of the url is expected to passed.
+
+    :param str url: (optional) The url
+    :param str sha256: (optional) The sha256 of the url.
+    :param int wait_timeout: (optional) The maximum number of seconds to wait. The server may wait for less.
+    :return: The same result as cloudphish_submit, which is still pending if the wait timed out.
+    """
+    if url is None and sha256 is None:
+        raise ValueError("you must supply either url or sha256 to cloudphish_wait")
+
+    params = { 'timeout': str(wait_timeout) }
+    if url:
+        params['url'] = url
+    if sha256:
+        params['s'] = sha256
+
+    # the request itself needs to wait at least as long as the server does
+    if kwargs.get('timeout') is not None:
+        kwargs['timeout'] += wait_timeout
+
+    return _execute_api_call('cloudphish/wait', params=params, *args, **kwargs).json()
+
+def _cli_cloudphish_wait(args):
+    url = args.target
+    sha256 = None
+
+    if args.sha256:
+        url = None
+        sha256 = args.target
+
+    return cloudphish_wait(remote_host=args.remote_host,
+                           ssl_verification=args.ssl_verification,
+                           url=url,
+                           sha256=sha256,
+                           wait_timeout=args.wait_timeout)
+
+cloudphish_wait_command_parser = _api_command(subparsers.add_parser('cloudphish-wait',
+    help="""Wait for Cloudphish to finish analyzing a URL."""))
+cloudphish_wait_command_parser.add_argument('target', 
+    help="""The URL (or sha256 if -s is used) to wait for.""")
+cloudphish_wait_command_parser.add_argument('-s', '--sha256', default=False, action='store_true',
+    help="Treat target as the sha256 of the URL.")
+cloudphish_wait_command_parser.add_argument('-t', '--wait-timeout', type=int, default=60,
+    help="The maximum number of seconds to wait.")
+cloudphish_wait_command_parser.set_defaults(func=_cli_cloudphish_wait)
+
 def cloudphish_download(url=None, sha256=None, output_path=None, output_fp=None, *args, **kwargs):
     """Download content from Cloudphish. 
     Note: either the url OR the sha256 of the url is expected to passed.
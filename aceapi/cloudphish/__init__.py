@@ -70,6 +70,25 @@ def submit():
     logging.debug("returning result {} for {}".format(result, url))
     return json_result(result.json())
 
+@cloudphish_bp.route('/wait', methods=['GET'])
+def wait():
+    """Blocks until the analysis of the url is completed or the timeout (in seconds) expires.
+       Returns the same result as submit (which may still be pending if the wait timed out.)"""
+    url, sha256_url = _get_url_and_hash()
+
+    max_timeout = saq.CONFIG['cloudphish'].getint('wait_timeout', fallback=60)
+    try:
+        timeout = min(int(request.values.get('timeout', max_timeout)), max_timeout)
+    except ValueError:
+        return "Invalid request (timeout is not an integer)", 400
+
+    result = wait_for_analysis(sha256_url, max(timeout, 0),
+                               poll_interval=saq.CONFIG['cloudphish'].getfloat('wait_poll_interval', fallback=1))
+    if result is None:
+        return "Unknown URL", 404
+
+    return json_result(result.json())
+
 @cloudphish_bp.route('/download', methods=['GET'])
 def download():
     url, sha256_url = _get_url_and_hash()
@@ -289,6 +289,47 @@ class CloudphishAPITestCase(CloudphishTestCase, ACEEngineTestCase):
         result = self.client.get(url_for('cloudphish.submit', url=b'\xFF\x80\x34\x01\x45', ignore_filters='1'))
         self.assertEquals(result.status_code, 500)
 
+    @use_db
+    def test_submit_duplicate_url(self, db, c):
+        # the same url submitted multiple times only creates a single analysis
+        results = []
+        for _ in range(3):
+            result = self.client.get(url_for('cloudphish.submit', url=TEST_URL, ignore_filters='1'))
+            results.append(result.get_json())
+
+        self.assertEquals(len(set([ _[KEY_UUID] for _ in results ])), 1)
+
+        c.execute("SELECT COUNT(*) FROM cloudphish_analysis_results")
+        self.assertEquals(c.fetchone()[0], 1)
+        c.execute("SELECT COUNT(*) FROM workload")
+        self.assertEquals(c.fetchone()[0], 1)
+
+        # the reprocess request does not replace analysis that has not completed yet
+        result = self.client.get(url_for('cloudphish.submit', url=TEST_URL, ignore_filters='1', r='1'))
+        self.assertEquals(result.get_json()[KEY_UUID], results[0][KEY_UUID])
+
+    def test_wait(self):
+        # unknown urls return 404
+        result = self.client.get(url_for('cloudphish.wait', url=TEST_URL, timeout='1'))
+        self.assertEquals(result.status_code, 404)
+
+        submission_result = self.client.get(url_for('cloudphish.submit', url=TEST_URL, ignore_filters='1'))
+        submission_result = submission_result.get_json()
+
+        # nothing is analyzing the url so the wait times out with the pending result
+        start = time.time()
+        result = self.client.get(url_for('cloudphish.wait', s=submission_result[KEY_SHA256_URL], timeout='1'))
+        self.assertGreaterEqual(time.time() - start, 1)
+        result = result.get_json()
+        self.assertEquals(result[KEY_STATUS], STATUS_NEW)
+        self.assertEquals(result[KEY_UUID], submission_result[KEY_UUID])
+
+        # completed analysis is returned right away
+        update_cloudphish_result(submission_result[KEY_SHA256_URL], status=STATUS_ANALYZED, result=SCAN_RESULT_CLEAR)
+        result = self.client.get(url_for('cloudphish.wait', url=TEST_URL, timeout='60')).get_json()
+        self.assertEquals(result[KEY_STATUS], STATUS_ANALYZED)
+        self.assertEquals(result[KEY_ANALYSIS_RESULT], SCAN_RESULT_CLEAR)
+
     def test_submit_ignore_filters(self):
         # we add a url for something that should be blacklisted but we ignore the filters
         with open(self.blacklist_path, 'w') as fp:
@@ -4,22 +4,19 @@ import json
 import logging
 import os.path
 
-import memcache
 import requests
 
 import saq
 from saq.database import get_db_connection, execute_with_retry, enable_cached_db_connections
 from saq.error import report_exception
+from saq.vt_hash_cache import HASH_TYPE_MD5, HASH_TYPE_SHA1, HASH_TYPE_SHA2, HASH_TYPE_COLUMNS, MAX_BATCH_SIZE, \
+                              get_memcache_client, get_hash_type, cache_result, lookup_hashes
 
 from app.vt_hash_cache import *
 
 from flask import redirect, request, make_response, Response
 import pymysql.err
 
-HASH_TYPE_MD5 = 'MD5'
-HASH_TYPE_SHA1 = 'SHA1'
-HASH_TYPE_SHA2 = 'SHA2'
-
 VT_KEY_MD5_HASH = 'md5'
 VT_KEY_SHA1_HASH = 'sha1'
 VT_KEY_SHA2_HASH = 'sha256'
@@ -38,7 +35,6 @@ def query():
     else:
         _hash = request.values['h'].lower()
 
-    _hash_type = None
     result_id = None
     vt_result = None
     md5_hash = None
@@ -46,25 +42,12 @@ def query():
     sha2_hash = None
     
     # determine the type by the lenght of the hash
-    if len(_hash) == 32:
-        _hash_type = HASH_TYPE_MD5
-    elif len(_hash) == 40:
-        _hash_type = HASH_TYPE_SHA1
-    elif len(_hash) == 64:
-        _hash_type = HASH_TYPE_SHA2
-    else:
+    _hash_type = get_hash_type(_hash)
+    if _hash_type is None:
          return "invalid hash", 500
 
     # do we already have a cached query result for this?
-    client_address = saq.CONFIG['memcached']['client_address']
-
-    # see if we are using a unix socket with a relative path
-    if client_address.startswith('unix:'):
-        address = client_address[len('unix:'):]
-        if not os.path.isabs(address):
-            client_address = 'unix:{}/{}'.format(saq.SAQ_HOME, address)
-
-    client = memcache.Client([client_address], debug=0)
+    client = get_memcache_client()
     result_id = client.get(_hash)
 
     if result_id:
@@ -78,12 +61,7 @@ def query():
         with get_db_connection('vt_hash_cache') as db:
             c = db.cursor()
 
-            if _hash_type == HASH_TYPE_MD5:
-                column = 'md5'
-            elif _hash_type == HASH_TYPE_SHA1:
-                column = 'sha1'
-            elif _hash_type == HASH_TYPE_SHA2:
-                column = 'sha2'
+            column = HASH_TYPE_COLUMNS[_hash_type]
 
             # there could potentionally be multiple rows
             # get the latest result
@@ -165,15 +143,38 @@ def query():
         return "VT Result unavailable", 500
 
     # now cache the result
-    if md5_hash:
-        client.set(md5_hash, str(result_id))
-    if sha1_hash:
-        client.set(sha1_hash, str(result_id))
-    if sha2_hash:
-        client.set(sha2_hash, str(result_id))
-
-    client.set(str(result_id), vt_result)
+    cache_result(client, result_id, vt_result, md5_hash, sha1_hash, sha2_hash)
         
     response = make_response(vt_result)
     response.mime_type = 'application/json'
     return response, 200
+
+@vt_hash_cache_bp.route('/vthc/batch', methods=['POST'])
+def batch():
+    """Looks up many hashes at once (passed as multiple h values) in memcached and the database.
+       Returns a json dict with the keys results (hash -> vt result) and misses (the list of hashes that were not
+       available.) The misses are NOT looked up with virus total; use /vthc/query for that."""
+
+    hashes = [ _.lower() for _ in request.values.getlist('h') ]
+    if not hashes:
+        return "missing hashes", 400
+
+    if len(hashes) > MAX_BATCH_SIZE:
+        return "too many hashes (max {})".format(MAX_BATCH_SIZE), 400
+
+    for _hash in hashes:
+        if get_hash_type(_hash) is None:
+            return "invalid hash {}".format(_hash), 400
+
+    try:
+        results, misses = lookup_hashes(hashes)
+    except Exception as e:
+        logging.error("unable to look up hashes: {}".format(e))
+        report_exception()
+        return "unable to look up hashes: {}".format(e), 500
+
+    response = make_response(json.dumps({
+        'results': { _hash: json.loads(vt_result) for _hash, vt_result in results.items() },
+        'misses': misses }))
+    response.mime_type = 'application/json'
+    return response, 200
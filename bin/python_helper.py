@@ -0,0 +1,188 @@
+#!/usr/bin/env python2.7
+#
+# long-lived interpreter that runs python command line tools on request (see saq.helper_pool)
+# this has to run under both python2 and python3 and cannot import anything from saq
+#
+# protocol (every message is a 4 byte big endian length followed by a JSON object)
+# parent --> helper : {"argv": [script, arg, ...], "cwd": dir, "stdout": path, "stderr": path}
+# helper --> parent : {"returncode": int, "recycle": bool, "fallback": bool}
+# fallback is true if the script could not be loaded (the parent runs it with a normal process instead)
+#
+# the script is executed as __main__ with file descriptors 1 and 2 redirected to the given files
+# so the output is the same as running it from the command line
+# modules imported by the scripts stay loaded between jobs
+#
+
+import json
+import logging
+import os
+import struct
+import sys
+import traceback
+import types
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+LENGTH = struct.Struct('>I')
+
+def read_message(fd):
+    header = read_bytes(fd, LENGTH.size)
+    if header is None:
+        return None
+
+    data = read_bytes(fd, LENGTH.unpack(header)[0])
+    if data is None:
+        return None
+
+    return json.loads(data.decode('utf8'))
+
+def read_bytes(fd, count):
+    result = b''
+    while len(result) < count:
+        data = os.read(fd, count - len(result))
+        if not data:
+            return None
+
+        result += data
+
+    return result
+
+def write_message(fd, message):
+    data = json.dumps(message).encode('utf8')
+    data = LENGTH.pack(len(data)) + data
+    while data:
+        data = data[os.write(fd, data):]
+
+# key = path, value = (mtime, compiled script)
+code_cache = {}
+
+def get_code(path):
+    mtime = os.path.getmtime(path)
+    if path not in code_cache or code_cache[path][0] != mtime:
+        with open(path, 'rb') as fp:
+            code_cache[path] = mtime, compile(fp.read(), path, 'exec')
+
+    return code_cache[path][1]
+
+def redirect(path, target_fd):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    os.dup2(fd, target_fd)
+    os.close(fd)
+
+class CannotRun(Exception):
+    pass
+
+def run_job(job):
+    """Runs the job and returns the return code the script would have exited with."""
+    saved_path = sys.path[:]
+    saved_argv = sys.argv
+    saved_cwd = os.getcwd()
+    saved_main = sys.modules['__main__']
+    root_logger = logging.getLogger()
+    saved_handlers = root_logger.handlers[:]
+    saved_level = root_logger.level
+
+    redirect(job['stdout'], 1)
+    redirect(job['stderr'], 2)
+
+    returncode = 0
+    try:
+        if job.get('cwd'):
+            os.chdir(job['cwd'])
+
+        script = job['argv'][0]
+        try:
+            code = get_code(os.path.abspath(script))
+        except (IOError, OSError, SyntaxError, ValueError):
+            # let the parent run it so that it fails the way the interpreter does
+            raise CannotRun()
+
+        sys.argv = list(job['argv'])
+        if sys.version_info[0] == 2:
+            # command line arguments are byte strings in python2
+            sys.argv = [ _.encode('utf8') for _ in sys.argv ]
+
+        sys.path[0] = os.path.dirname(os.path.abspath(script))
+        main_module = types.ModuleType('__main__')
+        main_module.__file__ = script
+        sys.modules['__main__'] = main_module
+        exec(code, main_module.__dict__)
+
+    except CannotRun:
+        raise
+
+    except SystemExit as e:
+        # same rules as the interpreter uses for the exit status
+        if e.code is None:
+            returncode = 0
+        elif isinstance(e.code, int):
+            returncode = e.code
+        else:
+            sys.stderr.write('{}\n'.format(e.code))
+            returncode = 1
+
+    except BaseException:
+        # skip the frame of this function so the traceback looks like the one the interpreter prints
+        etype, value, tb = sys.exc_info()
+        traceback.print_exception(etype, value, tb.tb_next)
+        returncode = 1
+        if isinstance(value, MemoryError):
+            raise
+
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        except Exception:
+            pass
+
+        redirect(os.devnull, 1)
+        redirect(os.devnull, 2)
+        os.chdir(saved_cwd)
+        sys.modules['__main__'] = saved_main
+        sys.argv = saved_argv
+        sys.path[:] = saved_path
+        root_logger.handlers[:] = saved_handlers
+        root_logger.setLevel(saved_level)
+
+    return returncode
+
+def main():
+    # usage: python_helper.py [memory_limit_in_bytes]
+    if len(sys.argv) > 1 and resource is not None:
+        memory_limit = int(sys.argv[1])
+        if memory_limit > 0:
+            resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+    # responses go to the original stdout, the job output goes to fds 1 and 2
+    request_fd = os.dup(0)
+    response_fd = os.dup(1)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+    redirect(os.devnull, 1)
+
+    while True:
+        job = read_message(request_fd)
+        if job is None:
+            break
+
+        response = { 'returncode': None, 'recycle': False, 'fallback': False }
+        try:
+            response['returncode'] = run_job(job)
+        except CannotRun:
+            response['fallback'] = True
+        except MemoryError:
+            # the heap may be in bad shape
+            response['returncode'] = 1
+            response['recycle'] = True
+
+        write_message(response_fd, response)
+        if response['recycle']:
+            break
+
+if __name__ == '__main__':
+    main()
@@ -21,6 +21,7 @@ from saq.configuration import load_configuration, import_encrypted_passwords
 from saq.constants import *
 from saq.messaging import initialize_message_system
 from saq.network_semaphore import initialize_fallback_semaphores
+from saq.radix import NetworkTree
 from saq.sla import SLA
 from saq.util import create_directory
 
@@ -128,6 +129,22 @@ def set_node(name):
         SAQ_NODE_ID = None
         initialize_node()
 
+def initialize_managed_networks():
+    """Loads MANAGED_NETWORKS from the managed_networks option in [network_configuration].
+       This is called by load_configuration every time the configuration is (re)loaded."""
+    global MANAGED_NETWORKS
+
+    managed_networks = NetworkTree()
+    for cidr in CONFIG['network_configuration']['managed_networks'].split(','):
+        try:
+            if cidr.strip():
+                managed_networks.add(cidr)
+        except Exception as e:
+            logging.error("invalid managed network {}: {}".format(cidr, str(e)))
+
+    # swapped in all at once so that readers never see a partially loaded tree
+    MANAGED_NETWORKS = managed_networks
+
 def initialize(saq_home=None, 
                config_paths=None, 
                logging_config_path=None, 
@@ -190,7 +207,7 @@ def initialize(saq_home=None,
     PROXIES = {}
     OTHER_PROXIES = {}
     TOR_PROXY = None
-    # list of iptools.IpRange objects defined in [network_configuration]
+    # saq.radix.NetworkTree of the managed_networks defined in [network_configuration]
     MANAGED_NETWORKS = None
     # set this to True to force all anlaysis to result in an alert being generated
     FORCED_ALERTS = False
@@ -549,17 +566,6 @@ def initialize(saq_home=None,
                         OTHER_PROXIES[proxy_name][proxy_key] = '{}://{}:{}'.format(
                         CONFIG[section]['transport'], CONFIG[section]['host'], CONFIG[section]['port'])
 
-    # load global constants
-    import iptools
-    
-    MANAGED_NETWORKS = []
-    for cidr in CONFIG['network_configuration']['managed_networks'].split(','):
-        try:
-            if cidr:
-                MANAGED_NETWORKS.append(iptools.IpRange(cidr.strip()))
-        except Exception as e:
-            logging.error("invalid managed network {}: {}".format(cidr, str(e)))
-
     # are we running as a daemon?
     if args:
         DAEMON_MODE = args.daemon
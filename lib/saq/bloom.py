@@ -0,0 +1,49 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# bloom filter
+#
+# answers "is this value in the set" without storing the values
+# a value that was added is always found, a value that was not added is found with a probability of about error_rate
+#
+
+import hashlib
+import math
+
+class BloomFilter(object):
+    """A bloom filter sized for a given number of values and false positive rate."""
+
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(capacity, 1)
+        # the number of bits and hash functions that give the requested error rate at capacity
+        self.bit_count = max(int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))), 8)
+        self.hash_count = max(int(round(self.bit_count / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.bit_count + 7) // 8)
+        # the number of values added
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _positions(self, value):
+        if isinstance(value, str):
+            value = value.encode('utf8', errors='surrogateescape')
+
+        # the positions are derived from two halves of a single hash (double hashing)
+        digest = hashlib.blake2b(value, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [ (h1 + i * h2) % self.bit_count for i in range(self.hash_count) ]
+
+    def add(self, value):
+        """Adds the given str or bytes value."""
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+        self.count += 1
+
+    def __contains__(self, value):
+        for position in self._positions(value):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+
+        return True
@@ -1,66 +1,278 @@
 # vim: sw=4:ts=4:et:cc=120
 #
 # utility functions to use the brocess databases
+#
+# the counts are cached per process for [brocess_cache] ttl seconds (see TTLCache)
+# the bulk functions (query_brocess_by_fqdns, etc...) look up all the keys that are not cached with a single query
+# the cache hit rate and the average query latency are recorded as metrics (see saq.performance.record_metric)
+#
 
 import csv
 import datetime
 import logging
-import os.path
+import os, os.path
+import time
 
 import saq
 from saq.database import execute_with_retry, use_db
 from saq.modules import AnalysisModule
-from saq.util import iterate_fqdn_parts
+from saq.performance import record_metric
+from saq.util import iterate_fqdn_parts, TTLCache
 
 import pymysql
 
+# the types of brocess counts that are cached
+CACHE_FQDN = 'fqdn'
+CACHE_DEST_IPV4 = 'dest_ipv4'
+CACHE_SOURCE_EMAIL = 'source_email'
+CACHE_EMAIL_CONVERSATION = 'email_conversation'
+
+# the maximum number of keys looked up in a single query
+BULK_QUERY_SIZE = 500
+
+# the cache is created once per process
+_brocess_cache = None
+_brocess_cache_pid = None
+
+class BrocessStats(object):
+    """Counts the brocess queries and the cache hits and misses since the metrics were last recorded."""
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.query_count = 0
+        self.query_time = 0.0
+        self.last_recorded = time.time()
+
+    @property
+    def hit_rate(self):
+        if not self.hits + self.misses:
+            return None
+
+        return self.hits / (self.hits + self.misses)
+
+    @property
+    def average_query_time(self):
+        """The average time (in seconds) a brocess query took."""
+        if not self.query_count:
+            return None
+
+        return self.query_time / self.query_count
+
+_brocess_stats = BrocessStats()
+
+def get_brocess_cache():
+    """Returns the TTLCache of brocess counts for this process, or None if caching is disabled."""
+    global _brocess_cache, _brocess_cache_pid, _brocess_stats
+
+    if not saq.CONFIG['brocess_cache'].getboolean('enabled', fallback=False):
+        return None
+
+    if _brocess_cache_pid != os.getpid():
+        _brocess_cache = TTLCache(saq.CONFIG['brocess_cache'].getint('max_size', fallback=65536),
+                                  saq.CONFIG['brocess_cache'].getint('ttl', fallback=300))
+        _brocess_cache_pid = os.getpid()
+        _brocess_stats = BrocessStats()
+
+    return _brocess_cache
+
+def clear_brocess_cache():
+    """Removes all the cached counts in this process."""
+    if _brocess_cache is not None:
+        _brocess_cache.clear()
+
+def get_brocess_stats():
+    """Returns the BrocessStats for this process."""
+    return _brocess_stats
+
+def record_brocess_metrics(force=False):
+    """Records the cache hit rate and average query latency (in ms) if it's time to do so (see metrics_frequency.)"""
+    global _brocess_stats
+
+    stats = _brocess_stats
+    if not force and time.time() - stats.last_recorded < saq.CONFIG['brocess_cache'].getint('metrics_frequency',
+                                                                                             fallback=300):
+        return
+
+    _brocess_stats = BrocessStats()
+
+    try:
+        if stats.hit_rate is not None:
+            record_metric('brocess_cache_hit_rate', '{:.3f}'.format(stats.hit_rate))
+        if stats.average_query_time is not None:
+            record_metric('brocess_query_latency', '{:.3f}'.format(stats.average_query_time * 1000))
+    except OSError as e:
+        logging.warning("unable to record brocess metrics: {}".format(e))
+
+def _cached_query(cache_type, keys, query_function):
+    """Returns a dict of key -> count for the given keys. Keys that are not cached are passed as a list to
+       query_function which returns a dict of key -> count for them."""
+    cache = get_brocess_cache()
+    result = {}
+    # brocess compares the values case insensitively so keys that only differ by case are only queried once
+    # key = _cache_key(key), value = the list of keys that are not cached
+    missing = {}
+    for key in keys:
+        if key in result:
+            continue
+
+        cache_key = _cache_key(key)
+        if cache_key in missing:
+            result[key] = None
+            missing[cache_key].append(key)
+            continue
+
+        if cache is not None:
+            count = cache.get((cache_type, cache_key))
+            if count is not None:
+                _brocess_stats.hits += 1
+                result[key] = count
+                continue
+
+            _brocess_stats.misses += 1
+
+        # placeholder until it is queried
+        result[key] = None
+        missing[cache_key] = [ key ]
+
+    missing = list(missing.items())
+    for index in range(0, len(missing), BULK_QUERY_SIZE):
+        chunk = missing[index:index + BULK_QUERY_SIZE]
+        start = time.time()
+        counts = query_function([ group[0] for cache_key, group in chunk ])
+        _brocess_stats.query_time += time.time() - start
+        _brocess_stats.query_count += 1
+        for cache_key, group in chunk:
+            for key in group:
+                result[key] = counts[group[0]]
+
+            if cache is not None:
+                cache.put((cache_type, cache_key), counts[group[0]])
+
+    record_brocess_metrics()
+    return result
+
+def _cache_key(key):
+    if isinstance(key, tuple):
+        return tuple([ _.lower() for _ in key ])
+
+    return key.lower()
+
+def _invalidate(cache_type, keys):
+    cache = get_brocess_cache()
+    if cache is not None:
+        for key in keys:
+            cache.discard((cache_type, _cache_key(key)))
+
 @use_db(name='brocess')
-def query_brocess_by_fqdn(fqdn, db, c):
-        c.execute('SELECT SUM(numconnections) FROM httplog WHERE host = %s', (fqdn,))
-    
-        for row in c:
-            count = row[0]
-            return int(count) if count is not None else 0
+def _query_httplog(fqdns, db, c):
+    result = { fqdn: 0 for fqdn in fqdns }
+    # hosts are compared case insensitively (_cached_query never passes two fqdns that only differ by case)
+    lowered = { fqdn.lower(): fqdn for fqdn in fqdns }
+    c.execute('SELECT host, SUM(numconnections) FROM httplog WHERE host IN ({}) GROUP BY host'.format(
+              ','.join([ '%s' ] * len(fqdns))), tuple(fqdns))
 
-        raise RuntimeError("failed to return a row for sum() query operation !?")
+    for host, count in c:
+        fqdn = lowered.get(host.lower())
+        if fqdn is not None and count is not None:
+            result[fqdn] += int(count)
+
+    return result
 
 @use_db(name='brocess')
-def query_brocess_by_dest_ipv4(ipv4, db, c):
-    c.execute('SELECT SUM(numconnections) FROM connlog WHERE destip = INET_ATON(%s)', (ipv4,))
-    
-    for row in c:
-        count = row[0]
-        return int(count) if count is not None else 0
+def _query_connlog(ipv4s, db, c):
+    result = { ipv4: 0 for ipv4 in ipv4s }
+    c.execute('SELECT INET_NTOA(destip), SUM(numconnections) FROM connlog WHERE destip IN ({}) GROUP BY destip'.format(
+              ','.join([ 'INET_ATON(%s)' ] * len(ipv4s))), tuple(ipv4s))
+
+    for ipv4, count in c:
+        if ipv4 in result and count is not None:
+            result[ipv4] = int(count)
 
-    raise RuntimeError("failed to return a row for sum() query operation !?")
+    return result
 
 @use_db(name='brocess')
-def query_brocess_by_email_conversation(source_email_address, dest_email_address, db, c):
-    c.execute('SELECT SUM(numconnections) FROM smtplog WHERE source = %s AND destination = %s', (
-               source_email_address, dest_email_address,))
-    
-    for row in c:
-        count = row[0]
-        return int(count) if count is not None else 0
+def _query_smtplog_source(addresses, db, c):
+    result = { address: 0 for address in addresses }
+    lowered = { address.lower(): address for address in addresses }
+    c.execute('SELECT source, SUM(numconnections) FROM smtplog WHERE source IN ({}) GROUP BY source'.format(
+              ','.join([ '%s' ] * len(addresses))), tuple(addresses))
+
+    for source, count in c:
+        address = lowered.get(source.lower())
+        if address is not None and count is not None:
+            result[address] += int(count)
 
-    raise RuntimeError("failed to return a row for sum() query operation !?")
+    return result
 
 @use_db(name='brocess')
-def query_brocess_by_source_email(source_email_address, db, c):
-    c.execute('SELECT SUM(numconnections) FROM smtplog WHERE source = %s', (source_email_address,))
-    
-    for row in c:
-        count = row[0]
-        return int(count) if count is not None else 0
+def _query_smtplog_conversation(conversations, db, c):
+    result = { conversation: 0 for conversation in conversations }
+    lowered = { _cache_key(conversation): conversation for conversation in conversations }
+    params = []
+    for source, destination in conversations:
+        params.extend([ source, destination ])
+
+    c.execute("""SELECT source, destination, SUM(numconnections) FROM smtplog
+                 WHERE ( source, destination ) IN ({}) GROUP BY source, destination""".format(
+              ','.join([ '(%s, %s)' ] * len(conversations))), tuple(params))
+
+    for source, destination, count in c:
+        conversation = lowered.get((source.lower(), destination.lower()))
+        if conversation is not None and count is not None:
+            result[conversation] += int(count)
+
+    return result
+
+def query_brocess_by_fqdns(fqdns):
+    """Returns a dict of fqdn -> count for each of the given fqdns (see query_brocess_by_fqdn.)"""
+    return _cached_query(CACHE_FQDN, fqdns, _query_httplog)
+
+def query_brocess_by_fqdn(fqdn):
+    """Returns the total number of connections to the given fqdn."""
+    return query_brocess_by_fqdns([ fqdn ])[fqdn]
+
+def query_brocess_by_dest_ipv4s(ipv4s):
+    """Returns a dict of ipv4 -> count for each of the given ipv4 addresses (see query_brocess_by_dest_ipv4.)"""
+    return _cached_query(CACHE_DEST_IPV4, ipv4s, _query_connlog)
+
+def query_brocess_by_dest_ipv4(ipv4):
+    """Returns the total number of connections to the given ipv4 address."""
+    return query_brocess_by_dest_ipv4s([ ipv4 ])[ipv4]
+
+def query_brocess_by_email_conversations(conversations):
+    """Returns a dict of (source, destination) -> count for each of the given tuples of email addresses
+       (see query_brocess_by_email_conversation.)"""
+    return _cached_query(CACHE_EMAIL_CONVERSATION, [ tuple(_) for _ in conversations ],
+                         _query_smtplog_conversation)
+
+def query_brocess_by_email_conversation(source_email_address, dest_email_address):
+    """Returns the number of emails source_email_address has sent to dest_email_address."""
+    conversation = (source_email_address, dest_email_address)
+    return query_brocess_by_email_conversations([ conversation ])[conversation]
+
+def query_brocess_by_source_emails(source_email_addresses):
+    """Returns a dict of email address -> count for each of the given email addresses
+       (see query_brocess_by_source_email.)"""
+    return _cached_query(CACHE_SOURCE_EMAIL, source_email_addresses, _query_smtplog_source)
+
+def query_brocess_by_source_email(source_email_address):
+    """Returns the number of emails source_email_address has sent."""
+    return query_brocess_by_source_emails([ source_email_address ])[source_email_address]
 
-    raise RuntimeError("failed to return a row for sum() query operation !?")
+def invalidate_smtplog(source, destinations):
+    """Removes the cached counts of the given source email address and of its conversations with the given
+       destination email addresses. Call this after updating the smtplog table."""
+    _invalidate(CACHE_SOURCE_EMAIL, [ source ])
+    _invalidate(CACHE_EMAIL_CONVERSATION, [ (source, destination) for destination in destinations ])
 
 @use_db(name='brocess')
 def add_httplog(fqdn, db, c):
     for fqdn_part in iterate_fqdn_parts(fqdn):
         execute_with_retry(db, c, """
-INSERT INTO httplog ( host, numconnections, firstconnectdate ) 
+INSERT INTO httplog ( host, numconnections, firstconnectdate )
 VALUES ( LOWER(%s), 1, UNIX_TIMESTAMP(NOW()) )
 ON DUPLICATE KEY UPDATE numconnections = numconnections + 1""", ( fqdn_part, ))
 
     db.commit()
+    # the counts just changed
+    _invalidate(CACHE_FQDN, iterate_fqdn_parts(fqdn))
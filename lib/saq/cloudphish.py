@@ -2,11 +2,13 @@
 # constants used by cloudphish
 
 import datetime
+import fcntl
 import hashlib
 import json
 import logging
 import os, os.path
 import pickle
+import time
 import uuid
 
 from urllib.parse import urlparse
@@ -19,8 +21,6 @@ from saq.database import execute_with_retry, use_db
 from saq.error import report_exception
 from saq.util import workload_storage_dir, storage_dir_from_uuid
 
-import pymysql.err
-
 __all__ = [ 
     'RESULT_OK',
     'RESULT_ERROR',
@@ -45,6 +45,9 @@ __all__ = [
     'SCAN_RESULT_PASS',
     'hash_url',
     'get_cached_analysis',
+    'get_cached_analysis_by_hash',
+    'get_analysis_status',
+    'wait_for_analysis',
     'create_analysis',
     'initialize_url_filter',
     'analyze_url',
@@ -55,6 +58,7 @@ __all__ = [
     'update_cloudphish_result',
     'update_content_metadata',
     'get_content_metadata',
+    'CloudphishRequestCoalescer',
 ]
 
 # json schema
@@ -176,6 +180,92 @@ def hash_url(url):
     h.update(url.encode('ascii', errors='ignore'))
     return h.hexdigest()
 
+class CloudphishRequestCoalescer(object):
+    """Shares a single in-flight cloudphish request per url between the processes on this node.
+
+       The processes that submit the same url at the same time wait for the one that got there first and use
+       the response it got. Responses for urls that are still being analyzed are shared for pending_ttl seconds,
+       completed responses for analyzed_ttl seconds.
+
+       The urls are spread across lock_count lock files in request_dir. Each lock file also holds the recent
+       responses for its urls."""
+
+    def __init__(self, request_dir, pending_ttl, analyzed_ttl, lock_timeout, lock_count=4096):
+        self.request_dir = request_dir
+        self.pending_ttl = pending_ttl
+        self.analyzed_ttl = analyzed_ttl
+        self.lock_timeout = lock_timeout
+        self.lock_count = lock_count
+        # the number of requests that were made and the number of shared responses used (since created)
+        self.request_count = 0
+        self.shared_count = 0
+
+    def lock_path(self, sha256_url):
+        return os.path.join(self.request_dir, '{:x}.lock'.format(int(sha256_url, 16) % self.lock_count))
+
+    def _ttl(self, response):
+        if response.get(KEY_RESULT) == RESULT_OK and response.get(KEY_STATUS) == STATUS_ANALYZED:
+            return self.analyzed_ttl
+
+        return self.pending_ttl
+
+    def _lock(self, fp):
+        """Waits up to lock_timeout seconds for the lock. Returns True if the lock was acquired."""
+        timeout = time.time() + self.lock_timeout
+        while True:
+            try:
+                fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                if time.time() >= timeout:
+                    return False
+
+                time.sleep(0.05)
+
+    def _load(self, fp):
+        fp.seek(0)
+        try:
+            return json.loads(fp.read() or '{}')
+        except ValueError as e:
+            logging.warning("invalid cloudphish request file {}: {}".format(fp.name, e))
+            return {}
+
+    def _save(self, fp, responses):
+        now = time.time()
+        fp.seek(0)
+        fp.truncate()
+        fp.write(json.dumps({ key: value for key, value in responses.items() if value['expires'] > now }))
+        fp.flush()
+
+    def submit(self, url, submit_function):
+        """Returns the response for the given url, calling submit_function() to get it only if no other process
+           on this node has a recent response for it or is requesting it."""
+        sha256_url = hash_url(url)
+        os.makedirs(self.request_dir, exist_ok=True)
+
+        with open(self.lock_path(sha256_url), 'a+') as fp:
+            if not self._lock(fp):
+                # whatever is holding the lock is taking too long so we just make our own request
+                logging.warning("timed out waiting for cloudphish request lock for {}".format(url))
+                self.request_count += 1
+                return submit_function()
+
+            try:
+                responses = self._load(fp)
+                if sha256_url in responses and responses[sha256_url]['expires'] > time.time():
+                    logging.debug("using shared cloudphish response for {}".format(url))
+                    self.shared_count += 1
+                    return responses[sha256_url]['response']
+
+                self.request_count += 1
+                response = submit_function()
+                responses[sha256_url] = { 'expires': time.time() + self._ttl(response), 'response': response }
+                self._save(fp, responses)
+                return response
+
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
 class CloudphishAnalysisResult(object):
     def __init__(self, result, details, status=None, analysis_result=None, http_result=None, http_message=None,
                  sha256_content=None, sha256_url=None, location=None, file_name=None, uuid=None):
@@ -216,19 +306,22 @@ class CloudphishAnalysisResult(object):
 
 def get_cached_analysis(url):
     """Returns the CloudphishAnalysisResult of the cached analysis or None if analysis is not cached."""
+    return get_cached_analysis_by_hash(hash_url(url))
+
+def get_cached_analysis_by_hash(sha256):
+    """Returns the CloudphishAnalysisResult of the cached analysis for the given sha256 of a url
+       or None if analysis is not cached."""
     try:
-        return _get_cached_analysis(url)
+        return _get_cached_analysis(sha256)
     except Exception as e:
-        message = "Unable to get analysis for url {}: {}".format(url, e)
+        message = "Unable to get analysis for url hash {}: {}".format(sha256, e)
         logging.error(message)
         report_exception()
 
-        return CloudphishAnalysisResults(RESULT_ERROR, message)
+        return CloudphishAnalysisResult(RESULT_ERROR, message)
 
 @use_db
-def _get_cached_analysis(url, db, c):
-    sha256 = hash_url(url)
-
+def _get_cached_analysis(sha256, db, c):
     # have we already requested and/or processed this URL before?
     c.execute("""SELECT
                      ar.status,
@@ -287,6 +380,33 @@ def _get_cached_analysis(url, db, c):
     # if we have not then we return None
     return None
     
+@use_db
+def get_analysis_status(sha256, db, c):
+    """Returns the status (STATUS_*) of the analysis for the given sha256 of a url or None if there is none."""
+    c.execute("SELECT status FROM cloudphish_analysis_results WHERE sha256_url = UNHEX(%s)", (sha256,))
+    row = c.fetchone()
+    # make sure we're not looking at an old snapshot the next time we ask
+    db.commit()
+    if row is None:
+        return None
+
+    return row[0]
+
+def wait_for_analysis(sha256, timeout, poll_interval=1):
+    """Waits up to timeout seconds for the analysis of the given sha256 of a url to complete.
+       Returns the CloudphishAnalysisResult (which may still be pending if the wait timed out)
+       or None if the url has not been submitted."""
+    timeout = time.time() + timeout
+    while True:
+        status = get_analysis_status(sha256)
+        if status is None:
+            return None
+
+        if status == STATUS_ANALYZED or time.time() + poll_interval > timeout:
+            return get_cached_analysis_by_hash(sha256)
+
+        time.sleep(poll_interval)
+
 def create_analysis(url, reprocess, details):
     try:
         # url must be parsable
@@ -311,34 +431,21 @@ def _create_analysis(url, reprocess, details, db, c):
         # if we're reprocessing the url then we clear any existing analysis
         # IF the current analysis has completed
         # it's OK if we delete nothing here
-        execute_with_retry("""DELETE FROM cloudphish_analysis_results 
-                              WHERE sha256_url = UNHEX(%s) AND status = 'ANALYZED'""", 
+        execute_with_retry(db, c, """DELETE FROM cloudphish_analysis_results 
+                                     WHERE sha256_url = UNHEX(%s) AND status = 'ANALYZED'""", 
                           (sha256_url,), commit=True)
 
     # if we're at this point it means that when we asked the database for an entry from cloudphish_analysis_results
     # it was empty, OR, we cleared existing analysis
     # however, we could have multiple requests coming in at the same time for the same url
-    # so we need to take that into account here
+    # so the insert either creates the pending entry or leaves the one that is already there alone
+    # only the request that created the entry goes on to create the analysis
 
     # first we'll generate our analysis uuid we're going to use
     _uuid = str(uuid.uuid4())
 
-    # so first we try to insert it
-    try:
-        execute_with_retry(db, c, ["""INSERT INTO cloudphish_analysis_results ( sha256_url, uuid, insert_date ) 
-                                      VALUES ( UNHEX(%s), %s, NOW() )""",
-                                   """INSERT INTO cloudphish_url_lookup ( sha256_url, url )
-                                      VALUES ( UNHEX(%s), %s )"""],
-                           [(sha256_url, _uuid),
-                            (sha256_url, url)], commit=True)
-    except pymysql.err.IntegrityError as e:
-        # (<class 'pymysql.err.IntegrityError'>--(1062, "Duplicate entry
-        # if we get a duplicate key entry here then it means that an entry was created between when we asked
-        # and now
-        if e.args[0] != 1062:
-            raise e
-
-        # so just return that one that was already created
+    if not execute_with_retry(db, c, _insert_pending_analysis, (sha256_url, url, _uuid), commit=True):
+        logging.debug("analysis request for {} already exists".format(url))
         return get_cached_analysis(url)
 
     # at this point we've inserted an entry into cloudphish_analysis_results for this url
@@ -382,11 +489,30 @@ def _create_analysis(url, reprocess, details, db, c):
     if url_observable:
         url_observable.add_directive(DIRECTIVE_CRAWL)
 
-    root.save()
-    root.schedule()
+    try:
+        root.save()
+        root.schedule()
+    except Exception as e:
+        # remove the pending entry so that the next request for this url tries again
+        execute_with_retry(db, c, "DELETE FROM cloudphish_analysis_results WHERE sha256_url = UNHEX(%s) AND uuid = %s",
+                          (sha256_url, _uuid), commit=True)
+        raise e
 
     return get_cached_analysis(url)
 
+def _insert_pending_analysis(db, c, sha256_url, url, _uuid):
+    """Inserts a new pending entry into cloudphish_analysis_results for the given url.
+       Returns True if the entry was created, False if one already exists."""
+    c.execute("""INSERT IGNORE INTO cloudphish_analysis_results ( sha256_url, uuid, insert_date )
+                 VALUES ( UNHEX(%s), %s, NOW() )""", (sha256_url, _uuid))
+
+    if c.rowcount != 1:
+        return False
+
+    c.execute("""INSERT INTO cloudphish_url_lookup ( sha256_url, url ) VALUES ( UNHEX(%s), %s )
+                 ON DUPLICATE KEY UPDATE last_lookup = NOW()""", (sha256_url, url))
+    return True
+
 def analyze_url(url, reprocess, ignore_filters, details):
     """Analyze the given url with cloudphish. If reprocess is True then the existing (cached) results are deleted 
        and the url is processed again."""
@@ -24,6 +24,7 @@ from saq.database import use_db, \
                          disable_cached_db_connections
 
 from saq.error import report_exception
+from saq.collectors.watcher import DirectoryWatcher
 from saq.service import ACEService
 from saq.util import create_directory
 
@@ -538,6 +539,9 @@ class Collector(ACEService):
         # NOTE there is no wait if something was previously collected
         self.collection_frequency = collection_frequency
 
+        # the list of DirectoryWatcher objects created by watch_directory
+        self.directory_watchers = []
+
         # XXX meh -- maybe this should be hard coded, or at least in a configuratin file or something
         # get the workload type_id from the database, or, add it if it does not already exist
         try:
@@ -564,6 +568,17 @@ class Collector(ACEService):
         """Called automatically at the end of initialize_environment."""
         pass
 
+    def watch_directory(self, target_dir, recursive=False, file_filter=None):
+        """Returns a new DirectoryWatcher for the given directory, configured from the [collection] section.
+           The watcher is stopped when the service is cleaned up."""
+        watcher = DirectoryWatcher(target_dir, 
+                                   recursive=recursive, 
+                                   file_filter=file_filter,
+                                   use_inotify=saq.CONFIG['collection'].getboolean('use_inotify', fallback=True),
+                                   rescan_frequency=saq.CONFIG['collection'].getint('rescan_frequency', fallback=60))
+        self.directory_watchers.append(watcher)
+        return watcher
+
     def queue_submission(self, submission):
         """Adds the given Submission object to the queue."""
         assert isinstance(submission, Submission)
@@ -604,6 +619,10 @@ class Collector(ACEService):
         # call any subclass-defined initialization routines
         self.initialize_collector()
 
+    def cleanup_service(self):
+        for watcher in self.directory_watchers:
+            watcher.stop()
+
     #
     # ------------
 
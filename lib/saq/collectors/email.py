@@ -2,6 +2,7 @@
 
 import datetime
 import collections
+import concurrent.futures
 import os, os.path
 import socket
 import logging
@@ -9,9 +10,21 @@ import logging
 import saq
 from saq.constants import *
 from saq.collectors import Collector, Submission
+from saq.yara_rules import CompiledRules
 
 import yara
 
+# the yara context used by the assignment scanner processes
+_assignment_yara_context = None
+
+def _initialize_assignment_scanner(compiled_rules_path):
+    global _assignment_yara_context
+    _assignment_yara_context = yara.load(compiled_rules_path)
+
+def _scan_email(email_path):
+    """Returns the list of (rule, tags) tuples for the assignment rules that match the given email."""
+    return [(match.rule, match.tags) for match in _assignment_yara_context.match(email_path)]
+
 class EmailCollector(Collector):
     """Collects emails received by local email system."""
     def __init__(self, *args, **kwargs):
@@ -23,8 +36,17 @@ class EmailCollector(Collector):
         # the location of the incoming emails
         self.email_dir = os.path.join(saq.DATA_DIR, saq.CONFIG['email']['email_dir'])
 
-        # the list of emails that we need to process
-        self.stream_list = collections.deque()
+        # watches for new emails delivered into the subdirectories of email_dir
+        # emails are written to a file with a .new extension while being written
+        # then renamed without with .new when completed
+        self.watcher = self.watch_directory(self.email_dir, recursive=True, 
+                                            file_filter=lambda file_name: not file_name.endswith('.new'))
+
+        # the list of (email_path, future) tuples for emails that are being scanned
+        # future is None if the email is not being scanned by the process pool
+        self.pending_emails = collections.deque()
+        # the set of paths in pending_emails
+        self.pending_paths = set()
 
         # for tool_instance
         self.hostname = socket.getfqdn()
@@ -36,118 +58,203 @@ class EmailCollector(Collector):
         # we keep this list so we don't keep trying to delete them
         self.invalid_subdirs = set()
 
-        # inbound emails are scanned by this yara context to support node assignment
-        self.yara_context = None
+        # inbound emails are scanned by these (precompiled) yara rules to support node assignment
+        self.assignment_rules = None
         self.assignment_yara_rule_path = self.service_config['assignment_yara_rule_path']
         self.blacklist_yara_rule_path = self.service_config['blacklist_yara_rule_path']
 
+        # inbound emails are scanned in parallel by a small pool of processes
+        self.assignment_scanner_count = self.service_config.getint('assignment_scanner_count', fallback=2)
+        self.assignment_scanner_pool = None
+
+        # the last time we looked for empty subdirectories to delete
+        self.last_subdir_cleanup = None
+
+    @property
+    def yara_context(self):
+        """The yara rules (assignment + blacklist rules) inbound emails are scanned with, or None."""
+        if self.assignment_rules is None:
+            return None
+
+        return self.assignment_rules.rules
+
     def initialize_collector(self):
-        rule = ''
+        rule_files = {}
 
         if self.assignment_yara_rule_path:
             if os.path.exists(self.assignment_yara_rule_path):
-                logging.debug("reading assignment rules from {}".format(self.assignment_yara_rule_path))
-                with open(self.assignment_yara_rule_path, 'r') as fp:
-                    rule += fp.read()
+                logging.debug("using assignment rules from {}".format(self.assignment_yara_rule_path))
+                rule_files['assignment'] = self.assignment_yara_rule_path
 
         if self.blacklist_yara_rule_path:
             if os.path.exists(self.blacklist_yara_rule_path):
-                logging.debug("reading blacklist rules from {}".format(self.assignment_yara_rule_path))
-                with open(self.blacklist_yara_rule_path, 'r') as fp:
-                    rule += '\n\n' # just make it easier to read if we ever have to look at it
-                    rule += fp.read()
+                logging.debug("using blacklist rules from {}".format(self.blacklist_yara_rule_path))
+                rule_files['blacklist'] = self.blacklist_yara_rule_path
 
-        if rule:
+        if rule_files:
             try:
-                self.yara_context = yara.compile(source=rule)
+                assignment_rules = CompiledRules(None,
+                    os.path.join(saq.DATA_DIR, saq.CONFIG['service_yara']['compiled_rules_dir'], 'email_assignment'),
+                    update_frequency=saq.CONFIG['service_yara'].getint('update_frequency'),
+                    rule_files=rule_files)
+                assignment_rules.load()
+                self.assignment_rules = assignment_rules
             except Exception as e:
                 logging.error("unable to compile yara rule: {}".format(e))
 
-    def get_next_submission(self):
-        """Returns the next HTTP stream to be processed or None if nothing is available to be processed."""
-        # we collect a list of stuff to send so that we don't have to query the
-        # directory listing every time we submit 
-        if len(self.stream_list) == 0:
-            # first get a list of the sub-directories in this directory
+        self.start_assignment_scanner_pool()
+        self.watcher.start()
+
+    def start_assignment_scanner_pool(self):
+        if self.yara_context is None or self.assignment_scanner_count < 1:
+            return
+
+        self.assignment_scanner_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.assignment_scanner_count,
+            initializer=_initialize_assignment_scanner, 
+            initargs=(self.assignment_rules.path,))
+
+    def check_assignment_rules(self):
+        """Swaps in the new version of the yara rules if they have changed."""
+        if self.assignment_rules is None or not self.assignment_rules.refresh():
+            return
+
+        # the scanner processes are replaced with ones that load the new rules
+        # emails already submitted to the old ones are still scanned with the old rules
+        if self.assignment_scanner_pool is not None:
+            self.assignment_scanner_pool.shutdown(wait=False)
+            self.assignment_scanner_pool = None
+            self.start_assignment_scanner_pool()
+
+    def cleanup_service(self):
+        super().cleanup_service()
+        if self.assignment_scanner_pool is not None:
+            self.assignment_scanner_pool.shutdown(wait=False)
+            self.assignment_scanner_pool = None
+
+    @property
+    def max_pending_emails(self):
+        """Returns the maximum number of emails we'll have queued up for scanning at one time."""
+        return max(self.assignment_scanner_count * 4, 1)
+
+    def queue_pending_emails(self):
+        """Moves newly delivered emails into the scanning queue."""
+        self.check_assignment_rules()
+        while len(self.pending_emails) < self.max_pending_emails:
+            email_path = self.watcher.get_next()
+            if email_path is None:
+                break
+
+            if email_path in self.pending_paths:
+                continue
+
+            future = None
+            if self.assignment_scanner_pool is not None:
+                try:
+                    future = self.assignment_scanner_pool.submit(_scan_email, email_path)
+                except Exception as e:
+                    logging.error("unable to submit {} for scanning: {}".format(email_path, e))
+                    # we'll just scan it here and restart the pool for the next one
+                    self.assignment_scanner_pool.shutdown(wait=False)
+                    self.start_assignment_scanner_pool()
+
+            self.pending_emails.append((email_path, future))
+            self.pending_paths.add(email_path)
+
+    def get_yara_matches(self, email_path, future):
+        """Returns the list of (rule, tags) tuples for the yara rules that match the given email."""
+        if self.yara_context is None:
+            return []
+
+        if future is not None:
+            try:
+                return future.result()
+            except Exception as e:
+                logging.error("unable to scan {} in assignment scanner pool: {}".format(email_path, e))
+
+        return [(match.rule, match.tags) for match in self.yara_context.match(email_path)]
+
+    def cleanup_subdirs(self):
+        """Deletes the empty email subdirectories other than the one for the current hour."""
+        if self.last_subdir_cleanup is not None \
+        and datetime.datetime.now() - self.last_subdir_cleanup < datetime.timedelta(seconds=60):
+            return
+
+        self.last_subdir_cleanup = datetime.datetime.now()
+        current_subdir = datetime.datetime.now().strftime(self.subdir_format)
+
+        for entry in os.scandir(self.email_dir):
             # each directory has the format YYYYMMDDHH
-            # these should be sorted from oldest to newest
-            subdirs = sorted(filter(os.path.isdir, [os.path.join(self.email_dir, _) for _ in os.listdir(self.email_dir)]), key=os.path.getmtime)
-
-            for subdir_name in subdirs:
-                target_dir = os.path.join(self.email_dir, subdir_name)
-                # skip the ones we couldn't delete
-                if target_dir in self.invalid_subdirs:
-                    continue
-
-                logging.debug("checking for emails in {}".format(target_dir))
-                email_count = 0
-
-                for email_file in os.listdir(target_dir):
-                    email_count += 1
-                    # emails are written to a file with a .new extension while being written
-                    # then renamed without with .new when completed
-                    if email_file.endswith(".new"):
-                        continue
-
-                    email_path = os.path.join(target_dir, email_file)
-                    logging.info("found email {}".format(email_file))
-
-                    group_assignments = []
-
-                    if self.yara_context is not None:
-                        # yara rules can control what groups the email actually gets sent to
-                        yara_matches = self.yara_context.match(email_path)
-
-                        # check for blacklisting first
-                        blacklisted = False
-                        for match in yara_matches:
-                            for tag in match.tags:
-                                if tag == 'blacklist':
-                                    logging.info("{} matched blacklist rule {}".format(email_path, match.rule))
-                                    blacklisted = True
-                                    break
-
-                        if blacklisted:
-                            # we just delete it and move on
-                            try:
-                                os.remove(email_path)
-                            except Exception as e:
-                                logging.error("unable to delete {}: {}".format(email_path, e))
-
-                            continue
-
-                        for match in yara_matches:
-                            group_assignments = match.tags[:]
-                            logging.info("assigning email {} to groups {}".format(email_path, ','.join(group_assignments)))
-
-                    # create a new submission request for this
-                    self.stream_list.append(Submission(
-                        description = 'ACE Mailbox Scanner Detection - {}'.format(email_file),
-                        analysis_mode = ANALYSIS_MODE_EMAIL,
-                        tool = 'ACE - Mailbox Scanner',
-                        tool_instance = self.hostname,
-                        type = ANALYSIS_TYPE_MAILBOX,
-                        event_time = datetime.datetime.fromtimestamp(os.path.getmtime(email_path)),
-                        details = {},
-                        observables = [ { 'type': F_FILE, 
-                                        'value': 'email.rfc822', 
-                                        'directives': [ DIRECTIVE_NO_SCAN, DIRECTIVE_ORIGINAL_EMAIL, DIRECTIVE_ARCHIVE ], } ],
-                        tags = [],
-                        files=[(email_path, 'email.rfc822')],
-                        group_assignments=group_assignments))
-
-                # was this directory empty?
-                if email_count == 0:
-                    # does the current directory name not equal the current YYYYMMDDHH?
-                    if subdir_name != datetime.datetime.now().strftime(self.subdir_format):
-                        try:
-                            logging.info("deleting empty email directory {}".format(target_dir))
-                            os.rmdir(target_dir)
-                        except Exception as e:
-                            logging.error("unable to delete {}: {}".format(target_dir, e))
-                            #self.invalid_subdirs.add(target_dir)
-
-        if len(self.stream_list) == 0:
-            return None
+            if not entry.is_dir() or entry.name == current_subdir or entry.path in self.invalid_subdirs:
+                continue
+
+            # os.rmdir will only remove it if it's empty
+            try:
+                os.rmdir(entry.path)
+                logging.info("deleted empty email directory {}".format(entry.path))
+            except OSError:
+                pass
+
+    def get_next_submission(self):
+        """Returns the next email to be processed or None if nothing is available to be processed."""
+        # the watcher is normally started in initialize_collector
+        if self.watcher.last_scan is None:
+            self.watcher.start()
+
+        while True:
+            self.queue_pending_emails()
+            if not self.pending_emails:
+                self.cleanup_subdirs()
+                return None
+
+            email_path, future = self.pending_emails.popleft()
+            self.pending_paths.discard(email_path)
+            email_file = os.path.basename(email_path)
+            logging.info("found email {}".format(email_file))
+
+            try:
+                # yara rules can control what groups the email actually gets sent to
+                yara_matches = self.get_yara_matches(email_path, future)
+                event_time = datetime.datetime.fromtimestamp(os.path.getmtime(email_path))
+            except FileNotFoundError:
+                logging.warning("email {} disappeared before it was collected".format(email_path))
+                continue
+
+            group_assignments = []
+
+            # check for blacklisting first
+            blacklisted = False
+            for rule, tags in yara_matches:
+                if 'blacklist' in tags:
+                    logging.info("{} matched blacklist rule {}".format(email_path, rule))
+                    blacklisted = True
+                    break
+
+            if blacklisted:
+                # we just delete it and move on
+                try:
+                    os.remove(email_path)
+                except Exception as e:
+                    logging.error("unable to delete {}: {}".format(email_path, e))
+
+                continue
+
+            for rule, tags in yara_matches:
+                group_assignments = tags[:]
+                logging.info("assigning email {} to groups {}".format(email_path, ','.join(group_assignments)))
 
-        return self.stream_list.popleft()
+            # create a new submission request for this
+            return Submission(
+                description = 'ACE Mailbox Scanner Detection - {}'.format(email_file),
+                analysis_mode = ANALYSIS_MODE_EMAIL,
+                tool = 'ACE - Mailbox Scanner',
+                tool_instance = self.hostname,
+                type = ANALYSIS_TYPE_MAILBOX,
+                event_time = event_time,
+                details = {},
+                observables = [ { 'type': F_FILE, 
+                                'value': 'email.rfc822', 
+                                'directives': [ DIRECTIVE_NO_SCAN, DIRECTIVE_ORIGINAL_EMAIL, DIRECTIVE_ARCHIVE ], } ],
+                tags = [],
+                files=[(email_path, 'email.rfc822')],
+                group_assignments=group_assignments)
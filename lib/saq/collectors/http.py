@@ -1,6 +1,5 @@
 # vim: sw=4:ts=4:et:cc=120
 
-import collections
 import datetime
 import os, os.path
 import re
@@ -26,49 +25,49 @@ class BroHTTPStreamCollector(Collector):
         # the location of the incoming http streams
         self.bro_http_dir = os.path.join(saq.DATA_DIR, saq.CONFIG['bro']['http_dir'])
 
-        # the list of streams (connection ids) that we need to process
-        self.stream_list = collections.deque()
+        # watches for the "ready" files bro creates when a stream is ready for processing
+        self.watcher = self.watch_directory(self.bro_http_dir, 
+                                            file_filter=lambda file_name: REGEX_CONNECTION_ID.match(file_name))
 
         # for tool_instance
         self.hostname = socket.getfqdn()
 
+    def initialize_collector(self):
+        self.watcher.start()
+
     def get_next_submission(self):
         """Returns the next HTTP stream to be processed or None if nothing is available to be processed."""
-        # we collect a list of stuff to send so that we don't have to query the
-        # directory listing every time we submit 
-        if len(self.stream_list) == 0:
-            for file_name in os.listdir(self.bro_http_dir):
-                m = REGEX_CONNECTION_ID.match(file_name)
-                if m:
-                    # found a "ready" file indicating the stream is ready for processing
-                    stream_prefix = m.group(1)
-                    logging.info("found http stream {}".format(stream_prefix))
+        # the watcher is normally started in initialize_collector
+        if self.watcher.last_scan is None:
+            self.watcher.start()
 
-                    # these are all the possible files that can exist for a single stream request/response
-                    source_files = [ os.path.join(self.bro_http_dir, '{}.request'.format(stream_prefix)),
-                                     os.path.join(self.bro_http_dir, '{}.request.entity'.format(stream_prefix)),
-                                     os.path.join(self.bro_http_dir, '{}.reply'.format(stream_prefix)),
-                                     os.path.join(self.bro_http_dir, '{}.reply.entity'.format(stream_prefix)),
-                                     os.path.join(self.bro_http_dir, '{}.ready'.format(stream_prefix)) ]
+        ready_file_path = self.watcher.get_next()
+        if ready_file_path is None:
+            return None
 
-                    # filter this list down to what is actually available for this one
-                    source_files = [f for f in source_files if os.path.exists(f)]
+        # found a "ready" file indicating the stream is ready for processing
+        stream_prefix = REGEX_CONNECTION_ID.match(os.path.basename(ready_file_path)).group(1)
+        logging.info("found http stream {}".format(stream_prefix))
 
-                    # create a new submission request for this
-                    self.stream_list.append(Submission(
-                        description = 'BRO HTTP Scanner Detection - {}'.format(stream_prefix),
-                        analysis_mode = ANALYSIS_MODE_HTTP,
-                        tool = 'ACE - Bro HTTP Scanner',
-                        tool_instance = self.hostname,
-                        type = ANALYSIS_TYPE_BRO_HTTP,
-                        event_time = datetime.datetime.fromtimestamp(os.path.getmtime(os.path.join(
-                                                                                      self.bro_http_dir, file_name))),
-                        details = {},
-                        observables = [],
-                        tags = [],
-                        files=source_files))
+        # these are all the possible files that can exist for a single stream request/response
+        source_files = [ os.path.join(self.bro_http_dir, '{}.request'.format(stream_prefix)),
+                         os.path.join(self.bro_http_dir, '{}.request.entity'.format(stream_prefix)),
+                         os.path.join(self.bro_http_dir, '{}.reply'.format(stream_prefix)),
+                         os.path.join(self.bro_http_dir, '{}.reply.entity'.format(stream_prefix)),
+                         ready_file_path ]
 
-        if len(self.stream_list) == 0:
-            return None
+        # filter this list down to what is actually available for this one
+        source_files = [f for f in source_files if os.path.exists(f)]
 
-        return self.stream_list.popleft()
+        # create a new submission request for this
+        return Submission(
+            description = 'BRO HTTP Scanner Detection - {}'.format(stream_prefix),
+            analysis_mode = ANALYSIS_MODE_HTTP,
+            tool = 'ACE - Bro HTTP Scanner',
+            tool_instance = self.hostname,
+            type = ANALYSIS_TYPE_BRO_HTTP,
+            event_time = datetime.datetime.fromtimestamp(os.path.getmtime(ready_file_path)),
+            details = {},
+            observables = [],
+            tags = [],
+            files=source_files)
@@ -24,7 +24,9 @@
 
 import configparser
 import datetime
+import heapq
 import importlib
+import itertools
 import logging
 import operator
 import os, os.path
@@ -75,6 +77,9 @@ class Hunt(object):
         # in that case we don't want to record any of the execution time stamps
         self.manual_hunt = False
 
+        # reference to the HuntManager managing this hunt (set by HuntManager.add_hunt)
+        self.manager = None
+
         # this property maps to the "tool_instance" property of alerts
         # this shows where the alert came from
         # by default we use localhost
@@ -270,14 +275,30 @@ class HuntManager(object):
 CREATE TABLE hunt ( 
     hunt_name TEXT NOT NULL,
     last_executed_time timestamp,
-    last_end_time timestamp )""")
+    last_end_time timestamp,
+    last_start_time timestamp )""")
                 c.execute("""
 CREATE UNIQUE INDEX idx_name ON hunt(hunt_name)""")
                 db.commit()
 
+        # older databases do not have the last_start_time column
+        with open_hunt_db(self.hunt_type) as db:
+            c = db.cursor()
+            c.execute("PRAGMA table_info(hunt)")
+            if 'last_start_time' not in [row[1] for row in c.fetchall()]:
+                c.execute("ALTER TABLE hunt ADD COLUMN last_start_time timestamp")
+                db.commit()
+
         # the list of Hunt objects that are being managed
         self._hunts = []
 
+        # priority queue of (next_execution_time, sequence, Hunt) for the hunts waiting to execute
+        # hunts are removed while they execute and are scheduled again when they complete
+        self.schedule = []
+        self.schedule_lock = threading.RLock()
+        # breaks ties between hunts scheduled for the same time
+        self.schedule_sequence = itertools.count()
+
         # the type of concurrency contraint this type of hunt uses (can be None)
         # use the set_concurrency_limit() function to change it
         self.concurrency_type = None
@@ -333,7 +354,10 @@ CREATE UNIQUE INDEX idx_name ON hunt(hunt_name)""")
         self.cancel_hunts()
         
         # then release all the hunts and load the new ones
-        self._hunts = []
+        with self.schedule_lock:
+            self._hunts = []
+            self.schedule = []
+
         self.load_hunts_from_config()
 
     def start(self):
@@ -379,23 +403,64 @@ CREATE UNIQUE INDEX idx_name ON hunt(hunt_name)""")
 
         logging.debug(f"stopped {self}")
 
+    def schedule_hunt(self, hunt):
+        """Schedules the given hunt to execute at its next execution time."""
+        with self.schedule_lock:
+            heapq.heappush(self.schedule, (hunt.next_execution_time, next(self.schedule_sequence), hunt))
+
+        # wake up the manager thread in case this hunt is now the next one to run
+        self.wait_control_event.set()
+
+    def get_next_hunt(self):
+        """Returns a tuple of (hunt, wait_time) for the next hunt in the schedule.
+           If the hunt is ready to execute it is removed from the schedule and wait_time is None.
+           Otherwise wait_time is the number of seconds until the hunt is ready.
+           Returns (None, None) if nothing is scheduled."""
+        with self.schedule_lock:
+            while self.schedule:
+                scheduled_time, _, hunt = self.schedule[0]
+
+                # skip over hunts that have been removed
+                if hunt not in self._hunts:
+                    heapq.heappop(self.schedule)
+                    continue
+
+                if hunt.ready:
+                    heapq.heappop(self.schedule)
+                    return hunt, None
+
+                # if something else is executing this hunt then check back later
+                if hunt.running:
+                    return hunt, 1
+
+                # if the hunt's next execution time moved out since it was scheduled then re-schedule it
+                next_execution_time = hunt.next_execution_time
+                if next_execution_time > scheduled_time:
+                    heapq.heapreplace(self.schedule, (next_execution_time, next(self.schedule_sequence), hunt))
+                    continue
+
+                return hunt, max((next_execution_time - local_time()).total_seconds(), 0)
+
+        return None, None
+
     def execute(self):
-        # the next one to run should be the first in our list
-        for hunt in self.hunts:
-            if hunt.ready:
+        # execute everything that is ready to go
+        while not self.manager_control_event.is_set():
+            hunt, wait_time = self.get_next_hunt()
+            if hunt is not None and wait_time is None:
                 self.execute_hunt(hunt)
                 continue
+
+            if hunt is None:
+                logging.debug(f"no hunts scheduled for {self}")
             else:
-                # this one isn't ready so wait for this hunt to be ready
-                wait_time = (hunt.next_execution_time - local_time()).total_seconds()
                 logging.info(f"next hunt is {hunt} @ {hunt.next_execution_time} ({wait_time} seconds)")
-                self.wait_control_event.wait(wait_time)
-                self.wait_control_event.clear()
 
-                # if a hunt ends while we're waiting, wait_control_event will break out before wait_time seconds
-                # at this point, it's possible there's another hunt ready to execute before this one we're waiting on
-                # so no matter what, we break out so that we re-enter with a re-ordered list of hunts
-                return
+            # wait until the next hunt is ready
+            # this wakes up early if a hunt completes or the hunts are changed
+            self.wait_control_event.wait(wait_time)
+            self.wait_control_event.clear()
+            return
 
     def execute_hunt(self, hunt):
         # are we ready to run another one of these types of hunts?
@@ -406,6 +471,8 @@ CREATE UNIQUE INDEX idx_name ON hunt(hunt_name)""")
         if self.manager_control_event.is_set():
             if hunt.semaphore is not None:
                 hunt.semaphore.release()
+
+            self.schedule_hunt(hunt)
             return
 
         # keep track of how long it's taking to acquire the resource
@@ -424,6 +491,7 @@ CREATE UNIQUE INDEX idx_name ON hunt(hunt_name)""")
         hunt.startup_barrier.wait()
 
     def execute_threaded_hunt(self, hunt):
+        submissions = None
         try:
             submissions = hunt.execute_with_lock()
         except Exception as e:
@@ -432,7 +500,7 @@ CREATE UNIQUE INDEX idx_name ON hunt(hunt_name)""")
         finally:
             self.release_concurrency_lock(hunt.semaphore)
             # at this point this hunt has finished and is eligible to execute again
-            self.wait_control_event.set()
+            self.schedule_hunt(hunt)
 
         if submissions is not None:
             for submission in submissions:
@@ -465,27 +533,37 @@ CREATE UNIQUE INDEX idx_name ON hunt(hunt_name)""")
             logging.debug(f"concurrency limit for {self.hunt_type} set to "
                           f"network semaphore {self.concurrency_semaphore}")
 
-    def acquire_concurrency_lock(self):
+    def acquire_concurrency_lock(self, cancel_callback=None):
         """Acquires a concurrency lock for this type of hunt if specified in the configuration for the hunt.
            Returns a NetworkSemaphoreClient object if the concurrency_type is CONCURRENCY_TYPE_NETWORK_SEMAPHORE
            or a reference to the threading.Semaphore object if concurrency_type is CONCURRENCY_TYPE_LOCAL_SEMAPHORE.
-           Immediately returns None if non concurrency limits are in place for this type of hunt."""
+           Immediately returns None if non concurrency limits are in place for this type of hunt.
+           The optional cancel_callback returns True if the request should be cancelled, in which case 
+           None is returned if the lock was not acquired."""
 
         if self.concurrency_type is None:
             return None
 
+        def _cancelled():
+            # make sure we cancel outstanding request when shutting down
+            return self.manager_control_event.is_set() or ( cancel_callback is not None and cancel_callback() )
+
         result = None
         start_time = local_time()
         if self.concurrency_type == CONCURRENCY_TYPE_NETWORK_SEMAPHORE:
             logging.debug(f"acquiring network concurrency semaphore {self.concurrency_semaphore} "
                           f"for hunt type {self.hunt_type}")
-            result = NetworkSemaphoreClient(cancel_request_callback=self.manager_control_event.is_set)
-                                                                # make sure we cancel outstanding request 
-                                                                # when shutting down
-            result.acquire(self.concurrency_semaphore)
+            result = NetworkSemaphoreClient(cancel_request_callback=_cancelled)
+            if not result.acquire(self.concurrency_semaphore) and cancel_callback is not None:
+                try:
+                    result.socket.close()
+                except Exception:
+                    pass
+
+                result = None
         else:
             logging.debug(f"acquiring local concurrency semaphore for hunt type {self.hunt_type}")
-            while not self.manager_control_event.is_set():
+            while not _cancelled():
                 if self.concurrency_semaphore.acquire(blocking=True, timeout=0.1):
                     result = self.concurrency_semaphore
                     break
@@ -502,6 +580,55 @@ CREATE UNIQUE INDEX idx_name ON hunt(hunt_name)""")
             logging.debug(f"releasing concurrency semaphore for hunt type {self.hunt_type}")
             semaphore.release()
 
+    def execute_concurrently(self, targets):
+        """Executes the given list of callables in parallel within the concurrency limits of this type of hunt.
+           This is called from a hunt execution thread that already holds a concurrency lock, so the calling thread
+           executes targets itself while additional threads execute the rest as they acquire additional locks.
+           Returns the list of the return values of the targets (None for targets that failed.)"""
+        results = [ None for _ in targets ]
+        work_queue = list(enumerate(targets))
+        work_lock = threading.Lock()
+
+        def _next_target():
+            with work_lock:
+                return work_queue.pop(0) if work_queue else (None, None)
+
+        def _drain():
+            while not self.manager_control_event.is_set():
+                index, target = _next_target()
+                if target is None:
+                    break
+
+                try:
+                    results[index] = target()
+                except Exception as e:
+                    logging.error(f"{target} failed: {e}")
+                    report_exception()
+
+        def _helper():
+            # give up waiting for a lock once everything has been picked up
+            semaphore = self.acquire_concurrency_lock(cancel_callback=lambda: not work_queue)
+            if semaphore is None and self.concurrency_type is not None:
+                return
+
+            try:
+                _drain()
+            finally:
+                self.release_concurrency_lock(semaphore)
+
+        helper_threads = []
+        for index in range(len(targets) - 1):
+            helper_thread = threading.Thread(target=_helper, name=f"Hunt Helper {self.hunt_type} #{index}")
+            helper_thread.start()
+            helper_threads.append(helper_thread)
+
+        _drain()
+
+        for helper_thread in helper_threads:
+            helper_thread.join()
+
+        return results
+
     def load_hunts_from_config(self, hunt_filter=lambda hunt: True):
         """Loads the hunts from the configuration settings.
            Returns True if all of the hunts were loaded correctly, False if any errors occurred.
@@ -552,8 +679,11 @@ CREATE UNIQUE INDEX idx_name ON hunt(hunt_name)""")
                      (hunt.name,))
             db.commit()
 
-        self._hunts.append(hunt)
-        self.wait_control_event.set()
+        hunt.manager = self
+        with self.schedule_lock:
+            self._hunts.append(hunt)
+
+        self.schedule_hunt(hunt)
         return hunt
 
     def remove_hunt(self, hunt):
@@ -565,7 +695,11 @@ CREATE UNIQUE INDEX idx_name ON hunt(hunt_name)""")
                      (hunt.name,))
             db.commit()
 
-        self._hunts.remove(hunt)
+        # NOTE the hunt is dropped from the schedule when it comes up
+        with self.schedule_lock:
+            self._hunts.remove(hunt)
+
+        hunt.manager = None
         self.wait_control_event.set()
         return hunt
 
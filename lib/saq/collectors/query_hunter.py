@@ -4,9 +4,11 @@
 #
 
 import datetime
+import functools
 import logging
 import re
 import json
+import threading
 
 COMMENT_REGEX = re.compile(r'^\s*#.*?$', re.M)
 
@@ -35,6 +37,7 @@ class QueryHunt(Hunt):
                        strip_comments=False,
                        max_result_count=None,
                        query_result_file=None,
+                       max_catchup_windows=None,
                        *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -71,6 +74,11 @@ class QueryHunt(Hunt):
         # debugging utility to save the results of the query to a file
         self.query_result_file = query_result_file
 
+        # when a full coverage hunt falls behind (for example after downtime) the time it missed
+        # is split into windows of max_time_range (or time_range) that execute in parallel
+        # this is the maximum number of windows a single execution will cover
+        self.max_catchup_windows = max_catchup_windows
+
     def execute_query(self, start_time, end_time, *args, **kwargs):
         """Called to execute the query over the time period given by the start_time and end_time parameters.
            Returns a list of zero or more Submission objects."""
@@ -115,6 +123,46 @@ class QueryHunt(Hunt):
 
         self._last_end_time = value
 
+    @property
+    def last_start_time(self):
+        """The start_time value of the last window this hunt covered."""
+        if hasattr(self, '_last_start_time'):
+            return self._last_start_time
+        else:
+            with open_hunt_db(self.type) as db:
+                c = db.cursor()
+                c.execute("SELECT last_start_time FROM hunt WHERE hunt_name = ?",
+                         (self.name,))
+                row = c.fetchone()
+                if row is None:
+                    self._last_start_time = None
+                    return self._last_start_time
+                else:
+                    self._last_start_time = row[0]
+                    if self._last_start_time is not None and self._last_start_time.tzinfo is None:
+                        self._last_start_time = pytz.utc.localize(self._last_start_time)
+                    return self._last_start_time
+
+    def record_window(self, start_time, end_time):
+        """Records the given time range as the last window this hunt covered."""
+        if start_time.tzinfo is None:
+            start_time = pytz.utc.localize(start_time)
+
+        if end_time.tzinfo is None:
+            end_time = pytz.utc.localize(end_time)
+
+        start_time = start_time.astimezone(pytz.utc)
+        end_time = end_time.astimezone(pytz.utc)
+
+        with open_hunt_db(self.type) as db:
+            c = db.cursor()
+            c.execute("UPDATE hunt SET last_start_time = ?, last_end_time = ? WHERE hunt_name = ?",
+                     (start_time.replace(tzinfo=None), end_time.replace(tzinfo=None), self.name))
+            db.commit()
+
+        self._last_start_time = start_time
+        self._last_end_time = end_time
+
     @property
     def start_time(self):
         """Returns the starting time of this query based on the last time we searched."""
@@ -152,6 +200,11 @@ class QueryHunt(Hunt):
             # if we're not doing full coverage then we don't worry about the last end time
             return now
 
+    @property
+    def catching_up(self):
+        """Returns True if the difference between now and the last_end_time is >= the time_range."""
+        return self.last_end_time is not None and local_time() - self.last_end_time >= self.time_range
+
     @property
     def ready(self):
         """Returns True if the hunt is ready to execute, False otherwise."""
@@ -163,14 +216,49 @@ class QueryHunt(Hunt):
         if self.last_executed_time is None:
             return True
 
-        # if the difference between now and the last_end_time is >= the time_range
-        # then we are playing catchup and we need to run again
-        if self.last_end_time is not None and local_time() - self.last_end_time >= self.time_range:
+        # if we are playing catchup then we need to run again
+        if self.catching_up:
             return True
 
         # otherwise we're not ready until it's past the next execution time
         return local_time() >= self.next_execution_time
 
+    @property
+    def next_execution_time(self):
+        # if we are playing catchup then we need to run again right away
+        if self.last_executed_time is not None and self.catching_up:
+            return local_time()
+
+        return super().next_execution_time
+
+    @property
+    def execution_windows(self):
+        """Returns the list of (start_time, end_time) tuples to cover on the next execution.
+           Normally this is the single range given by start_time and end_time.
+           When a full coverage hunt has fallen behind by more than one window the time missed is split
+           into windows of max_time_range (or time_range if that is not set) up to max_catchup_windows."""
+        start_time = self.start_time
+        end_time = self.end_time
+        if not self.full_coverage or self.last_end_time is None:
+            return [ (start_time, end_time) ]
+
+        now = local_time()
+        window_size = self.max_time_range if self.max_time_range is not None else self.time_range
+        if now - start_time <= window_size:
+            return [ (start_time, end_time) ]
+
+        max_catchup_windows = self.max_catchup_windows
+        if max_catchup_windows is None:
+            max_catchup_windows = saq.CONFIG['query_hunter'].getint('max_catchup_windows', fallback=8)
+
+        result = []
+        while start_time < now and len(result) < max(max_catchup_windows, 1):
+            end_time = min(start_time + window_size, now)
+            result.append((start_time, end_time))
+            start_time = end_time
+
+        return result
+
     def load_query_from_file(self, path):
         with open(abs_path(self.search_query_path), 'r') as fp:
             result = fp.read()
@@ -207,6 +295,10 @@ class QueryHunt(Hunt):
         self.query_timeout = rule_section.get('query_timeout',
                                               fallback=saq.CONFIG['query_hunter']['query_timeout'])
 
+        self.max_catchup_windows = rule_section.getint('max_catchup_windows',
+                                                       fallback=saq.CONFIG['query_hunter'].getint(
+                                                           'max_catchup_windows', fallback=8))
+
         if 'offset' in rule_section:
             self.offset = create_timedelta(rule_section['offset'])
 
@@ -255,29 +347,68 @@ class QueryHunt(Hunt):
     # to allow manual command line hunting (for research purposes)
     def execute(self, start_time=None, end_time=None, *args, **kwargs):
 
-        offset_start_time = target_start_time = start_time if start_time is not None else self.start_time
-        offset_end_time = target_end_time = end_time if end_time is not None else self.end_time
+        if start_time is not None or end_time is not None:
+            windows = [ (start_time if start_time is not None else self.start_time,
+                         end_time if end_time is not None else self.end_time) ]
+        else:
+            windows = self.execution_windows
+
+        if len(windows) > 1:
+            logging.info(f"{self} catching up from {windows[0][0]} to {windows[-1][1]} in {len(windows)} windows")
+
+        # windows can complete out of order when they execute in parallel
+        # so we only record the window when everything before it has also completed
+        # that way we never leave a gap in coverage
+        completed_windows = [ False for _ in windows ]
+        progress = { 'next_window': 0 }
+        progress_lock = threading.Lock()
+
+        def _execute_window(index):
+            try:
+                return self.execute_window(*windows[index], *args, **kwargs)
+            finally:
+                with progress_lock:
+                    completed_windows[index] = True
+                    while progress['next_window'] < len(windows) and completed_windows[progress['next_window']]:
+                        # if we're not manually hunting then record the last window
+                        if not self.manual_hunt:
+                            self.record_window(*windows[progress['next_window']])
+
+                        progress['next_window'] += 1
+
+        if len(windows) == 1 or self.manager is None:
+            results = [ _execute_window(index) for index in range(len(windows)) ]
+        else:
+            results = self.manager.execute_concurrently([ functools.partial(_execute_window, index) 
+                                                          for index in range(len(windows)) ])
+
+        submissions = []
+        for result in results:
+            if result:
+                submissions.extend(result)
+
+        return submissions
 
-        try:
-            # the optional offset allows hunts to run at some offset of time
-            if not self.manual_hunt and self.offset:
-                offset_start_time -= self.offset
-                offset_end_time -= self.offset
+    def execute_window(self, start_time, end_time, *args, **kwargs):
+        """Executes the query over the given time range. Returns a list of zero or more Submission objects."""
+        # the optional offset allows hunts to run at some offset of time
+        if not self.manual_hunt and self.offset:
+            start_time -= self.offset
+            end_time -= self.offset
 
-            query_result = self.execute_query(offset_start_time, offset_end_time, *args, **kwargs)
+        query_result = self.execute_query(start_time, end_time, *args, **kwargs)
 
-            if self.query_result_file is not None:
-                with open(self.query_result_file, 'w') as fp:
-                    json.dump(query_result, fp)
+        if self.query_result_file is not None:
+            # results can be streamed as a generator
+            if query_result is not None and not isinstance(query_result, list):
+                query_result = list(query_result)
 
-                logging.info(f"saved results to {self.query_result_file}")
+            with open(self.query_result_file, 'w') as fp:
+                json.dump(query_result, fp)
 
-            return self.process_query_results(query_result)
+            logging.info(f"saved results to {self.query_result_file}")
 
-        finally:
-            # if we're not manually hunting then record the last end time
-            if not self.manual_hunt:
-                self.last_end_time = target_end_time
+        return self.process_query_results(query_result)
 
     def extract_event_timestamp(self, query_result):
         """Given a JSON object that represents a single row/entry from a query result, return a datetime.datetime
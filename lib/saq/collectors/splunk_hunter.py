@@ -111,15 +111,11 @@ class SplunkHunt(QueryHunt):
             max_result_count=self.max_result_count,
             query_timeout=self.query_timeout)
 
-        search_result = searcher.query(query)
+        # the results are streamed into process_query_results as they are downloaded
+        search_result = searcher.query(query, download=False)
 
         if not search_result:
             logging.error(f"search failed for {self}")
             return None
 
-        query_result = searcher.json()
-        if query_result is None:
-            logging.error(f"search {self} returned no results (usually indicates an issue with the search)")
-            return None
-
-        return query_result
+        return searcher.iter_results()
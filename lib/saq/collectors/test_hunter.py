@@ -160,4 +160,34 @@ class TestCase(HunterBaseTestCase):
         collector.stop_service()
         collector.wait_service()
 
-    # TODO test the semaphore locking
+    def test_hunt_schedule(self):
+        hunter = HuntManager(**manager_kwargs())
+        hunt_1 = hunter.add_hunt(default_hunt(name='test_hunt_1', frequency=create_timedelta('00:10')))
+        hunt_2 = hunter.add_hunt(default_hunt(name='test_hunt_2', frequency=create_timedelta('00:20')))
+
+        hunt_1.last_executed_time = local_time()
+        hunt_2.last_executed_time = local_time() - create_timedelta('00:30')
+
+        # hunt_2 is past due so it comes off the schedule first
+        hunt, wait_time = hunter.get_next_hunt()
+        self.assertEquals(hunt, hunt_2)
+        self.assertIsNone(wait_time)
+
+        # hunt_1 is not ready for another 10 minutes
+        hunt, wait_time = hunter.get_next_hunt()
+        self.assertEquals(hunt, hunt_1)
+        self.assertTrue(0 < wait_time <= 600)
+
+        # once hunt_2 is scheduled again it's next in line
+        hunt_2.last_executed_time = local_time()
+        hunter.schedule_hunt(hunt_2)
+        hunt, wait_time = hunter.get_next_hunt()
+        self.assertEquals(hunt, hunt_1)
+
+        # removed hunts drop off the schedule
+        hunter.remove_hunt(hunt_1)
+        hunt, wait_time = hunter.get_next_hunt()
+        self.assertEquals(hunt, hunt_2)
+        self.assertTrue(wait_time > 600)
+
+        # TODO test the semaphore locking
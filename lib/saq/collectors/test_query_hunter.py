@@ -4,6 +4,8 @@ import datetime
 import os, os.path
 import shutil
 
+import pytz
+
 import saq
 from saq.collectors.hunter import HuntManager, HunterCollector, open_hunt_db
 from saq.collectors.test_hunter import HunterBaseTestCase
@@ -185,6 +187,9 @@ class TestCase(HunterBaseTestCase):
                             offset=create_timedelta('00:30:00'))
         manager.add_hunt(hunt)
 
+        # only cover a single window so we can check the times of that query
+        hunt.max_catchup_windows = 1
+
         # set the last time we executed to 3 hours ago
         hunt.last_executed_time = local_time() - datetime.timedelta(hours=3)
         # and the last end date to 2 hours ago
@@ -195,3 +200,64 @@ class TestCase(HunterBaseTestCase):
         # the times passed to hunt.execute_query should be 30 minutes offset
         self.assertEquals(target_start_time - hunt.offset, hunt.exec_start_time)
         self.assertEquals(hunt.last_end_time - hunt.offset, hunt.exec_end_time)
+
+    def test_catchup_windows(self):
+        manager = HuntManager(**manager_kwargs())
+        hunt = default_hunt(time_range=create_timedelta('01:00:00'), 
+                            frequency=create_timedelta('01:00:00'))
+        hunt.max_catchup_windows = 8
+        manager.add_hunt(hunt)
+
+        # not behind yet so we cover a single window
+        hunt.last_executed_time = local_time() - datetime.timedelta(minutes=5)
+        hunt.last_end_time = local_time() - datetime.timedelta(minutes=5)
+        self.assertEquals(len(hunt.execution_windows), 1)
+
+        # we've been down for three and a half hours
+        hunt.last_executed_time = local_time() - datetime.timedelta(hours=3, minutes=30)
+        hunt.last_end_time = local_time() - datetime.timedelta(hours=3, minutes=30)
+        self.assertTrue(hunt.ready)
+        self.assertTrue(hunt.next_execution_time <= local_time())
+
+        windows = hunt.execution_windows
+        self.assertEquals(len(windows), 4)
+        self.assertEquals(windows[0][0], hunt.last_end_time)
+        for index, (start_time, end_time) in enumerate(windows):
+            self.assertTrue(end_time - start_time <= hunt.time_range)
+            if index > 0:
+                # no gaps in coverage
+                self.assertEquals(windows[index - 1][1], start_time)
+
+        # the number of windows is limited
+        hunt.max_catchup_windows = 2
+        self.assertEquals(len(hunt.execution_windows), 2)
+
+    def test_catchup_execution(self):
+        kwargs = manager_kwargs()
+        kwargs['concurrency_limit'] = 2
+        manager = HuntManager(**kwargs)
+        hunt = default_hunt(time_range=create_timedelta('01:00:00'), 
+                            frequency=create_timedelta('01:00:00'))
+        hunt.max_catchup_windows = 8
+        manager.add_hunt(hunt)
+
+        hunt.last_executed_time = local_time() - datetime.timedelta(hours=3, minutes=30)
+        hunt.last_end_time = local_time() - datetime.timedelta(hours=3, minutes=30)
+        windows = hunt.execution_windows
+        hunt.execute()
+
+        # each window was queried
+        self.assertEquals(log_count('executing query'), len(windows))
+
+        # and the last window was recorded
+        # (the last window ends at the time the hunt executed)
+        self.assertEquals(hunt.last_start_time, windows[-1][0])
+        self.assertTrue(hunt.last_end_time >= windows[-1][1])
+        self.assertFalse(hunt.catching_up)
+
+        with open_hunt_db('test_query') as db:
+            c = db.cursor()
+            c.execute("SELECT last_start_time, last_end_time FROM hunt WHERE hunt_name = ?", (hunt.name,))
+            row = c.fetchone()
+            self.assertEquals(row[0], hunt.last_start_time.astimezone(pytz.utc).replace(tzinfo=None))
+            self.assertEquals(row[1], hunt.last_end_time.astimezone(pytz.utc).replace(tzinfo=None))
@@ -0,0 +1,99 @@
+# vim: sw=4:ts=4:et:cc=120
+
+import os, os.path
+import shutil
+
+import saq
+from saq.collectors.watcher import DirectoryWatcher
+from saq.test import *
+
+class DirectoryWatcherTestCase(ACEBasicTestCase):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+
+        self.watch_dir = os.path.join(saq.TEMP_DIR, 'watch')
+        if os.path.isdir(self.watch_dir):
+            shutil.rmtree(self.watch_dir)
+
+        os.makedirs(self.watch_dir)
+
+    def create_file(self, *path):
+        path = os.path.join(self.watch_dir, *path)
+        with open(path, 'w') as fp:
+            fp.write('test')
+
+        return path
+
+    def drain(self, watcher):
+        result = []
+        while True:
+            path = watcher.get_next()
+            if path is None:
+                return result
+
+            result.append(path)
+
+    def _test_existing_files(self, use_inotify):
+        first = self.create_file('first')
+        second = self.create_file('second')
+        os.utime(first, (0, 0))
+
+        watcher = DirectoryWatcher(self.watch_dir, use_inotify=use_inotify)
+        watcher.start()
+        self.assertEquals(watcher.inotify_enabled, use_inotify)
+        # oldest first
+        self.assertEquals(self.drain(watcher), [ first, second ])
+        watcher.stop()
+
+    def test_existing_files_inotify(self):
+        self._test_existing_files(True)
+
+    def test_existing_files_polling(self):
+        self._test_existing_files(False)
+
+    def _test_new_files(self, use_inotify):
+        watcher = DirectoryWatcher(self.watch_dir, recursive=True, use_inotify=use_inotify,
+                                   file_filter=lambda file_name: not file_name.endswith('.new'))
+        watcher.start()
+        self.assertIsNone(watcher.get_next())
+
+        # emails are delivered to subdirectories as .new files and then renamed
+        os.mkdir(os.path.join(self.watch_dir, 'subdir'))
+        temp_path = self.create_file('subdir', 'email.new')
+        self.assertIsNone(watcher.get_next())
+        email_path = os.path.join(self.watch_dir, 'subdir', 'email')
+        os.rename(temp_path, email_path)
+
+        self.assertEquals(watcher.get_next(), email_path)
+        # we don't get the same file twice
+        self.assertIsNone(watcher.get_next())
+
+        os.remove(email_path)
+        watcher.stop()
+
+    def test_new_files_inotify(self):
+        self._test_new_files(True)
+
+    def test_new_files_polling(self):
+        self._test_new_files(False)
+
+    def test_rescan(self):
+        # files that are not consumed are picked up again on the next rescan
+        watcher = DirectoryWatcher(self.watch_dir, use_inotify=True, rescan_frequency=0)
+        watcher.start()
+        path = self.create_file('test')
+        self.assertEquals(watcher.get_next(), path)
+        self.assertEquals(watcher.get_next(), path)
+        os.remove(path)
+        self.assertIsNone(watcher.get_next())
+        watcher.stop()
+
+    def test_removed_file(self):
+        watcher = DirectoryWatcher(self.watch_dir)
+        watcher.start()
+        path = self.create_file('test')
+        watcher.poll()
+        self.assertEquals(len(watcher), 1)
+        os.remove(path)
+        self.assertIsNone(watcher.get_next())
+        watcher.stop()
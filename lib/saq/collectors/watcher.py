@@ -0,0 +1,333 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# directory watching for file-drop collectors
+#
+# collectors that pick up files dropped into a directory by some other process (amc_mda, bro, etc...)
+# used to call os.listdir on every collection cycle, which gets slow when the directory backs up
+# the DirectoryWatcher uses inotify (when available) to maintain an ordered in-memory queue of new files
+# and falls back to polling the directory when inotify is not available
+#
+
+import collections
+import ctypes
+import ctypes.util
+import datetime
+import logging
+import os, os.path
+import select
+import struct
+
+# inotify constants (see inotify(7))
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = 0o00004000
+IN_CLOEXEC = 0o02000000
+
+# the events we care about
+# IN_CREATE is only used to start watching new sub directories (see recursive)
+# NOTE files are not picked up on IN_CREATE because the file is not complete at that point
+# files are picked up when they are closed after writing or when they are moved into the directory
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+# struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[]; }
+INOTIFY_EVENT_HEADER = struct.Struct('iIII')
+
+_libc = None
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+
+    return _libc
+
+class INotify(object):
+    """Minimal ctypes wrapper around the linux inotify API."""
+    def __init__(self):
+        libc = _get_libc()
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+    def add_watch(self, path, mask):
+        """Adds a watch for the given directory. Returns the watch descriptor."""
+        wd = _get_libc().inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+
+        return wd
+
+    def rm_watch(self, wd):
+        _get_libc().inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout=0):
+        """Returns a list of (wd, mask, cookie, name) tuples for all pending events.
+           Waits up to timeout seconds for events to become available."""
+        if timeout:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+            if not readable:
+                return []
+
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        result = []
+        offset = 0
+        while offset + INOTIFY_EVENT_HEADER.size <= len(buf):
+            wd, mask, cookie, length = INOTIFY_EVENT_HEADER.unpack_from(buf, offset)
+            offset += INOTIFY_EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip(b'\0')
+            offset += length
+            result.append((wd, mask, cookie, os.fsdecode(name)))
+
+        return result
+
+    def close(self):
+        if self.fd is not None and self.fd >= 0:
+            os.close(self.fd)
+
+        self.fd = None
+
+class DirectoryWatcher(object):
+    """Tracks files that are dropped into a directory as an ordered in-memory queue.
+
+       If recursive is True then the files in the sub directories of target_dir are also tracked (one level deep),
+       which is how the amc_mda lays out the emails it receives (target_dir/YYYYMMDDHH/email_file).
+
+       file_filter is an optional callable that takes the file name and returns True if the file should be queued.
+
+       Uses inotify if use_inotify is True and inotify is available, otherwise the directory is polled.
+       In either case the directory is fully re-scanned every rescan_frequency seconds as a safety net."""
+
+    def __init__(self, target_dir, recursive=False, file_filter=None, use_inotify=True, rescan_frequency=60):
+        self.target_dir = target_dir
+        self.recursive = recursive
+        self.file_filter = file_filter
+        self.use_inotify = use_inotify
+        self.rescan_frequency = rescan_frequency
+
+        # ordered set of the paths of the files that are waiting to be consumed
+        self.queue = collections.OrderedDict()
+
+        # maps the paths of the files returned by get_next to the time they were returned
+        # these are not queued again until they are removed, or until rescan_frequency seconds have passed
+        # (which would happen if the collector was unable to process them)
+        self.active = {}
+
+        # the INotify object (or None if we're polling)
+        self.inotify = None
+
+        # maps inotify watch descriptor to the directory being watched
+        self.watches = {}
+
+        # the last time we did a full scan of the directory
+        self.last_scan = None
+
+        # set to True when a full scan is needed (at start and when the inotify event queue overflows)
+        self.scan_required = True
+
+    def __len__(self):
+        return len(self.queue)
+
+    def __str__(self):
+        return "DirectoryWatcher({}{})".format(self.target_dir, ' (inotify)' if self.inotify else '')
+
+    @property
+    def inotify_enabled(self):
+        return self.inotify is not None
+
+    def start(self):
+        """Starts watching the directory. Files that already exist are queued (oldest first.)"""
+        if self.use_inotify and self.inotify is None:
+            try:
+                self.inotify = INotify()
+                self._add_watch(self.target_dir)
+                if self.recursive:
+                    for entry in os.scandir(self.target_dir):
+                        if entry.is_dir():
+                            self._add_watch(entry.path)
+
+                logging.debug("using inotify to watch {}".format(self.target_dir))
+
+            except Exception as e:
+                logging.warning("unable to use inotify for {} (falling back to polling): {}".format(
+                                self.target_dir, e))
+                self._close_inotify()
+
+        self.scan_required = True
+        self.poll()
+
+    def stop(self):
+        self._close_inotify()
+
+    def _close_inotify(self):
+        if self.inotify is not None:
+            try:
+                self.inotify.close()
+            except Exception as e:
+                logging.error("unable to close inotify: {}".format(e))
+
+        self.inotify = None
+        self.watches = {}
+
+    def _add_watch(self, path):
+        wd = self.inotify.add_watch(path, WATCH_MASK)
+        self.watches[wd] = path
+        return wd
+
+    def _accept(self, file_name):
+        if self.file_filter is None:
+            return True
+
+        return self.file_filter(file_name)
+
+    def _enqueue(self, path):
+        if path in self.queue:
+            return
+
+        if path in self.active:
+            if datetime.datetime.now() - self.active[path] < datetime.timedelta(seconds=self.rescan_frequency):
+                return
+
+            del self.active[path]
+
+        self.queue[path] = None
+
+    def _list_dir(self, dir_path):
+        """Returns a list of os.DirEntry objects for the files we are interested in inside the given directory."""
+        result = []
+        try:
+            for entry in os.scandir(dir_path):
+                if entry.is_dir():
+                    if self.recursive and dir_path == self.target_dir:
+                        # make sure we're watching any sub directory we missed the event for
+                        if self.inotify is not None and entry.path not in self.watches.values():
+                            try:
+                                self._add_watch(entry.path)
+                            except OSError as e:
+                                logging.error("unable to watch {}: {}".format(entry.path, e))
+
+                        result.extend(self._list_dir(entry.path))
+
+                    continue
+
+                if self._accept(entry.name):
+                    result.append(entry)
+
+        except FileNotFoundError:
+            pass
+
+        return result
+
+    def _mtime(self, entry):
+        try:
+            return entry.stat().st_mtime
+        except FileNotFoundError:
+            return 0
+
+    def scan(self, dir_path=None):
+        """Scans the directory and queues any files not already queued, oldest first."""
+        if dir_path is None:
+            dir_path = self.target_dir
+
+        for entry in sorted(self._list_dir(dir_path), key=self._mtime):
+            self._enqueue(entry.path)
+
+        # drop anything that has disappeared out from under us
+        if dir_path == self.target_dir:
+            for path in [_ for _ in self.queue.keys() if not os.path.exists(_)]:
+                del self.queue[path]
+
+            for path in [_ for _ in self.active.keys() if not os.path.exists(_)]:
+                del self.active[path]
+
+            self.last_scan = datetime.datetime.now()
+            self.scan_required = False
+
+    def _process_events(self, timeout):
+        for wd, mask, cookie, name in self.inotify.read_events(timeout):
+            if mask & IN_Q_OVERFLOW:
+                logging.warning("inotify event queue overflow for {}".format(self.target_dir))
+                self.scan_required = True
+                continue
+
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+
+            dir_path = self.watches.get(wd)
+            if dir_path is None:
+                continue
+
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                if dir_path == self.target_dir:
+                    logging.error("watched directory {} was removed".format(dir_path))
+                    self.scan_required = True
+
+                continue
+
+            path = os.path.join(dir_path, name)
+
+            if mask & IN_ISDIR:
+                # new sub directory
+                if self.recursive and dir_path == self.target_dir and mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        self._add_watch(path)
+                    except OSError as e:
+                        logging.error("unable to watch {}: {}".format(path, e))
+                        self.scan_required = True
+                        continue
+
+                    # files may have landed before we started watching
+                    self.scan(path)
+
+                continue
+
+            if mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and self._accept(name):
+                self._enqueue(path)
+
+    def poll(self, timeout=0):
+        """Picks up any new files. If inotify is used then this waits up to timeout seconds for events."""
+        if self.inotify is None:
+            self.scan_required = True
+        elif self.last_scan is None \
+        or datetime.datetime.now() - self.last_scan >= datetime.timedelta(seconds=self.rescan_frequency):
+            self.scan_required = True
+
+        if self.inotify is not None:
+            try:
+                self._process_events(timeout)
+            except Exception as e:
+                logging.error("unable to read inotify events for {} (falling back to polling): {}".format(
+                              self.target_dir, e))
+                self._close_inotify()
+                self.scan_required = True
+
+        if self.scan_required:
+            self.scan()
+
+    def get_next(self, timeout=0):
+        """Returns the path to the next file to process, or None if nothing is available."""
+        if not self.queue:
+            self.poll(timeout)
+
+        # skip over anything that was removed after we queued it
+        while self.queue:
+            path, _ = self.queue.popitem(last=False)
+            if os.path.exists(path):
+                self.active[path] = datetime.datetime.now()
+                return path
+
+        return None
@@ -69,6 +69,8 @@ def apply_config(source, override):
 def load_configuration():
     try:
         _load_configuration()
+        # anything built from the configuration is rebuilt when it is reloaded
+        saq.initialize_managed_networks()
     except Exception as e:
         sys.stderr.write("unable to load configuration: {}\n".format(e))
         traceback.print_exc()
@@ -3,15 +3,16 @@
 
 import sqlite3
 import logging
-import os.path
+import os, os.path
 import re
-from ipaddress import IPv4Network, IPv4Address
 from urllib.parse import urlparse, ParseResult, urlunparse
 
 import saq
-from saq.brocess import query_brocess_by_fqdn, add_httplog
+from saq.bloom import BloomFilter
+from saq.brocess import query_brocess_by_fqdns, add_httplog
 from saq.error import report_exception
-from saq.util import is_ipv4, is_subdomain, iterate_fqdn_parts, add_netmask
+from saq.radix import NetworkTree
+from saq.util import is_ipv4, iterate_fqdn_parts, add_netmask, DomainTrie
 
 analysis_module = 'analysis_module_crawlphish'
 
@@ -46,6 +47,12 @@ CRITS_FILE_NAME = 'Windows - FileName'
 
 SCHEMA_REGEX = re.compile('^[a-zA-Z]+://')
 
+# the false positive rate of the bloom filters in front of the indicator cache databases
+INDICATOR_BLOOM_ERROR_RATE = 0.001
+
+# the values in the indicator cache databases are stored with the sqlite LOWER() function which only lowers ascii
+_SQLITE_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+
 def process_url(url):
     m = SCHEMA_REGEX.search(url)
     if m is None:
@@ -73,13 +80,87 @@ class FilterResult(object):
     def __bool__(self):
         return self.filtered
 
+class IndicatorCache(object):
+    """A read only connection to a local indicator cache database (see saq.intel.update_local_cache) with a bloom
+       filter of the indicators in it. The database is opened again when the cache is updated."""
+
+    def __init__(self, path):
+        # path to the database (a symlink to the current version of the cache)
+        self.path = path
+        self.db = None
+        self.bloom = None
+        # the (path, device, inode, mtime) of the database file that is open
+        self.file_key = None
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+
+        self.db = None
+        self.bloom = None
+        self.file_key = None
+
+    def open(self):
+        """Opens the current version of the database if it is not already open."""
+        path = os.path.realpath(self.path)
+        st = os.stat(path)
+        file_key = (path, st.st_dev, st.st_ino, st.st_mtime_ns)
+        if file_key == self.file_key:
+            return
+
+        self.close()
+        db = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True, check_same_thread=False)
+        bloom = BloomFilter(db.execute("SELECT COUNT(*) FROM indicators").fetchone()[0], INDICATOR_BLOOM_ERROR_RATE)
+        for indicator_type, value in db.execute("SELECT type, value FROM indicators"):
+            bloom.add('{}\x00{}'.format(indicator_type, value))
+
+        logging.debug("loaded {} indicators from {}".format(len(bloom), path))
+        self.db = db
+        self.bloom = bloom
+        self.file_key = file_key
+
+    def find(self, indicators):
+        """Returns a tuple of (type, value, id) for the first of the given (type, value) indicators that is in the
+           database, or None if none of them are."""
+        self.open()
+        for indicator_type, value in indicators:
+            # most values are not in the database so most of them are not queried
+            if '{}\x00{}'.format(indicator_type, value) not in self.bloom:
+                continue
+
+            row = self.db.execute("SELECT id FROM indicators WHERE type = ? AND value = ?",
+                                  (indicator_type, value)).fetchone()
+            if row:
+                return indicator_type, value, row[0]
+
+        return None
+
+# the indicator caches are opened once per process (sqlite connections cannot be shared across fork)
+# key = path, value = IndicatorCache
+_indicator_caches = {}
+_indicator_caches_pid = None
+
+def get_indicator_cache(path):
+    """Returns the IndicatorCache for the given database path for this process."""
+    global _indicator_caches, _indicator_caches_pid
+
+    if _indicator_caches_pid != os.getpid():
+        _indicator_caches = {}
+        _indicator_caches_pid = os.getpid()
+
+    try:
+        return _indicator_caches[path]
+    except KeyError:
+        _indicator_caches[path] = IndicatorCache(path)
+        return _indicator_caches[path]
+
 class CrawlphishURLFilter(object):
 
     def __init__(self):
-        self.blacklisted_cidr = []
-        self.blacklisted_fqdn = []
-        self.whitelisted_cidr = []
-        self.whitelisted_fqdn = []
+        self.blacklisted_cidr = NetworkTree()
+        self.blacklisted_fqdn = DomainTrie()
+        self.whitelisted_cidr = NetworkTree()
+        self.whitelisted_fqdn = DomainTrie()
         self.path_regexes = []
 
     #def __init__(self):
@@ -117,8 +198,9 @@ class CrawlphishURLFilter(object):
 
     def load_whitelist(self):
         logging.debug("loading whitelist from {}".format(self.whitelist_path))
-        whitelisted_fqdn = []
-        whitelisted_cidr = []
+        whitelisted_fqdn = DomainTrie()
+        whitelisted_cidr = NetworkTree()
+        fqdn_count = 0
 
         try:
             with open(self.whitelist_path, 'r') as fp:
@@ -134,15 +216,16 @@ class CrawlphishURLFilter(object):
                         continue
 
                     if is_ipv4(line):
-                        whitelisted_cidr.append(IPv4Network(add_netmask(line)))
+                        whitelisted_cidr.add(add_netmask(line))
                     else:
-                        whitelisted_fqdn.append(line)
+                        whitelisted_fqdn.add(line)
+                        fqdn_count += 1
 
             self.whitelisted_cidr = whitelisted_cidr
             self.whitelisted_fqdn = whitelisted_fqdn
             logging.debug("loaded {} cidr {} fqdn whitelisted items".format(
                            len(self.whitelisted_cidr),
-                           len(self.whitelisted_fqdn)))
+                           fqdn_count))
 
         except Exception as e:
             logging.error("unable to load whitelist {}: {}".format(self.whitelist_path, e))
@@ -150,24 +233,25 @@ class CrawlphishURLFilter(object):
 
     def is_whitelisted(self, value):
         if is_ipv4(value):
-            for cidr in self.whitelisted_cidr:
-                if IPv4Address(value) in cidr:
-                    logging.debug("{} matches whitelisted cidr {}".format(value, cidr))
-                    return True
+            cidr = self.whitelisted_cidr.longest_match(value)
+            if cidr is not None:
+                logging.debug("{} matches whitelisted cidr {}".format(value, cidr))
+                return True
 
             return False
 
-        for dst in self.whitelisted_fqdn:
-            if is_subdomain(value, dst):
-                logging.debug("{} matches whitelisted fqdn {}".format(value, dst))
-                return True
+        dst = self.whitelisted_fqdn.find(value)
+        if dst is not None:
+            logging.debug("{} matches whitelisted fqdn {}".format(value, dst))
+            return True
 
         return False
 
     def load_blacklist(self):
         logging.debug("loading blacklist from {}".format(self.blacklist_path))
-        blacklisted_fqdn = []
-        blacklisted_cidr = []
+        blacklisted_fqdn = DomainTrie()
+        blacklisted_cidr = NetworkTree()
+        fqdn_count = 0
 
         try:
             with open(self.blacklist_path, 'r') as fp:
@@ -183,15 +267,16 @@ class CrawlphishURLFilter(object):
                         continue
 
                     if is_ipv4(line):
-                        blacklisted_cidr.append(IPv4Network(add_netmask(line)))
+                        blacklisted_cidr.add(add_netmask(line))
                     else:
-                        blacklisted_fqdn.append(line)
+                        blacklisted_fqdn.add(line)
+                        fqdn_count += 1
 
             self.blacklisted_cidr = blacklisted_cidr
             self.blacklisted_fqdn = blacklisted_fqdn
             logging.debug("loaded {} cidr {} fqdn blacklisted items".format(
                            len(self.blacklisted_cidr),
-                           len(self.blacklisted_fqdn)))
+                           fqdn_count))
 
         except Exception as e:
             logging.error("unable to load blacklist {}: {}".format(self.blacklist_path, e))
@@ -229,21 +314,23 @@ class CrawlphishURLFilter(object):
 
     def is_blacklisted(self, value):
         if is_ipv4(value):
-            for cidr in self.blacklisted_cidr:
-                try:
-                    if IPv4Address(value) in cidr:
-                        logging.debug("{} matches blacklisted cidr {}".format(value, cidr))
-                        return True
-                except Exception as e:
-                    logging.error("failed to compare {} to {}: {}".format(value, cidr, e))
-                    report_exception()
+            try:
+                cidr = self.blacklisted_cidr.longest_match(value)
+            except Exception as e:
+                logging.error("failed to compare {} to blacklisted cidrs: {}".format(value, e))
+                report_exception()
+                return False
+
+            if cidr is not None:
+                logging.debug("{} matches blacklisted cidr {}".format(value, cidr))
+                return True
 
             return False
 
-        for dst in self.blacklisted_fqdn:
-            if is_subdomain(value, dst):
-                logging.debug("{} matches blacklisted fqdn {}".format(value, dst))
-                return True
+        dst = self.blacklisted_fqdn.find(value)
+        if dst is not None:
+            logging.debug("{} matches blacklisted fqdn {}".format(value, dst))
+            return True
 
         return False
 
@@ -282,64 +369,38 @@ class CrawlphishURLFilter(object):
         """Is this URL in crits?  value is the result of calling process_url on a URL."""
         assert isinstance(value, ParseResult)
 
-        with sqlite3.connect('file:{}?mode=ro'.format(cache_path), uri=True) as db:
-            db_cursor = db.cursor()
-            row = None
-
-            # check ipv4
-            if is_ipv4(value.hostname):
-                db_cursor.execute("SELECT id FROM indicators WHERE type = ? AND value = ?", 
-                                 (CRITS_IPV4, value.hostname))
-
-                row = db_cursor.fetchone()
-                if row:
-                    logging.debug("{} matched ipv4 indicator {}".format(value.hostname, row[0]))
-                    return True
-            else:
-                # check fqdn
-                for partial_fqdn in iterate_fqdn_parts(value.hostname):
-                    #logging.debug("checking crits for {}".format(partial_fqdn))
-                    db_cursor.execute("SELECT id FROM indicators WHERE type = ? AND value = ?",
-                                     (CRITS_FQDN, partial_fqdn.lower()))
-
-                    row = db_cursor.fetchone()
-                    if row:
-                        logging.debug("{} matched fqdn indicator {}".format(partial_fqdn, row[0]))
-                        return True
-                        
-            # check full url
-            db_cursor.execute("SELECT id FROM indicators WHERE type = ? AND value = LOWER(?)",
-                             (CRITS_URL, value.geturl()))
-
-            row = db_cursor.fetchone()
-            if row:
-                logging.debug("{} matched url indicator{}".format(value.geturl(), row[0]))
-                return True
+        # the indicators to check in the order they are checked
+        indicators = []
+
+        # check ipv4
+        if is_ipv4(value.hostname):
+            indicators.append((CRITS_IPV4, value.hostname))
+        else:
+            # check fqdn
+            for partial_fqdn in iterate_fqdn_parts(value.hostname):
+                indicators.append((CRITS_FQDN, partial_fqdn.lower()))
+
+        # check full url
+        indicators.append((CRITS_URL, value.geturl().translate(_SQLITE_LOWER)))
+
+        # check url path
+        path = urlunparse(('', '', value.path, value.params, value.query, value.fragment))
+        if path:
+            indicators.append((CRITS_URL_PATH, path.translate(_SQLITE_LOWER)))
+
+        # check url file name
+        if value.path:
+            if not value.path.endswith('/'):
+                file_name = value.path.split('/')[-1]
+                indicators.append((CRITS_FILE_NAME, file_name.translate(_SQLITE_LOWER)))
+
+        match = get_indicator_cache(cache_path).find(indicators)
+        if match:
+            indicator_type, indicator_value, indicator_id = match
+            logging.debug("{} matched {} indicator {}".format(indicator_value, indicator_type, indicator_id))
+            return True
 
-            # check url path
-            path = urlunparse(('', '', value.path, value.params, value.query, value.fragment))
-            if path:
-                db_cursor.execute("SELECT id FROM indicators WHERE type = ? AND value = LOWER(?)",
-                                 (CRITS_URL_PATH, path))
-
-                row = db_cursor.fetchone()
-                if row:
-                    logging.debug("{} matched url_path indicator {}".format(value.path, row[0]))
-                    return True
-
-            # check url file name
-            if value.path:
-                if not value.path.endswith('/'):
-                    file_name = value.path.split('/')[-1]
-                    db_cursor.execute("SELECT id FROM indicators WHERE type = ? AND value = LOWER(?)",
-                                     (CRITS_FILE_NAME, file_name))
-
-                    row = db_cursor.fetchone()
-                    if row:
-                        logging.debug("{} matched file_name indicator {}".format(file_name, row[0]))
-                        return True
-
-            return False
+        return False
 
     def _is_uncommon_fqdn(self, fqdn):
         """Returns True if the given fqnd is considered "uncommon"."""
@@ -347,8 +408,10 @@ class CrawlphishURLFilter(object):
         # if d is common then we want to see if c.d is uncommon
         # if c.d is common then we look at b.c.d, and so forth
         # if they are all common then we return False
-        for partial_fqdn in iterate_fqdn_parts(fqdn):
-            count = query_brocess_by_fqdn(partial_fqdn)
+        partial_fqdns = list(iterate_fqdn_parts(fqdn))
+        counts = query_brocess_by_fqdns(partial_fqdns)
+        for partial_fqdn in partial_fqdns:
+            count = counts[partial_fqdn]
 
             if count is None:
                 continue
@@ -2383,6 +2383,20 @@ def add_delayed_analysis_request(root, observable, analysis_module, next_analysi
         report_exception()
         return False
 
+@use_db
+def resume_delayed_analysis_request(uuid, observable_uuid, analysis_module, seconds=0, db=None, c=None):
+    """Moves the delayed analysis request for the given analysis module on the given observable up to now
+       (plus the given number of seconds) so that it is processed as soon as possible.
+       Returns True if the request was found."""
+    row_count = execute_with_retry(db, c, """
+                                   UPDATE delayed_analysis SET delayed_until = NOW() + INTERVAL %s SECOND
+                                   WHERE uuid = %s AND observable_uuid = %s AND analysis_module = %s""",
+                                   ( seconds, uuid, observable_uuid, analysis_module ), commit=True)
+
+    logging.debug("resumed delayed analysis uuid {} observable_uuid {} analysis_module {} (row count {})".format(
+                  uuid, observable_uuid, analysis_module, row_count))
+    return row_count > 0
+
 @use_db
 def clear_delayed_analysis_requests(root, db, c):
     """Clears all delayed analysis requests for the given RootAnalysis object."""
@@ -0,0 +1,464 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# in-process archive extraction
+#
+# zip, tar (compressed or not) and single file gzip, bzip2 and xz streams are extracted with the standard library
+# each member is streamed straight into the target directory while the size of the member, the total amount of
+# data extracted and the compression ratio are checked, so a decompression bomb is stopped as soon as it crosses
+# a limit instead of after it has filled the disk
+#
+# the md5, sha1 and sha256 hashes of each member are computed while it is written
+# a member with the same content as one that was already extracted is not kept
+#
+# anything else (rar, ace, 7z, zip files encrypted with AES, etc...) is left to the command line tools
+#
+
+import bz2
+import fnmatch
+import gzip
+import hashlib
+import logging
+import lzma
+import os, os.path
+import struct
+import tarfile
+import zipfile
+import zlib
+
+from saq.hashing import HASH_MD5, HASH_SHA1, HASH_SHA256
+
+EXTRACTION_BUFFER_SIZE = 1024 * 1024
+
+FORMAT_ZIP = 'zip'
+FORMAT_TAR = 'tar'
+FORMAT_GZIP = 'gzip'
+FORMAT_BZIP2 = 'bzip2'
+FORMAT_XZ = 'xz'
+
+# reasons a member was not extracted
+SKIP_DUPLICATE = 'duplicate'
+SKIP_ENCRYPTED = 'encrypted'
+SKIP_EXCLUDED = 'excluded'
+SKIP_FILE_SIZE = 'file size limit'
+SKIP_TOTAL_SIZE = 'total size limit'
+SKIP_RATIO = 'compression ratio limit'
+SKIP_CORRUPT = 'corrupt'
+SKIP_INVALID_PATH = 'invalid path'
+
+# compression methods zipfile can decompress
+SUPPORTED_ZIP_COMPRESSION = frozenset([ zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED, zipfile.ZIP_BZIP2,
+                                        zipfile.ZIP_LZMA ])
+
+# errors raised by the decompressors for damaged data
+CORRUPT_DATA_ERRORS = ( zipfile.BadZipFile, tarfile.TarError, zlib.error, lzma.LZMAError, EOFError, OSError,
+                        ValueError, NotImplementedError )
+
+STREAM_OPENERS = {
+    FORMAT_GZIP: gzip.open,
+    FORMAT_BZIP2: bz2.open,
+    FORMAT_XZ: lzma.open,
+}
+
+STREAM_EXTENSIONS = {
+    FORMAT_GZIP: [ '.gz', '.gzip', '.z' ],
+    FORMAT_BZIP2: [ '.bz2', '.bzip2', '.bz' ],
+    FORMAT_XZ: [ '.xz' ],
+}
+
+class ExtractionError(Exception):
+    pass
+
+class TooManyFiles(ExtractionError):
+    """Raised when an archive contains more files than allowed."""
+    pass
+
+class LimitExceeded(ExtractionError):
+    """Raised when extracting a member crosses one of the limits.
+       If fatal is True then nothing else in the archive is extracted."""
+    def __init__(self, reason, fatal=False):
+        super().__init__(reason)
+        self.reason = reason
+        self.fatal = fatal
+
+class ExtractionLimits(object):
+    """Limits applied while extracting. Sizes are in bytes, None means unlimited."""
+
+    def __init__(self, max_file_size=None, max_total_size=None, max_ratio=None,
+                 ratio_minimum_size=EXTRACTION_BUFFER_SIZE):
+        # the largest a single extracted file can be
+        self.max_file_size = max_file_size
+        # the most data that can be extracted from a single archive
+        self.max_total_size = max_total_size
+        # the largest (extracted size / compressed size) ratio allowed
+        self.max_ratio = max_ratio
+        # the ratio is not checked until at least this much data has been extracted
+        # (small files of repeated data compress very well)
+        self.ratio_minimum_size = ratio_minimum_size
+
+    def ratio_exceeded(self, size, compressed_size):
+        return self.max_ratio is not None and size > self.ratio_minimum_size \
+               and size > compressed_size * self.max_ratio
+
+class ExtractedFile(object):
+    """A file that was extracted from an archive."""
+    def __init__(self, name, path, size, hashes):
+        # the name of the member in the archive
+        self.name = name
+        # the path it was extracted to
+        self.path = path
+        self.size = size
+        # see saq.hashing.compute_file_hashes
+        self.hashes = hashes
+
+    def __repr__(self):
+        return 'ExtractedFile({}, {})'.format(self.name, self.path)
+
+def detect_archive_format(path):
+    """Returns the FORMAT_ of the given file by looking at the header, or None if it is not supported."""
+    with open(path, 'rb') as fp:
+        header = fp.read(512)
+
+    if header.startswith(b'PK\x03\x04') or header.startswith(b'PK\x05\x06'):
+        return FORMAT_ZIP
+    if header.startswith(b'\x1f\x8b'):
+        return FORMAT_GZIP
+    if header.startswith(b'BZh'):
+        return FORMAT_BZIP2
+    if header.startswith(b'\xfd7zXZ\x00'):
+        return FORMAT_XZ
+    if header[257:262] == b'ustar':
+        return FORMAT_TAR
+
+    return None
+
+def get_archive_depth(path):
+    """Returns how many archives deep the given (extracted) file is."""
+    return len([ _ for _ in os.path.normpath(path).split(os.sep) if _.endswith('.extracted') ])
+
+def safe_member_path(name):
+    """Returns the relative path a member with the given name is extracted to, or None if it has no usable name.
+       Absolute paths, drive letters and parent directory references are removed."""
+    parts = []
+    for part in name.replace('\\', '/').replace('\x00', '_').split('/'):
+        if part in ( '', '.', '..' ):
+            continue
+
+        # C: and the like
+        if not parts and len(part) == 2 and part[1] == ':':
+            continue
+
+        parts.append(part)
+
+    if not parts:
+        return None
+
+    return os.path.join(*parts)
+
+def _gzip_original_name(path):
+    """Returns the original file name stored in the gzip header, or None."""
+    try:
+        with open(path, 'rb') as fp:
+            header = fp.read(10)
+            if len(header) < 10 or not header[3] & 0x08:
+                return None
+
+            # FEXTRA comes before FNAME
+            if header[3] & 0x04:
+                fp.seek(struct.unpack('<H', fp.read(2))[0], os.SEEK_CUR)
+
+            name = fp.read(1024).split(b'\x00', 1)[0]
+            return os.path.basename(name.decode('latin-1').replace('\\', '/')) or None
+    except (OSError, struct.error):
+        return None
+
+class _CountingReader(object):
+    """Wraps a file object and counts the number of bytes read from it."""
+    def __init__(self, fp):
+        self.fp = fp
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        self.count += len(data)
+        return data
+
+class Archive(object):
+    """An archive that can be extracted in-process. Use open_archive to create one."""
+
+    def __init__(self, path, archive_format, password=None):
+        self.path = path
+        self.format = archive_format
+        # used for encrypted zip members
+        self.password = password
+        # the names of the members, or None if they are not known until the archive is extracted (streams)
+        self.names = None
+        # the number of files in the archive, or None if it is not known until the archive is extracted
+        self.file_count = None
+        # list of (member name, SKIP_) of members that were not extracted
+        self.skipped = []
+        self.zip_members = None
+
+        # the state of the current extraction
+        self._target_dir = None
+        self._limits = None
+        self._total_size = 0
+        self._input = None
+        self._sha256_hashes = set()
+        self._extracted = []
+
+    def _load(self):
+        if self.format == FORMAT_ZIP:
+            with zipfile.ZipFile(self.path) as zfile:
+                self.zip_members = [ _ for _ in zfile.infolist() if not _.is_dir() ]
+
+            for info in self.zip_members:
+                if info.compress_type not in SUPPORTED_ZIP_COMPRESSION:
+                    raise NotImplementedError("unsupported compression method {}".format(info.compress_type))
+
+            self.names = [ _.filename for _ in self.zip_members ]
+            self.file_count = len(self.zip_members)
+
+        elif self.format in STREAM_OPENERS:
+            # is this a compressed tar file?
+            with STREAM_OPENERS[self.format](self.path) as fp:
+                if fp.read(512)[257:262] == b'ustar':
+                    self.format = FORMAT_TAR
+
+    def _skip(self, name, reason):
+        logging.debug("skipping {} in {}: {}".format(name, self.path, reason))
+        self.skipped.append((name, reason))
+
+    def _target_path(self, name):
+        relative_path = safe_member_path(name)
+        if relative_path is None:
+            relative_path = 'file_{}'.format(len(self._extracted) + len(self.skipped))
+
+        target_path = os.path.join(self._target_dir, relative_path)
+        # never overwrite anything (members can have the same name)
+        index = 0
+        unique_path = target_path
+        while os.path.lexists(unique_path):
+            index += 1
+            unique_path = '{}_{}'.format(target_path, index)
+
+        return unique_path
+
+    def _write(self, name, fp, compressed_size=None):
+        """Streams the data in fp into a new file in the target directory and returns the ExtractedFile,
+           or None if the member was skipped. Raises LimitExceeded if a fatal limit was crossed."""
+        limits = self._limits
+        target_path = self._target_path(name)
+        try:
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            target_fp = open(target_path, 'xb')
+        except (OSError, ValueError) as e:
+            logging.debug("unable to create {}: {}".format(target_path, e))
+            self._skip(name, SKIP_INVALID_PATH)
+            return None
+
+        hashers = [ hashlib.md5(), hashlib.sha1(), hashlib.sha256() ]
+        size = 0
+        try:
+            with target_fp:
+                while True:
+                    data = fp.read(EXTRACTION_BUFFER_SIZE)
+                    if not data:
+                        break
+
+                    size += len(data)
+                    self._total_size += len(data)
+
+                    if limits.max_total_size is not None and self._total_size > limits.max_total_size:
+                        raise LimitExceeded(SKIP_TOTAL_SIZE, fatal=True)
+
+                    if self._input is not None and limits.ratio_exceeded(self._total_size, self._input.count):
+                        raise LimitExceeded(SKIP_RATIO, fatal=True)
+
+                    if limits.max_file_size is not None and size > limits.max_file_size:
+                        raise LimitExceeded(SKIP_FILE_SIZE)
+
+                    if compressed_size is not None and limits.ratio_exceeded(size, compressed_size):
+                        raise LimitExceeded(SKIP_RATIO)
+
+                    target_fp.write(data)
+                    for hasher in hashers:
+                        hasher.update(data)
+
+        except LimitExceeded as e:
+            os.remove(target_path)
+            self._skip(name, e.reason)
+            if e.fatal:
+                raise
+
+            return None
+
+        except RuntimeError as e:
+            # zipfile raises RuntimeError for a bad password
+            os.remove(target_path)
+            self._skip(name, SKIP_ENCRYPTED)
+            return None
+
+        except CORRUPT_DATA_ERRORS as e:
+            logging.debug("unable to extract {} from {}: {}".format(name, self.path, e))
+            os.remove(target_path)
+            self._skip(name, SKIP_CORRUPT)
+            return None
+
+        md5, sha1, sha256 = [ _.hexdigest() for _ in hashers ]
+        if sha256 in self._sha256_hashes:
+            os.remove(target_path)
+            self._skip(name, SKIP_DUPLICATE)
+            return None
+
+        self._sha256_hashes.add(sha256)
+        result = ExtractedFile(name, target_path, size, { HASH_MD5: md5, HASH_SHA1: sha1, HASH_SHA256: sha256 })
+        self._extracted.append(result)
+        return result
+
+    def _check_file_count(self, max_files):
+        if max_files is not None and self.file_count > max_files:
+            raise TooManyFiles("{} contains more than {} files".format(self.path, max_files))
+
+    def _extract_zip(self, max_files, exclude):
+        self._check_file_count(max_files)
+        with zipfile.ZipFile(self.path) as zfile:
+            for info in self.zip_members:
+                if any([ fnmatch.fnmatch(info.filename, _) for _ in exclude ]):
+                    self._skip(info.filename, SKIP_EXCLUDED)
+                    continue
+
+                # don't bother decompressing what we already know is too big
+                limits = self._limits
+                if limits.max_file_size is not None and info.file_size > limits.max_file_size:
+                    self._skip(info.filename, SKIP_FILE_SIZE)
+                    continue
+
+                if limits.ratio_exceeded(info.file_size, info.compress_size):
+                    self._skip(info.filename, SKIP_RATIO)
+                    continue
+
+                try:
+                    fp = zfile.open(info, pwd=self.password if info.flag_bits & 0x1 else None)
+                except RuntimeError:
+                    self._skip(info.filename, SKIP_ENCRYPTED)
+                    continue
+                except CORRUPT_DATA_ERRORS as e:
+                    logging.debug("unable to extract {} from {}: {}".format(info.filename, self.path, e))
+                    self._skip(info.filename, SKIP_CORRUPT)
+                    continue
+
+                with fp:
+                    # the size in the header cannot be trusted so the limits are also checked as the data is read
+                    self._write(info.filename, fp, compressed_size=info.compress_size)
+
+    def _extract_tar(self, max_files, exclude):
+        self.file_count = 0
+        with open(self.path, 'rb') as raw_fp:
+            # the ratio is checked against the amount of the (compressed) archive read so far
+            self._input = _CountingReader(raw_fp)
+            # reading the archive as a stream means nothing is buffered or read twice
+            with tarfile.open(fileobj=self._input, mode='r|*') as tar:
+                for member in tar:
+                    # no links, devices, etc...
+                    if not member.isreg():
+                        continue
+
+                    self.file_count += 1
+                    self._check_file_count(max_files)
+
+                    if any([ fnmatch.fnmatch(member.name, _) for _ in exclude ]):
+                        self._skip(member.name, SKIP_EXCLUDED)
+                        continue
+
+                    if self._limits.max_file_size is not None and member.size > self._limits.max_file_size:
+                        # the data is still decompressed to get to the next member
+                        self._total_size += member.size
+                        if self._limits.max_total_size is not None \
+                        and self._total_size > self._limits.max_total_size:
+                            self._skip(member.name, SKIP_TOTAL_SIZE)
+                            break
+
+                        self._skip(member.name, SKIP_FILE_SIZE)
+                        continue
+
+                    fp = tar.extractfile(member)
+                    if fp is None:
+                        continue
+
+                    self._write(member.name, fp)
+
+    def _extract_stream(self, max_files, exclude):
+        self.file_count = 1
+        self._check_file_count(max_files)
+
+        name = None
+        if self.format == FORMAT_GZIP:
+            name = _gzip_original_name(self.path)
+
+        if name is None:
+            name = os.path.basename(self.path)
+            for ext in STREAM_EXTENSIONS[self.format]:
+                if name.lower().endswith(ext) and len(name) > len(ext):
+                    name = name[:-len(ext)]
+                    break
+
+        with open(self.path, 'rb') as raw_fp:
+            self._input = _CountingReader(raw_fp)
+            with STREAM_OPENERS[self.format](self._input) as fp:
+                self._write(name, fp)
+
+    def extract(self, target_dir, limits=None, max_files=None, exclude=None):
+        """Extracts the archive into target_dir and returns the list of ExtractedFile that were extracted.
+           Raises TooManyFiles if the archive has more than max_files files (some may already be extracted.)
+           Members that match any of the fnmatch patterns in exclude are not extracted.
+           Members that were not extracted are recorded in self.skipped."""
+        self._target_dir = target_dir
+        self._limits = limits or ExtractionLimits()
+        self._total_size = 0
+        self._input = None
+        self._sha256_hashes = set()
+        self._extracted = []
+        self.skipped = []
+        exclude = exclude or []
+
+        os.makedirs(target_dir, exist_ok=True)
+
+        try:
+            if self.format == FORMAT_ZIP:
+                self._extract_zip(max_files, exclude)
+            elif self.format == FORMAT_TAR:
+                self._extract_tar(max_files, exclude)
+            else:
+                self._extract_stream(max_files, exclude)
+
+        except LimitExceeded as e:
+            logging.warning("stopped extracting {}: {} exceeded".format(self.path, e.reason))
+
+        except CORRUPT_DATA_ERRORS as e:
+            logging.info("unable to extract all of {}: {}".format(self.path, e))
+
+        finally:
+            self._input = None
+
+        return self._extracted
+
+def open_archive(path, password=None):
+    """Returns an Archive for the given file if it can be extracted in-process, None otherwise."""
+    try:
+        archive_format = detect_archive_format(path)
+    except OSError as e:
+        logging.warning("unable to read {}: {}".format(path, e))
+        return None
+
+    if archive_format is None:
+        return None
+
+    archive = Archive(path, archive_format, password=password)
+    try:
+        archive._load()
+    except CORRUPT_DATA_ERRORS as e:
+        # the command line tools may do better with it
+        logging.debug("unable to open {} as {}: {}".format(path, archive_format, e))
+        return None
+
+    return archive
@@ -0,0 +1,105 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# file type identification
+#
+# uses libmagic in-process (python-magic) with handles that are opened once per process
+# falls back to running file(1) if libmagic is not available
+# results are memoized by the sha256 of the file when it is known
+#
+
+import collections
+import logging
+import os, os.path
+
+from saq.process_server import Popen, PIPE
+
+try:
+    import magic
+except ImportError:
+    magic = None
+
+# maximum number of results remembered
+FILE_TYPE_CACHE_SIZE = 4096
+
+# key = sha256, value = (file_type, mime_type)
+_file_type_cache = collections.OrderedDict()
+
+# (description handle, mime type handle) for this process
+_magic_handles = None
+_magic_handles_pid = None
+
+def get_magic_handles():
+    """Returns a tuple of the python-magic handles (description, mime type) for this process,
+       or None if libmagic is not available."""
+    global _magic_handles, _magic_handles_pid
+
+    if _magic_handles_pid == os.getpid():
+        return _magic_handles
+
+    _magic_handles = None
+    _magic_handles_pid = os.getpid()
+
+    if magic is None:
+        logging.debug("python-magic is not installed")
+        return None
+
+    try:
+        _magic_handles = magic.Magic(), magic.Magic(mime=True)
+    except Exception as e:
+        logging.warning("unable to load libmagic: {}".format(e))
+
+    return _magic_handles
+
+def _file_command(path, *options):
+    p = Popen(['file', '-b'] + list(options) + ['-L', path], stdout=PIPE, stderr=PIPE)
+    stdout, stderr = p.communicate()
+
+    if len(stderr) > 0:
+        logging.warning("file command returned error output for {}".format(path))
+
+    return stdout.decode(errors='ignore').strip()
+
+def _identify(path):
+    handles = get_magic_handles()
+    if handles is not None:
+        try:
+            # same as file -L (libmagic does not follow symlinks by default)
+            real_path = os.path.realpath(path)
+            return handles[0].from_file(real_path), handles[1].from_file(real_path)
+        except Exception as e:
+            logging.warning("libmagic failed for {}: {}".format(path, e))
+
+    return _file_command(path), _file_command(path, '--mime-type')
+
+def get_file_type(path, sha256=None):
+    """Returns a tuple of (file_type, mime_type) for the given file, which are the same as the output of
+       file -b -L and file -b --mime-type -L. If the sha256 of the file is given then the result is memoized."""
+    if sha256 is not None:
+        try:
+            _file_type_cache.move_to_end(sha256)
+            return _file_type_cache[sha256]
+        except KeyError:
+            pass
+
+    result = _identify(path)
+
+    if sha256 is not None:
+        _file_type_cache[sha256] = result
+        if len(_file_type_cache) > FILE_TYPE_CACHE_SIZE:
+            _file_type_cache.popitem(last=False)
+
+    return result
+
+def get_mime_type(path, sha256=None):
+    """Returns the mime type of the given file (see get_file_type.)"""
+    if sha256 is not None and sha256 in _file_type_cache:
+        return get_file_type(path, sha256)[1]
+
+    handles = get_magic_handles()
+    if handles is not None:
+        try:
+            return handles[1].from_file(os.path.realpath(path))
+        except Exception as e:
+            logging.warning("libmagic failed for {}: {}".format(path, e))
+
+    return _file_command(path, '--mime-type')
@@ -0,0 +1,413 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# ssdeep (fuzzy hash) support
+#
+# hashes are computed by libfuzzy (installed with the ssdeep package) if it can be loaded, otherwise by running the
+# ssdeep binary; comparisons use libfuzzy if available, otherwise the python implementation below (same algorithm)
+#
+# SsdeepIndex finds the known hashes (the output of the ssdeep command) that are similar to a given hash without
+# comparing it to every known hash
+# two ssdeep hashes can only have a score above zero if they have chunks at the same block size that share at least
+# one 7 character substring, so the chunks of the known hashes are indexed by (block size, 7-gram)
+# the index is compiled into a file that is memory mapped read-only by every process that uses it
+#
+# index file layout (native byte order)
+# header
+# keys[key_count] (uint64) sorted, block size bits (6) | 7-gram hash (34) | entry index (24)
+# entry_offsets[entry_count + 1] (uint64)
+# entry data (hash<TAB>file name, utf8)
+#
+
+import bisect
+import ctypes
+import ctypes.util
+import logging
+import mmap
+import os, os.path
+import struct
+import tempfile
+
+from array import array
+
+from saq.intervals import rebuild_if_stale
+from saq.process_server import Popen, PIPE
+
+SPAMSUM_LENGTH = 64
+MIN_BLOCKSIZE = 3
+ROLLING_WINDOW = 7
+FUZZY_MAX_RESULT = 2 * SPAMSUM_LENGTH + 20
+
+SSDEEP_INDEX_MAGIC = b'ACESSD01'
+SSDEEP_INDEX_HEADER = struct.Struct('8sIQ')
+SSDEEP_INDEX_MAX_ENTRIES = 1 << 24
+
+# edit distance costs used by ssdeep
+EDIT_DISTN_INSERT_COST = 1
+EDIT_DISTN_REMOVE_COST = 1
+EDIT_DISTN_REPLACE_COST = 2
+
+_libfuzzy = None
+_libfuzzy_loaded = False
+
+def get_libfuzzy():
+    """Returns the libfuzzy library loaded with ctypes, or None if it is not available."""
+    global _libfuzzy, _libfuzzy_loaded
+    if _libfuzzy_loaded:
+        return _libfuzzy
+
+    _libfuzzy_loaded = True
+    path = ctypes.util.find_library('fuzzy')
+    if path is None:
+        logging.debug("libfuzzy is not available")
+        return None
+
+    try:
+        _libfuzzy = ctypes.CDLL(path)
+        _libfuzzy.fuzzy_hash_filename.argtypes = [ ctypes.c_char_p, ctypes.c_char_p ]
+        _libfuzzy.fuzzy_hash_filename.restype = ctypes.c_int
+        _libfuzzy.fuzzy_compare.argtypes = [ ctypes.c_char_p, ctypes.c_char_p ]
+        _libfuzzy.fuzzy_compare.restype = ctypes.c_int
+        # the streaming interface is only available in libfuzzy 2.13 and later
+        if hasattr(_libfuzzy, 'fuzzy_new'):
+            _libfuzzy.fuzzy_new.argtypes = []
+            _libfuzzy.fuzzy_new.restype = ctypes.c_void_p
+            _libfuzzy.fuzzy_update.argtypes = [ ctypes.c_void_p, ctypes.c_char_p, ctypes.c_size_t ]
+            _libfuzzy.fuzzy_update.restype = ctypes.c_int
+            _libfuzzy.fuzzy_digest.argtypes = [ ctypes.c_void_p, ctypes.c_char_p, ctypes.c_uint ]
+            _libfuzzy.fuzzy_digest.restype = ctypes.c_int
+            _libfuzzy.fuzzy_free.argtypes = [ ctypes.c_void_p ]
+            _libfuzzy.fuzzy_free.restype = None
+    except Exception as e:
+        logging.warning("unable to load libfuzzy from {}: {}".format(path, e))
+        _libfuzzy = None
+
+    return _libfuzzy
+
+def fuzzy_hash_file(path):
+    """Returns the ssdeep hash of the given file. Raises RuntimeError if the hash cannot be computed."""
+    libfuzzy = get_libfuzzy()
+    if libfuzzy is not None:
+        result = ctypes.create_string_buffer(FUZZY_MAX_RESULT)
+        if libfuzzy.fuzzy_hash_filename(os.fsencode(path), result) != 0:
+            raise RuntimeError("unable to compute ssdeep hash of {}".format(path))
+
+        return result.value.decode('ascii')
+
+    p = Popen([ 'ssdeep', '-s', '-b', path ], stdout=PIPE, stderr=PIPE, universal_newlines=True)
+    stdout, stderr = p.communicate()
+    lines = [ _ for _ in stdout.split('\n') if _ and not _.startswith('ssdeep,') ]
+    if p.returncode != 0 or not lines:
+        raise RuntimeError("unable to compute ssdeep hash of {}: {}".format(path, stderr.strip()))
+
+    return lines[0].split(',', 1)[0]
+
+class FuzzyHasher(object):
+    """Computes an ssdeep hash incrementally like the hashlib objects (update() then hexdigest().)
+       Use FuzzyHasher.available() to check if the installed libfuzzy supports this."""
+
+    @staticmethod
+    def available():
+        libfuzzy = get_libfuzzy()
+        return libfuzzy is not None and hasattr(libfuzzy, 'fuzzy_new')
+
+    def __init__(self):
+        self.libfuzzy = get_libfuzzy()
+        self.state = self.libfuzzy.fuzzy_new()
+        if not self.state:
+            raise RuntimeError("unable to allocate ssdeep state")
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if getattr(self, 'state', None):
+            self.libfuzzy.fuzzy_free(self.state)
+            self.state = None
+
+    def update(self, data):
+        # writable buffers (bytearray and memoryviews of them) are passed without copying them
+        if not isinstance(data, bytes):
+            data = (ctypes.c_char * len(data)).from_buffer(data)
+
+        if self.libfuzzy.fuzzy_update(self.state, data, len(data)) != 0:
+            raise RuntimeError("unable to update ssdeep hash")
+
+    def hexdigest(self):
+        result = ctypes.create_string_buffer(FUZZY_MAX_RESULT)
+        if self.libfuzzy.fuzzy_digest(self.state, result, 0) != 0:
+            raise RuntimeError("unable to compute ssdeep hash")
+
+        return result.value.decode('ascii')
+
+def parse_hash(value):
+    """Parses an ssdeep hash (blocksize:chunk:double_chunk) into a tuple of (block_size, chunk, double_chunk).
+       Anything after a comma is ignored (the file name in ssdeep output.) Raises ValueError if the hash is invalid."""
+    block_size, chunk, double_chunk = value.split(',', 1)[0].strip().split(':', 2)
+    return int(block_size), chunk, double_chunk
+
+def eliminate_sequences(value):
+    """Returns the value with sequences of more than three identical characters reduced to three."""
+    result = value[:3]
+    for index in range(3, len(value)):
+        c = value[index]
+        if c != value[index - 1] or c != value[index - 2] or c != value[index - 3]:
+            result += c
+
+    return result
+
+def ngrams(value):
+    """Returns the set of ROLLING_WINDOW length substrings of value."""
+    return set([ value[index:index + ROLLING_WINDOW] for index in range(len(value) - ROLLING_WINDOW + 1) ])
+
+def edit_distance(s1, s2):
+    """Returns the weighted edit distance ssdeep uses to compare chunks."""
+    previous = [ index * EDIT_DISTN_INSERT_COST for index in range(len(s2) + 1) ]
+    for i, c1 in enumerate(s1):
+        current = [ (i + 1) * EDIT_DISTN_REMOVE_COST ]
+        for j, c2 in enumerate(s2):
+            current.append(min(previous[j + 1] + EDIT_DISTN_REMOVE_COST,
+                               current[j] + EDIT_DISTN_INSERT_COST,
+                               previous[j] + (0 if c1 == c2 else EDIT_DISTN_REPLACE_COST)))
+        previous = current
+
+    return previous[-1]
+
+def score_strings(s1, s2, block_size):
+    """Returns the ssdeep score of two chunks (with sequences eliminated) at the given block size."""
+    if len(s1) > SPAMSUM_LENGTH or len(s2) > SPAMSUM_LENGTH:
+        return 0
+
+    if not ngrams(s1) & ngrams(s2):
+        return 0
+
+    score = edit_distance(s1, s2)
+    score = (score * SPAMSUM_LENGTH) // (len(s1) + len(s2))
+    score = (100 * score) // SPAMSUM_LENGTH
+    if score >= 100:
+        return 0
+
+    score = 100 - score
+    # small block sizes can not produce high scores unless the chunks are long enough
+    if block_size >= (99 + ROLLING_WINDOW) // ROLLING_WINDOW * MIN_BLOCKSIZE:
+        return score
+
+    return min(score, block_size // MIN_BLOCKSIZE * min(len(s1), len(s2)))
+
+def _compare_parsed(block_size1, s1_1, s1_2, block_size2, s2_1, s2_2):
+    """Compares two parsed hashes whose chunks have already had sequences eliminated."""
+    if block_size1 == block_size2 and s1_1 == s2_1:
+        return 100
+
+    if block_size1 == block_size2:
+        return max(score_strings(s1_1, s2_1, block_size1), score_strings(s1_2, s2_2, block_size1 * 2))
+    elif block_size1 * 2 == block_size2:
+        return score_strings(s2_1, s1_2, block_size2)
+    elif block_size2 * 2 == block_size1:
+        return score_strings(s1_1, s2_2, block_size1)
+
+    return 0
+
+def fuzzy_compare(hash1, hash2):
+    """Returns the ssdeep score (0 - 100) of two ssdeep hashes. Raises ValueError if either hash is invalid."""
+    libfuzzy = get_libfuzzy()
+    if libfuzzy is not None:
+        result = libfuzzy.fuzzy_compare(hash1.encode('ascii'), hash2.encode('ascii'))
+        if result < 0:
+            raise ValueError("invalid ssdeep hash {} or {}".format(hash1, hash2))
+
+        return result
+
+    block_size1, s1_1, s1_2 = parse_hash(hash1)
+    block_size2, s2_1, s2_2 = parse_hash(hash2)
+    return _compare_parsed(block_size1, eliminate_sequences(s1_1), eliminate_sequences(s1_2),
+                           block_size2, eliminate_sequences(s2_1), eliminate_sequences(s2_2))
+
+def _chunk_keys(block_size, chunk):
+    """Returns the set of index keys (without the entry index) for a chunk (with sequences eliminated.)"""
+    prefix = block_size.bit_length() << 58
+    chunk = chunk.encode('ascii', errors='replace')
+    if len(chunk) < ROLLING_WINDOW:
+        # short chunks can only match if they are identical
+        grams = [ chunk ]
+    else:
+        grams = [ chunk[index:index + ROLLING_WINDOW] for index in range(len(chunk) - ROLLING_WINDOW + 1) ]
+
+    result = set()
+    for gram in grams:
+        value = int.from_bytes(gram, 'big')
+        result.add(prefix | (((value ^ (value >> 34)) & 0x3FFFFFFFF) << 24))
+
+    return result
+
+def _hash_keys(_hash):
+    """Returns the set of index keys (without the entry index) for both chunks of a hash."""
+    block_size, chunk, double_chunk = parse_hash(_hash)
+    return _chunk_keys(block_size, eliminate_sequences(chunk)) | \
+           _chunk_keys(block_size * 2, eliminate_sequences(double_chunk))
+
+def load_ssdeep_hashes(path):
+    """Loads the hashes from the given file (the output of the ssdeep command.)
+       Returns a list of (hash, file_name) tuples. Invalid hashes are logged and skipped."""
+    result = []
+    with open(path, 'r') as fp:
+        for line_number, line in enumerate(fp):
+            line = line.strip()
+            if not line or line.startswith('ssdeep,'):
+                continue
+
+            try:
+                _hash, file_name = line.split(',', 1)
+                parse_hash(_hash)
+                result.append((_hash, file_name.strip('"')))
+            except ValueError as e:
+                logging.error("invalid ssdeep hash on line {} of {}: {}".format(line_number + 1, path, e))
+
+    return result
+
+def write_ssdeep_index(path, hashes_path):
+    """Compiles the ssdeep hashes in hashes_path into an index at the given path.
+       The file is written to a temporary file and then moved into place, so processes that have the current file
+       open are not affected."""
+    entries = load_ssdeep_hashes(hashes_path)
+    if len(entries) > SSDEEP_INDEX_MAX_ENTRIES:
+        logging.warning("too many ssdeep hashes in {} (only the first {} are indexed)".format(
+                        hashes_path, SSDEEP_INDEX_MAX_ENTRIES))
+        entries = entries[:SSDEEP_INDEX_MAX_ENTRIES]
+
+    keys = []
+    records = []
+    for entry_index, (_hash, file_name) in enumerate(entries):
+        keys.extend([ key | entry_index for key in _hash_keys(_hash) ])
+        records.append('{}\t{}'.format(_hash, file_name).encode('utf8', errors='replace'))
+
+    keys.sort()
+    keys = array('Q', keys)
+    entry_offsets = array('Q', [ 0 ])
+    for record in records:
+        entry_offsets.append(entry_offsets[-1] + len(record))
+
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.{}.'.format(
+                                     os.path.basename(path)))
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(SSDEEP_INDEX_HEADER.pack(SSDEEP_INDEX_MAGIC, len(records), len(keys)))
+            keys.tofile(fp)
+            entry_offsets.tofile(fp)
+            for record in records:
+                fp.write(record)
+
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+
+    except Exception:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+        raise
+
+    logging.debug("wrote ssdeep index {} with {} hashes and {} keys".format(path, len(records), len(keys)))
+
+class SsdeepIndex(object):
+    """A read-only memory mapped ssdeep index created by write_ssdeep_index."""
+
+    def __init__(self, path):
+        self.path = path
+        self.mmap = None
+
+        with open(path, 'rb') as fp:
+            stat = os.fstat(fp.fileno())
+            # used to detect when the file has been replaced
+            self.file_id = (stat.st_dev, stat.st_ino)
+            self.mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.entry_count, self.key_count = SSDEEP_INDEX_HEADER.unpack_from(self.mmap, 0)
+        if magic != SSDEEP_INDEX_MAGIC:
+            self.close()
+            raise ValueError("{} is not an ssdeep index".format(path))
+
+        self._view = view = memoryview(self.mmap)
+        offset = SSDEEP_INDEX_HEADER.size
+        size = self.key_count * 8
+        self.keys = view[offset:offset + size].cast('Q')
+        offset += size
+        size = (self.entry_count + 1) * 8
+        self.entry_offsets = view[offset:offset + size].cast('Q')
+        self.entry_data_offset = offset + size
+
+    def __len__(self):
+        return self.entry_count
+
+    def close(self):
+        for name in [ 'keys', 'entry_offsets', '_view' ]:
+            view = getattr(self, name, None)
+            if view is not None:
+                view.release()
+                setattr(self, name, None)
+
+        if self.mmap is not None:
+            try:
+                self.mmap.close()
+            except BufferError:
+                # something is still using the memory (it will be freed when the reference goes away)
+                pass
+
+            self.mmap = None
+
+    @property
+    def replaced(self):
+        """Returns True if the file this index was loaded from has been replaced."""
+        try:
+            stat = os.stat(self.path)
+            return (stat.st_dev, stat.st_ino) != self.file_id
+        except FileNotFoundError:
+            return False
+
+    def get_entry(self, entry_index):
+        """Returns the (hash, file_name) of the given entry."""
+        start = self.entry_data_offset + self.entry_offsets[entry_index]
+        end = self.entry_data_offset + self.entry_offsets[entry_index + 1]
+        _hash, file_name = self.mmap[start:end].decode('utf8').split('\t', 1)
+        return _hash, file_name
+
+    def candidates(self, _hash):
+        """Returns the sorted list of the indexes of the entries that could have a score above zero with the hash."""
+        result = set()
+        for key in _hash_keys(_hash):
+            index = bisect.bisect_left(self.keys, key)
+            while index < self.key_count:
+                value = self.keys[index]
+                if value >> 24 != key >> 24:
+                    break
+
+                result.add(value & 0xFFFFFF)
+                index += 1
+
+        return sorted(result)
+
+    def matches(self, _hash, threshold=1):
+        """Returns the list of (file_name, score) for the known hashes that score at least threshold against the
+           given hash, in the order they were listed in the hash file."""
+        result = []
+        for entry_index in self.candidates(_hash):
+            known_hash, file_name = self.get_entry(entry_index)
+            score = fuzzy_compare(_hash, known_hash)
+            if score >= threshold:
+                result.append((file_name, score))
+
+        return result
+
+def open_ssdeep_index(path, hashes_path, current=None):
+    """Returns an SsdeepIndex for the given path, compiling it from hashes_path first if it does not exist or if it
+       is older than hashes_path. If current is an SsdeepIndex that is still up to date then it is returned as-is."""
+    rebuild_if_stale(path, [ hashes_path ], lambda _: write_ssdeep_index(_, hashes_path))
+
+    if current is not None and not current.replaced:
+        return current
+
+    result = SsdeepIndex(path)
+    if current is not None:
+        current.close()
+
+    return result
@@ -0,0 +1,305 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# file hashing
+#
+# compute_file_hashes reads a file once and feeds md5, sha1, sha256 (and optionally ssdeep) from the same buffer
+#
+# get_file_hashes also caches the results in a node-local sqlite database keyed by the identity of the file
+# (device, inode, size, mtime and ctime) so that a file that was already hashed on this node is not read again
+# ctime is included because it cannot be set from user space (extraction tools restore the mtime of the files)
+#
+
+import hashlib
+import logging
+import os, os.path
+import sqlite3
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import saq
+
+HASH_BUFFER_SIZE = 1024 * 1024
+
+HASH_MD5 = 'md5'
+HASH_SHA1 = 'sha1'
+HASH_SHA256 = 'sha256'
+HASH_SSDEEP = 'ssdeep'
+
+# files at least this large are hashed with a thread per hash
+# (hashlib and ctypes release the GIL while hashing so the hashes are computed in parallel)
+PARALLEL_HASH_MINIMUM_SIZE = 8 * HASH_BUFFER_SIZE
+
+def _update(fp, update_functions, buffer_size):
+    """Reads fp to the end and passes each chunk to the update functions."""
+    buffer = bytearray(buffer_size)
+    with memoryview(buffer) as view:
+        while True:
+            count = fp.readinto(buffer)
+            if not count:
+                break
+
+            data = view[:count] if count < buffer_size else view
+            for update in update_functions:
+                update(data)
+
+def _update_parallel(fp, update_functions, buffer_size):
+    """Same as _update but each update function runs in its own thread.
+       The next chunk is read into a second buffer while the current one is being hashed."""
+    buffers = [ bytearray(buffer_size), bytearray(buffer_size) ]
+    views = [ memoryview(_) for _ in buffers ]
+    pending = []
+    index = 0
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(update_functions)) as executor:
+            while True:
+                count = fp.readinto(buffers[index])
+                # the other buffer is reused by the next read
+                for future in pending:
+                    future.result()
+
+                if not count:
+                    break
+
+                data = views[index][:count] if count < buffer_size else views[index]
+                pending = [ executor.submit(update, data) for update in update_functions ]
+                index ^= 1
+
+    finally:
+        for view in views:
+            view.release()
+
+def compute_file_hashes(path, ssdeep=False, buffer_size=HASH_BUFFER_SIZE):
+    """Reads the given file once and returns a dict of the md5, sha1 and sha256 hex digests.
+       If ssdeep is True then the ssdeep hash is also included (set to None if it cannot be computed.)
+       Raises OSError if the file cannot be read."""
+    hashers = { HASH_MD5: hashlib.md5(), HASH_SHA1: hashlib.sha1(), HASH_SHA256: hashlib.sha256() }
+
+    fuzzy_hasher = None
+    if ssdeep:
+        from saq.fuzzy import FuzzyHasher
+        if FuzzyHasher.available():
+            fuzzy_hasher = FuzzyHasher()
+            hashers[HASH_SSDEEP] = fuzzy_hasher
+
+    update_functions = [ _.update for _ in hashers.values() ]
+
+    try:
+        with open(path, 'rb', buffering=0) as fp:
+            if os.fstat(fp.fileno()).st_size >= PARALLEL_HASH_MINIMUM_SIZE and (os.cpu_count() or 1) > 1:
+                _update_parallel(fp, update_functions, buffer_size)
+            else:
+                _update(fp, update_functions, buffer_size)
+
+        result = {}
+        for name, hasher in hashers.items():
+            try:
+                result[name] = hasher.hexdigest()
+            except RuntimeError as e:
+                logging.debug("unable to compute {} hash of {}: {}".format(name, path, e))
+                result[name] = None
+
+    finally:
+        if fuzzy_hasher is not None:
+            fuzzy_hasher.close()
+
+    # older versions of libfuzzy cannot hash incrementally
+    if ssdeep and fuzzy_hasher is None:
+        from saq.fuzzy import fuzzy_hash_file
+        try:
+            result[HASH_SSDEEP] = fuzzy_hash_file(path)
+        except RuntimeError as e:
+            logging.debug("unable to compute ssdeep hash of {}: {}".format(path, e))
+            result[HASH_SSDEEP] = None
+
+    return result
+
+def compute_ssdeep_hash(path, buffer_size=HASH_BUFFER_SIZE):
+    """Returns the ssdeep hash of the given file (or None if it cannot be computed.)
+       This is used when the other hashes of the file are already known (see compute_file_hashes.)
+       Raises OSError if the file cannot be read."""
+    from saq.fuzzy import FuzzyHasher, fuzzy_hash_file
+    try:
+        # older versions of libfuzzy cannot hash incrementally
+        if not FuzzyHasher.available():
+            return fuzzy_hash_file(path)
+
+        fuzzy_hasher = FuzzyHasher()
+        try:
+            with open(path, 'rb', buffering=0) as fp:
+                _update(fp, [ fuzzy_hasher.update ], buffer_size)
+
+            return fuzzy_hasher.hexdigest()
+        finally:
+            fuzzy_hasher.close()
+
+    except RuntimeError as e:
+        logging.debug("unable to compute ssdeep hash of {}: {}".format(path, e))
+        return None
+
+def _file_key(st):
+    """Returns the cache key for the given os.stat_result."""
+    return ( st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns )
+
+class HashCache(object):
+    """Caches file hashes in a sqlite database keyed by the identity of the file."""
+
+    def __init__(self, path, max_age=None):
+        """Opens (or creates) the cache database at the given path.
+           If max_age (in seconds) is given then entries older than that are removed."""
+        self.path = path
+        # other processes may be writing to the database at the same time
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+CREATE TABLE IF NOT EXISTS file_hashes (
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    ctime INTEGER NOT NULL,
+    md5 TEXT NOT NULL,
+    sha1 TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    ssdeep TEXT,
+    insert_time INTEGER NOT NULL,
+    PRIMARY KEY (device, inode, size, mtime, ctime))""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS idx_file_hashes_insert_time ON file_hashes(insert_time)")
+
+        if max_age is not None:
+            self.expire(max_age)
+
+    def close(self):
+        self.db.close()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM file_hashes").fetchone()[0]
+
+    def get(self, st, ssdeep=False):
+        """Returns the cached hashes (see compute_file_hashes) for the given os.stat_result, or None.
+           If ssdeep is True then the ssdeep hash is included, set to None if it has not been cached yet
+           (see update_ssdeep.)"""
+        row = self.db.execute("""SELECT md5, sha1, sha256, ssdeep FROM file_hashes
+                                 WHERE device = ? AND inode = ? AND size = ? AND mtime = ? AND ctime = ?""",
+                              _file_key(st)).fetchone()
+        if row is None:
+            return None
+
+        md5, sha1, sha256, ssdeep_hash = row
+        result = { HASH_MD5: md5, HASH_SHA1: sha1, HASH_SHA256: sha256 }
+        if ssdeep:
+            result[HASH_SSDEEP] = ssdeep_hash
+
+        return result
+
+    def put(self, st, hashes):
+        """Stores the given hashes (see compute_file_hashes) for the given os.stat_result."""
+        self.db.execute("""INSERT OR REPLACE INTO file_hashes ( device, inode, size, mtime, ctime, md5, sha1, sha256,
+                                                               ssdeep, insert_time )
+                           VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, ?, ? )""",
+                        _file_key(st) + ( hashes[HASH_MD5], hashes[HASH_SHA1], hashes[HASH_SHA256],
+                                          hashes.get(HASH_SSDEEP), int(time.time()) ))
+
+    def update_ssdeep(self, st, ssdeep_hash):
+        """Adds the ssdeep hash to the cached hashes of the given os.stat_result."""
+        self.db.execute("""UPDATE file_hashes SET ssdeep = ?
+                           WHERE device = ? AND inode = ? AND size = ? AND mtime = ? AND ctime = ?""",
+                        ( ssdeep_hash, ) + _file_key(st))
+
+    def expire(self, max_age):
+        """Removes the entries older than max_age seconds."""
+        self.db.execute("DELETE FROM file_hashes WHERE insert_time < ?", (int(time.time() - max_age),))
+
+# the cache is opened once per process (sqlite connections cannot be shared across fork)
+_hash_cache = None
+_hash_cache_pid = None
+
+def get_hash_cache():
+    """Returns the HashCache for this process, or None if the cache is disabled or cannot be opened."""
+    global _hash_cache, _hash_cache_pid
+
+    if not saq.CONFIG['hash_cache'].getboolean('enabled', fallback=False):
+        return None
+
+    if _hash_cache_pid == os.getpid():
+        return _hash_cache
+
+    _hash_cache = None
+    _hash_cache_pid = os.getpid()
+
+    path = os.path.join(saq.DATA_DIR, saq.CONFIG['hash_cache']['path'])
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _hash_cache = HashCache(path, max_age=saq.CONFIG['hash_cache'].getint('max_age_days', fallback=7) * 86400)
+    except Exception as e:
+        logging.warning("unable to open hash cache {}: {}".format(path, e))
+
+    return _hash_cache
+
+def get_file_hashes(path, ssdeep=False):
+    """Returns the hashes of the given file (see compute_file_hashes), using the local hash cache if enabled.
+       Raises OSError if the file cannot be read."""
+    st = os.stat(path)
+    cache = None
+    if st.st_size >= saq.CONFIG['hash_cache'].getint('minimum_size', fallback=0):
+        cache = get_hash_cache()
+
+    result = None
+    if cache is not None:
+        try:
+            result = cache.get(st, ssdeep)
+        except sqlite3.Error as e:
+            logging.warning("unable to query hash cache: {}".format(e))
+            cache = None
+
+    if result is not None:
+        if not ssdeep or result[HASH_SSDEEP] is not None:
+            logging.debug("using cached hashes for {}".format(path))
+            return result
+
+        # the file was hashed without the ssdeep hash so that is the only one that needs to be computed
+        logging.debug("using cached hashes for {} (computing the ssdeep hash)".format(path))
+        result[HASH_SSDEEP] = compute_ssdeep_hash(path)
+        if result[HASH_SSDEEP] is not None:
+            try:
+                if _file_key(os.stat(path)) == _file_key(st):
+                    cache.update_ssdeep(st, result[HASH_SSDEEP])
+            except (OSError, sqlite3.Error) as e:
+                logging.warning("unable to update hash cache: {}".format(e))
+
+        return result
+
+    result = compute_file_hashes(path, ssdeep=ssdeep)
+
+    if cache is not None and (not ssdeep or result[HASH_SSDEEP] is not None):
+        try:
+            # don't cache anything if the file changed while we were reading it
+            if _file_key(os.stat(path)) == _file_key(st):
+                cache.put(st, result)
+        except (OSError, sqlite3.Error) as e:
+            logging.warning("unable to update hash cache: {}".format(e))
+
+    return result
+
+def cache_file_hashes(path, hashes):
+    """Stores hashes of the given file that were computed some other way (for example while it was being written)
+       in the local hash cache so that get_file_hashes does not read the file again."""
+    try:
+        st = os.stat(path)
+    except OSError as e:
+        logging.warning("unable to stat {}: {}".format(path, e))
+        return
+
+    if st.st_size < saq.CONFIG['hash_cache'].getint('minimum_size', fallback=0):
+        return
+
+    cache = get_hash_cache()
+    if cache is None:
+        return
+
+    try:
+        cache.put(st, hashes)
+    except sqlite3.Error as e:
+        logging.warning("unable to update hash cache: {}".format(e))
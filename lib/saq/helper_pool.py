@@ -0,0 +1,282 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# pool of long-lived python interpreters used to run python command line tools
+#
+# some of the tools we use are python2 scripts that we run for every file
+# starting the interpreter and importing the libraries each time takes longer than the analysis itself
+# so instead each worker process keeps a few helper processes (bin/python_helper.py) running
+# that execute the scripts on request (see bin/python_helper.py for the protocol)
+#
+# the output (stdout, stderr and return code) is the same as running the script from the command line
+# if a helper dies while running a job then the job is executed again with a normal process
+#
+
+import atexit
+import json
+import locale
+import logging
+import os, os.path
+import select
+import signal
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+
+import saq
+from saq.process_server import Popen, PIPE, TimeoutExpired
+
+LENGTH = struct.Struct('>I')
+
+class HelperResult(object):
+    """The result of running a script. stdout is None if it was written to a file."""
+    def __init__(self, returncode, stdout, stderr, timed_out=False):
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+
+    @staticmethod
+    def _text(data):
+        # same as universal_newlines=True
+        if data is None:
+            return None
+
+        return data.decode(locale.getpreferredencoding(False)).replace('\r\n', '\n').replace('\r', '\n')
+
+    @property
+    def stdout_text(self):
+        return self._text(self.stdout)
+
+    @property
+    def stderr_text(self):
+        return self._text(self.stderr)
+
+class HelperError(Exception):
+    """Raised when a helper process fails (dies, times out or stops responding.)"""
+    pass
+
+class Helper(object):
+    """A single helper process."""
+
+    def __init__(self, interpreter, memory_limit=None):
+        self.interpreter = interpreter
+        self.memory_limit = memory_limit
+        self.job_count = 0
+        self.process = subprocess.Popen([ interpreter, os.path.join(saq.SAQ_HOME, 'bin', 'python_helper.py'),
+                                          str(memory_limit or 0) ],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                        close_fds=True, start_new_session=True)
+        logging.debug("started helper process {} ({})".format(self.process.pid, interpreter))
+
+    @property
+    def alive(self):
+        return self.process.poll() is None
+
+    def _read(self, count, deadline):
+        result = b''
+        while len(result) < count:
+            timeout = None if deadline is None else deadline - time.time()
+            if timeout is not None and timeout <= 0:
+                raise TimeoutExpired(self.process.args, None)
+
+            readable, _, _ = select.select([ self.process.stdout ], [], [], timeout)
+            if not readable:
+                continue
+
+            data = os.read(self.process.stdout.fileno(), count - len(result))
+            if not data:
+                raise HelperError("helper process {} exited with {}".format(self.process.pid, self.process.wait()))
+
+            result += data
+
+        return result
+
+    def execute(self, job, timeout=None):
+        """Sends the job to the helper and returns the response. Raises TimeoutExpired or HelperError."""
+        deadline = None if timeout is None else time.time() + timeout
+        data = json.dumps(job).encode('utf8')
+        try:
+            self.process.stdin.write(LENGTH.pack(len(data)) + data)
+            self.process.stdin.flush()
+        except OSError as e:
+            raise HelperError("unable to send job to helper process {}: {}".format(self.process.pid, e))
+
+        self.job_count += 1
+        length = LENGTH.unpack(self._read(LENGTH.size, deadline))[0]
+        return json.loads(self._read(length, deadline).decode('utf8'))
+
+    def close(self):
+        if self.alive:
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+        try:
+            self.process.stdin.close()
+            self.process.stdout.close()
+        except OSError:
+            pass
+
+        self.process.wait()
+
+class HelperPool(object):
+    """A pool of helper processes that run scripts with the given interpreter."""
+
+    def __init__(self, interpreter, size=1, max_jobs=100, memory_limit=None):
+        # the python interpreter to run the scripts with
+        self.interpreter = interpreter
+        # maximum number of helper processes
+        self.size = size
+        # helpers are replaced after this many jobs
+        self.max_jobs = max_jobs
+        # memory limit (in bytes) of each helper process
+        self.memory_limit = memory_limit
+        # helpers that are not running anything right now
+        self.idle = []
+        self.helper_count = 0
+        self.condition = threading.Condition()
+
+    def _acquire(self):
+        with self.condition:
+            while not self.idle and self.helper_count >= self.size:
+                self.condition.wait()
+
+            if self.idle:
+                return self.idle.pop()
+
+            self.helper_count += 1
+
+        try:
+            return Helper(self.interpreter, self.memory_limit)
+        except Exception:
+            with self.condition:
+                self.helper_count -= 1
+                self.condition.notify()
+            raise
+
+    def _release(self, helper, recycle=False):
+        if recycle or not helper.alive or helper.job_count >= self.max_jobs:
+            helper.close()
+            helper = None
+
+        with self.condition:
+            if helper is None:
+                self.helper_count -= 1
+            else:
+                self.idle.append(helper)
+
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            for helper in self.idle:
+                helper.close()
+
+            self.helper_count -= len(self.idle)
+            self.idle = []
+
+    def run(self, argv, stdout_path=None, cwd=None, timeout=None):
+        """Runs the given script (argv[0] is the path to the script) and returns a HelperResult.
+           If stdout_path is given then stdout is written to that file, otherwise it is captured."""
+        # arguments are passed as utf8 (paths that are not valid utf8 cannot be passed to the helper)
+        try:
+            for arg in list(argv) + [ stdout_path or '', cwd or '' ]:
+                arg.encode('utf8')
+        except UnicodeEncodeError:
+            return self.run_process(argv, stdout_path=stdout_path, cwd=cwd, timeout=timeout)
+
+        with tempfile.TemporaryDirectory(prefix='helper', dir=saq.TEMP_DIR) as temp_dir:
+            job = { 'argv': argv,
+                    'cwd': cwd or os.getcwd(),
+                    'stdout': stdout_path or os.path.join(temp_dir, 'stdout'),
+                    'stderr': os.path.join(temp_dir, 'stderr') }
+
+            helper = self._acquire()
+            response = None
+            recycle = True
+            try:
+                response = helper.execute(job, timeout=timeout)
+                recycle = response['recycle']
+                returncode = response['returncode']
+                timed_out = False
+            except TimeoutExpired:
+                logging.warning("{} timed out after {} seconds".format(argv[0], timeout))
+                returncode = None
+                timed_out = True
+            except HelperError as e:
+                logging.warning("helper failed running {}: {}".format(argv[0], e))
+                return self.run_process(argv, stdout_path=stdout_path, cwd=cwd, timeout=timeout)
+            finally:
+                self._release(helper, recycle=recycle)
+
+            if response is not None and response['fallback']:
+                return self.run_process(argv, stdout_path=stdout_path, cwd=cwd, timeout=timeout)
+
+            def _read(path):
+                try:
+                    with open(path, 'rb') as fp:
+                        return fp.read()
+                except FileNotFoundError:
+                    return b''
+
+            return HelperResult(returncode, None if stdout_path else _read(job['stdout']), _read(job['stderr']),
+                                timed_out=timed_out)
+
+    def run_process(self, argv, stdout_path=None, cwd=None, timeout=None):
+        """Runs the given script in a new process (the way it was done before helpers.)"""
+        stdout_fp = open(stdout_path, 'wb') if stdout_path else None
+        try:
+            p = Popen([ self.interpreter ] + list(argv), stdout=stdout_fp or PIPE, stderr=PIPE, cwd=cwd)
+            try:
+                stdout, stderr = p.communicate(timeout=timeout)
+                timed_out = False
+            except TimeoutExpired:
+                logging.warning("{} timed out after {} seconds".format(argv[0], timeout))
+                stdout, stderr = p.communicate()
+                timed_out = True
+
+            return HelperResult(p.returncode, None if stdout_path else stdout, stderr, timed_out=timed_out)
+        finally:
+            if stdout_fp:
+                stdout_fp.close()
+
+# key = interpreter, value = HelperPool
+_pools = {}
+_pools_pid = None
+_pools_lock = threading.Lock()
+
+def get_helper_pool(interpreter='python2.7'):
+    """Returns the HelperPool for this process that runs scripts with the given interpreter."""
+    global _pools, _pools_pid
+    with _pools_lock:
+        # helpers belong to the process that started them
+        if _pools_pid != os.getpid():
+            _pools = {}
+            _pools_pid = os.getpid()
+
+        if interpreter not in _pools:
+            config = saq.CONFIG['helper_pool']
+            _pools[interpreter] = HelperPool(interpreter,
+                                             size=config.getint('pool_size', fallback=1),
+                                             max_jobs=config.getint('max_jobs', fallback=100),
+                                             memory_limit=config.getint('memory_limit', fallback=0) * 1024 * 1024)
+
+        return _pools[interpreter]
+
+def run_python_script(argv, stdout_path=None, cwd=None, timeout=None, interpreter='python2.7'):
+    """Runs the given python script (argv[0] is the path to the script) with the given interpreter.
+       Uses a helper process if [helper_pool] is enabled, otherwise starts a new process. Returns a HelperResult."""
+    pool = get_helper_pool(interpreter)
+    if saq.CONFIG['helper_pool'].getboolean('enabled', fallback=False):
+        return pool.run(argv, stdout_path=stdout_path, cwd=cwd, timeout=timeout)
+
+    return pool.run_process(argv, stdout_path=stdout_path, cwd=cwd, timeout=timeout)
+
+@atexit.register
+def _close_helper_pools():
+    if _pools_pid == os.getpid():
+        for pool in _pools.values():
+            pool.close()
@@ -0,0 +1,238 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# memory mapped interval tables
+#
+# an interval table maps ranges of integers (typically ipv4 addresses) to records (arbitrary bytes)
+# the table is compiled once into a file which is then memory mapped read-only by every process that uses it
+# so that the data is shared between processes and lookups are a binary search
+#
+# intervals can be nested (for example a /16 that contains a /24) in which case the most specific (smallest)
+# interval wins, which is what you want for routing tables and network assignments
+#
+# file layout (native byte order)
+# header
+# starts[segment_count] (uint32)
+# ends[segment_count] (uint32)
+# interval_starts[segment_count] (uint32) the start of the interval the segment came from
+# interval_ends[segment_count] (uint32) the end of the interval the segment came from
+# record_index[segment_count] (uint32)
+# record_offsets[record_count + 1] (uint64)
+# record data
+#
+
+import bisect
+import fcntl
+import heapq
+import logging
+import mmap
+import os, os.path
+import struct
+import tempfile
+
+from array import array
+
+INTERVAL_TABLE_MAGIC = b'ACEIVL01'
+INTERVAL_TABLE_HEADER = struct.Struct('8sII')
+
+def compile_segments(intervals):
+    """Turns a list of (start, end, record_index) intervals (inclusive) that may overlap into a sorted list of
+       non-overlapping (start, end, interval_start, interval_end, record_index) segments where each segment is
+       assigned to the smallest interval that contains it. If two intervals of the same size overlap then the one
+       that comes last wins."""
+    intervals = sorted([ (start, end, record_index, sequence)
+                         for sequence, (start, end, record_index) in enumerate(intervals) ])
+
+    boundaries = set()
+    for start, end, _, _ in intervals:
+        boundaries.add(start)
+        boundaries.add(end + 1)
+
+    boundaries = sorted(boundaries)
+    segments = []
+    active = [] # heap of (size, -sequence, start, end, record_index)
+    index = 0
+
+    for boundary_index, boundary in enumerate(boundaries[:-1]):
+        while index < len(intervals) and intervals[index][0] == boundary:
+            start, end, record_index, sequence = intervals[index]
+            heapq.heappush(active, (end - start, -sequence, start, end, record_index))
+            index += 1
+
+        # remove intervals that have ended
+        while active and active[0][3] < boundary:
+            heapq.heappop(active)
+
+        if not active:
+            continue
+
+        _, _, interval_start, interval_end, record_index = active[0]
+        segment_end = boundaries[boundary_index + 1] - 1
+
+        # merge with the previous segment if it came from the same interval
+        if segments and segments[-1][1] == boundary - 1 and segments[-1][2] == interval_start \
+        and segments[-1][3] == interval_end and segments[-1][4] == record_index:
+            segments[-1] = (segments[-1][0], segment_end, interval_start, interval_end, record_index)
+        else:
+            segments.append((boundary, segment_end, interval_start, interval_end, record_index))
+
+    return segments
+
+def write_interval_table(path, intervals, records):
+    """Compiles the given intervals and records into an interval table at the given path.
+       intervals is a list of (start, end, record_index) tuples where start and end are inclusive uint32 values.
+       records is a list of bytes.
+       The file is written to a temporary file and then moved into place, so processes that have the current file
+       open are not affected."""
+    segments = compile_segments(intervals)
+
+    columns = [ array('I', [ segment[column] for segment in segments ]) for column in range(5) ]
+    record_offsets = array('Q', [ 0 ])
+    for record in records:
+        record_offsets.append(record_offsets[-1] + len(record))
+
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.{}.'.format(
+                                     os.path.basename(path)))
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(INTERVAL_TABLE_HEADER.pack(INTERVAL_TABLE_MAGIC, len(segments), len(records)))
+            for column in columns:
+                column.tofile(fp)
+
+            record_offsets.tofile(fp)
+            for record in records:
+                fp.write(record)
+
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+
+    except Exception:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+        raise
+
+    logging.debug("wrote interval table {} with {} segments and {} records".format(path, len(segments), len(records)))
+
+class IntervalTable(object):
+    """A read-only memory mapped interval table created by write_interval_table."""
+
+    def __init__(self, path):
+        self.path = path
+        self.mmap = None
+
+        with open(path, 'rb') as fp:
+            stat = os.fstat(fp.fileno())
+            # used to detect when the file has been replaced
+            self.file_id = (stat.st_dev, stat.st_ino)
+            self.mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.segment_count, self.record_count = INTERVAL_TABLE_HEADER.unpack_from(self.mmap, 0)
+        if magic != INTERVAL_TABLE_MAGIC:
+            self.close()
+            raise ValueError("{} is not an interval table".format(path))
+
+        self._view = view = memoryview(self.mmap)
+        offset = INTERVAL_TABLE_HEADER.size
+        columns = []
+        for _ in range(5):
+            size = self.segment_count * 4
+            columns.append(view[offset:offset + size].cast('I'))
+            offset += size
+
+        self.starts, self.ends, self.interval_starts, self.interval_ends, self.record_index = columns
+
+        size = (self.record_count + 1) * 8
+        self.record_offsets = view[offset:offset + size].cast('Q')
+        self.record_data_offset = offset + size
+
+    def __len__(self):
+        return self.segment_count
+
+    def close(self):
+        for name in [ 'starts', 'ends', 'interval_starts', 'interval_ends', 'record_index', 'record_offsets', 
+                      '_view' ]:
+            view = getattr(self, name, None)
+            if view is not None:
+                view.release()
+                setattr(self, name, None)
+
+        if self.mmap is not None:
+            try:
+                self.mmap.close()
+            except BufferError:
+                # something is still using the memory (it will be freed when the reference goes away)
+                pass
+
+            self.mmap = None
+
+    def get_record(self, record_index):
+        start = self.record_data_offset + self.record_offsets[record_index]
+        end = self.record_data_offset + self.record_offsets[record_index + 1]
+        return self.mmap[start:end]
+
+    def lookup(self, value):
+        """Returns a tuple of (interval_start, interval_end, record) for the smallest interval that contains the given
+           value, or None if there isn't one."""
+        index = bisect.bisect_right(self.starts, value) - 1
+        if index < 0 or self.ends[index] < value:
+            return None
+
+        return self.interval_starts[index], self.interval_ends[index], self.get_record(self.record_index[index])
+
+    @property
+    def replaced(self):
+        """Returns True if the file this table was loaded from has been replaced."""
+        try:
+            stat = os.stat(self.path)
+            return (stat.st_dev, stat.st_ino) != self.file_id
+        except FileNotFoundError:
+            return False
+
+def rebuild_if_stale(path, source_paths, build):
+    """Calls build(path) if the file at path does not exist or if it is older than any of the source files.
+       If more than one process needs to build the file at the same time then only one of them does."""
+
+    def _stale():
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return True
+
+        for source_path in source_paths:
+            try:
+                if os.stat(source_path).st_mtime > mtime:
+                    return True
+            except FileNotFoundError:
+                pass
+
+        return False
+
+    if _stale():
+        with open('{}.lock'.format(path), 'a') as lock_fp:
+            fcntl.flock(lock_fp.fileno(), fcntl.LOCK_EX)
+            try:
+                # someone else may have compiled it while we were waiting
+                if _stale():
+                    logging.info("compiling {} from {}".format(path, ','.join(source_paths)))
+                    build(path)
+            finally:
+                fcntl.flock(lock_fp.fileno(), fcntl.LOCK_UN)
+
+def open_interval_table(path, source_paths, build, current=None):
+    """Returns an IntervalTable for the given path, compiling it first if it does not exist or if it is older than
+       any of the source files. build is a callable that takes the path to write the table to and calls
+       write_interval_table. If more than one process needs to compile the table at the same time then only one of
+       them does. If current is an IntervalTable that is still up to date then it is returned as-is."""
+
+    rebuild_if_stale(path, source_paths, build)
+
+    if current is not None and not current.replaced:
+        return current
+
+    result = IntervalTable(path)
+    if current is not None:
+        current.close()
+
+    return result
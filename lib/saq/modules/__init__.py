@@ -1,6 +1,7 @@
 # vim: sw=4:ts=4:et:cc=120
 
 import datetime
+import fnmatch
 import inspect
 import json
 import logging
@@ -125,6 +126,16 @@ class AnalysisModule(object):
         # automation limit settings control how many times an analysis module runs automatically during correlation
         self.automation_limit = self.config.getint('automation_limit', fallback=None)
 
+        # modules that look things up in external systems can look up observables of the same type together
+        # (see get_batch)
+        self.batch_size = self.config.getint('batch_size', fallback=1)
+        # observables are only looked up together if their times are within batch_window of each other
+        self.batch_window = create_timedelta(self.config.get('batch_window', fallback='00:15:00'))
+        # the results of batched lookups for observables that have not been analyzed yet
+        self.batch_results = {} # key = observable.id, value = results
+        # the ids of the observables we've already looked up
+        self.batch_searched = set()
+
     @property
     def is_grouped_by_time(self):
         """Returns True if the observation_grouping_time_range configuration option is being used."""
@@ -172,6 +183,8 @@ class AnalysisModule(object):
         self.generated_observables = []
         self.cancel_analysis_flag = False
         self.cooldown_timeout = None
+        self.batch_results = {}
+        self.batch_searched = set()
 
     @property
     def cooldown_period(self):
@@ -825,6 +838,38 @@ configuration."""
         """Returns how often to execute the maintenance function, in seconds, or None to disable (the default.)"""
         return None
 
+    def batch_time(self, observable):
+        """Returns the time the given observable is searched around."""
+        return self.root.event_time_datetime if observable.time_datetime is None else observable.time_datetime
+
+    def get_batch(self, observable):
+        """Returns the list of observables to look up together with the given observable (including the observable.)
+           These are the observables of the same type in the current analysis that this module would analyze
+           and has not already looked up. The ids of the returned observables are added to batch_searched."""
+        batch = [ observable ]
+        if self.batch_size <= 1:
+            self.batch_searched.add(observable.id)
+            return batch
+
+        target_time = self.batch_time(observable)
+        for candidate in self.root.get_observables_by_type(observable.type):
+            if len(batch) >= self.batch_size:
+                break
+
+            if candidate is observable or candidate.id in self.batch_searched:
+                continue
+
+            if abs(self.batch_time(candidate) - target_time) > self.batch_window:
+                continue
+
+            if not self.accepts(candidate):
+                continue
+
+            batch.append(candidate)
+
+        self.batch_searched.update([ target.id for target in batch ])
+        return batch
+
     def analysis_covered(self, observable):
         """Returns True if the value of this observable has already been analyzed in another observable
            that has an observation time with range of this observable."""
@@ -1033,6 +1078,12 @@ class SplunkAnalysisModule(AnalysisModule, SplunkQueryObject):
         else:
             self.relative_duration_after = saq.CONFIG.get('splunk', 'relative_duration_after')
 
+        # modules that use splunk_batch_query search for up to batch_size observables of the same type at once
+        self.batch_size = self.config.getint('batch_size', fallback=saq.CONFIG['splunk'].getint('batch_size', 
+                                                                                                   fallback=1))
+        self.batch_window = create_timedelta(self.config.get('batch_window', 
+                                             fallback=saq.CONFIG['splunk'].get('batch_window', fallback='00:15:00')))
+
     @property
     def semaphore_name(self):
         return 'splunk'
@@ -1067,6 +1118,94 @@ class SplunkAnalysisModule(AnalysisModule, SplunkQueryObject):
         # try to stop any existing splunk query
         self.cancel()
 
+    def batch_value(self, observable):
+        """Returns the value used to search for the given observable in splunk_batch_query.
+           Wildcards (*) are allowed. Defaults to the value of the observable."""
+        return observable.value
+
+    def batch_result_matches(self, observable, field, result):
+        """Returns True if the given JSON result from a batched search belongs to the given observable.
+           Defaults to a case insensitive (wildcard) match of the value of the field against batch_value()."""
+        values = result.get(field)
+        if values is None:
+            return False
+
+        # multi-value fields come back as lists
+        if not isinstance(values, list):
+            values = [ values ]
+
+        pattern = self.batch_value(observable).lower()
+        return any(fnmatch.fnmatchcase(str(value).lower(), pattern) for value in values)
+
+    def splunk_batch_query(self, observable, query, field):
+        """Searches splunk for the given observable along with any other observables of the same type in the current 
+           analysis that this module has not analyzed yet, so that an alert with hundreds of observables results in 
+           a handful of searches instead of hundreds.
+
+           The query is formatted with the following keywords.
+           {values} - the values of the observables OR'd together ("value1" OR "value2" ...)
+           {filter} - field IN ("pattern1", "pattern2", ...) where the patterns come from batch_value()
+
+           The results are split back out per observable using batch_result_matches().
+           Returns the list of JSON results for the given observable, or None if the search failed."""
+
+        if observable.id in self.batch_results:
+            logging.debug(f"using batched splunk results for {observable}")
+            return self.batch_results.pop(observable.id)
+
+        def _quote(value):
+            return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+
+        batch = self.get_batch(observable)
+        values = []
+        patterns = []
+        for target in batch:
+            value = _quote(target.value)
+            if value not in values:
+                values.append(value)
+
+            pattern = _quote(self.batch_value(target))
+            if pattern not in patterns:
+                patterns.append(pattern)
+
+        query = query.format(values=' OR '.join(values), filter='{} IN ({})'.format(field, ', '.join(patterns)))
+        batch_times = [ self.batch_time(target) for target in batch ]
+        time_start = min(batch_times) - create_timedelta(self.relative_duration_before)
+        time_end = max(batch_times) + create_timedelta(self.relative_duration_after)
+
+        if len(batch) > 1:
+            logging.info(f"{self} searching for {len(batch)} {observable.type} observables in {self.root}")
+
+        # each observable in the batch gets the same number of results it would get searching for it by itself
+        max_result_count = self.max_result_count
+        self.max_result_count = int(max_result_count) * len(batch)
+
+        try:
+            if not self.acquire_semaphore():
+                if not self.cancel_analysis_flag:
+                    logging.warning("unable to acquire semaphore")
+                return None
+
+            if not self.enabled or not self.query_with_time(query, time_start, time_end):
+                return None
+
+        finally:
+            self.max_result_count = max_result_count
+            self.release_semaphore()
+
+        results = self.json()
+        if results is None:
+            return None
+
+        for target in batch:
+            target_results = [ _ for _ in results if self.batch_result_matches(target, field, _) ]
+            if target is observable:
+                observable_results = target_results
+            else:
+                self.batch_results[target.id] = target_results
+
+        return observable_results
+
 class CarbonBlackAnalysisModule(AnalysisModule):
     """An analysis module that directly queries Carbon Black servers as part of its analysis."""
     @property
@@ -1119,23 +1258,37 @@ class ELKAnalysisModule(AnalysisModule):
         if 'cluster' in self.config:
             self.cluster = self.config['cluster']
 
-    def search(self, index, query, target=None, earliest=None, latest=None, fields=[], sort=[]):
-        """Searches ELK using the given query.
-            :param index: The index to search.
-            :param query: The query to execute against the index.
-            :param target: A datetime to reference if the time span is relative.
-            :param earliest: The earliest part of an absolute time span.
-            :param latest: The latest part of an absolute time span.
-            :param fields: Optional list of fields in include in the results. Defaults to all fields.
-            :param sort: Optional list of JSON dicts specifying the sort. Defaults to event_timestamp desc.
-            (see https://www.elastic.co/guide/en/elasticsearch/reference/current/search-request-sort.html)
-            :returns: or None on failure
-        """
+        # the number of results to download per request when we need more than one request
+        self.page_size = self.config.getint('page_size', fallback=saq.CONFIG['elk'].getint('page_size', 
+                                                                                              fallback=1000))
+        # how long ELK keeps the search context alive between pages
+        self.scroll_timeout = saq.CONFIG['elk'].get('scroll_timeout', fallback='1m')
 
-        # is elk searching enabled?
-        if not saq.CONFIG['elk'].getboolean('enabled'):
-            logging.warning("analysis module {} enabled but elk is disabled globally".format(self.name))
-            return None
+        # modules that use batch_search search for up to batch_size observables of the same type at once
+        self.batch_size = self.config.getint('batch_size', fallback=saq.CONFIG['elk'].getint('batch_size', 
+                                                                                                fallback=1))
+        self.batch_window = create_timedelta(self.config.get('batch_window', 
+                                             fallback=saq.CONFIG['elk'].get('batch_window', fallback='00:15:00')))
+
+        # search timing statistics
+        self.search_count = 0
+        self.search_time = 0.0
+
+        self._http = None
+
+    @property
+    def http(self):
+        """The requests.Session used to talk to ELK (keeps the connections alive between searches.)"""
+        if self._http is None:
+            self._http = requests.Session()
+            self._http.verify = False # XXX remove verify=False
+            self._http.headers.update({'Content-type':'application/json'})
+
+        return self._http
+
+    def build_search(self, query, target=None, earliest=None, latest=None, fields=[], sort=[], size=None):
+        """Returns the JSON search body for the given query. See search() for the parameters.
+           size defaults to max_result_count."""
 
         if ( earliest is None and latest is not None ) or ( earliest is not None and latest is None ):
             raise RuntimeError("if you pass an absolute time range to ELKAnalysisModule.search you must "
@@ -1164,7 +1317,7 @@ class ELKAnalysisModule(AnalysisModule):
             sort = [ { 'event_timestamp': { 'order': 'desc'} } ]
 
         search_json = {
-            'size': self.max_result_count,
+            'size': self.max_result_count if size is None else size,
             'query': {
                 'bool': {
                     'filter': [
@@ -1192,30 +1345,218 @@ class ELKAnalysisModule(AnalysisModule):
         if fields:
             search_json['_source'] = fields
 
+        return search_json
+
+    def format_index(self, index):
         # are we specifying a cluster?
         if self.cluster:
-            index = '{}:{}'.format(self.cluster, index)
-
-        search_uri = "{}{}/_search".format(self.elk_uri, index)
-        search_id = '{} query {} earliest {} latest {}'.format(search_uri, query, earliest, latest)
-        logging.debug("executing search {}".format(search_id))
-
-        headers = {'Content-type':'application/json'}
-        search_result = requests.get(search_uri, data=json.dumps(search_json), headers=headers, verify=False) # XXX remove verify=False
+            return '{}:{}'.format(self.cluster, index)
+
+        return index
+
+    def record_search_time(self, search_id, elapsed, json_result):
+        """Records how long the given search took."""
+        took = json_result.get('took') if isinstance(json_result, dict) else None
+        self.search_count += 1
+        self.search_time += elapsed
+        logging.debug("search {} took {:.3f} seconds (elk reported {} ms)".format(search_id, elapsed, took))
+
+    def elk_request(self, method, uri, search_id, **kwargs):
+        """Sends the request to ELK and returns the parsed JSON response, or None on failure."""
+        start = time.time()
+        search_result = self.http.request(method, uri, **kwargs)
+        elapsed = time.time() - start
         if search_result.status_code != 200:
             logging.warning("search failed for {}: {}".format(search_id, search_result.text))
             return None
 
         json_result = search_result.json()
+        self.record_search_time(search_id, elapsed, json_result)
+        return json_result
+
+    def search(self, index, query, target=None, earliest=None, latest=None, fields=[], sort=[]):
+        """Searches ELK using the given query.
+            :param index: The index to search.
+            :param query: The query to execute against the index.
+            :param target: A datetime to reference if the time span is relative.
+            :param earliest: The earliest part of an absolute time span.
+            :param latest: The latest part of an absolute time span.
+            :param fields: Optional list of fields in include in the results. Defaults to all fields.
+            :param sort: Optional list of JSON dicts specifying the sort. Defaults to event_timestamp desc.
+            (see https://www.elastic.co/guide/en/elasticsearch/reference/current/search-request-sort.html)
+            :returns: or None on failure
+
+            If max_result_count is larger than page_size then the results are downloaded page_size at a time
+            and combined into the hits of the first response.
+        """
+
+        # is elk searching enabled?
+        if not saq.CONFIG['elk'].getboolean('enabled'):
+            logging.warning("analysis module {} enabled but elk is disabled globally".format(self.name))
+            return None
+
+        if self.max_result_count > self.page_size:
+            json_result = None
+            hits = []
+            for response in self.iter_search_pages(index, query, target=target, earliest=earliest, latest=latest, 
+                                                   fields=fields, sort=sort):
+                if response is None:
+                    return None
+
+                if json_result is None:
+                    json_result = response
+
+                hits.extend(response['hits']['hits'])
+
+            if json_result is not None:
+                json_result['hits']['hits'] = hits[:self.max_result_count]
+
+            return json_result
+
+        search_json = self.build_search(query, target=target, earliest=earliest, latest=latest, 
+                                        fields=fields, sort=sort)
+        search_uri = "{}{}/_search".format(self.elk_uri, self.format_index(index))
+        search_id = '{} query {}'.format(search_uri, query)
+        logging.debug("executing search {}".format(search_id))
+
+        json_result = self.elk_request('GET', search_uri, search_id, data=json.dumps(search_json))
+        if json_result is None:
+            return None
+
         logging.debug("search result {}: timed_out {} took {} shards {} clusters {}".format(
                       search_id,
                       json_result['timed_out'],
                       json_result['took'],
                       json_result['_shards'],
-                      json_result['_clusters']))
+                      json_result.get('_clusters')))
 
         return json_result
 
+    def iter_search_pages(self, index, query, target=None, earliest=None, latest=None, fields=[], sort=[], 
+                          limit=None):
+        """Executes the search using the scroll api and yields each page of results as it is downloaded.
+           Yields None if a request fails (and then stops.) Stops after limit results (defaults to max_result_count.)
+           Pass a limit of 0 to download everything."""
+        if limit is None:
+            limit = self.max_result_count
+
+        search_json = self.build_search(query, target=target, earliest=earliest, latest=latest, fields=fields, 
+                                        sort=sort, size=self.page_size if not limit else min(limit, self.page_size))
+        search_uri = "{}{}/_search".format(self.elk_uri, self.format_index(index))
+        search_id = '{} query {}'.format(search_uri, query)
+        logging.debug("executing scrolling search {}".format(search_id))
+
+        scroll_id = None
+        count = 0
+        try:
+            json_result = self.elk_request('POST', search_uri, search_id, params={'scroll': self.scroll_timeout}, 
+                                           data=json.dumps(search_json))
+
+            while True:
+                if json_result is None:
+                    yield None
+                    return
+
+                scroll_id = json_result.get('_scroll_id')
+                hits = json_result['hits']['hits']
+                if not hits:
+                    return
+
+                count += len(hits)
+                yield json_result
+
+                if limit and count >= limit:
+                    return
+
+                if scroll_id is None:
+                    return
+
+                json_result = self.elk_request('POST', '{}_search/scroll'.format(self.elk_uri), search_id, 
+                                               data=json.dumps({'scroll': self.scroll_timeout, 
+                                                                'scroll_id': scroll_id}))
+
+        finally:
+            # free up the resources on the server side
+            if scroll_id is not None:
+                try:
+                    self.http.delete('{}_search/scroll'.format(self.elk_uri), 
+                                     data=json.dumps({'scroll_id': [ scroll_id ]}))
+                except Exception as e:
+                    logging.debug("unable to clear scroll for {}: {}".format(search_id, e))
+
+    def iter_search(self, *args, **kwargs):
+        """Same as iter_search_pages but yields the individual hits. Raises an exception if a request fails."""
+        for json_result in self.iter_search_pages(*args, **kwargs):
+            if json_result is None:
+                raise RuntimeError("search failed")
+
+            yield from json_result['hits']['hits']
+
+    def msearch(self, searches):
+        """Executes multiple searches in a single request using the _msearch api.
+           searches is a list of (index, search_json) tuples (see build_search.)
+           Returns a list of the JSON responses (None for searches that failed), or None if the request failed."""
+        lines = []
+        for index, search_json in searches:
+            lines.append(json.dumps({'index': self.format_index(index)}))
+            lines.append(json.dumps(search_json))
+
+        search_uri = "{}_msearch".format(self.elk_uri)
+        search_id = '{} ({} searches)'.format(search_uri, len(searches))
+        logging.debug("executing multi search {}".format(search_id))
+
+        json_result = self.elk_request('POST', search_uri, search_id, data='\n'.join(lines) + '\n', 
+                                       headers={'Content-type':'application/x-ndjson'})
+        if json_result is None:
+            return None
+
+        result = []
+        for (index, search_json), response in zip(searches, json_result['responses']):
+            if 'error' in response:
+                logging.warning("search against {} failed: {}".format(index, response['error']))
+                result.append(None)
+            else:
+                result.append(response)
+
+        return result
+
+    def batch_search(self, observable, index, query, fields=[], sort=[]):
+        """Searches ELK for the given observable along with any other observables of the same type in the current
+           analysis that this module has not analyzed yet, using a single _msearch request. 
+           The query is formatted with the keyword {value} for each observable.
+           The search for each observable is relative to the time of the observable.
+           Returns the search results for the given observable, or None on failure."""
+
+        if observable.id in self.batch_results:
+            logging.debug(f"using batched elk results for {observable}")
+            return self.batch_results.pop(observable.id)
+
+        # is elk searching enabled?
+        if not saq.CONFIG['elk'].getboolean('enabled'):
+            logging.warning("analysis module {} enabled but elk is disabled globally".format(self.name))
+            return None
+
+        batch = self.get_batch(observable)
+        if len(batch) > 1:
+            logging.info(f"{self} searching for {len(batch)} {observable.type} observables in {self.root}")
+
+        searches = [ (index, self.build_search(query.format(value=target.value), target=self.batch_time(target),
+                                               fields=fields, sort=sort)) for target in batch ]
+        results = self.msearch(searches)
+        if results is None:
+            return None
+
+        for target, json_result in zip(batch, results):
+            if target is observable:
+                observable_result = json_result
+            elif json_result is not None:
+                self.batch_results[target.id] = json_result
+            else:
+                # let it search again by itself
+                self.batch_searched.discard(target.id)
+
+        return observable_result
+
 class ExternalProcessAnalysisModule(AnalysisModule):
     """An analysis module that executes an external process as part of it's analysis."""
     
@@ -151,7 +151,7 @@ class AdvancedLinkAnalyzer(AnalysisModule):
         if parsed_url.hostname and parsed_url.path:
             if is_ipv4(parsed_url.hostname) and SINGLE_FILE_REGEX.match(parsed_url.path):
                 # ignore a link to a URL in the local network (common for companies to do locally)
-                if not any([parsed_url.hostname in cidr for cidr in saq.MANAGED_NETWORKS]):
+                if parsed_url.hostname not in saq.MANAGED_NETWORKS:
                     # and then the file extension must end in something suspicious
                     if _susp_file(parsed_url.path):
                         analysis.details = True
@@ -1,6 +1,7 @@
 # vim: sw=4:ts=4:et
 
 import csv
+import ipaddress
 import logging
 import os.path
 import re
@@ -10,8 +11,7 @@ from saq.analysis import Analysis, Observable
 from saq.modules import AnalysisModule
 from saq.modules.asset import NetworkIdentifierAnalysis
 from saq.constants import *
-
-from iptools import IpRange
+from saq.intervals import open_interval_table, write_interval_table
 
 KEY_CIDR = 'cidr'
 KEY_ASN = 'asn'
@@ -44,7 +44,105 @@ class ASNAnalysis(Analysis):
                 self.cidr, self.asn, self.organization)
         return None
 
+def parse_asn_files(netmask_to_asn_file_path, netmask_to_asn_file_encoding, 
+                    asn_to_owner_file_path, asn_to_owner_file_encoding):
+    """Parses the BGP routing table and ASN ownership files.
+       Returns a tuple of (routes, owners) where routes is a list of (cidr, owner_id) tuples
+       and owners is a dict that maps owner_id to org name."""
+
+    routes = [] # list of (cidr, owner_id)
+    line_number = 0
+
+    logging.debug("loading internet BGP routing tables...")
+    with open(netmask_to_asn_file_path, 'r', encoding=netmask_to_asn_file_encoding) as cidr_fp:
+        while True:
+            try:
+                line = next(cidr_fp)
+                line_number += 1
+            except StopIteration:
+                break
+            except Exception as e:
+                logging.error("unable to load line {0} from {1}: {2}".format(line_number, netmask_to_asn_file_path, str(e)))
+                continue
+
+            line = line.strip()
+            m = re.match(r'^(\S+)\s+(\d+)$', line)
+            if m is None:
+                logging.error("error parsing line {0} in {1}".format(line, netmask_to_asn_file_path))
+                continue
+
+            (cidr, owner_id) = m.groups()
+            m = re.match(r'^([0-9]{1,3})\.([0-9]{1,3})\.([0-9]{1,3})\.([0-9]{1,3})/([0-9]{1,2})$', cidr)
+            if m is None:
+                logging.error("regex failed for cidr {0}".format(cidr))
+                continue
+
+            routes.append((cidr, owner_id))
+
+    logging.debug("loaded {0} ASN routes".format(len(routes)))
+    logging.debug("loading ASN ownership")
+
+    owners = {} # key = str(owner_id), value = org_name
+    line_number = 0
+    with open(asn_to_owner_file_path, 'r', encoding=asn_to_owner_file_encoding) as owner_fp:
+        while True:
+            try:
+                line = next(owner_fp)
+                line_number += 1
+            except StopIteration:
+                break
+            except Exception as e:
+                logging.error("unable to parse line {0} from {1}: {2}".format(line_number, asn_to_owner_file_path, str(e)))
+                continue
+
+            line = line.strip()
+            m = re.match(r'^\s*(\d+)\s+(.*)$', line)
+            if m is None:
+                logging.error("error parsing line {0} in {1}".format(line, asn_to_owner_file_path))
+                continue
+
+            (assigned_id, owner) = m.groups()
+            owners[assigned_id] = owner
+
+    logging.debug("loaded {0} ASN ownership indexes".format(len(owners)))
+    return routes, owners
+
+def write_asn_table(path, netmask_to_asn_file_path, netmask_to_asn_file_encoding, 
+                    asn_to_owner_file_path, asn_to_owner_file_encoding):
+    """Compiles the BGP routing table and ASN ownership files into an interval table.
+       Each route becomes an interval that points to a record of owner_id<TAB>org_name."""
+    routes, owners = parse_asn_files(netmask_to_asn_file_path, netmask_to_asn_file_encoding,
+                                     asn_to_owner_file_path, asn_to_owner_file_encoding)
+
+    records = [] # the ASN to owner table
+    record_index = {} # key = owner_id, value = index into records
+    intervals = []
+    for cidr, owner_id in routes:
+        # routes to unknown owners are ignored
+        if owner_id not in owners:
+            continue
+
+        try:
+            network = ipaddress.IPv4Network(cidr, strict=False)
+        except ValueError as e:
+            logging.error("invalid cidr {}: {}".format(cidr, e))
+            continue
+
+        if owner_id not in record_index:
+            record_index[owner_id] = len(records)
+            records.append('{}\t{}'.format(owner_id, owners[owner_id]).encode('utf8', errors='replace'))
+
+        intervals.append((int(network.network_address), int(network.broadcast_address), record_index[owner_id]))
+
+    # if the same network is listed more than once then the first one wins
+    intervals.reverse()
+    write_interval_table(path, intervals, records)
+
 class ASNAnalyzer(AnalysisModule):
+    """Looks up ASN routes for an IP address.
+
+       The BGP routing table is compiled into an interval table (see saq.intervals) that is memory mapped
+       read-only by every process that uses this module. The table is recompiled when the source files change."""
 
     def verify_environment(self):
         self.verify_config_exists('netmask_to_asn_file')
@@ -64,109 +162,71 @@ class ASNAnalyzer(AnalysisModule):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.asn_table = None
+
+        # load (compiling if needed) the table and watch the source files for changes
+        # we also watch the compiled table in case another process recompiles it
+        self.watch_file(self.netmask_to_asn_file_path, self.load_asn_table)
+        self.watch_file(self.asn_to_owner_file_path, self.load_asn_table)
+        self.watch_file(self.asn_table_path, self.load_asn_table)
+
+    @property
+    def netmask_to_asn_file_path(self):
+        return os.path.join(saq.SAQ_HOME, self.config['netmask_to_asn_file'])
+
+    @property
+    def asn_to_owner_file_path(self):
+        return os.path.join(saq.SAQ_HOME, self.config['asn_to_owner_file'])
+
+    @property
+    def asn_table_path(self):
+        return os.path.join(saq.SAQ_HOME, self.config.get('asn_table_file', fallback='etc/asn/asn.table'))
+
+    def build_asn_table(self, path):
+        write_asn_table(path, 
+                        self.netmask_to_asn_file_path, self.config['netmask_to_asn_file_encoding'],
+                        self.asn_to_owner_file_path, self.config['asn_to_owner_file_encoding'])
+
+    def load_asn_table(self):
+        self.asn_table = open_interval_table(self.asn_table_path, 
+                                             [ self.netmask_to_asn_file_path, self.asn_to_owner_file_path ], 
+                                             self.build_asn_table, current=self.asn_table)
+
+    def lookup(self, value):
+        """Returns a tuple of (cidr, owner_id, org_name) for the given ipv4 address, or None if it is not routed."""
+        result = self.asn_table.lookup(int(ipaddress.IPv4Address(value)))
+        if result is None:
+            return None
+
+        interval_start, interval_end, record = result
+        owner_id, owner = record.decode('utf8').split('\t', 1)
+        cidr = next(ipaddress.summarize_address_range(ipaddress.IPv4Address(interval_start), 
+                                                      ipaddress.IPv4Address(interval_end)))
+        return str(cidr), owner_id, owner
 
-        # how we map these things
-        # a.b.c.d 
-        # self.internet[a] = [ list of cidrs that start with a ]
-        # self.internet[a.b] = [ list of cidrs that start with a.b ]
-        # self.internet [a.b.c] = [ list of cidrs that start with a.b.c ]
-        # 
-        # to search, start with a.b.c, then a.b, then a
-
-        # map of the internet
-        self.internet = {} # huge dict
-        netmask_to_asn_file_path = os.path.join(saq.SAQ_HOME, saq.CONFIG.get(self.config_section, 'netmask_to_asn_file'))
-        netmask_to_asn_file_encoding = saq.CONFIG.get(self.config_section, 'netmask_to_asn_file_encoding')
-        line_number = 0
-
-        # TODO need to find a way to only do this once
-        logging.debug("loading internet BGP routing tables...")
-        with open(netmask_to_asn_file_path, 'r', encoding=netmask_to_asn_file_encoding) as cidr_fp:
-            while True:
-                try:
-                    line = next(cidr_fp)
-                    line_number += 1
-                except StopIteration:
-                    break
-                except Exception as e:
-                    logging.error("unable to load line {0} from {1}: {2}".format(line_number, netmask_to_asn_file_path, str(e)))
-                    continue
-
-                line = line.strip()
-                m = re.match(r'^(\S+)\s+(\d+)$', line)
-                if m is None:
-                    logging.error("error parsing line {0} in {1}".format(line, netmask_to_asn_file_path))
-                    continue
-
-                (cidr, owner_id) = m.groups()
-                m = re.match(r'^([0-9]{1,3})\.([0-9]{1,3})\.([0-9]{1,3})\.([0-9]{1,3})/([0-9]{1,2})$', cidr)
-                if m is None:
-                    logging.error("regex failed for cidr {0}".format(cidr))
-                    continue
-
-                (a, b, c, d, net) = m.groups()
-                for key in [ '{0}'.format(a), '{0}.{1}'.format(a, b), '{0}.{1}.{2}'.format(a, b, c) ]:
-                    if key not in self.internet:
-                        self.internet[key] = []
-                    self.internet[key].append((cidr, owner_id))
-
-        logging.debug("loaded {0} ASN lookup indexes".format(len(self.internet)))
-        logging.debug("loading ASN ownership")
-        asn_to_owner_file_path = os.path.join(saq.SAQ_HOME, saq.CONFIG.get(self.config_section, 'asn_to_owner_file'))
-        asn_to_owner_file_encoding = saq.CONFIG.get(self.config_section, 'asn_to_owner_file_encoding')
-
-        # also cache the owners
-        self.owners = {} # key = str(owner_id), value = org_name
-        line_number = 0
-        with open(asn_to_owner_file_path, 'r', encoding=asn_to_owner_file_encoding) as owner_fp:
-            while True:
-                try:
-                    line = next(owner_fp)
-                    line_number += 1
-                except StopIteration:
-                    break
-                except Exception as e:
-                    logging.error("unable to parse line {0} data {1} from {2}: {3}".format(line_number, line, saq.CONFIG.get(self.config_section, 'asn_to_owner_file'), str(e)))
-                    continue
-            #for line in owner_fp:
-                line = line.strip()
-                m = re.match('^\s*(\d+)\s+(.*)$', line)
-                if m is None:
-                    logging.error("error parsing line {0} in {1}".format(line, saq.CONFIG.get(self.config_section, 'asn_to_owner_file')))
-                    continue
-
-                (assigned_id, owner) = m.groups()
-                self.owners[assigned_id] = owner
-
-        logging.debug("loaded {0} ASN ownership indexes".format(len(self.owners)))
-
-    """Looks up ASN routes for an IP address."""
     def execute_analysis(self, ipv4):
 
         analysis = ASNAnalysis()
         ipv4.add_analysis(analysis)
         analysis.details = None
 
-        logging.debug("scanning ASN routes for {0}".format(ipv4.value))
-        
-        m = re.match(r'^([0-9]{1,3})\.([0-9]{1,3})\.([0-9]{1,3})\.([0-9]{1,3})$', ipv4.value)
-        if m is None:
-            logging.error("regex failed for ipvr {0}".format(ipv4.value))
+        if self.asn_table is None:
+            logging.warning("ASN table is not available")
             return
 
-        (a, b, c, d) = m.groups()
-
         logging.debug("performing ASN lookup for {0}".format(ipv4.value))
-        for key in [ '{0}.{1}.{2}'.format(a, b, c), '{0}.{1}'.format(a, b), '{0}'.format(a) ]:
-            try:
-                for (cidr, owner_id) in self.internet[key]:
-                    cidr_object = IpRange(cidr)
-                    if ipv4.value in cidr_object:
-                        logging.debug("found ASN {0} for ipv4 {1} in network {2}".format(owner_id, ipv4.value, cidr))
-                        analysis.details = {
-                            KEY_CIDR: cidr,
-                            KEY_ASN: owner_id,
-                            KEY_ORGANIZATION: self.owners[owner_id]  }
-                        return
-            except KeyError:
-                pass
+        try:
+            result = self.lookup(ipv4.value)
+        except ValueError:
+            logging.error("invalid ipv4 {0}".format(ipv4.value))
+            return
+
+        if result is None:
+            return
+
+        cidr, owner_id, owner = result
+        logging.debug("found ASN {0} for ipv4 {1} in network {2}".format(owner_id, ipv4.value, cidr))
+        analysis.details = {
+            KEY_CIDR: cidr,
+            KEY_ASN: owner_id,
+            KEY_ORGANIZATION: owner }
@@ -14,8 +14,7 @@ import saq
 from saq.analysis import Analysis, Observable
 from saq.modules import AnalysisModule, LDAPAnalysisModule, CarbonBlackAnalysisModule
 from saq.constants import *
-
-import iptools
+from saq.radix import NetworkTree
 
 ANALYSIS_DNS_RESOLVED = 'resolved'
 ANALYSIS_DNS_FQDN = 'fqdn'
@@ -49,11 +48,6 @@ def is_fqdn(value):
 
     return False
 
-class _NetworkDefinition(object):
-    def __init__(self, cidr, name):
-        self.cidr = cidr
-        self.name = name
-
 class NetworkIdentifierAnalysis(Analysis):
     """Is this a managed IP address?  What is the general network location?"""
 
@@ -95,7 +89,7 @@ class NetworkIdentifier(AnalysisModule):
     
     def __init__(self, *args, **kwargs):
         super(NetworkIdentifier, self).__init__(*args, **kwargs)
-        self._networks = [] # list of _NetworkDefinition
+        self._networks = NetworkTree()
         
         # load the network definitions from the CSV file
         with open(os.path.join(saq.SAQ_HOME, saq.CONFIG.get(self.config_section, 'csv_file')), 'r') as fp:
@@ -106,7 +100,10 @@ class NetworkIdentifier(AnalysisModule):
             assert header[1] == 'Indicator_Type'
             for row in reader:
                 #logging.debug("loading {0} = {1}".format(row[0], row[1]))
-                self._networks.append(_NetworkDefinition(iptools.IpRange(row[0]), row[1]))
+                try:
+                    self._networks.add(row[0], row[1])
+                except ValueError as e:
+                    logging.error("invalid network definition {}: {}".format(row[0], e))
 
         logging.debug("loaded {0} network definitions".format(len(self._networks)))
 
@@ -115,15 +112,11 @@ class NetworkIdentifier(AnalysisModule):
         # results contain a list of the names of the networks this IP address is in
         analysis = self.create_analysis(observable)
 
-        for network in self._networks:
-            try:
-                if observable.value in network.cidr:
-                    analysis.details.append(network.name)
-            except Exception as e:
-                logging.error("invalid ipv4 {}: {}".format(observable.value, str(e)))
-                continue
+        try:
+            analysis.details = [ network.name for network in self._networks.matches(observable.value) ]
+        except ValueError as e:
+            logging.error("invalid ipv4 {}: {}".format(observable.value, str(e)))
 
-        #analysis.details = [x.name for x in self._networks if observable.value in x.cidr]
         observable.add_analysis(analysis)
 
         # if this ipv4 has at least one identified network then we can assume it's an asset
@@ -6,6 +6,7 @@ import logging
 import os.path
 import shutil
 import tempfile
+import threading
 import time
 
 from subprocess import Popen, PIPE
@@ -16,7 +17,7 @@ import saq
 from saq.analysis import Analysis, RootAnalysis, _JSONEncoder
 from saq.cloudphish import *
 from saq.constants import *
-from saq.database import use_db, execute_with_retry
+from saq.database import use_db, execute_with_retry, resume_delayed_analysis_request
 from saq.error import report_exception
 from saq.modules import AnalysisModule
 
@@ -213,10 +214,75 @@ class CloudphishAnalysis(Analysis):
 
         return message
 
+class CloudphishResultWaiter(object):
+    """Waits for cloudphish results on background threads and resumes the delayed analysis waiting on them
+       as soon as they are ready. A single wait request is made per url no matter how many analyses are waiting."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # key = sha256 of the url, value = set of (uuid, observable_uuid, analysis_module) waiting on it
+        self.waiting = {}
+
+    def wait(self, sha256_url, wait_function, delayed_analysis, retry_delay):
+        """Calls wait_function() on a thread (unless something is already waiting on this url) and then resumes the
+           given delayed analysis (a tuple of uuid, observable_uuid, analysis_module) if the analysis completed.
+           If the wait request fails the delayed analysis is rescheduled retry_delay seconds from now."""
+        with self.lock:
+            if sha256_url in self.waiting:
+                self.waiting[sha256_url].add(delayed_analysis)
+                return
+
+            self.waiting[sha256_url] = { delayed_analysis }
+
+        threading.Thread(target=self._wait, args=(sha256_url, wait_function, retry_delay), 
+                         name="Cloudphish Waiter {}".format(sha256_url[:8]), daemon=True).start()
+
+    def _wait(self, sha256_url, wait_function, retry_delay):
+        response = None
+        try:
+            response = wait_function()
+        except Exception as e:
+            logging.warning("cloudphish wait request for {} failed: {}".format(sha256_url, e))
+
+        with self.lock:
+            waiting = self.waiting.pop(sha256_url, set())
+
+        # if the wait request failed then we go back to polling
+        if response is None:
+            delay = retry_delay
+        # if the result is not ready yet then the delayed analysis picks it up when it comes due
+        elif response.get(KEY_STATUS) not in [ STATUS_ANALYZED, None ]:
+            return
+        else:
+            delay = 0
+
+        for uuid, observable_uuid, analysis_module in waiting:
+            try:
+                resume_delayed_analysis_request(uuid, observable_uuid, analysis_module, seconds=delay)
+            except Exception as e:
+                logging.error("unable to resume delayed analysis for {}: {}".format(uuid, e))
+                report_exception()
+
+# the waiter is created once per process
+_result_waiter = None
+_result_waiter_pid = None
+
+def get_result_waiter():
+    """Returns the CloudphishResultWaiter for this process."""
+    global _result_waiter, _result_waiter_pid
+    if _result_waiter_pid != os.getpid():
+        _result_waiter = CloudphishResultWaiter()
+        _result_waiter_pid = os.getpid()
+
+    return _result_waiter
+
 class CloudphishAnalyzer(AnalysisModule):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.next_pool_index = 0
+        # shares in-flight requests with the other processes on this node (see coalescer)
+        self._coalescer = None
+        self._coalescer_pid = None
 
     @property
     def generated_analysis_type(self):
@@ -246,6 +312,31 @@ class CloudphishAnalyzer(AnalysisModule):
     def cloudphish_request_limit(self):
         return self.config.getint('cloudphish_request_limit')
 
+    @property
+    def wait_for_result(self):
+        return self.config.getboolean('wait_for_result', fallback=False)
+
+    @property
+    def wait_timeout(self):
+        return self.config.getint('wait_timeout', fallback=60)
+
+    @property
+    def coalesce_requests(self):
+        return self.config.getboolean('coalesce_requests', fallback=False)
+
+    @property
+    def coalescer(self):
+        """Returns the CloudphishRequestCoalescer for this process."""
+        if self._coalescer_pid != os.getpid():
+            self._coalescer = CloudphishRequestCoalescer(
+                os.path.join(saq.DATA_DIR, self.config.get('coalesce_dir', fallback='var/cloudphish/requests')),
+                pending_ttl=self.frequency,
+                analyzed_ttl=self.config.getint('coalesce_result_ttl', fallback=60),
+                lock_timeout=self.timeout)
+            self._coalescer_pid = os.getpid()
+
+        return self._coalescer
+
     def verify_environment(self):
         self.verify_config_exists('timeout')
         self.verify_config_exists('use_proxy')
@@ -356,13 +447,21 @@ class CloudphishAnalyzer(AnalysisModule):
                                              else o.time.strftime(event_time_format_json_tz)})
 
             context['t'] = json.dumps(tracking, cls=_JSONEncoder)
-            response = ace_api.cloudphish_submit(url.value, 
+
+            def _submit():
+                return ace_api.cloudphish_submit(url.value, 
                                                  context=context, 
                                                  remote_host=cloudphish_server,
                                                  ssl_verification=saq.CA_CHAIN_PATH,
                                                  proxies=saq.PROXIES if self.use_proxy else None,
                                                  timeout=self.timeout)
 
+            # the cloudphish servers share the same database so any response for this url will do
+            if self.coalesce_requests:
+                response = self.coalescer.submit(url.value, _submit)
+            else:
+                response = _submit()
+
             logging.debug("got result {} for cloudphish query @ {} for {}".format(response, cloudphish_server, url.value))
 
         except Exception as e:
@@ -382,12 +481,27 @@ class CloudphishAnalyzer(AnalysisModule):
                 logging.info("waiting for cloudphish analysis of {} ({})".format(
                              url.value, response[KEY_STATUS]))
 
-                if not self.delay_analysis(url, analysis, seconds=self.frequency, timeout_seconds=self.query_timeout):
+                # when we wait for the result the delayed analysis is resumed as soon as the result is ready
+                # (or frequency seconds from now if the wait request fails)
+                delay = self.wait_timeout + self.frequency if self.wait_for_result else self.frequency
+                if not self.delay_analysis(url, analysis, seconds=delay, timeout_seconds=self.query_timeout):
                     # analysis timed out
                     analysis.result = RESULT_ERROR
                     analysis.result_details = 'QUERY TIMED OUT'
                     return True
 
+                if self.wait_for_result:
+                    def _wait():
+                        return ace_api.cloudphish_wait(sha256=sha256_url,
+                                                       wait_timeout=self.wait_timeout,
+                                                       remote_host=cloudphish_server,
+                                                       ssl_verification=saq.CA_CHAIN_PATH,
+                                                       proxies=saq.PROXIES if self.use_proxy else None,
+                                                       timeout=self.timeout)
+
+                    get_result_waiter().wait(sha256_url, _wait, (self.root.uuid, url.id, self.config_section),
+                                             self.frequency)
+
         # sha256 E3B0C44298FC1C149AFBF4C8996FB92427AE41E4649B934CA495991B7852B855 is the hash for the empty string
         # we ignore this case
         if response[KEY_SHA256_CONTENT] and response[KEY_SHA256_CONTENT].upper() == \
@@ -6,7 +6,7 @@ import logging
 import re
 import tarfile
 
-from hashlib import md5
+from hashlib import md5, sha256
 from multiprocessing import Value
 from os import mkdir, listdir, remove, rename
 from os.path import exists, isfile, join, basename, relpath, isdir
@@ -16,7 +16,7 @@ import saq
 from saq.analysis import Analysis
 from saq.constants import *
 from saq.error import report_exception
-from saq.modules.sandbox import SandboxAnalysisModule
+from saq.modules.sandbox import *
 
 import requests
 
@@ -28,6 +28,7 @@ class CuckooAnalysis(Analysis):
         self.details = {
             'complete': False,
             'md5': md5(open(path, 'rb').read()).hexdigest(),
+            'sha256': sha256(open(path, 'rb').read()).hexdigest(),
             'tasks': {},
             'malscore': 0,
             'start_date': datetime.datetime.now(),
@@ -87,6 +88,15 @@ class CuckooAnalysis(Analysis):
     def md5(self, value):
         self.details['md5'] = value
 
+    @property
+    def sha256(self):
+        # not available for analysis created before the sandbox job registry existed
+        return self.details.get('sha256')
+
+    @sha256.setter
+    def sha256(self, value):
+        self.details['sha256'] = value
+
     def generate_summary(self):
         return "Cuckoo Analysis ({}/10.0)".format(self.malscore)
 
@@ -119,6 +129,21 @@ class CuckooAnalyzer(SandboxAnalysisModule):
 
         return 'http'
 
+    @property
+    def sandbox_name(self):
+        return 'cuckoo'
+
+    def get_tags(self, path):
+        """Returns the list of cuckoo tags (machine configurations) the given file is submitted with."""
+        parts = basename(path).split('.')
+        ext = "default"
+        if len(parts) > 1:
+            ext = parts[-1]
+        if ext in self.config:
+            return self.config[ext].split(',')
+
+        return self.config["default"].split(',')
+
     def execute_analysis(self, sample):
         # we want to sandbox the root file which this file originated from
         while sample.redirection:
@@ -157,8 +182,25 @@ class CuckooAnalyzer(SandboxAnalysisModule):
             analysis.complete = True
             return
 
+        # the profile of the sandbox job is the set of tags the sample is submitted with
+        profile = ','.join(self.get_tags(path))
+
+        # has another analysis already submitted this sample?
+        claimed = False
+        if analysis.server is None and analysis.sha256 is not None:
+            claimed, job = self.claim_submission(analysis.sha256, profile)
+            if not claimed:
+                if job is None or job.status == SANDBOX_JOB_STATUS_SUBMITTING:
+                    logging.debug("waiting for the submission of {} by another analysis".format(sample.value))
+                    self.wait_for_sandbox_job(sample, analysis, analysis.sha256, profile, seconds=self.frequency)
+                    return
+
+                logging.info("using existing {} for {}".format(job, sample.value))
+                analysis.server = job.details['server']
+
+        # once a server has been selected that is the only one we need to check
         tasks = []
-        for server in self.servers:
+        for server in self.servers if analysis.server is None else [ analysis.server ]:
             try:
                 # get existing tasks
                 tasks = self.get_tasks(server, analysis)
@@ -173,6 +215,8 @@ class CuckooAnalyzer(SandboxAnalysisModule):
                 logging.error("unable to query for existing tasks: {}".format(e))
                 report_exception()
                 analysis.fail(str(e))
+                if claimed:
+                    self.record_submission(analysis.sha256, profile, SANDBOX_JOB_STATUS_FAILED)
                 return
 
         # if no server had existing tasks then pick one to submit to
@@ -187,17 +231,28 @@ class CuckooAnalyzer(SandboxAnalysisModule):
         # submit the sample if there are no existing tasks
         if len(tasks) == 0:
             try:
-                self.submit_sample(server, path)
+                self.submit_sample(analysis.server, path)
             except Exception as e:
-                logging.error("unable to submit {} to {}: {}".format(path, server, e))
+                logging.error("unable to submit {} to {}: {}".format(path, analysis.server, e))
                 report_exception()
                 analysis.fail(str(e))
+                if analysis.sha256 is not None:
+                    self.record_submission(analysis.sha256, profile, SANDBOX_JOB_STATUS_FAILED)
                 return
 
-            self.delay_analysis(sample, analysis, seconds=self.frequency)
+            claimed = analysis.sha256 is not None
+
+        # let the other analysis of this sample know where to find it
+        if claimed:
+            self.record_submission(analysis.sha256, profile, SANDBOX_JOB_STATUS_PENDING, job_id=analysis.md5,
+                                   details={ 'server': analysis.server, 'md5': analysis.md5 })
+
+        if len(tasks) == 0:
+            self.wait_for_sandbox_job(sample, analysis, analysis.sha256, profile, seconds=self.frequency)
             return
 
         # fetch report for all completed tasks
+        server = analysis.server
         analysis.complete = True
         for task in tasks:
             # ignore if we have already processed this task
@@ -226,16 +281,31 @@ class CuckooAnalyzer(SandboxAnalysisModule):
 
         # if we have not received a report for every task then check back later
         if not analysis.complete:
-            self.delay_analysis(sample, analysis, seconds=self.frequency)
+            self.wait_for_sandbox_job(sample, analysis, analysis.sha256, profile, seconds=self.frequency)
+        elif analysis.sha256 is not None:
+            self.record_submission(analysis.sha256, profile, SANDBOX_JOB_STATUS_COMPLETE)
 
         # mark samples as malicious that exceed the threshold defined in the configuration file
         if analysis.malscore >= self.threat_score_threshold:
             sample.add_tag('malicious')
 
+    def get_sandbox_job_status(self, job):
+        tasks = self.get_tasks_by_md5(job.details['server'], job.details['md5'])
+        if len(tasks) == 0 or any([ task['status'] not in [ 'reported', 'failed_analysis' ] for task in tasks ]):
+            return SANDBOX_JOB_STATUS_PENDING
+
+        if all([ task['status'] == 'failed_analysis' for task in tasks ]):
+            return SANDBOX_JOB_STATUS_FAILED
+
+        return SANDBOX_JOB_STATUS_COMPLETE
+
     # gets list of tasks linked to this sample
     def get_tasks(self, server, analysis):
+        return self.get_tasks_by_md5(server, analysis.md5)
+
+    def get_tasks_by_md5(self, server, md5_hash):
         logging.debug("looking for existing tasks")
-        r = requests.get("{}://{}/api/tasks/search/md5/{}".format(self.protocol, server, analysis.md5), 
+        r = requests.get("{}://{}/api/tasks/search/md5/{}".format(self.protocol, server, md5_hash), 
                          proxies=self.proxies, verify=False) # XXX
         if r.status_code != 200:
             raise Exception("failed to get tasks: status code {}".format(r.status_code))
@@ -250,17 +320,7 @@ class CuckooAnalyzer(SandboxAnalysisModule):
 
     # submits sample to cuckoo for processing
     def submit_sample(self, server, path):
-        parts = basename(path).split('.')
-        ext = "default"
-        if len(parts) > 1:
-            ext = parts[-1]
-        tags = []
-        if ext in self.config:
-            tags = self.config[ext].split(',')
-        else:
-            tags = self.config["default"].split(',')
-
-        for tag in tags:
+        for tag in self.get_tags(path):
             with open(path, 'rb') as fp:
                 sample = { "file" : (basename(path), fp) }
                 url = "{}://{}/api/tasks/create/file/".format(self.protocol, server)
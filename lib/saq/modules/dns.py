@@ -3,7 +3,6 @@
 import csv
 import logging
 import os.path
-import socket
 
 from urllib.parse import urlparse
 
@@ -12,6 +11,7 @@ import saq
 from saq.analysis import Analysis, Observable
 from saq.constants import *
 from saq.modules import AnalysisModule, SplunkAnalysisModule, splunktime_to_saqtime
+from saq.resolver import DNSResolver, normalize_name
 
 KEY_SOURCE_COUNT = 'src_count'
 KEY_REQUEST_BREAKDOWN = 'request_breakdown'
@@ -41,6 +41,15 @@ class FQDNAnalyzer(AnalysisModule):
     """What IP address does this FQDN resolve to?"""
     # Add anything else you want to this FQDN Analyzer.
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._resolver = None
+        # the maximum number of fqdns resolved at once
+        self.batch_size = self.config.getint('batch_size', fallback=64)
+        # the resolutions of the fqdns of the root currently being analyzed
+        self.resolutions = {}
+        self.resolutions_uuid = None
+
     @property
     def generated_analysis_type(self):
         return FQDNAnalysis
@@ -49,24 +58,64 @@ class FQDNAnalyzer(AnalysisModule):
     def valid_observable_types(self):
         return F_FQDN
 
+    @property
+    def resolver(self):
+        if self._resolver is None:
+            nameservers = [ _.strip() for _ in self.config.get('nameservers', fallback='').split(',') if _.strip() ]
+            self._resolver = DNSResolver(nameservers=nameservers,
+                                         port=self.config.getint('port', fallback=53),
+                                         timeout=self.config.getfloat('timeout', fallback=2.0),
+                                         lifetime=self.config.getfloat('lifetime', fallback=5.0),
+                                         concurrency=self.config.getint('concurrency', fallback=16),
+                                         use_cache=self.config.getboolean('use_cache', fallback=True),
+                                         max_ttl=self.config.getint('max_ttl', fallback=3600),
+                                         negative_ttl=self.config.getint('negative_ttl', fallback=300))
+
+        return self._resolver
+
+    def resolve(self, fqdn):
+        """Returns the (aliaslist, ipaddrlist) of the given fqdn, or None if it could not be resolved.
+           The fqdn is resolved at the same time as up to batch_size - 1 other fqdns in the root that have not been
+           resolved yet. The rest are resolved by later calls."""
+        if self.resolutions_uuid != self.root.uuid:
+            self.resolutions = {}
+            self.resolutions_uuid = self.root.uuid
+
+        fqdn = normalize_name(fqdn)
+        if fqdn not in self.resolutions:
+            names = [ fqdn ]
+            names.extend([ normalize_name(_.value) for _ in self.root.get_observables_by_type(F_FQDN) ])
+            names = [ _ for _ in dict.fromkeys(names) if _ not in self.resolutions ][:max(1, self.batch_size)]
+            self.resolutions.update(self.resolver.resolve(names))
+            # names that could not be resolved are not tried again for this root
+            for name in names:
+                self.resolutions.setdefault(name, None)
+
+        return self.resolutions[fqdn]
+
     def execute_analysis(self, observable):
         try:
-            _hostname, _aliaslist, ipaddrlist = socket.gethostbyname_ex(observable.value)
-            if ipaddrlist:
-                # ipaddrlist should always be a list of strings
-                analysis = self.create_analysis(observable)
-                analysis.details['resolution_count'] = len(ipaddrlist)
-                analysis.details['all_resolutions'] = ipaddrlist
-                analysis.details['aliaslist'] = _aliaslist
-                # for now, just add the first ip address
-                analysis.details['ip_address'] = ipaddrlist[0]
-                analysis.add_observable(F_IPV4, ipaddrlist[0])
-                return True
-            return False
+            resolution = self.resolve(observable.value)
         except Exception as e:
             logging.error(f"Problem resolving FQDN: {e}")
             return False
 
+        if resolution is None:
+            return False
+
+        _aliaslist, ipaddrlist = resolution
+        if ipaddrlist:
+            # ipaddrlist should always be a list of strings
+            analysis = self.create_analysis(observable)
+            analysis.details['resolution_count'] = len(ipaddrlist)
+            analysis.details['all_resolutions'] = ipaddrlist
+            analysis.details['aliaslist'] = _aliaslist
+            # for now, just add the first ip address
+            analysis.details['ip_address'] = ipaddrlist[0]
+            analysis.add_observable(F_IPV4, ipaddrlist[0])
+            return True
+        return False
+
 #
 # Module:   DNS Request Analysis
 # Question: Who requested DNS resolution for this FQDN?
@@ -20,7 +20,9 @@ import uuid
 import saq
 
 from saq.analysis import Analysis, Observable, recurse_tree, search_down
-from saq.brocess import query_brocess_by_email_conversation, query_brocess_by_source_email
+from saq.brocess import query_brocess_by_email_conversation, query_brocess_by_source_email, \
+                        query_brocess_by_email_conversations, query_brocess_by_source_emails, get_brocess_cache, \
+                        invalidate_smtplog
 from saq.constants import *
 from saq.crypto import encrypt, decrypt
 from saq.database import get_db_connection, execute_with_retry, Alert, use_db
@@ -2122,6 +2124,11 @@ class EmailConversationFrequencyAnalysis(Analysis):
             self.details['dest_count'])
 
 class EmailConversationFrequencyAnalyzer(AnalysisModule):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the uuid of the last root analysis the brocess counts were prefetched for
+        self.prefetched_root_uuid = None
+
     def verify_environment(self):
         self.verify_config_exists('cooldown_period')
         self.verify_config_exists('conversation_count_threshold')
@@ -2149,6 +2156,7 @@ class EmailConversationFrequencyAnalyzer(AnalysisModule):
             return False
 
         mail_from, rcpt_to = parse_email_conversation(email_conversation.value)
+        self.prefetch_brocess_counts()
 
         # how often do we see this email address sending us emails?
         source_count = 0
@@ -2189,6 +2197,28 @@ class EmailConversationFrequencyAnalyzer(AnalysisModule):
 
         return True
 
+    def prefetch_brocess_counts(self):
+        """Looks up the brocess counts of all the email conversations in the root analysis that have not been
+           analyzed yet with bulk queries so that the analysis of each one is answered from the brocess cache."""
+        if self.prefetched_root_uuid == self.root.uuid or get_brocess_cache() is None:
+            return
+
+        self.prefetched_root_uuid = self.root.uuid
+        conversations = [ parse_email_conversation(_.value)
+                          for _ in self.root.get_observables_by_type(F_EMAIL_CONVERSATION)
+                          if _.get_analysis(EmailConversationFrequencyAnalysis) is None ]
+
+        if len(conversations) < 2:
+            return
+
+        try:
+            source_counts = query_brocess_by_source_emails([ mail_from for mail_from, rcpt_to in conversations ])
+            # conversations are only checked for senders we've seen before
+            query_brocess_by_email_conversations([ _ for _ in conversations if source_counts[_[0]] ])
+        except Exception as e:
+            # each conversation is queried (and errors are handled) when it is analyzed
+            logging.warning("unable to prefetch brocess counts: {}".format(e))
+
 class EmailConversationAttachmentAnalysis(Analysis):
     """Has someone who has never sent us an email before sent us an attachment used in attacks?"""
     def initialize_details(self):
@@ -2350,17 +2380,21 @@ class EmailHistoryAnalyzer_v1(SplunkAnalysisModule):
     def valid_observable_types(self):
         return F_EMAIL_ADDRESS
 
+    def batch_value(self, email_address):
+        return '*{}*'.format(email_address.value)
+
     def execute_analysis(self, email_address):
 
-        self.splunk_query('index=bro sourcetype=bro_smtp {0} | search rcptto = "*{0}*" | sort _time | fields *'.format(email_address.value), 
-            self.root.event_time_datetime if email_address.time_datetime is None else email_address.time_datetime)
+        # the rcptto field can contain more than one address
+        emails = self.splunk_batch_query(email_address, 
+            'index=bro sourcetype=bro_smtp ( {values} ) | search {filter} | sort _time | fields *', 'rcptto')
 
-        if self.search_results is None:
+        if emails is None:
             logging.debug("missing search results after splunk query")
             return False
 
         analysis = self.create_analysis(email_address)
-        analysis.emails = self.json()
+        analysis.emails = emails
 
 class EmailHistoryRecord(object):
     """Utility class to add extra fields not present in the splunk logs."""
@@ -2712,6 +2746,7 @@ class EmailLoggingAnalyzer(AnalysisModule):
         logging.debug("updating brocess for {}".format(mail_from))
 
         try:
+            destinations = []
             for email_address in entry['env_rcpt_to']:
                 email_address = normalize_email_address(email_address)
                 if not email_address:
@@ -2722,8 +2757,11 @@ class EmailLoggingAnalyzer(AnalysisModule):
                          ON DUPLICATE KEY UPDATE numconnections = numconnections + 1"""
                 params = (mail_from, email_address)
                 execute_with_retry(db, c, sql, params)
+                destinations.append(email_address)
 
             db.commit()
+            # the counts just changed
+            invalidate_smtplog(mail_from, destinations)
 
         except Exception as e:
             logging.error("unable to update brocess: {}".format(e))
@@ -2864,6 +2902,7 @@ class EmailLoggingAnalyzer(AnalysisModule):
             try:
                 with get_db_connection('brocess') as db:
                     c = db.cursor()
+                    destinations = []
                     for email_address in entry['env_rcpt_to']:
                         email_address = normalize_email_address(email_address)
                         if not email_address:
@@ -2874,8 +2913,11 @@ class EmailLoggingAnalyzer(AnalysisModule):
                                  ON DUPLICATE KEY UPDATE numconnections = numconnections + 1"""
                         params = (mail_from, email_address)
                         execute_with_retry(c, sql, params)
+                        destinations.append(email_address)
 
                     db.commit()
+                    # the counts just changed
+                    invalidate_smtplog(mail_from, destinations)
 
             except Exception as e:
                 logging.error("unable to update brocess: {}".format(e))
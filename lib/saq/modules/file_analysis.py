@@ -22,12 +22,10 @@ import time
 import zipfile
 
 from lxml import etree
-from urllib.parse import urlparse, urljoin
+from urllib.parse import urlparse, urljoin, urlsplit
 
 #from subprocess import Popen, PIPE, DEVNULL, TimeoutExpired
 
-from tld import get_tld
-from urlfinderlib import find_urls
 
 import saq
 import yara_scanner
@@ -35,9 +33,18 @@ import yara_scanner
 from saq.analysis import Analysis, Observable, RootAnalysis
 from saq.constants import *
 from saq.error import report_exception
+from saq.extraction import ExtractionLimits, TooManyFiles, get_archive_depth, open_archive
+from saq.file_type import get_file_type
+from saq.helper_pool import run_python_script
+from saq.fuzzy import get_libfuzzy, open_ssdeep_index
+from saq.hashing import cache_file_hashes, get_file_hashes, HASH_SHA256, HASH_SSDEEP
 from saq.modules import AnalysisModule
+from saq.observables import create_observable
 from saq.process_server import Popen, PIPE, DEVNULL, TimeoutExpired
-from saq.util import is_url, URL_REGEX_B, URL_REGEX_STR, is_subdomain, abs_path
+from saq.url_extraction import find_urls_in_file, get_registered_domain
+from saq.util import is_url, URL_REGEX_B, URL_REGEX_STR, is_subdomain, abs_path, DomainTrie
+from saq.yara_batch import YaraResultCache, scan_files
+from saq.yara_rules import CompiledRules, get_rules_version
 
 from bs4 import BeautifulSoup
 from iptools import IpRangeList
@@ -365,7 +372,9 @@ class SsdeepAnalyzer(AnalysisModule):
         self.verify_path_exists(self.config['ssdeep_hashes'])
         self.verify_config_exists('maximum_size')
         self.verify_config_exists('ssdeep_match_threshold')
-        self.verify_program_exists('ssdeep')
+        # the ssdeep program is only used to hash files when libfuzzy is not available
+        if get_libfuzzy() is None:
+            self.verify_program_exists('ssdeep')
 
     @property
     def ssdeep_hashes(self):
@@ -379,6 +388,21 @@ class SsdeepAnalyzer(AnalysisModule):
     def ssdeep_match_threshold(self):
         return self.config.getint('ssdeep_match_threshold')
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the known hashes are compiled into an index (see saq.fuzzy) that is recompiled when the hashes change
+        # we also watch the index in case another process recompiles it
+        self.ssdeep_index = None
+        self.watch_file(self.ssdeep_hashes, self.load_ssdeep_index)
+        self.watch_file(self.ssdeep_index_path, self.load_ssdeep_index)
+
+    @property
+    def ssdeep_index_path(self):
+        return self.config.get('ssdeep_index', fallback='{}.index'.format(self.ssdeep_hashes))
+
+    def load_ssdeep_index(self):
+        self.ssdeep_index = open_ssdeep_index(self.ssdeep_index_path, self.ssdeep_hashes, current=self.ssdeep_index)
+
     @property
     def generated_analysis_type(self):
         return SsdeepAnalysis
@@ -406,43 +430,31 @@ class SsdeepAnalyzer(AnalysisModule):
             logging.debug("{} too large ({}) for ssdeep analysis".format(local_file_path, file_size))
             return False
 
+        if self.ssdeep_index is None:
+            logging.warning("ssdeep index is not available")
+            return False
+
         logging.debug("analyzing file {}".format(local_file_path))
-        p = Popen(['ssdeep', '-m', self.ssdeep_hashes, local_file_path], 
-            stdout=PIPE, stderr=PIPE, universal_newlines=True)
-        (stdout, stderr) = p.communicate()
+        try:
+            # the ssdeep hash is computed along with the other hashes (and cached with them)
+            ssdeep_hash = get_file_hashes(local_file_path, ssdeep=True)[HASH_SSDEEP]
+        except OSError as e:
+            logging.debug("unable to read {}: {}".format(local_file_path, e))
+            return False
 
-        if len(stderr) > 0:
-            logging.debug("ssdeep returned errors for {}".format(local_file_path))
+        if ssdeep_hash is None:
+            logging.debug("unable to compute ssdeep hash of {}".format(local_file_path))
             return False
 
         analysis = None
 
-        for line in stdout.split('\n'):
-            # example output:
-            # /opt/mwzoo/data/pos/frameworkpos/1/a5dc57aea5f397c2313e127a6e01aa00 matches all_the_hashes.ssdeep:/opt/mwzoo/data/pos/frameworkpos/1/a5dc57aea5f397c2313e127a6e01aa00.sample (100)
-            if line == '':
-                continue
-
-            m = re.match(r'^.+? matches [^:]+:(.+) \(([0-9]{1,3})\)$', line)
-            if not m:
-                logging.error("unexpected ssdeep output: {}".format(line))
-                continue
-
-            matched_file = m.group(1)
-            ssdeep_score = 0
-
-            try:
-                ssdeep_score = int(m.group(2))
-            except Exception as e:
-                logging.error("unable to parse {} as integer".format(ssdeep_score))
-
-            if ssdeep_score >= self.ssdeep_match_threshold:
-                _file.add_tag('ssdeep')
-                _file.add_directive(DIRECTIVE_SANDBOX)
-                if not analysis:
-                    analysis = self.create_analysis(_file)
+        for matched_file, ssdeep_score in self.ssdeep_index.matches(ssdeep_hash, self.ssdeep_match_threshold):
+            _file.add_tag('ssdeep')
+            _file.add_directive(DIRECTIVE_SANDBOX)
+            if not analysis:
+                analysis = self.create_analysis(_file)
 
-                analysis.details['matches'].append({'file': matched_file, 'score': int(ssdeep_score)})
+            analysis.details['matches'].append({'file': matched_file, 'score': int(ssdeep_score)})
 
         return analysis is not None
 
@@ -452,6 +464,7 @@ class ArchiveAnalysis(Analysis):
     def initialize_details(self):
         self.details = {
             'file_count': None,
+            'skipped_files': [],
         }
 
     @property
@@ -462,6 +475,15 @@ class ArchiveAnalysis(Analysis):
     def file_count(self, value):
         self.details['file_count'] = value
 
+    @property
+    def skipped_files(self):
+        """Returns the list of [ file name, reason ] of the files that were not extracted."""
+        return self.details_property('skipped_files')
+
+    @skipped_files.setter
+    def skipped_files(self, value):
+        self.details['skipped_files'] = value
+
     def upgrade(self):
         if 'file_count' not in self.details:
             logging.debug("upgrading {0}".format(self))
@@ -477,7 +499,14 @@ class ArchiveAnalysis(Analysis):
         return None
 
 # 2018-02-19 12:15:48          319534300    299585795  155 files, 47 folders
-Z7_SUMMARY_REGEX = re.compile(rb'^\d{4}-\d{2}-\d{2}\s+\d{2}:\d{2}:\d{2}\s+\d+\s+\d+\s+(\d+)\s+files.*?')
+Z7_SUMMARY_REGEX = re.compile(rb'^\d{4}-\d{2}-\d{2}\s+\d{2}:\d{2}:\d{2}\s+(\d+)\s+(\d+)\s+(\d+)\s+files.*?')
+
+# files in zip files that indicate the zip file is an office document
+OFFICE_MEMBER_REGEX = re.compile(r'ppt/slides/_rels|word/document\.xml|xl/embeddings/oleObject|xl/worksheets/sheet|'
+                                 r'word.embeddings.oleObject1\.bin')
+
+# the numerous XML documents in excel files we don't extract
+EXCEL_EXCLUDED_FILES = [ 'xl/activeX/*', 'xl/activeX/_rels/*', 'xl/ctrlProps/*.xml' ]
 
 # listed: 1 files, totaling 711.168 bytes (compressed 326.520)
 UNACE_SUMMARY_REGEX = re.compile(rb'^listed: (\d+) files,.*')
@@ -505,6 +534,21 @@ class ArchiveAnalyzer(AnalysisModule):
     def timeout(self):
         return self.config.getint('timeout')
 
+    @property
+    def extract_in_process(self):
+        return self.config.getboolean('extract_in_process', fallback=True)
+
+    @property
+    def max_depth(self):
+        return self.config.getint('max_depth', fallback=0)
+
+    @property
+    def extraction_limits(self):
+        return ExtractionLimits(
+            max_file_size=self.config.getint('max_extracted_file_size', fallback=100) * 1024 * 1024,
+            max_total_size=self.config.getint('max_extracted_size', fallback=500) * 1024 * 1024,
+            max_ratio=self.config.getint('max_compression_ratio', fallback=100))
+
     @property
     def excluded_mime_types(self):
         if 'excluded_mime_types' in self.config:
@@ -543,6 +587,12 @@ class ArchiveAnalyzer(AnalysisModule):
                 logging.debug("skipping archive extraction of OLE file {}".format(_file.value))
                 return False
 
+        # archives inside of archives inside of archives...
+        if self.max_depth != 0 and get_archive_depth(_file.value) >= self.max_depth:
+            logging.info("skipping archive extraction of {}: nested more than {} archives deep".format(
+                         _file.value, self.max_depth))
+            return False
+
         # special logic for rar files
         is_rar_file = 'RAR archive data' in file_type_analysis.file_type
         is_rar_file |= file_type_analysis.mime_type == 'application/x-rar'
@@ -570,9 +620,41 @@ class ArchiveAnalyzer(AnalysisModule):
         is_ace_file = 'ACE archive data' in file_type_analysis.file_type
         is_ace_file |= _file.value.lower().endswith('.ace')
 
+        # we need a place to store these things
+        extracted_path = '{}.extracted'.format(local_file_path).replace('*', '_') # XXX need a normalize function
+
+        # zip, tar, gzip, bzip2 and xz files are extracted in-process (see saq.extraction)
+        # everything else (and anything the extractor cannot open) is extracted with the command line tools
+        archive = None
+        extracted_files = None
+        if self.extract_in_process and not ( is_rar_file or is_jar_file or is_ace_file ):
+            archive = open_archive(local_file_path, password=b'infected')
+
         count = 0
 
-        if is_rar_file:
+        if archive is not None:
+            logging.debug("extracting files from {} in process".format(local_file_path))
+            for name in archive.names or []:
+                if OFFICE_MEMBER_REGEX.search(name):
+                    is_office_document = True
+
+            count = archive.file_count
+            if count is None:
+                # the number of files in a stream is not known until it has been extracted
+                max_file_count = None if is_office_document or self.max_file_count == 0 else self.max_file_count
+                try:
+                    extracted_files = archive.extract(extracted_path, self.extraction_limits, max_files=max_file_count)
+                except TooManyFiles:
+                    logging.debug("skipping archive analysis of {}: file count exceeds configured maximum {} in "
+                                  "max_file_count setting".format(local_file_path, self.max_file_count))
+                    shutil.rmtree(extracted_path, ignore_errors=True)
+                    return False
+
+                count = archive.file_count
+                if count == 0:
+                    shutil.rmtree(extracted_path, ignore_errors=True)
+
+        elif is_rar_file:
             logging.debug("using unrar to extract files from {}".format(local_file_path))
             p = Popen(['unrar', 'la', local_file_path], stdout=PIPE, stderr=PIPE)
             try:
@@ -679,7 +761,15 @@ class ArchiveAnalyzer(AnalysisModule):
             for line in stdout.split(b'\n'):
                 m = Z7_SUMMARY_REGEX.match(line)
                 if m:
-                    count = int(m.group(1))
+                    count = int(m.group(3))
+
+                    # 7z extracts straight to disk so the best we can do is check the sizes it reports
+                    limits = self.extraction_limits
+                    size, packed_size = int(m.group(1)), int(m.group(2))
+                    if size > limits.max_total_size or limits.ratio_exceeded(size, packed_size):
+                        logging.warning("skipping archive extraction of {}: {} bytes compressed to {} bytes "
+                                        "exceeds extraction limits".format(local_file_path, size, packed_size))
+                        return False
 
                 #if line.startswith(b'Testing'):
                     #count += 1
@@ -717,8 +807,6 @@ class ArchiveAnalyzer(AnalysisModule):
         if count == 0:
             return False
 
-        # we need a place to store these things
-        extracted_path = '{}.extracted'.format(local_file_path).replace('*', '_') # XXX need a normalize function
         if not os.path.isdir(extracted_path):
             try:
                 os.makedirs(extracted_path)
@@ -734,7 +822,13 @@ class ArchiveAnalyzer(AnalysisModule):
         params = []
         kwargs = { 'stdout': PIPE, 'stderr': PIPE }
 
-        if is_rar_file:
+        if archive is not None:
+            if extracted_files is None:
+                extracted_files = archive.extract(extracted_path, self.extraction_limits,
+                                                  exclude=EXCEL_EXCLUDED_FILES if is_zip_file else None)
+
+            analysis.skipped_files = [ list(_) for _ in archive.skipped ]
+        elif is_rar_file:
             params = ['unrar', 'e', '-y', '-o+', local_file_path, extracted_path]
         elif is_jar_file:
             decompiler_path = os.path.join(saq.SAQ_HOME, "bin", "procyon_decompiler.jar")
@@ -762,18 +856,52 @@ class ArchiveAnalyzer(AnalysisModule):
 
         #logging.debug("extracted into {}".format(extracted_path))
 
+        try:
+            for root, dirs, files in os.walk(extracted_path):
+                for _dir in dirs:
+                    full_path = os.path.join(root, _dir)
+                    try:
+                        os.chmod(full_path, 0o775)
+                    except Exception as e:
+                        logging.error("unable to adjust permissions on dir {}: {}".format(full_path, e))
+
+                for file_name in files:
+                    full_path = os.path.join(root, file_name)
+                    try:
+                        os.chmod(full_path, 0o664)
+                    except Exception as e:
+                        logging.error("unable to adjust permissions on file {}: {}".format(full_path, e))
+
+        except Exception as e:
+            logging.error("some error was reported when trying to recursively chmod {}: {}".format(extracted_path, e))
+            report_exception()
+
+        # we already have the hashes of the files we extracted ourselves
+        # (this has to happen after the chmod because that changes the ctime)
+        # key = path, value = hashes (see saq.hashing.compute_file_hashes)
+        extracted_hashes = {}
+        for extracted_file in extracted_files or []:
+            cache_file_hashes(extracted_file.path, extracted_file.hashes)
+            extracted_hashes[os.path.normpath(extracted_file.path)] = extracted_file.hashes
+
         # rather than parse the output we just go find all the files we've created in that directory
         for root, dirs, files in os.walk(extracted_path):
             for file_name in files:
                 extracted_file = os.path.join(root, file_name)
                 logging.debug("extracted_file = {}".format(extracted_file))
 
-                file_observable = analysis.add_observable(F_FILE, 
+                file_observable = create_observable(F_FILE,
                     os.path.relpath(extracted_file, start=self.root.storage_dir))
 
                 if not file_observable:
                     continue
 
+                # so that the file is not read again to hash it when the observable is added
+                if os.path.normpath(extracted_file) in extracted_hashes:
+                    file_observable.set_hashes(extracted_hashes[os.path.normpath(extracted_file)])
+
+                file_observable = analysis.add_observable(file_observable)
+
                 # add a relationship back to the original file
                 file_observable.add_relationship(R_EXTRACTED_FROM, _file)
 
@@ -806,26 +934,6 @@ class ArchiveAnalyzer(AnalysisModule):
                             if extracted_file.value.lower().endswith(ext):
                                 analysis.add_tag('lnk_in_zip')
 
-        try:
-            for root, dirs, files in os.walk(extracted_path):
-                for _dir in dirs:
-                    full_path = os.path.join(root, _dir)
-                    try:
-                        os.chmod(full_path, 0o775)
-                    except Exception as e:
-                        logging.error("unable to adjust permissions on dir {}: {}".format(full_path, e))
-
-                for _file in files:
-                    full_path = os.path.join(root, _file)
-                    try:
-                        os.chmod(full_path, 0o664)
-                    except Exception as e:
-                        logging.error("unable to adjust permissions on file {}: {}".format(full_path, e))
-
-        except Exception as e:
-            logging.error("some error was reported when trying to recursively chmod {}: {}".format(extracted_path, e))
-            report_exception()
-
         return True
 
 # DEPRECATED
@@ -1006,7 +1114,7 @@ class OLEVBA_Analyzer_v1_1(AnalysisModule):
         # so we wrote our own
 
         output_dir = None
-        p = None
+        result = None
 
         try:
 
@@ -1019,8 +1127,11 @@ class OLEVBA_Analyzer_v1_1(AnalysisModule):
             if not os.path.isabs(olevba_wrapper_path):
                 olevba_wrapper_path = os.path.join(saq.SAQ_HOME, olevba_wrapper_path)
                 
-            p = Popen(['python2.7', olevba_wrapper_path, '-d', output_dir, local_file_path], stdout=PIPE, stderr=PIPE)
-            _stdout, _stderr = p.communicate(timeout=self.timeout)
+            result = run_python_script([olevba_wrapper_path, '-d', output_dir, local_file_path], timeout=self.timeout)
+            if result.timed_out:
+                raise RuntimeError("timed out after {} seconds".format(self.timeout))
+
+            _stdout, _stderr = result.stdout, result.stderr
 
         except Exception as e:
             logging.error("olevba execution error on {}: {}".format(local_file_path, e))
@@ -1030,16 +1141,10 @@ class OLEVBA_Analyzer_v1_1(AnalysisModule):
                 _file.add_tag('olevba_failed')
                 _file.add_directive(DIRECTIVE_SANDBOX)
 
-            try:
-                #p.kill()
-                _stdout, _stderr = p.communicate()
-            except Exception as e:
-                logging.error("unable to finished process {}: {}".format(p, e))
-
             return False
 
         # if the process returned with error code 2 then the parsing failed, which means it wasn't an office document format
-        if p.returncode == 2:
+        if result.returncode == 2:
             logging.debug("{} reported not a valid office document: {}".format(olevba_wrapper_path, local_file_path))
             return False
 
@@ -1972,23 +2077,8 @@ class FileTypeAnalyzer(AnalysisModule):
         logging.debug("analyzing file {}".format(local_file_path))
         analysis = self.create_analysis(_file)
 
-        # get the human readable
-        p = Popen(['file', '-b', '-L', local_file_path], stdout=PIPE, stderr=PIPE)
-        stdout, stderr = p.communicate()
-        
-        if len(stderr) > 0:
-            logging.warning("file command returned error output for {0}".format(local_file_path))
-
-        analysis.details['type'] = stdout.decode().strip()
-
-        # get the mime type
-        p = Popen(['file', '-b', '--mime-type', '-L', local_file_path], stdout=PIPE, stderr=PIPE)
-        stdout, stderr = p.communicate()
-        
-        if len(stderr) > 0:
-            logging.warning("file command returned error output for {0}".format(local_file_path))
-
-        analysis.details['mime'] = stdout.decode().strip()
+        # get the human readable description and the mime type
+        analysis.details['type'], analysis.details['mime'] = get_file_type(local_file_path, _file.sha256_hash)
 
         analysis.details['is_office_ext'] = is_office_ext(local_file_path)
         analysis.details['is_ole_file'] = is_ole_file(local_file_path)
@@ -2082,17 +2172,12 @@ class PDFAnalyzer(AnalysisModule):
         pdfparser_output_file = '{}.pdfparser'.format(local_file_path)
 
         # run pdf parser
-        with open(pdfparser_output_file, 'wb') as fp:
-            p = Popen(['python2.7', self.pdfparser_path,
-            '-f', '-w', '-v', '-c', '--debug', local_file_path], stdout=fp, stderr=PIPE)
-            try:
-                _, stderr = p.communicate(timeout=10)
-            except TimeoutExpired as e:
-                logging.warning("pdfparser timed out on {}".format(local_file_path))
-                #p.kill()
-                _, stderr = p.communicate()
+        result = run_python_script([self.pdfparser_path, '-f', '-w', '-v', '-c', '--debug', local_file_path],
+                                   stdout_path=pdfparser_output_file, timeout=10)
+        if result.timed_out:
+            logging.warning("pdfparser timed out on {}".format(local_file_path))
 
-        if len(stderr) > 0:
+        if len(result.stderr) > 0:
             logging.warning("pdfparser returned errors for {}".format(local_file_path))
 
         # add the output file as a new file to scan
@@ -2276,6 +2361,53 @@ class YaraScanner_v3_4(AnalysisModule):
         """Relative or absolute path to directory containing sub directories of yara rules."""
         return abs_path(saq.CONFIG['service_yara']['signature_dir'])
 
+    @property
+    def compiled_rules_dir(self):
+        """Directory of the precompiled yara rules (see saq.yara_rules.)"""
+        return os.path.join(saq.DATA_DIR, saq.CONFIG['service_yara']['compiled_rules_dir'])
+
+    @property
+    def batch_enabled(self):
+        return self.config.getboolean('batch_enabled', fallback=False)
+
+    @property
+    def batch_timeout(self):
+        return self.config.getint('batch_timeout', fallback=60)
+
+    @property
+    def batch_socket(self):
+        """Path to the unix socket of the batch scanner (see saq.yara_batch.)"""
+        return os.path.join(saq.DATA_DIR, saq.CONFIG['service_yara']['batch_socket'])
+
+    @property
+    def result_cache(self):
+        """Returns the YaraResultCache for this process, or None if it cannot be opened."""
+        if self._result_cache_pid == os.getpid():
+            return self._result_cache
+
+        self._result_cache = None
+        self._result_cache_pid = os.getpid()
+
+        path = os.path.join(saq.DATA_DIR, self.config.get('result_cache_path', fallback='var/yara_result_cache.db'))
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._result_cache = YaraResultCache(path,
+                max_age=self.config.getint('result_cache_max_age_days', fallback=7) * 86400)
+        except Exception as e:
+            logging.warning("unable to open yara result cache {}: {}".format(path, e))
+
+        return self._result_cache
+
+    @property
+    def rules_version(self):
+        """The current version of the yara rules (see saq.yara_rules.get_rules_version.)
+           This is checked as often as the yara scanner server checks for changes."""
+        if self._rules_version is None or time.time() >= self._rules_version_expiration:
+            self._rules_version = get_rules_version(self.signature_dir)
+            self._rules_version_expiration = time.time() + saq.CONFIG['service_yara'].getint('update_frequency')
+
+        return self._rules_version
+
     @property
     def generated_analysis_type(self):
         return YaraScanResults_v3_4
@@ -2306,11 +2438,18 @@ class YaraScanner_v3_4(AnalysisModule):
         # we use it for N minutes defined in the configuration
         self.scanner_start_time = None
 
+        # see the result_cache and rules_version properties
+        self._result_cache = None
+        self._result_cache_pid = None
+        self._rules_version = None
+        self._rules_version_expiration = None
+
     def initialize_local_scanner(self):
         logging.info("initializing local yara scanner")
-        # initialize the scanner and compile the rules
-        self.scanner = yara_scanner.YaraScanner(signature_dir=self.signature_dir)
-        self.scanner.load_rules()
+        # load the precompiled rules (compiling them if nothing else has yet)
+        self.scanner = CompiledRules(self.signature_dir, self.compiled_rules_dir,
+                                     update_frequency=saq.CONFIG['service_yara'].getint('update_frequency'))
+        self.scanner.load()
         self.scanner_start_time = datetime.datetime.now()
         #self.load_blacklist()
 
@@ -2340,9 +2479,8 @@ class YaraScanner_v3_4(AnalysisModule):
         # have the signatures changed?
         #logging.debug("checking for rule modifications")
         if self.scanner:
-            if self.scanner.check_rules():
-                logging.info("detected yara rules modification - reloading")
-                self.scanner.load_rules()
+            if self.scanner.refresh():
+                logging.info("detected yara rules modification - reloaded")
 
         # did the blacklist change?
         #try:
@@ -2351,6 +2489,94 @@ class YaraScanner_v3_4(AnalysisModule):
         #except Exception as e:
             #logging.error("unable to check blacklist {0}: {1}".format(self.blacklist_path, str(e)))
 
+    def get_cached_scan_results(self, path, rules_version):
+        """Returns the cached results of the given file (at the given absolute path) for the given version of the rules,
+           or None. Results are only reused for the same path because rules can filter on the full path."""
+        cache = self.result_cache
+        if cache is None:
+            return None
+
+        try:
+            result = cache.get(get_file_hashes(path)[HASH_SHA256], path, rules_version)
+        except Exception as e:
+            logging.warning("unable to query yara result cache for {}: {}".format(path, e))
+            return None
+
+        return result
+
+    def cache_scan_results(self, path, rules_version, result):
+        cache = self.result_cache
+        if cache is None:
+            return
+
+        try:
+            cache.put(get_file_hashes(path)[HASH_SHA256], path, rules_version, result)
+        except Exception as e:
+            logging.warning("unable to update yara result cache for {}: {}".format(path, e))
+
+    def get_batch_scan_results(self, _file, path):
+        """Returns the yara results for the given file (at the given absolute path) from the result cache or the
+           batch scanner, or None if they are not available (in which case the caller falls back to yss.)
+           The file is scanned together with the other files in the root that have not been scanned yet
+           (see AnalysisModule.get_batch.)"""
+        if _file.id in self.batch_results:
+            logging.debug("using batch scan results for {}".format(path))
+            return self.batch_results.pop(_file.id)
+
+        path = os.path.abspath(path)
+        rules_version = self.rules_version
+        result = self.get_cached_scan_results(path, rules_version)
+        if result is not None:
+            logging.debug("using cached yara results for {}".format(path))
+            return result
+
+        # key = absolute path, value = the file observable
+        targets = { path: _file }
+        for target in self.get_batch(_file):
+            if target is _file or target.has_directive(DIRECTIVE_NO_SCAN):
+                continue
+
+            target_path = os.path.abspath(get_local_file_path(self.root, target))
+            try:
+                if os.path.getsize(target_path) == 0:
+                    continue
+            except OSError:
+                continue
+
+            # files that already have cached results do not need to be scanned again
+            cached_result = self.get_cached_scan_results(target_path, rules_version)
+            if cached_result is not None:
+                self.batch_results[target.id] = cached_result
+                continue
+
+            targets[target_path] = target
+
+        result = None
+        try:
+            for target_path, target_rules_version, target_result in scan_files(list(targets.keys()),
+                                                                                self.batch_socket,
+                                                                                timeout=self.batch_timeout):
+                if isinstance(target_result, Exception):
+                    logging.info("batch scan of {} failed: {}".format(target_path, target_result))
+                    continue
+
+                self.cache_scan_results(target_path, target_rules_version, target_result)
+                if target_path == path:
+                    result = target_result
+                else:
+                    self.batch_results[targets[target_path].id] = target_result
+
+        except Exception as e:
+            logging.warning("unable to use yara batch scanner: {}".format(e))
+
+        # the files that did not get results are scanned on their own
+        for target in targets.values():
+            if target is not _file and target.id not in self.batch_results:
+                self.batch_searched.discard(target.id)
+
+        logging.debug("batch scanned {} files for {} (matches found: {})".format(len(targets), path, bool(result)))
+        return result
+
     def execute_analysis(self, _file):
 
         # does this file exist as an attachment?
@@ -2380,7 +2606,14 @@ class YaraScanner_v3_4(AnalysisModule):
                 _full_path = local_file_path
                 if not os.path.isabs(local_file_path):
                     _full_path = os.path.join(os.getcwd(), local_file_path)
-                result = yara_scanner.scan_file(_full_path, base_dir=self.base_dir, socket_dir=self.socket_dir)
+
+                result = None
+                if self.batch_enabled:
+                    result = self.get_batch_scan_results(_file, _full_path)
+
+                if result is None:
+                    result = yara_scanner.scan_file(_full_path, base_dir=self.base_dir, socket_dir=self.socket_dir)
+
                 matches_found = bool(result)
 
                 logging.debug("scanned file {} with yss (matches found: {})".format(_full_path, matches_found))
@@ -2400,9 +2633,11 @@ class YaraScanner_v3_4(AnalysisModule):
                 logging.warning("failed to connect to yara socket server: {}".format(e))
                 if not self.scanner:
                     self.initialize_local_scanner()
+                else:
+                    self.auto_reload()
 
-                matches_found = self.scanner.scan(local_file_path)
-                result = self.scanner.scan_results
+                _, result = self.scanner.match(local_file_path)
+                matches_found = bool(result)
                 # we want to keep using it for now...
                 self.scanner_start_time = datetime.datetime.now()
 
@@ -3099,10 +3334,9 @@ class RTFOLEObjectAnalyzer(AnalysisModule):
         analysis = self.create_analysis(_file)
 
         try:
-            p = Popen(['python2.7', self.rtfobj_path, '-d', output_dir, '-s', 'all', local_file_path], 
-                      stdout=PIPE, stderr=PIPE, universal_newlines=True)
-            analysis.stderr, analysis.stdout = p.communicate()
-            analysis.return_code = p.returncode
+            result = run_python_script([self.rtfobj_path, '-d', output_dir, '-s', 'all', local_file_path])
+            analysis.stderr, analysis.stdout = result.stdout_text, result.stderr_text
+            analysis.return_code = result.returncode
         except Exception as e:
             logging.error("execution of {} failed: {}".format(self.rtfobj_path, e))
             report_exception()
@@ -3296,11 +3530,30 @@ class URLExtractionAnalyzer(AnalysisModule):
     def required_directives(self):
         return [ DIRECTIVE_EXTRACT_URLS ]
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # tuple of (excluded_domains setting, DomainTrie)
+        self._excluded_domains = None
+
     @property
     def max_file_size(self):
         """The max file size to extract URLs from (in bytes.)"""
         return self.config.getint("max_file_size") * 1024 * 1024
 
+    @property
+    def chunk_size(self):
+        """Files larger than this (in bytes) are read a chunk at a time."""
+        return self.config.getint("chunk_size", fallback=8) * 1024 * 1024
+
+    @property
+    def excluded_domains(self):
+        """Returns a DomainTrie of the domains in the excluded_domains setting."""
+        value = self.config['excluded_domains']
+        if self._excluded_domains is None or self._excluded_domains[0] != value:
+            self._excluded_domains = value, DomainTrie([_.strip() for _ in value.split(',')])
+
+        return self._excluded_domains[1]
+
     def order_urls_by_interest(self, extracted_urls):
         """Sort the extracted urls into a list by their domain+TLD frequency and path extension.
         Baically, we want the urls that are more likely to be malicious to come first.
@@ -3311,21 +3564,21 @@ class URLExtractionAnalyzer(AnalysisModule):
         # -- calling a domain the domain+tld
         _groupings = {}
         for url in extracted_urls:
-            try:
-                res = get_tld(url, as_object=True)
-            except Exception as e:
-                logging.info("Failed to get TLD on url:{} - {}".format(url, e))
+            # lots of urls share the same host name so the lookups are memoized
+            registered_domain = get_registered_domain(url)
+            if registered_domain is None:
+                logging.info("Failed to get TLD on url:{}".format(url))
                 if 'no_tld' not in _groupings:
                     _groupings['no_tld'] = []
                 _groupings['no_tld'].append(url)
                 continue
 
-            domain = str(res.domain) + '.' + str(res)
+            domain = '.'.join(registered_domain)
             if domain not in _groupings:
                 _groupings[domain] = []
             _groupings[domain].append(url)
 
-            if res.parsed_url.path.endswith(image_extensions):
+            if urlsplit(url).path.endswith(image_extensions):
                 image_urls.append(url)
             # I'm not sure we want to do this with query extensions, always
             #if res.parsed_url.query.endswith(image_extensions):
@@ -3380,16 +3633,12 @@ class URLExtractionAnalyzer(AnalysisModule):
                 base_url = downloaded_from.target.value
 
         # extract all the URLs out of this file
-        with open(local_file_path, 'rb') as fp:
-            extracted_urls = find_urls(fp.read(), base_url=base_url)
-            logging.debug("extracted {} urls from {}".format(len(extracted_urls), local_file_path))
+        extracted_urls = find_urls_in_file(local_file_path, base_url=base_url, chunk_size=self.chunk_size)
+        logging.debug("extracted {} urls from {}".format(len(extracted_urls), local_file_path))
 
         # filter out the stuff that is excluded via configuration
-        fqdns = [_.strip() for _ in self.config['excluded_domains'].split(',')]
+        excluded_domains = self.excluded_domains
         def f(url):
-            if not fqdns:
-                return True
-
             try:
                 parsed_url = urlparse(url)
             except:
@@ -3398,11 +3647,7 @@ class URLExtractionAnalyzer(AnalysisModule):
             if parsed_url.hostname is None:
                 return True
 
-            for fqdn in fqdns:
-                if is_subdomain(parsed_url.hostname, fqdn):
-                    return False
-
-            return True
+            return not excluded_domains.matches(parsed_url.hostname)
         
         extracted_urls = list(filter(f, extracted_urls))
 
@@ -1,6 +1,8 @@
 # vim: sw=4:ts=4:et
 
 import csv
+import ipaddress
+import json
 import logging
 import os.path
 import re
@@ -8,6 +10,7 @@ import re
 import saq
 from saq.analysis import Analysis, Observable
 from saq.constants import *
+from saq.intervals import open_interval_table, write_interval_table
 from saq.modules import AnalysisModule
 
 from iptools import IpRange
@@ -156,8 +159,133 @@ class IPDBAnalysis(Analysis):
             return self.details[ASSIGNMENT_COMMENT]
         return None
 
+def parse_ipdb_csv(csv_file, csv_file_encoding):
+    """Parses the exported IPDB CSV file.
+       Returns a tuple of (networks, assignments) where networks is a list of IPDBNetwork objects
+       and assignments is a dict that maps ipv4 to IPDBAssignment objects."""
+
+    networks = [] # list of IPDBNetwork objects
+    assignments = {} # key = ipv4, value = IPDBAssignment
+    line_number = 0
+    with open(csv_file, 'r', encoding=csv_file_encoding) as fp:
+        reader = csv.reader(fp)
+        header = next(reader) # skip the header
+        line_number += 1
+        skip_mode = True # state variable, to skip over invalid network specs
+        current_network = None
+        while True: 
+            try:
+                row = next(reader)
+                line_number += 1
+            except StopIteration:
+                break
+            except Exception as e:
+                logging.debug("unable to read line {0} from {1}: {2}".format(line_number, csv_file, str(e)))
+                break
+
+            try:
+            
+                # network specifications are two columns
+                if len(row) < 2:
+                    continue
+
+                if len(row) == 2:
+                    (count, network) = row
+                    if network.strip() == '':
+                        continue
+                    if network.startswith('000.000.000.000'):
+                        skip_mode = True
+                        continue
+                    else:
+                        m = re.match(r'^([0-9]{3}\.[0-9]{3}\.[0-9]{3}\.[0-9]{3})\s+-\s+(.*)$', network)
+                        if m is None:
+                            #logging.debug("unable to parse network spec out of {0}".format(network))
+                            current_network = None
+                            continue
+
+                        network = m.group(1)
+                        name = m.group(2)
+
+                        # turn the nnn.nnn.nnn.nnn into an actual IP address
+                        m = re.match(r'([0-9]{3})\.([0-9]{3})\.([0-9]{3})\.([0-9]{3})$', network)
+                        (a,b,c,d) = m.groups()
+                        network = '{0}.{1}.{2}'.format(str(int(a)), str(int(b)), str(int(c)))
+                        cidr = IpRange('{0}.0/24'.format(network)) # assuming they are all /24 specs
+                        current_network = IPDBNetwork(network, name, cidr)
+                        networks.append(current_network)
+                        skip_mode = False
+                        #logging.debug("loaded {0}".format(current_network))
+
+                    continue
+
+                if len(row) != 8:
+                    logging.debug("invalid row count {0} for row {1}".format(
+                        len(row), ','.join(row)))
+                    continue
+
+                (count, network, host, _type, division, location, name, comment) = row
+
+                # skipping over assets assigned to 0.0.0.0 network
+                # I assume this is the "these assets are not on the network" flag for networking group
+                if skip_mode:
+                    continue
+
+                if current_network is None:
+                    #logging.debug("current_network is not set while parsing {0}".format(','.join(row)))
+                    continue
+
+                try:
+                    ipv4 = str(int(host))
+                except Exception as e:
+                    #logging.debug("value {0} specified for host column is invalid in {1}: {2}".format(
+                        #host, ','.join(row), str(e)))
+                    continue
+
+                ipv4 = '{0}.{1}'.format(current_network.network, ipv4)
+                assignment = IPDBAssignment(current_network, ipv4, _type, division, location, name, comment)
+                #if ipv4 in assignments:
+                    #logging.warning("duplicate ipv4 assignment for {0}".format(ipv4))
+
+                assignments[ipv4] = assignment
+                #logging.debug("loaded {0}".format(assignment))
+
+            except Exception as e:
+                logging.debug("trouble reading ipbd file: {0}".format(str(e)))
+                continue
+    
+    logging.debug("loaded {0} ipdb networks and {1} ipdb assignments".format(len(networks), len(assignments)))
+    return networks, assignments
+
+def write_ipdb_table(path, csv_file, csv_file_encoding):
+    """Compiles the IPDB CSV file into an interval table.
+       Each network becomes a /24 interval and each assignment becomes a single address interval
+       (which wins over the network it is in.) The records are the json of the network or assignment."""
+    networks, assignments = parse_ipdb_csv(csv_file, csv_file_encoding)
+
+    intervals = []
+    records = []
+    for network in networks:
+        start = int(ipaddress.IPv4Address('{0}.0'.format(network.network)))
+        intervals.append((start, start + 255, len(records)))
+        records.append(json.dumps(network.json).encode('utf8'))
+
+    for assignment in assignments.values():
+        try:
+            value = int(ipaddress.IPv4Address(assignment.ipv4))
+        except ValueError:
+            logging.debug("invalid ipdb assignment {0}".format(assignment.ipv4))
+            continue
+
+        intervals.append((value, value, len(records)))
+        records.append(json.dumps(assignment.json).encode('utf8'))
+
+    write_interval_table(path, intervals, records)
+
 class IPDBAnalyzer(AnalysisModule):
-    """Look up an IP address in the exported IPDB CSV file."""
+    """Look up an IP address in the exported IPDB CSV file.
+
+       The CSV file is compiled into an interval table (see saq.intervals) which is recompiled when the CSV file
+       changes."""
 
     @property
     def generated_analysis_type(self):
@@ -169,12 +297,12 @@ class IPDBAnalyzer(AnalysisModule):
     
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.ipdb_table = None
 
-        self.networks = [] # list of IPDBNetwork objects
-        self.assignments = {} # key = ipv4, value = IPDBAssignment
-
-        # load the ipdb csv
+        # load the ipdb table (compiling it from the csv if needed)
+        # we also watch the compiled table in case another process recompiles it
         self.watch_file(self.csv_file, self.load_csv_file)
+        self.watch_file(self.table_file, self.load_csv_file)
 
     @property
     def csv_file(self):
@@ -184,95 +312,26 @@ class IPDBAnalyzer(AnalysisModule):
     def csv_file_encoding(self):
         return self.config['csv_file_encoding']
 
-    def load_csv_file(self):
-        line_number = 0
-        with open(self.csv_file, 'r', encoding=self.csv_file_encoding) as fp:
-            reader = csv.reader(fp)
-            header = next(reader) # skip the header
-            line_number += 1
-            skip_mode = True # state variable, to skip over invalid network specs
-            current_network = None
-            while True: 
-                try:
-                    row = next(reader)
-                    line_number += 1
-                except Exception as e:
-                    logging.debug("unable to read line {0} from {1}: {2}".format(line_number, self.csv_file, str(e)))
-                    break
-                except StopIteration:
-                    break
-
-                try:
-                
-                    # network specifications are two columns
-                    if len(row) < 2:
-                        continue
-
-                    if len(row) == 2:
-                        (count, network) = row
-                        if network.strip() == '':
-                            continue
-                        if network.startswith('000.000.000.000'):
-                            skip_mode = True
-                            continue
-                        else:
-                            m = re.match(r'^([0-9]{3}\.[0-9]{3}\.[0-9]{3}\.[0-9]{3})\s+-\s+(.*)$', network)
-                            if m is None:
-                                #logging.debug("unable to parse network spec out of {0}".format(network))
-                                current_network = None
-                                continue
-
-                            network = m.group(1)
-                            name = m.group(2)
-
-                            # turn the nnn.nnn.nnn.nnn into an actual IP address
-                            m = re.match(r'([0-9]{3})\.([0-9]{3})\.([0-9]{3})\.([0-9]{3})$', network)
-                            (a,b,c,d) = m.groups()
-                            network = '{0}.{1}.{2}'.format(str(int(a)), str(int(b)), str(int(c)))
-                            cidr = IpRange('{0}.0/24'.format(network)) # assuming they are all /24 specs
-                            current_network = IPDBNetwork(network, name, cidr)
-                            self.networks.append(current_network)
-                            skip_mode = False
-                            #logging.debug("loaded {0}".format(current_network))
-
-                        continue
-
-                    if len(row) != 8:
-                        logging.debug("invalid row count {0} for row {1}".format(
-                            len(row), ','.join(row)))
-                        continue
-
-                    (count, network, host, _type, division, location, name, comment) = row
-
-                    # skipping over assets assigned to 0.0.0.0 network
-                    # I assume this is the "these assets are not on the network" flag for networking group
-                    if skip_mode:
-                        continue
-
-                    if current_network is None:
-                        #logging.debug("current_network is not set while parsing {0}".format(','.join(row)))
-                        continue
+    @property
+    def table_file(self):
+        return os.path.join(saq.SAQ_HOME, self.config.get('table_file', fallback='etc/ip_database.table'))
 
-                    try:
-                        ipv4 = str(int(host))
-                    except Exception as e:
-                        #logging.debug("value {0} specified for host column is invalid in {1}: {2}".format(
-                            #host, ','.join(row), str(e)))
-                        continue
+    def build_ipdb_table(self, path):
+        write_ipdb_table(path, self.csv_file, self.csv_file_encoding)
 
-                    ipv4 = '{0}.{1}'.format(current_network.network, ipv4)
-                    assignment = IPDBAssignment(current_network, ipv4, _type, division, location, name, comment)
-                    #if ipv4 in self.assignments:
-                        #logging.warning("duplicate ipv4 assignment for {0}".format(ipv4))
+    def load_csv_file(self):
+        self.ipdb_table = open_interval_table(self.table_file, [ self.csv_file ], self.build_ipdb_table, 
+                                              current=self.ipdb_table)
 
-                    self.assignments[ipv4] = assignment
-                    #logging.debug("loaded {0}".format(assignment))
+    def lookup(self, value):
+        """Returns the details of the assignment (or network if there is no assignment) for the given ipv4, or None
+           if the ipv4 is not in the IPDB."""
+        result = self.ipdb_table.lookup(int(ipaddress.IPv4Address(value)))
+        if result is None:
+            return None
 
-                except Exception as e:
-                    logging.debug("trouble reading ipbd file: {0}".format(str(e)))
-                    continue
-        
-        logging.debug("loaded {0} ipdb networks and {1} ipdb assignments".format(len(self.networks), len(self.assignments)))
+        interval_start, interval_end, record = result
+        return json.loads(record.decode('utf8'))
 
     def execute_analysis(self, ipv4):
 
@@ -280,19 +339,14 @@ class IPDBAnalyzer(AnalysisModule):
         analysis = IPDBAnalysis()
         analysis.details = None
 
-        # first check for the ipv4 direct mapping
-        try:
-            analysis.details = self.assignments[ipv4.value].json
-            logging.debug("got ipdb match for {0}: {1}".format(ipv4.value, self.assignments[ipv4.value]))
-        except KeyError:
-            # try to look for the network assignment instead
-            for network in self.networks:
-                try:
-                    if ipv4.value in network.cidr:
-                        analysis.details = network.json
-                        logging.debug("got ipdb network match for {0}: {1}".format(ipv4.value, network))
-                except TypeError:
-                    pass
+        if self.ipdb_table is None:
+            logging.warning("IPDB table is not available")
+        else:
+            try:
+                analysis.details = self.lookup(ipv4.value)
+                if analysis.details is not None:
+                    logging.debug("got ipdb match for {0}: {1}".format(ipv4.value, analysis.details))
+            except ValueError:
+                logging.debug("invalid ipv4 {0}".format(ipv4.value))
 
         ipv4.add_analysis(analysis)
-
@@ -2,13 +2,166 @@
 #
 # base functionality for all sandbox-type of analysis
 #
+# samples submitted to a sandbox are tracked in the sandbox_jobs table by sha256, sandbox and profile
+# (the environment, tags, etc... the sample is analyzed with) so that a sample is only submitted once
+# the analysis waiting on a job are tracked in the sandbox_job_waiters table and are resumed by the
+# sandbox job poller service (see saq.service.sandbox) when the job finishes
+#
 
+import hashlib
+import io
+import json
 import logging
 
 import saq
 from saq.constants import *
+from saq.database import use_db, execute_with_retry
 from saq.modules import AnalysisModule
 
+SANDBOX_JOB_STATUS_SUBMITTING = 'SUBMITTING'
+SANDBOX_JOB_STATUS_PENDING = 'PENDING'
+SANDBOX_JOB_STATUS_COMPLETE = 'COMPLETE'
+SANDBOX_JOB_STATUS_FAILED = 'FAILED'
+
+class SandboxJob(object):
+    """A sample submitted to a sandbox."""
+    def __init__(self, sha256, sandbox, profile, job_id=None, status=SANDBOX_JOB_STATUS_SUBMITTING, details=None):
+        self.sha256 = sha256
+        self.sandbox = sandbox
+        self.profile = profile
+        # the sandbox specific id of the job
+        self.job_id = job_id
+        self.status = status
+        # sandbox specific data needed to check on the job (dict)
+        self.details = details
+
+    @property
+    def finished(self):
+        return self.status in [ SANDBOX_JOB_STATUS_COMPLETE, SANDBOX_JOB_STATUS_FAILED ]
+
+    def __str__(self):
+        return "sandbox job {} sha256 {} profile {} ({})".format(self.sandbox, self.sha256, self.profile, self.status)
+
+def _load_sandbox_job(row):
+    sha256, sandbox, profile, job_id, status, details = row
+    return SandboxJob(sha256, sandbox, profile, job_id=job_id, status=status,
+                      details=json.loads(details) if details else None)
+
+@use_db
+def get_sandbox_job(sha256, sandbox, profile, db, c):
+    """Returns the SandboxJob for the given sample, sandbox and profile, or None if it does not exist."""
+    c.execute("""SELECT sha256, sandbox, profile, job_id, status, details FROM sandbox_jobs
+                 WHERE sha256 = %s AND sandbox = %s AND profile = %s""", (sha256.lower(), sandbox, str(profile)))
+    row = c.fetchone()
+    if row is None:
+        return None
+
+    return _load_sandbox_job(row)
+
+def _claim_sandbox_job(db, c, sha256, sandbox, profile, submit_timeout, max_age):
+    c.execute("""INSERT IGNORE INTO sandbox_jobs ( sha256, sandbox, profile, status, node_id, insert_date, last_update )
+                 VALUES ( %s, %s, %s, %s, %s, NOW(), NOW() )""",
+              (sha256, sandbox, profile, SANDBOX_JOB_STATUS_SUBMITTING, saq.SAQ_NODE_ID))
+    if c.rowcount == 1:
+        return True
+
+    # take over jobs that failed, jobs that were never submitted and jobs too old to be reused
+    c.execute("""UPDATE sandbox_jobs SET status = %s, job_id = NULL, details = NULL, node_id = %s,
+                 insert_date = NOW(), last_update = NOW()
+                 WHERE sha256 = %s AND sandbox = %s AND profile = %s AND (
+                     status = %s
+                     OR ( status = %s AND last_update < NOW() - INTERVAL %s SECOND )
+                     OR insert_date < NOW() - INTERVAL %s SECOND )""",
+              (SANDBOX_JOB_STATUS_SUBMITTING, saq.SAQ_NODE_ID, sha256, sandbox, profile,
+               SANDBOX_JOB_STATUS_FAILED, SANDBOX_JOB_STATUS_SUBMITTING, submit_timeout, max_age))
+    return c.rowcount == 1
+
+@use_db
+def claim_sandbox_job(sha256, sandbox, profile, db, c):
+    """Claims the submission of the given sample to the given sandbox and profile.
+       Returns a tuple of (claimed, job). If claimed is True then the caller is expected to submit the sample
+       and then call update_sandbox_job with the result. Otherwise job is the existing SandboxJob to use."""
+    sha256 = sha256.lower()
+    profile = str(profile)
+    config = saq.CONFIG['sandbox_jobs']
+    if execute_with_retry(db, c, _claim_sandbox_job, (sha256, sandbox, profile,
+                                                      config.getint('submit_timeout', fallback=600),
+                                                      config.getint('max_age', fallback=86400)), commit=True):
+        logging.debug("claimed sandbox job {} sha256 {} profile {}".format(sandbox, sha256, profile))
+        return True, None
+
+    c.execute("""SELECT sha256, sandbox, profile, job_id, status, details FROM sandbox_jobs
+                 WHERE sha256 = %s AND sandbox = %s AND profile = %s""", (sha256, sandbox, profile))
+    row = c.fetchone()
+    return False, _load_sandbox_job(row) if row is not None else None
+
+@use_db
+def update_sandbox_job(sha256, sandbox, profile, status, job_id=None, details=None, db=None, c=None):
+    """Updates the status (and optionally the job_id and details) of the given sandbox job.
+       Returns True if the job exists."""
+    return execute_with_retry(db, c, """
+                              UPDATE sandbox_jobs SET status = %s, job_id = COALESCE(%s, job_id), 
+                              details = COALESCE(%s, details), last_update = NOW()
+                              WHERE sha256 = %s AND sandbox = %s AND profile = %s""",
+                              (status, job_id, json.dumps(details) if details is not None else None,
+                               sha256.lower(), sandbox, str(profile)), commit=True) > 0
+
+@use_db
+def add_sandbox_job_waiter(sha256, sandbox, profile, uuid, observable_uuid, analysis_module, db, c):
+    """Records that the given delayed analysis is waiting on the given sandbox job.
+       Returns True if the job exists and has not finished yet, False otherwise."""
+    sha256 = sha256.lower()
+    profile = str(profile)
+    c.execute("SELECT status FROM sandbox_jobs WHERE sha256 = %s AND sandbox = %s AND profile = %s",
+              (sha256, sandbox, profile))
+    row = c.fetchone()
+    if row is None or row[0] not in [ SANDBOX_JOB_STATUS_SUBMITTING, SANDBOX_JOB_STATUS_PENDING ]:
+        return False
+
+    execute_with_retry(db, c, """
+                       INSERT INTO sandbox_job_waiters ( sha256, sandbox, profile, uuid, observable_uuid, 
+                                                         analysis_module, node_id, insert_date )
+                       VALUES ( %s, %s, %s, %s, %s, %s, %s, NOW() )
+                       ON DUPLICATE KEY UPDATE node_id = VALUES(node_id), insert_date = VALUES(insert_date)""",
+                       (sha256, sandbox, profile, uuid, observable_uuid, analysis_module, saq.SAQ_NODE_ID),
+                       commit=True)
+    return True
+
+@use_db
+def remove_sandbox_job_waiter(sha256, sandbox, profile, uuid, observable_uuid, analysis_module, db, c):
+    execute_with_retry(db, c, """
+                       DELETE FROM sandbox_job_waiters WHERE sha256 = %s AND sandbox = %s AND profile = %s
+                       AND uuid = %s AND observable_uuid = %s AND analysis_module = %s""",
+                       (sha256, sandbox, profile, uuid, observable_uuid, analysis_module), commit=True)
+
+@use_db
+def get_waiting_sandbox_jobs(node_id, db, c):
+    """Returns a list of (SandboxJob, waiters) for every sandbox job that analysis on the given node is waiting on,
+       where waiters is the list of (uuid, observable_uuid, analysis_module) of the delayed analysis."""
+    c.execute("""SELECT j.sha256, j.sandbox, j.profile, j.job_id, j.status, j.details, 
+                        w.uuid, w.observable_uuid, w.analysis_module
+                 FROM sandbox_jobs j JOIN sandbox_job_waiters w 
+                     ON j.sha256 = w.sha256 AND j.sandbox = w.sandbox AND j.profile = w.profile
+                 WHERE w.node_id = %s
+                 ORDER BY j.sha256, j.sandbox, j.profile""", (node_id,))
+
+    result = []
+    for row in c:
+        if not result or (result[-1][0].sha256, result[-1][0].sandbox, result[-1][0].profile) != row[:3]:
+            result.append((_load_sandbox_job(row[:6]), []))
+
+        result[-1][1].append(row[6:])
+
+    return result
+
+@use_db
+def clear_expired_sandbox_job_waiters(node_id, seconds, db, c):
+    """Deletes waiters on the given node that have been waiting longer than the given number of seconds."""
+    return execute_with_retry(db, c, """
+                              DELETE FROM sandbox_job_waiters 
+                              WHERE node_id = %s AND insert_date < NOW() - INTERVAL %s SECOND""",
+                              (node_id, seconds), commit=True)
+
 class SandboxAnalysisModule(AnalysisModule):
 
     @property
@@ -44,6 +197,73 @@ class SandboxAnalysisModule(AnalysisModule):
     def valid_observable_types(self):
         return F_FILE
 
+    @property
+    def sandbox_name(self):
+        """The name the jobs of this sandbox are tracked under in the sandbox_jobs table.
+           Analysis modules that use the same sandbox should return the same name."""
+        return self.config_section
+
+    @property
+    def use_job_registry(self):
+        """Returns True if submissions to this sandbox are tracked in the sandbox_jobs table."""
+        return saq.CONFIG['sandbox_jobs'].getboolean('enabled', fallback=False)
+
+    @property
+    def use_job_poller(self):
+        """Returns True if the sandbox job poller service resumes the analysis waiting on sandbox jobs."""
+        return self.use_job_registry and saq.CONFIG['service_sandbox_poller'].getboolean('enabled', fallback=False)
+
+    @property
+    def job_poller_fallback_frequency(self):
+        """The amount of time (in seconds) analysis waiting on the sandbox job poller checks back on its own."""
+        return saq.CONFIG['sandbox_jobs'].getint('fallback_frequency', fallback=300)
+
+    def get_sample_sha256(self, path):
+        """Returns the (lower case) sha256 of the given file."""
+        h = hashlib.sha256()
+        with open(path, 'rb') as fp:
+            while True:
+                data = fp.read(io.DEFAULT_BUFFER_SIZE)
+                if not data:
+                    break
+
+                h.update(data)
+
+        return h.hexdigest()
+
+    def claim_submission(self, sha256, profile):
+        """Claims the submission of the given sample with the given profile to this sandbox.
+           Returns a tuple of (claimed, job), see claim_sandbox_job.
+           If the job registry is not used then the submission is always claimed."""
+        if not self.use_job_registry:
+            return True, None
+
+        return claim_sandbox_job(sha256, self.sandbox_name, profile)
+
+    def record_submission(self, sha256, profile, status, job_id=None, details=None):
+        """Records the status of the job of the given sample with the given profile."""
+        if not self.use_job_registry:
+            return False
+
+        return update_sandbox_job(sha256, self.sandbox_name, profile, status, job_id=job_id, details=details)
+
+    def get_sandbox_job_status(self, job):
+        """Returns the current SANDBOX_JOB_STATUS_* of the given SandboxJob as reported by the sandbox.
+           This is called by the sandbox job poller service. Override this in your subclass."""
+        raise NotImplementedError()
+
+    def wait_for_sandbox_job(self, observable, analysis, sha256, profile, seconds, timeout_minutes=None):
+        """Delays analysis until the sandbox job of the given sample and profile has finished.
+           If the job is tracked by the sandbox job poller then the analysis is resumed when the job finishes
+           (and otherwise checks back every fallback_frequency seconds.)
+           If it is not then the analysis checks back in the given number of seconds."""
+        if self.use_job_poller and sha256 is not None \
+        and add_sandbox_job_waiter(sha256, self.sandbox_name, profile, self.root.uuid, observable.id, 
+                                   self.config_section):
+            seconds = max(seconds, self.job_poller_fallback_frequency)
+
+        return self.delay_analysis(observable, analysis, seconds=seconds, timeout_minutes=timeout_minutes)
+
     @property
     def required_directives(self):
         return [ DIRECTIVE_SANDBOX ]
@@ -9,6 +9,11 @@ import re
 import smtplib
 import ipaddress
 
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
 import saq
 
 from saq.analysis import Analysis, Observable, recurse_down, TaggableObject
@@ -16,7 +21,8 @@ from saq.database import Alert
 from saq.constants import *
 from saq.error import report_exception
 from saq.modules import AnalysisModule, TagAnalysisModule
-from saq.util import is_subdomain
+from saq.radix import NetworkTree
+from saq.util import is_subdomain, DomainTrie
 
 class TagAnalysis(Analysis):
     """Base class for all tag analysis.  We don't display this as analysis in the GUI."""
@@ -106,6 +112,163 @@ class _tag_mapping(object):
         # is value equal to or a subdomain of self.value?
         return is_subdomain(value, self.value)
 
+def _glob_literals(pattern):
+    """Returns the list of literal strings that any value that matches the given glob pattern must contain.
+       The pattern is parsed the same way fnmatch.translate parses it."""
+    literals = []
+    current = []
+    index = 0
+    while index < len(pattern):
+        c = pattern[index]
+        if c == '[':
+            # a ] right after the [ (or [!) is part of the set
+            end = index + 1
+            if end < len(pattern) and pattern[end] == '!':
+                end += 1
+            if end < len(pattern) and pattern[end] == ']':
+                end += 1
+
+            end = pattern.find(']', end)
+            if end == -1:
+                # fnmatch treats a [ without a matching ] as a literal [
+                current.append(c)
+            else:
+                if current:
+                    literals.append(''.join(current))
+                    current = []
+
+                # skip over the character set
+                index = end
+
+        elif c in '*?':
+            if current:
+                literals.append(''.join(current))
+                current = []
+
+        else:
+            current.append(c)
+
+        index += 1
+
+    if current:
+        literals.append(''.join(current))
+
+    return literals
+
+def _regex_literals(pattern, flags=0):
+    """Returns the list of literal strings that any value that matches the given regex must contain.
+       Only literals at the top level of the regex are used, so this may return nothing."""
+    literals = []
+    current = []
+    for op, av in sre_parse.parse(pattern, flags):
+        if op == sre_parse.LITERAL:
+            current.append(chr(av))
+            continue
+
+        if current:
+            literals.append(''.join(current))
+            current = []
+
+    if current:
+        literals.append(''.join(current))
+
+    return literals
+
+def _trigrams(value):
+    return [ value[index:index + 3] for index in range(len(value) - 2) ]
+
+class _compiled_tag_mappings(object):
+    """All the _tag_mapping objects for a single observable type compiled together so that every matching
+       mapping is found at once instead of testing each mapping in turn.
+       - default mappings are looked up in dicts
+       - cidr mappings are stored in a prefix tree
+       - subdomain mappings are stored in a trie of reversed domain labels
+       - glob and regex mappings are indexed by a (lowercase) trigram of a literal string every match must contain
+         so that only the patterns that can possibly match are tested"""
+
+    def __init__(self, mappings):
+        self.mappings = mappings
+
+        self.exact = {} # key = value, value = [mapping_index]
+        self.exact_ignore_case = {} # key = value.lower(), value = [mapping_index]
+        self.networks = NetworkTree() # data = mapping_index
+        self.other_networks = [] # list of (ipaddress.ip_network, mapping_index) for non-ipv4 networks
+        self.subdomains = DomainTrie()
+        self.subdomain_mappings = {} # key = domain (lowercase), value = [mapping_index]
+        self.patterns = {} # key = trigram, value = [(compiled_regex, is_glob, mapping_index)]
+        self.unindexed_patterns = [] # list of (compiled_regex, is_glob, mapping_index) that are always tested
+
+        for index, mapping in enumerate(mappings):
+            if mapping.match_type == _tag_mapping.MATCH_TYPE_DEFAULT:
+                if mapping.ignore_case:
+                    self.exact_ignore_case.setdefault(mapping.value.lower(), []).append(index)
+                else:
+                    self.exact.setdefault(mapping.value, []).append(index)
+
+            elif mapping.match_type == _tag_mapping.MATCH_TYPE_CIDR:
+                if isinstance(mapping.compiled_cidr, ipaddress.IPv4Network):
+                    self.networks.add(mapping.compiled_cidr, data=index)
+                else:
+                    self.other_networks.append((mapping.compiled_cidr, index))
+
+            elif mapping.match_type == _tag_mapping.MATCH_TYPE_SUBDOMAIN:
+                self.subdomains.add(mapping.value)
+                self.subdomain_mappings.setdefault(mapping.value.lower(), []).append(index)
+
+            elif mapping.match_type in [ _tag_mapping.MATCH_TYPE_GLOB, _tag_mapping.MATCH_TYPE_REGEX ]:
+                if mapping.match_type == _tag_mapping.MATCH_TYPE_GLOB:
+                    # fnmatch.fnmatch only ignores case if the platform does (see os.path.normcase)
+                    pattern = os.path.normcase(mapping.value) if mapping.ignore_case else mapping.value
+                    entry = (re.compile(fnmatch.translate(pattern)), True, index)
+                    literals = _glob_literals(pattern)
+                else:
+                    entry = (mapping.compiled_regex, False, index)
+                    literals = _regex_literals(mapping.value, mapping.compiled_regex.flags)
+
+                # index the pattern by the trigram that has the fewest patterns so far
+                trigrams = [ _ for literal in literals for _ in _trigrams(literal.lower()) ]
+                if not trigrams:
+                    self.unindexed_patterns.append(entry)
+                    continue
+
+                trigram = min(trigrams, key=lambda _: len(self.patterns.get(_, ())))
+                self.patterns.setdefault(trigram, []).append(entry)
+
+    def matches(self, value):
+        """Returns the list of _tag_mapping objects that match the given value (in the order they were loaded.)"""
+        result = set()
+        result.update(self.exact.get(value, ()))
+        if self.exact_ignore_case:
+            result.update(self.exact_ignore_case.get(value.lower(), ()))
+
+        if len(self.networks) or self.other_networks:
+            try:
+                address = ipaddress.ip_address(value)
+                if isinstance(address, ipaddress.IPv4Address):
+                    result.update([ entry.data for entry in self.networks.matches(int(address)) ])
+
+                for network, index in self.other_networks:
+                    if address in network:
+                        result.add(index)
+
+            except ValueError as e:
+                logging.debug("{} did not parse out to be an ip/cidr: {}".format(value, e))
+
+        if self.subdomain_mappings:
+            for domain in self.subdomains.find_all(value):
+                result.update(self.subdomain_mappings[domain])
+
+        candidates = list(self.unindexed_patterns)
+        if self.patterns:
+            for trigram in set(_trigrams(value.lower())):
+                candidates.extend(self.patterns.get(trigram, ()))
+
+        for regex, is_glob, index in candidates:
+            if regex.match(value) if is_glob else regex.search(value):
+                result.add(index)
+
+        return [ self.mappings[index] for index in sorted(result) ]
+
 class SiteTagAnalyzer(TagAnalysisModule):
     def verify_environment(self):
         self.verify_config_exists('csv_file')
@@ -129,31 +292,34 @@ class SiteTagAnalyzer(TagAnalysisModule):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.tag_mapping = {} # key = type, value = [_tag_mapping]
+        self.tag_mapping = {} # key = type, value = _compiled_tag_mappings
         self.watch_file(self.csv_file, self.load_csv_file)
 
     def load_csv_file(self):
+        tag_mapping = {} # key = type, value = [_tag_mapping]
+
         # load the configuration
         with open(self.csv_file, 'r') as fp:
             for row in csv.reader(fp):
                 try:
                     o_types, match_type, ignore_case, value, tags = row
+                    o_types = o_types.split('|')
+                    ignore_case = bool(ignore_case)
+                    tags = tags.split('|')
+
+                    mapper = _tag_mapping(match_type, ignore_case, value, tags)
+                    #logging.debug("created mapping {}".format(mapper))
                 except Exception as e:
                     logging.error("invalid tag specification: {}: {}".format(','.join(row), e))
                     continue
 
-                o_types = o_types.split('|')
-                ignore_case = bool(ignore_case)
-                tags = tags.split('|')
-
-                mapper = _tag_mapping(match_type, ignore_case, value, tags)
-                #logging.debug("created mapping {}".format(mapper))
-
                 for o_type in o_types:
-                    if o_type not in self.tag_mapping:
-                        self.tag_mapping[o_type] = []
+                    if o_type not in tag_mapping:
+                        tag_mapping[o_type] = []
+
+                    tag_mapping[o_type].append(mapper)
 
-                    self.tag_mapping[o_type].append(mapper)
+        self.tag_mapping = { o_type: _compiled_tag_mappings(mappings) for o_type, mappings in tag_mapping.items() }
 
     def execute_analysis(self, observable):
 
@@ -162,11 +328,10 @@ class SiteTagAnalyzer(TagAnalysisModule):
 
         analysis = self.create_analysis(observable)
 
-        for mapper in self.tag_mapping[observable.type]:
-            if mapper.matches(observable.value):
-                logging.debug("{} matches {}".format(observable, mapper))
-                for tag in mapper.tags:
-                    observable.add_tag(tag)
+        for mapper in self.tag_mapping[observable.type].matches(observable.value):
+            logging.debug("{} matches {}".format(observable, mapper))
+            for tag in mapper.tags:
+                observable.add_tag(tag)
 
         return True
 
@@ -195,6 +360,8 @@ class CorrelatedTagDefinition(object):
         self.text = text
         # the list of tags we expect to see in the children of a target object
         self.tags = set(tags)
+        # the bitmask of the tags (see CorrelatedTagAnalyzer.tag_bits)
+        self.mask = 0
 
 class CorrelatedTagAnalyzer(AnalysisModule):
     """Does this combination of tagging exist on objects with a common ancestry?"""
@@ -215,27 +382,55 @@ class CorrelatedTagAnalyzer(AnalysisModule):
                                          [x.strip() for x in self.config[config_rule].split(',')]))
                 logging.debug("loaded definition for {}".format(config_rule))
 
-    def execute_post_analysis(self):
+        # each tag used by a definition is assigned a bit so that definitions can be matched with a mask test
+        self.tag_bits = {} # key = tag, value = bit
         for d in self.definitions:
-            tag_map = {} # key = object_id, value = [tags]
-            def callback(obj):
-                if obj is self.root:
-                    return
-
-                if id(obj) not in tag_map:
-                    tag_map[id(obj)] = set()
-
-                tag_map[id(obj)].add(t)
-                if tag_map[id(obj)] == d.tags:
-                    o.add_detection_point("Correlated Tag Match: {}".format(d.text))
-
-            for t in d.tags:
-                for o in self.root.all:
-                    # exclude looking at the RootAnalysis object itself
-                    if o is self.root:
-                        continue
-
-                    # if this object has the tag we're looking for...
-                    if o.has_tag(t):
-                        # then "apply" the tag all the way down to (but not including) the root
-                        recurse_down(o, callback)
+            for tag in d.tags:
+                if tag not in self.tag_bits:
+                    self.tag_bits[tag] = 1 << len(self.tag_bits)
+
+                d.mask |= self.tag_bits[tag]
+
+    def execute_post_analysis(self):
+        if not self.definitions:
+            return
+
+        # map each object to the objects that reference it (the next step towards the root)
+        parents = {} # key = id(obj), value = [obj]
+        for analysis in self.root.all_analysis:
+            for observable in analysis.observables:
+                parents.setdefault(id(observable), []).append(analysis)
+
+        for observable in self.root.all_observables:
+            for analysis in observable.all_analysis:
+                parents.setdefault(id(analysis), []).append(observable)
+
+        # then "apply" the tags of each tagged object all the way down to (but not including) the root
+        tag_map = {} # key = id(obj), value = mask of the tags applied to the object
+        for o in self.root.all:
+            # exclude looking at the RootAnalysis object itself
+            if o is self.root:
+                continue
+
+            mask = 0
+            for tag in o.tags:
+                mask |= self.tag_bits.get(tag.name, 0)
+
+            if not mask:
+                continue
+
+            definitions = [ d for d in self.definitions if d.mask & mask ]
+            visited = set([ id(o) ])
+            targets = list(parents.get(id(o), []))
+            while targets:
+                target = targets.pop()
+                if target is self.root or id(target) in visited:
+                    continue
+
+                visited.add(id(target))
+                target_mask = tag_map[id(target)] = tag_map.get(id(target), 0) | mask
+                for d in definitions:
+                    if target_mask & d.mask == d.mask:
+                        o.add_detection_point("Correlated Tag Match: {}".format(d.text))
+
+                targets.extend(parents.get(id(target), []))
@@ -0,0 +1,80 @@
+# vim: sw=4:ts=4:et:cc=120
+
+import os, os.path
+import shutil
+
+import saq
+from saq.constants import *
+from saq.modules.asn import ASNAnalyzer, ASNAnalysis
+from saq.test import *
+
+class TestCase(ACEBasicTestCase):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+
+        self.asn_dir = os.path.join(saq.TEMP_DIR, 'asn')
+        if os.path.isdir(self.asn_dir):
+            shutil.rmtree(self.asn_dir)
+
+        os.makedirs(self.asn_dir)
+
+        with open(os.path.join(self.asn_dir, 'data-raw-table'), 'w') as fp:
+            fp.write('1.0.0.0/24\t13335\n')
+            fp.write('8.0.0.0/8\t3356\n')
+            fp.write('8.8.8.0/24\t15169\n')
+            fp.write('9.9.9.0/24\t99999\n') # unknown owner
+
+        with open(os.path.join(self.asn_dir, 'data-used-autnums'), 'w') as fp:
+            fp.write('  3356 LEVEL3, US\n')
+            fp.write(' 13335 CLOUDFLARENET, US\n')
+            fp.write(' 15169 GOOGLE, US\n')
+
+        if not saq.CONFIG.has_section('analysis_module_test_asn'):
+            saq.CONFIG.add_section('analysis_module_test_asn')
+
+        config = saq.CONFIG['analysis_module_test_asn']
+        config['netmask_to_asn_file'] = os.path.join(self.asn_dir, 'data-raw-table')
+        config['netmask_to_asn_file_encoding'] = 'latin-1'
+        config['asn_to_owner_file'] = os.path.join(self.asn_dir, 'data-used-autnums')
+        config['asn_to_owner_file_encoding'] = 'latin-1'
+        config['asn_table_file'] = os.path.join(self.asn_dir, 'asn.table')
+
+    def tearDown(self, *args, **kwargs):
+        super().tearDown(*args, **kwargs)
+        saq.CONFIG.remove_section('analysis_module_test_asn')
+
+    def test_lookup(self):
+        analyzer = ASNAnalyzer('analysis_module_test_asn')
+        self.assertTrue(os.path.exists(os.path.join(self.asn_dir, 'asn.table')))
+
+        self.assertEquals(analyzer.lookup('1.0.0.1'), ('1.0.0.0/24', '13335', 'CLOUDFLARENET, US'))
+        # most specific route wins
+        self.assertEquals(analyzer.lookup('8.8.8.8'), ('8.8.8.0/24', '15169', 'GOOGLE, US'))
+        self.assertEquals(analyzer.lookup('8.8.9.8'), ('8.0.0.0/8', '3356', 'LEVEL3, US'))
+        self.assertIsNone(analyzer.lookup('9.9.9.9'))
+        self.assertIsNone(analyzer.lookup('10.0.0.1'))
+
+    def test_execute_analysis(self):
+        analyzer = ASNAnalyzer('analysis_module_test_asn')
+        root = create_root_analysis()
+        ipv4 = root.add_observable(F_IPV4, '8.8.8.8')
+        analyzer.execute_analysis(ipv4)
+        analysis = ipv4.get_analysis(ASNAnalysis)
+        self.assertIsNotNone(analysis)
+        self.assertEquals(analysis.cidr, '8.8.8.0/24')
+        self.assertEquals(analysis.asn, '15169')
+        self.assertEquals(analysis.organization, 'GOOGLE, US')
+
+    def test_rebuild(self):
+        analyzer = ASNAnalyzer('analysis_module_test_asn')
+        self.assertIsNone(analyzer.lookup('9.9.9.9'))
+
+        with open(os.path.join(self.asn_dir, 'data-used-autnums'), 'a') as fp:
+            fp.write(' 99999 QUAD9, US\n')
+
+        # make sure the change is detected even if it happens within the same mtime tick
+        os.utime(os.path.join(self.asn_dir, 'data-used-autnums'),
+                 (os.path.getmtime(os.path.join(self.asn_dir, 'asn.table')) + 1, ) * 2)
+
+        analyzer.load_asn_table()
+        self.assertEquals(analyzer.lookup('9.9.9.9'), ('9.9.9.0/24', '99999', 'QUAD9, US'))
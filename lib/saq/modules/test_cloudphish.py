@@ -14,7 +14,7 @@ from aceapi.cloudphish.test import CloudphishTestCase
 from saq.analysis import RootAnalysis, Analysis
 from saq.cloudphish import *
 from saq.constants import *
-from saq.database import get_db_connection, use_db
+from saq.database import get_db_connection, use_db, initialize_node
 from saq.test import *
 from saq.util import *
 
@@ -140,6 +140,83 @@ class TestCase(CloudphishTestCase, ACEModuleTestCase):
         self.assertEquals(cloudphish_analysis.location, q[KEY_LOCATION])
         self.assertEquals(cloudphish_analysis.file_name, q[KEY_FILE_NAME])
 
+    def test_submit_wait(self):
+
+        # the delayed analysis only comes due on its own after a long time
+        saq.CONFIG['analysis_module_cloudphish']['frequency'] = '300'
+        saq.CONFIG['analysis_module_cloudphish']['wait_for_result'] = 'yes'
+        saq.CONFIG['analysis_module_cloudphish']['wait_timeout'] = '10'
+
+        self.start_api_server()
+
+        root = create_root_analysis(analysis_mode=ANALYSIS_MODE_ANALYSIS)
+        root.initialize_storage()
+        url = root.add_observable(F_URL, TEST_URL)
+        url.add_directive(DIRECTIVE_CRAWL)
+        root.save()
+        root.schedule()
+
+        engine = TestEngine(analysis_pools={ANALYSIS_MODE_ANALYSIS: 1,
+                                            ANALYSIS_MODE_CLOUDPHISH: 1}, 
+                            local_analysis_modes=[ANALYSIS_MODE_ANALYSIS,
+                                                  ANALYSIS_MODE_CLOUDPHISH])
+
+        engine.enable_module('analysis_module_cloudphish', ANALYSIS_MODE_ANALYSIS)
+        engine.enable_module('analysis_module_cloudphish_request_analyzer', ANALYSIS_MODE_CLOUDPHISH)
+        engine.enable_module('analysis_module_crawlphish', ANALYSIS_MODE_CLOUDPHISH)
+
+        engine.start()
+
+        # the waiter resumes the delayed analysis as soon as cloudphish is done
+        wait_for_log_count('resumed delayed analysis', 1, 10)
+        wait_for_log_count('analysis CloudphishAnalysis is completed', 1, 10)
+
+        engine.controlled_stop()
+        engine.wait()
+
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        url = root.get_observable(url.id)
+
+        from saq.modules.cloudphish import CloudphishAnalysis
+        cloudphish_analysis = url.get_analysis(CloudphishAnalysis)
+        self.assertIsNotNone(cloudphish_analysis)
+        self.assertEquals(cloudphish_analysis.status, STATUS_ANALYZED)
+        self.assertEquals(cloudphish_analysis.analysis_result, SCAN_RESULT_CLEAR)
+
+    def test_wait_failure(self):
+        from saq.modules.cloudphish import CloudphishResultWaiter
+        initialize_node()
+
+        root = create_root_analysis(analysis_mode=ANALYSIS_MODE_ANALYSIS)
+        root.initialize_storage()
+        url = root.add_observable(F_URL, TEST_URL)
+        root.save()
+
+        with get_db_connection() as db:
+            c = db.cursor()
+            c.execute("""INSERT INTO delayed_analysis ( uuid, observable_uuid, analysis_module, delayed_until, node_id,
+                                                       storage_dir, insert_date )
+                         VALUES ( %s, %s, 'analysis_module_cloudphish', NOW() + INTERVAL 1 HOUR, %s, %s, NOW() )""",
+                      (root.uuid, url.id, saq.SAQ_NODE_ID, root.storage_dir))
+            db.commit()
+
+        def _wait():
+            raise requests.exceptions.HTTPError('404 Client Error: NOT FOUND')
+
+        # if the wait request fails then the delayed analysis goes back to polling every frequency seconds
+        waiter = CloudphishResultWaiter()
+        waiter.wait('0' * 64, _wait, (root.uuid, url.id, 'analysis_module_cloudphish'), 30)
+        wait_for_log_count('resumed delayed analysis', 1, 5)
+
+        with get_db_connection() as db:
+            c = db.cursor()
+            c.execute("""SELECT TIMESTAMPDIFF(SECOND, NOW(), delayed_until) FROM delayed_analysis
+                         WHERE uuid = %s AND observable_uuid = %s""", (root.uuid, url.id))
+            delay = c.fetchone()[0]
+
+        self.assertTrue(25 <= delay <= 30)
+
     def test_submit_alert(self):
 
         # disable cleaup for analysis mode analysis
@@ -0,0 +1,237 @@
+# vim: sw=4:ts=4:et:cc=120
+
+import http.server
+import json
+import threading
+import urllib.parse
+import uuid
+
+import saq
+from saq.constants import *
+from saq.modules.elk import SnortAlertsAnalyzer
+from saq.test import *
+
+class FakeElasticsearchServer(object):
+    """A local http server that implements enough of the Elasticsearch search api to test with.
+       Documents are added to the indexes attribute (key = index name, value = list of documents.)
+       Queries are expected to be in the form field:value OR field:value ..."""
+
+    def __init__(self):
+        self.indexes = {}
+
+        # key = scroll_id, value = list of remaining hits
+        self.scrolls = {}
+        self.lock = threading.Lock()
+
+        # statistics
+        self.requests = [] # list of (method, path)
+
+        fake = self
+        class _handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, *args, **kwargs):
+                pass
+
+            def _handle(self, method):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+                fake.handle(self, method, body)
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_POST(self):
+                self._handle('POST')
+
+            def do_DELETE(self):
+                self._handle('DELETE')
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def uri(self):
+        return 'http://127.0.0.1:{}/'.format(self.server.server_address[1])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="Fake Elasticsearch Server")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def respond(self, handler, status, result):
+        body = json.dumps(result).encode()
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def execute(self, index, search_json):
+        """Returns the list of hits that match the search."""
+        query = search_json['query']['bool']['filter'][0]['query_string']['query']
+        terms = [ _.strip().split(':', 1) for _ in query.split(' OR ') ]
+        hits = []
+        for doc_id, doc in enumerate(self.indexes.get(index, [])):
+            if any([ str(doc.get(field)) == value for field, value in terms ]):
+                hits.append({ '_index': index, '_id': str(doc_id), '_source': doc })
+
+        return hits
+
+    def page(self, hits, size, scroll_id=None):
+        result = { 'took': 1, 'timed_out': False, '_shards': { 'total': 1, 'successful': 1, 'failed': 0 },
+                   'hits': { 'total': len(hits), 'hits': hits[:size] } }
+        if scroll_id is not None:
+            result['_scroll_id'] = scroll_id
+
+        return result
+
+    def handle(self, handler, method, body):
+        url = urllib.parse.urlparse(handler.path)
+        params = urllib.parse.parse_qs(url.query)
+        with self.lock:
+            self.requests.append((method, url.path))
+
+        if url.path == '/_msearch' and method == 'POST':
+            lines = [ json.loads(_) for _ in body.split('\n') if _.strip() ]
+            responses = []
+            for header, search_json in zip(lines[0::2], lines[1::2]):
+                if header['index'] not in self.indexes:
+                    responses.append({ 'error': { 'type': 'index_not_found_exception' }, 'status': 404 })
+                    continue
+
+                responses.append(self.page(self.execute(header['index'], search_json), search_json['size']))
+
+            return self.respond(handler, 200, { 'took': 1, 'responses': responses })
+
+        if url.path == '/_search/scroll':
+            request = json.loads(body)
+            if method == 'DELETE':
+                with self.lock:
+                    for scroll_id in request['scroll_id']:
+                        self.scrolls.pop(scroll_id, None)
+
+                return self.respond(handler, 200, { 'succeeded': True })
+
+            with self.lock:
+                scroll = self.scrolls.get(request['scroll_id'])
+
+            if scroll is None:
+                return self.respond(handler, 404, { 'error': 'search_context_missing_exception' })
+
+            size, hits = scroll
+            with self.lock:
+                self.scrolls[request['scroll_id']] = (size, hits[size:])
+
+            return self.respond(handler, 200, self.page(hits, size, request['scroll_id']))
+
+        if url.path.endswith('/_search'):
+            index = url.path[1:-len('/_search')]
+            if index not in self.indexes:
+                return self.respond(handler, 404, { 'error': { 'type': 'index_not_found_exception' } })
+
+            search_json = json.loads(body)
+            hits = self.execute(index, search_json)
+            size = search_json['size']
+            scroll_id = None
+            if 'scroll' in params:
+                scroll_id = str(uuid.uuid4())
+                with self.lock:
+                    self.scrolls[scroll_id] = (size, hits[size:])
+
+            result = self.page(hits, size, scroll_id)
+            result['_clusters'] = { 'total': 1 }
+            return self.respond(handler, 200, result)
+
+        return self.respond(handler, 404, { 'error': 'not found' })
+
+class TestCase(ACEBasicTestCase):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+
+        self.server = FakeElasticsearchServer()
+        self.server.indexes['snort'] = [ { 'src_ip': '10.0.0.{}'.format(index % 3), 'dest_ip': '1.2.3.4' }
+                                         for index in range(30) ]
+        self.server.start()
+
+        saq.CONFIG['elk']['enabled'] = 'yes'
+        if not saq.CONFIG.has_section('analysis_module_test_snort_alerts'):
+            saq.CONFIG.add_section('analysis_module_test_snort_alerts')
+
+    def tearDown(self, *args, **kwargs):
+        super().tearDown(*args, **kwargs)
+        self.server.stop()
+        saq.CONFIG['elk']['enabled'] = 'no'
+        saq.CONFIG.remove_section('analysis_module_test_snort_alerts')
+
+    def create_analyzer(self, root=None, **settings):
+        for key, value in settings.items():
+            saq.CONFIG['analysis_module_test_snort_alerts'][key] = str(value)
+
+        analyzer = SnortAlertsAnalyzer('analysis_module_test_snort_alerts')
+        analyzer.elk_uri = self.server.uri
+        analyzer.root = root
+        return analyzer
+
+    def test_search(self):
+        analyzer = self.create_analyzer(create_root_analysis(), max_result_count=5)
+        result = analyzer.search('snort', 'src_ip:10.0.0.1')
+        self.assertEquals(result['hits']['total'], 10)
+        self.assertEquals(len(result['hits']['hits']), 5)
+        self.assertEquals(analyzer.search_count, 1)
+        self.assertTrue(analyzer.search_time > 0)
+
+    def test_search_pages(self):
+        # more results than fit in a single page
+        analyzer = self.create_analyzer(create_root_analysis(), max_result_count=25, page_size=4)
+        result = analyzer.search('snort', 'dest_ip:1.2.3.4')
+        self.assertEquals(len(result['hits']['hits']), 25)
+        self.assertEquals(len(set([ _['_id'] for _ in result['hits']['hits'] ])), 25)
+        # 7 pages
+        self.assertEquals(analyzer.search_count, 7)
+        # and the scroll was cleared
+        self.assertEquals(self.server.scrolls, {})
+
+    def test_iter_search(self):
+        analyzer = self.create_analyzer(create_root_analysis(), max_result_count=10, page_size=4)
+        hits = analyzer.iter_search('snort', 'dest_ip:1.2.3.4', limit=0)
+        self.assertEquals(next(hits)['_source']['dest_ip'], '1.2.3.4')
+        # only the first page has been downloaded
+        self.assertEquals(analyzer.search_count, 1)
+        self.assertEquals(len(list(hits)), 29)
+        self.assertEquals(self.server.scrolls, {})
+
+        # stopping early still clears the scroll
+        hits = analyzer.iter_search('snort', 'dest_ip:1.2.3.4', limit=0)
+        next(hits)
+        hits.close()
+        self.assertEquals(self.server.scrolls, {})
+
+    def test_msearch(self):
+        analyzer = self.create_analyzer(create_root_analysis())
+        results = analyzer.msearch([ ('snort', analyzer.build_search('src_ip:10.0.0.0')),
+                                     ('missing', analyzer.build_search('src_ip:10.0.0.0')),
+                                     ('snort', analyzer.build_search('src_ip:10.0.0.2')) ])
+
+        self.assertEquals(len(results), 3)
+        self.assertEquals(results[0]['hits']['total'], 10)
+        self.assertIsNone(results[1])
+        self.assertEquals(results[2]['hits']['total'], 10)
+        self.assertEquals(self.server.requests, [ ('POST', '/_msearch') ])
+
+    def test_batch_search(self):
+        root = create_root_analysis()
+        ipv4s = [ root.add_observable(F_IPV4, '10.0.0.{}'.format(index)) for index in range(4) ]
+        analyzer = self.create_analyzer(root, batch_size=10)
+
+        for ipv4 in ipv4s:
+            self.assertTrue(analyzer.execute_analysis(ipv4))
+            analysis = ipv4.get_analysis(analyzer.generated_analysis_type)
+            self.assertIsNotNone(analysis)
+            self.assertEquals(analysis.details['hits']['total'], 0 if ipv4.value == '10.0.0.3' else 10)
+
+        # all of the observables were searched in a single request
+        self.assertEquals(self.server.requests, [ ('POST', '/_msearch') ])
@@ -0,0 +1,89 @@
+# vim: sw=4:ts=4:et:cc=120
+
+import os, os.path
+import shutil
+
+import saq
+from saq.constants import *
+from saq.modules.ipdb import IPDBAnalyzer, IPDBAnalysis
+from saq.test import *
+
+class TestCase(ACEBasicTestCase):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+
+        self.ipdb_dir = os.path.join(saq.TEMP_DIR, 'ipdb')
+        if os.path.isdir(self.ipdb_dir):
+            shutil.rmtree(self.ipdb_dir)
+
+        os.makedirs(self.ipdb_dir)
+        self.csv_file = os.path.join(self.ipdb_dir, 'ip_database.csv')
+
+        with open(self.csv_file, 'w') as fp:
+            fp.write('Count,Network,Host,Type,Division,Location,Name,Comment\n')
+            fp.write('1,010.001.002.000 - Server Network\n')
+            fp.write('2,10.1.2,10,Server,IT,Datacenter,server10,web server\n')
+            fp.write('3,10.1.2,11,Server,IT,Datacenter,server11,\n')
+            fp.write('4,000.000.000.000 - Unassigned\n')
+            fp.write('5,0.0.0,12,Server,IT,Datacenter,ignored,\n')
+            fp.write('6,010.001.003.000 - Workstation Network\n')
+
+        if not saq.CONFIG.has_section('analysis_module_test_ipdb'):
+            saq.CONFIG.add_section('analysis_module_test_ipdb')
+
+        config = saq.CONFIG['analysis_module_test_ipdb']
+        config['csv_file'] = self.csv_file
+        config['csv_file_encoding'] = 'latin-1'
+        config['table_file'] = os.path.join(self.ipdb_dir, 'ip_database.table')
+
+    def tearDown(self, *args, **kwargs):
+        super().tearDown(*args, **kwargs)
+        saq.CONFIG.remove_section('analysis_module_test_ipdb')
+
+    def test_lookup(self):
+        analyzer = IPDBAnalyzer('analysis_module_test_ipdb')
+        self.assertTrue(os.path.exists(os.path.join(self.ipdb_dir, 'ip_database.table')))
+
+        # assignments win over the network they are in
+        details = analyzer.lookup('10.1.2.10')
+        self.assertEquals(details['ipv4'], '10.1.2.10')
+        self.assertEquals(details['name'], 'server10')
+        self.assertEquals(details['comment'], 'web server')
+
+        details = analyzer.lookup('10.1.2.200')
+        self.assertEquals(details['network'], '10.1.2')
+        self.assertEquals(details['network_name'], 'Server Network')
+
+        self.assertEquals(analyzer.lookup('10.1.3.1')['network_name'], 'Workstation Network')
+        self.assertIsNone(analyzer.lookup('0.0.0.12'))
+        self.assertIsNone(analyzer.lookup('10.1.4.1'))
+
+    def test_execute_analysis(self):
+        analyzer = IPDBAnalyzer('analysis_module_test_ipdb')
+        root = create_root_analysis()
+        ipv4 = root.add_observable(F_IPV4, '10.1.2.11')
+        analyzer.execute_analysis(ipv4)
+        analysis = ipv4.get_analysis(IPDBAnalysis)
+        self.assertIsNotNone(analysis)
+        self.assertEquals(analysis.name, 'server11')
+        self.assertEquals(analysis.type, 'Server')
+
+        ipv4 = root.add_observable(F_IPV4, '192.168.1.1')
+        analyzer.execute_analysis(ipv4)
+        analysis = ipv4.get_analysis(IPDBAnalysis)
+        self.assertIsNotNone(analysis)
+        self.assertIsNone(analysis.details)
+
+    def test_reload(self):
+        analyzer = IPDBAnalyzer('analysis_module_test_ipdb')
+        self.assertIsNone(analyzer.lookup('10.1.4.1'))
+
+        with open(self.csv_file, 'a') as fp:
+            fp.write('7,010.001.004.000 - Lab Network\n')
+
+        # make sure the change is detected even if it happens within the same mtime tick
+        table_mtime = os.path.getmtime(os.path.join(self.ipdb_dir, 'ip_database.table'))
+        os.utime(self.csv_file, (table_mtime + 1, table_mtime + 1))
+
+        analyzer.load_csv_file()
+        self.assertEquals(analyzer.lookup('10.1.4.1')['network_name'], 'Lab Network')
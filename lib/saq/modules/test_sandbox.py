@@ -0,0 +1,270 @@
+# vim: sw=4:ts=4:et
+
+import email
+import hashlib
+import io
+import json
+import os, os.path
+import re
+import tarfile
+import threading
+import uuid
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+import saq, saq.test
+from saq.analysis import RootAnalysis
+from saq.constants import *
+from saq.database import get_db_connection, initialize_node
+from saq.modules.sandbox import *
+from saq.test import *
+
+SAMPLE_DATA = b'MZ' + b'\x00' * 1024
+SAMPLE_MD5 = hashlib.md5(SAMPLE_DATA).hexdigest()
+SAMPLE_SHA256 = hashlib.sha256(SAMPLE_DATA).hexdigest()
+
+class FakeCuckooServer(ThreadingMixIn, HTTPServer):
+    """Implements the parts of the cuckoo REST api used by the CuckooAnalyzer."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeCuckooRequestHandler)
+        self.lock = threading.Lock()
+        # key = md5, value = list of { 'id': task_id, 'status': status }
+        self.tasks = {}
+        # the status new tasks are created with
+        self.task_status = 'reported'
+        self.submission_count = 0
+        self.thread = None
+
+    @property
+    def address(self):
+        return '{}:{}'.format(*self.server_address)
+
+    def set_task_status(self, status):
+        with self.lock:
+            self.task_status = status
+            for tasks in self.tasks.values():
+                for task in tasks:
+                    task['status'] = status
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name="Fake Cuckoo Server")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+class FakeCuckooRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args, **kwargs):
+        pass
+
+    def send_json(self, data):
+        content = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        m = re.match(r'^/api/tasks/search/md5/([a-f0-9]+)$', self.path)
+        if m:
+            with self.server.lock:
+                tasks = [ dict(_) for _ in self.server.tasks.get(m.group(1), []) ]
+
+            return self.send_json({ 'error': False, 'data': tasks if tasks else "Sample not found in database" })
+
+        if re.match(r'^/api/tasks/get/report/\d+$', self.path):
+            return self.send_json({
+                'malscore': 5.0,
+                'behavior': { 'summary': { 'files': [], 'keys': [], 'mutexes': [] } },
+                'network': {} })
+
+        if re.match(r'^/api/tasks/get/dropped/\d+/$', self.path):
+            content = io.BytesIO()
+            with tarfile.open(fileobj=content, mode='w'):
+                pass
+
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(content.getvalue())))
+            self.end_headers()
+            self.wfile.write(content.getvalue())
+            return
+
+        self.send_error(404)
+
+    def do_POST(self):
+        if self.path != '/api/tasks/create/file/':
+            return self.send_error(404)
+
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        message = email.message_from_bytes('Content-Type: {}\r\n\r\n'.format(
+                                           self.headers['Content-Type']).encode() + body)
+        data = None
+        for part in message.get_payload():
+            if part.get_param('name', header='content-disposition') == 'file':
+                data = part.get_payload(decode=True)
+
+        with self.server.lock:
+            self.server.submission_count += 1
+            tasks = self.server.tasks.setdefault(hashlib.md5(data).hexdigest(), [])
+            task_id = self.server.submission_count
+            tasks.append({ 'id': task_id, 'status': self.server.task_status })
+
+        self.send_json({ 'error': False, 'data': { 'task_ids': [ task_id ] } })
+
+class CuckooTestCase(ACEBasicTestCase):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.cuckoo = FakeCuckooServer()
+        self.cuckoo.start()
+
+    def tearDown(self, *args, **kwargs):
+        self.cuckoo.stop()
+        super().tearDown(*args, **kwargs)
+
+    def test_get_sandbox_job_status(self):
+        from saq.modules.cuckoo import CuckooAnalyzer
+        saq.CONFIG['analysis_module_cuckoo']['hosts'] = self.cuckoo.address
+        saq.CONFIG['analysis_module_cuckoo']['default'] = 'win7'
+
+        path = os.path.join(saq.TEMP_DIR, 'sample.exe')
+        with open(path, 'wb') as fp:
+            fp.write(SAMPLE_DATA)
+
+        m = CuckooAnalyzer('analysis_module_cuckoo')
+        self.cuckoo.task_status = 'pending'
+        m.submit_sample(self.cuckoo.address, path)
+        self.assertEqual(self.cuckoo.submission_count, 1)
+
+        job = SandboxJob(SAMPLE_SHA256, m.sandbox_name, 'win7', job_id=SAMPLE_MD5, status=SANDBOX_JOB_STATUS_PENDING,
+                         details={ 'server': self.cuckoo.address, 'md5': SAMPLE_MD5 })
+        self.assertEqual(m.get_sandbox_job_status(job), SANDBOX_JOB_STATUS_PENDING)
+        self.cuckoo.set_task_status('reported')
+        self.assertEqual(m.get_sandbox_job_status(job), SANDBOX_JOB_STATUS_COMPLETE)
+        self.cuckoo.set_task_status('failed_analysis')
+        self.assertEqual(m.get_sandbox_job_status(job), SANDBOX_JOB_STATUS_FAILED)
+
+class SandboxJobTestCase(ACEModuleTestCase):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.cuckoo = FakeCuckooServer()
+        self.cuckoo.start()
+
+        saq.CONFIG['sandbox_jobs']['enabled'] = 'yes'
+        # the poller is tested separately so analysis checks back on its own
+        saq.CONFIG['service_sandbox_poller']['enabled'] = 'no'
+        saq.CONFIG['analysis_module_cuckoo']['hosts'] = self.cuckoo.address
+        saq.CONFIG['analysis_module_cuckoo']['default'] = 'win7'
+        saq.CONFIG['analysis_module_cuckoo']['frequency'] = '1'
+        saq.CONFIG['analysis_module_cuckoo']['use_proxy'] = 'no'
+
+    def tearDown(self, *args, **kwargs):
+        self.cuckoo.stop()
+        super().tearDown(*args, **kwargs)
+
+    def test_claim_sandbox_job(self):
+        claimed, job = claim_sandbox_job(SAMPLE_SHA256, 'cuckoo', 'win7')
+        self.assertTrue(claimed)
+        self.assertIsNone(job)
+
+        # the sample is being submitted by someone else
+        claimed, job = claim_sandbox_job(SAMPLE_SHA256.upper(), 'cuckoo', 'win7')
+        self.assertFalse(claimed)
+        self.assertEqual(job.status, SANDBOX_JOB_STATUS_SUBMITTING)
+
+        # other profiles and sandboxes are tracked separately
+        self.assertTrue(claim_sandbox_job(SAMPLE_SHA256, 'cuckoo', 'win10')[0])
+        self.assertTrue(claim_sandbox_job(SAMPLE_SHA256, 'vxstream', 100)[0])
+
+        self.assertTrue(update_sandbox_job(SAMPLE_SHA256, 'cuckoo', 'win7', SANDBOX_JOB_STATUS_PENDING,
+                                           job_id=SAMPLE_MD5, details={ 'server': self.cuckoo.address }))
+        claimed, job = claim_sandbox_job(SAMPLE_SHA256, 'cuckoo', 'win7')
+        self.assertFalse(claimed)
+        self.assertEqual(job.status, SANDBOX_JOB_STATUS_PENDING)
+        self.assertEqual(job.job_id, SAMPLE_MD5)
+        self.assertEqual(job.details, { 'server': self.cuckoo.address })
+
+        # failed jobs can be claimed again
+        update_sandbox_job(SAMPLE_SHA256, 'cuckoo', 'win7', SANDBOX_JOB_STATUS_FAILED)
+        self.assertTrue(claim_sandbox_job(SAMPLE_SHA256, 'cuckoo', 'win7')[0])
+
+        # and so can submissions that never finished
+        with get_db_connection() as db:
+            c = db.cursor()
+            c.execute("UPDATE sandbox_jobs SET last_update = NOW() - INTERVAL 1 HOUR")
+            db.commit()
+
+        self.assertTrue(claim_sandbox_job(SAMPLE_SHA256, 'cuckoo', 'win7')[0])
+
+    def test_poller(self):
+        from saq.service.sandbox import SandboxJobPollerService
+        initialize_node()
+
+        self.cuckoo.task_status = 'pending'
+        self.cuckoo.tasks[SAMPLE_MD5] = [ { 'id': 1, 'status': 'pending' } ]
+
+        self.assertTrue(claim_sandbox_job(SAMPLE_SHA256, 'cuckoo', 'win7')[0])
+        # analysis cannot wait on a job that is not tracked
+        self.assertFalse(add_sandbox_job_waiter(SAMPLE_SHA256, 'cuckoo', 'win10',
+                                                'uuid', 'observable_uuid', 'analysis_module_cuckoo'))
+        self.assertTrue(add_sandbox_job_waiter(SAMPLE_SHA256, 'cuckoo', 'win7',
+                                               'uuid', 'observable_uuid', 'analysis_module_cuckoo'))
+
+        poller = SandboxJobPollerService()
+        # still being submitted
+        self.assertEqual(poller.poll(), 0)
+
+        update_sandbox_job(SAMPLE_SHA256, 'cuckoo', 'win7', SANDBOX_JOB_STATUS_PENDING, job_id=SAMPLE_MD5,
+                           details={ 'server': self.cuckoo.address, 'md5': SAMPLE_MD5 })
+        self.assertEqual(poller.poll(), 0)
+
+        self.cuckoo.set_task_status('reported')
+        self.assertEqual(poller.poll(), 1)
+        self.assertEqual(get_sandbox_job(SAMPLE_SHA256, 'cuckoo', 'win7').status, SANDBOX_JOB_STATUS_COMPLETE)
+
+        # the waiter is removed once it has been resumed
+        self.assertEqual(get_waiting_sandbox_jobs(saq.SAQ_NODE_ID), [])
+        self.assertEqual(poller.poll(), 0)
+
+    def test_cuckoo_submission(self):
+        # the same sample in two different alerts is only submitted once
+        roots = []
+        for _ in range(2):
+            root = create_root_analysis(uuid=str(uuid.uuid4()), analysis_mode='test_single')
+            root.initialize_storage()
+            path = os.path.join(root.storage_dir, 'sample.exe')
+            with open(path, 'wb') as fp:
+                fp.write(SAMPLE_DATA)
+
+            _file = root.add_observable(F_FILE, 'sample.exe')
+            _file.add_directive(DIRECTIVE_SANDBOX)
+            root.save()
+            root.schedule()
+            roots.append((root, _file))
+
+        engine = TestEngine(analysis_pools={'test_single': 2})
+        engine.enable_module('analysis_module_cuckoo', 'test_single')
+        engine.controlled_stop()
+        engine.start()
+        engine.wait()
+
+        self.assertEqual(self.cuckoo.submission_count, 1)
+
+        from saq.modules.cuckoo import CuckooAnalysis
+        for root, _file in roots:
+            root = RootAnalysis(storage_dir=root.storage_dir)
+            root.load()
+            analysis = root.get_observable(_file.id).get_analysis(CuckooAnalysis)
+            self.assertIsNotNone(analysis)
+            self.assertTrue(analysis.complete)
+            self.assertEqual(analysis.server, self.cuckoo.address)
+            self.assertEqual(analysis.malscore, 5.0)
+
+        self.assertEqual(get_sandbox_job(SAMPLE_SHA256, 'cuckoo', 'win7').status, SANDBOX_JOB_STATUS_COMPLETE)
@@ -0,0 +1,113 @@
+# vim: sw=4:ts=4:et:cc=120
+
+import datetime
+import re
+
+import saq
+from saq.constants import *
+from saq.modules.vpn_analysis import VPNAnalyzer
+from saq.splunk import clear_splunk_sessions
+from saq.test import *
+from saq.test_splunk import FakeSplunkServer
+
+class TestCase(ACEBasicTestCase):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        clear_splunk_sessions()
+
+        self.server = FakeSplunkServer(job_latency=0)
+        self.server.results = self.radius_logs
+        self.server.start()
+
+        saq.CONFIG['splunk']['uri'] = self.server.uri
+        saq.CONFIG['splunk']['username'] = 'test'
+        saq.CONFIG['splunk']['password'] = 'test'
+        saq.CONFIG['splunk']['max_result_count'] = '100'
+
+        if not saq.CONFIG.has_section('analysis_module_test_vpn_analyzer'):
+            saq.CONFIG.add_section('analysis_module_test_vpn_analyzer')
+
+        saq.CONFIG['analysis_module_test_vpn_analyzer']['batch_size'] = '3'
+        saq.CONFIG['analysis_module_test_vpn_analyzer']['batch_window'] = '00:15:00'
+
+    def tearDown(self, *args, **kwargs):
+        super().tearDown(*args, **kwargs)
+        self.server.stop()
+        clear_splunk_sessions()
+        saq.CONFIG.remove_section('analysis_module_test_vpn_analyzer')
+
+    def radius_logs(self, search):
+        """Returns one log entry for each user searched for (except for USER_MISSING.)"""
+        m = re.search(r'User_Name IN \(([^)]+)\)', search)
+        self.assertIsNotNone(m)
+        users = [ _.strip().strip('"') for _ in m.group(1).split(',') ]
+        fields = [ '_time', 'User_Name', 'Acct_Status_Type' ]
+        return fields, [ [ '2017-11-11T07:36:01.000-05:00', user, 'Start' ] 
+                         for user in users if user != 'USER_MISSING' ]
+
+    def radius_log(self, user):
+        return { '_time': '2017-11-11T07:36:01.000-05:00', 'User_Name': user, 'Acct_Status_Type': 'Start' }
+
+    def create_analyzer(self, root):
+        analyzer = VPNAnalyzer('analysis_module_test_vpn_analyzer')
+        analyzer.root = root
+        # semaphores are not used in testing
+        analyzer.acquire_semaphore = lambda: True
+        return analyzer
+
+    def test_batch_query(self):
+        root = create_root_analysis()
+        users = [ root.add_observable(F_USER, 'user_{}'.format(index)) for index in range(4) ]
+        missing = root.add_observable(F_USER, 'user_missing')
+        analyzer = self.create_analyzer(root)
+
+        query = 'index=radius {filter} | fields *'
+        results = analyzer.splunk_batch_query(users[0], query, 'User_Name')
+        self.assertEquals(results, [ self.radius_log('USER_0') ])
+        # one search for the first three users
+        self.assertEquals(len(self.server.searches), 1)
+        self.assertTrue('User_Name IN ("USER_0", "USER_1", "USER_2")' in self.server.searches[0])
+
+        for index in range(1, 3):
+            results = analyzer.splunk_batch_query(users[index], query, 'User_Name')
+            self.assertEquals(results, [ self.radius_log('USER_{}'.format(index)) ])
+
+        self.assertEquals(len(self.server.searches), 1)
+
+        # and then another search for the rest
+        results = analyzer.splunk_batch_query(users[3], query, 'User_Name')
+        self.assertEquals(results, [ self.radius_log('USER_3') ])
+        self.assertEquals(len(self.server.searches), 2)
+        self.assertTrue('User_Name IN ("USER_3", "USER_MISSING")' in self.server.searches[1])
+
+        # no results for this one
+        self.assertEquals(analyzer.splunk_batch_query(missing, query, 'User_Name'), [])
+        self.assertEquals(len(self.server.searches), 2)
+
+        # the batched results do not carry over to the next analysis
+        analyzer.reset()
+        self.assertEquals(analyzer.batch_results, {})
+
+    def test_batch_window(self):
+        root = create_root_analysis()
+        first = root.add_observable(F_USER, 'user_0', root.event_time_datetime)
+        second = root.add_observable(F_USER, 'user_1', root.event_time_datetime + datetime.timedelta(hours=1))
+        analyzer = self.create_analyzer(root)
+
+        # these are too far apart in time to search together
+        analyzer.splunk_batch_query(first, 'index=radius {filter}', 'User_Name')
+        analyzer.splunk_batch_query(second, 'index=radius {filter}', 'User_Name')
+        self.assertEquals(len(self.server.searches), 2)
+
+    def test_execute_analysis(self):
+        root = create_root_analysis()
+        users = [ root.add_observable(F_USER, 'user_{}'.format(index)) for index in range(3) ]
+        analyzer = self.create_analyzer(root)
+
+        for user in users:
+            analyzer.execute_analysis(user)
+            analysis = user.get_analysis(analyzer.generated_analysis_type)
+            self.assertIsNotNone(analysis)
+            self.assertEquals(len(analysis.logs), 1)
+
+        self.assertEquals(len(self.server.searches), 1)
@@ -0,0 +1,167 @@
+# vim: sw=4:ts=4:et:cc=120
+
+import os, os.path
+import shutil
+
+import saq
+from saq.constants import *
+from saq.modules.tag import SiteTagAnalyzer, SiteTagAnalysis, CorrelatedTagAnalyzer, _tag_mapping, \
+                           _compiled_tag_mappings, _glob_literals, _regex_literals
+from saq.test import *
+
+TEST_MAPPINGS = [
+    _tag_mapping('default', False, 'evil.exe', [ 'default' ]),
+    _tag_mapping('default', True, 'EVIL.EXE', [ 'default_nocase' ]),
+    _tag_mapping('glob', False, '*.exe', [ 'glob' ]),
+    _tag_mapping('glob', False, 'ev?l.*', [ 'glob_single' ]),
+    _tag_mapping('glob', False, '*[0-9]*[0-9]*', [ 'glob_digits' ]),
+    _tag_mapping('glob', False, 'x[!]]bbx', [ 'glob_bracket' ]),
+    _tag_mapping('glob', False, 'line1[', [ 'glob_unclosed' ]),
+    _tag_mapping('regex', False, r'^ev', [ 'regex_anchor' ]),
+    _tag_mapping('regex', True, r'VIL', [ 'regex_nocase' ]),
+    _tag_mapping('regex', False, r'(a|b)\1', [ 'regex_backref' ]),
+    _tag_mapping('regex', False, r'foo|bar', [ 'regex_alternation' ]),
+    _tag_mapping('regex', False, r'line2$', [ 'regex_newline' ]),
+    _tag_mapping('cidr', False, '10.0.0.0/8', [ 'cidr_8' ]),
+    _tag_mapping('cidr', False, '10.1.0.0/16', [ 'cidr_16' ]),
+    _tag_mapping('cidr', False, '2001:db8::/32', [ 'cidr_ipv6' ]),
+    _tag_mapping('subdomain', False, 'example.com', [ 'subdomain' ]),
+    _tag_mapping('subdomain', False, 'mail.example.com', [ 'subdomain_mail' ]),
+]
+
+TEST_VALUES = [ 'evil.exe', 'Evil.EXE', 'evel.txt', 'test12.doc', 'aa', 'xbbx', 'foobar', 'line1\nline2',
+                '10.1.2.3', '10.2.3.4', '11.0.0.1', '2001:db8::1', 'example.com', 'www.example.com',
+                'MAIL.Example.com', 'notexample.com', 'com', '', 'xabbx', 'x]bbx', 'line1[' ]
+
+class TestCase(ACEBasicTestCase):
+    def test_compiled_matches(self):
+        compiled = _compiled_tag_mappings(TEST_MAPPINGS)
+
+        # the compiled mappings must match exactly what the individual mappings match
+        for value in TEST_VALUES:
+            self.assertEquals([ _.tags[0] for _ in compiled.matches(value) ],
+                              [ _.tags[0] for _ in TEST_MAPPINGS if _.matches(value) ], value)
+
+    def test_compiled_matches_specific(self):
+        compiled = _compiled_tag_mappings(TEST_MAPPINGS)
+        self.assertEquals([ _.tags[0] for _ in compiled.matches('evil.exe') ],
+                          [ 'default', 'default_nocase', 'glob', 'glob_single', 'regex_anchor', 'regex_nocase' ])
+        self.assertEquals([ _.tags[0] for _ in compiled.matches('10.1.2.3') ], [ 'glob_digits', 'cidr_8', 'cidr_16' ])
+        self.assertEquals([ _.tags[0] for _ in compiled.matches('www.example.com') ], [ 'subdomain' ])
+        self.assertEquals(compiled.matches('nothing'), [])
+
+    def test_literals(self):
+        self.assertEquals(_glob_literals('*.exe'), [ '.exe' ])
+        self.assertEquals(_glob_literals('ev?l[0-9]*.doc'), [ 'ev', 'l', '.doc' ])
+        # an unclosed [ is a literal [
+        self.assertEquals(_glob_literals('abc[def'), [ 'abc[def' ])
+        # a ] right after [ or [! is part of the set
+        self.assertEquals(_glob_literals('ab[]x]cd'), [ 'ab', 'cd' ])
+        self.assertEquals(_glob_literals('ab[!]x]cd'), [ 'ab', 'cd' ])
+        self.assertEquals(_glob_literals('ab[]cd'), [ 'ab[]cd' ])
+        self.assertEquals(_regex_literals(r'^evil\.exe$'), [ 'evil.exe' ])
+        self.assertEquals(_regex_literals(r'abc[0-9]+def'), [ 'abc', 'def' ])
+        self.assertEquals(_regex_literals(r'abc|def'), [])
+
+    def test_unindexed_patterns(self):
+        mappings = [ _tag_mapping('regex', False, r'(?P<x>a)(?P=x)', [ 'named' ]),
+                     _tag_mapping('regex', False, r'(?i)abc', [ 'global_flags' ]),
+                     _tag_mapping('glob', False, '*', [ 'everything' ]) ]
+        compiled = _compiled_tag_mappings(mappings)
+        self.assertEquals(len(compiled.unindexed_patterns), 2)
+        self.assertEquals([ _.tags[0] for _ in compiled.matches('aa') ], [ 'named', 'everything' ])
+        self.assertEquals([ _.tags[0] for _ in compiled.matches('xABCb') ], [ 'global_flags', 'everything' ])
+
+    def test_site_tag_analyzer(self):
+        site_tag_dir = os.path.join(saq.TEMP_DIR, 'site_tags')
+        if os.path.isdir(site_tag_dir):
+            shutil.rmtree(site_tag_dir)
+
+        os.makedirs(site_tag_dir)
+        csv_file = os.path.join(site_tag_dir, 'site_tags.csv')
+        with open(csv_file, 'w') as fp:
+            fp.write('ipv4,cidr,,10.0.0.0/8,internal\n')
+            fp.write('ipv4|fqdn,default,,10.1.1.1,server|critical\n')
+            fp.write('fqdn,subdomain,,example.com,example\n')
+            fp.write('ipv4,cidr,,not a cidr,invalid\n')
+            fp.write('invalid row\n')
+
+        if not saq.CONFIG.has_section('analysis_module_test_site_tagger'):
+            saq.CONFIG.add_section('analysis_module_test_site_tagger')
+
+        saq.CONFIG['analysis_module_test_site_tagger']['csv_file'] = csv_file
+
+        try:
+            analyzer = SiteTagAnalyzer('analysis_module_test_site_tagger')
+            root = create_root_analysis()
+
+            ipv4 = root.add_observable(F_IPV4, '10.1.1.1')
+            self.assertTrue(analyzer.execute_analysis(ipv4))
+            self.assertIsNotNone(ipv4.get_analysis(SiteTagAnalysis))
+            self.assertEquals(sorted([ str(_) for _ in ipv4.tags ]), [ 'critical', 'internal', 'server' ])
+
+            fqdn = root.add_observable(F_FQDN, 'www.example.com')
+            self.assertTrue(analyzer.execute_analysis(fqdn))
+            self.assertEquals([ str(_) for _ in fqdn.tags ], [ 'example' ])
+
+            url = root.add_observable(F_URL, 'http://www.example.com/')
+            self.assertFalse(analyzer.execute_analysis(url))
+
+        finally:
+            saq.CONFIG.remove_section('analysis_module_test_site_tagger')
+
+    def create_correlated_tag_analyzer(self, root):
+        if not saq.CONFIG.has_section('analysis_module_test_correlated_tag_analyzer'):
+            saq.CONFIG.add_section('analysis_module_test_correlated_tag_analyzer')
+
+        config = saq.CONFIG['analysis_module_test_correlated_tag_analyzer']
+        config['definition_001_rule'] = 't1, t2'
+        config['definition_001_text'] = 'test definition'
+        config['definition_002_rule'] = 't2,t3,t4'
+        config['definition_002_text'] = 'other definition'
+        config['definition_003_rule'] = 't5'
+
+        analyzer = CorrelatedTagAnalyzer('analysis_module_test_correlated_tag_analyzer')
+        analyzer.root = root
+        saq.CONFIG.remove_section('analysis_module_test_correlated_tag_analyzer')
+        return analyzer
+
+    def test_correlated_tag_definitions(self):
+        analyzer = self.create_correlated_tag_analyzer(create_root_analysis())
+        # definition_003 is missing the text
+        self.assertEquals(len(analyzer.definitions), 2)
+        self.assertEquals(len(analyzer.tag_bits), 4)
+        self.assertEquals(analyzer.definitions[0].mask, analyzer.tag_bits['t1'] | analyzer.tag_bits['t2'])
+
+    def test_correlated_tags(self):
+        # (A) and (B) are both in (C) which is in the root
+        root = create_root_analysis()
+        c = root.add_observable(F_TEST, 'c')
+        analysis = SiteTagAnalysis()
+        c.add_analysis(analysis)
+        a = analysis.add_observable(F_TEST, 'a')
+        b = analysis.add_observable(F_TEST, 'b')
+        other = root.add_observable(F_TEST, 'other')
+
+        a.add_tag('t1')
+        other.add_tag('t2')
+        analyzer = self.create_correlated_tag_analyzer(root)
+        analyzer.execute_post_analysis()
+        # (A) and (other) do not have a common ancestry (other than the root)
+        self.assertFalse(any([ _.has_detection_points() for _ in root.all if _ is not root ]))
+
+        b.add_tag('t2')
+        analyzer.execute_post_analysis()
+        self.assertTrue(a.has_detection_points() or b.has_detection_points())
+        self.assertFalse(c.has_detection_points())
+        self.assertFalse(other.has_detection_points())
+
+        # a single object with all the tags does not match by itself
+        root = create_root_analysis()
+        d = root.add_observable(F_TEST, 'd')
+        for tag in [ 't2', 't3', 't4' ]:
+            d.add_tag(tag)
+
+        analyzer = self.create_correlated_tag_analyzer(root)
+        analyzer.execute_post_analysis()
+        self.assertFalse(d.has_detection_points())
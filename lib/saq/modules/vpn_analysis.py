@@ -68,18 +68,20 @@ class VPNAnalyzer(SplunkAnalysisModule):
     def valid_observable_types(self):
         return F_USER
 
+    def batch_value(self, user):
+        return user.value.upper()
+
     def execute_analysis(self, user):
 
         # query radius logs to get VPN login information
-        self.splunk_query('index=radius User_Name="{0}" ( Acct_Status_Type=Stop OR Acct_Status_Type=Start ) | fields User_Name Acct_Status_Type Framed_IP_Address Calling_Station_ID Acct_Session_Time | sort _time'.format(
-            user.value.upper()), self.root.event_time_datetime if user.time_datetime is None else user.time_datetime)
+        logs = self.splunk_batch_query(user, 'index=radius {filter} ( Acct_Status_Type=Stop OR Acct_Status_Type=Start ) | fields User_Name Acct_Status_Type Framed_IP_Address Calling_Station_ID Acct_Session_Time | sort _time', 'User_Name')
 
-        if self.search_results is None:
+        if logs is None:
             logging.debug("missing search results after splunk query")
             return False
 
         analysis = self.create_analysis(user)
-        analysis.logs = self.json()
+        analysis.logs = logs
 
         # was this user logged into VPN when the event occured?
         user_login_time = None
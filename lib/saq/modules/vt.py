@@ -11,6 +11,7 @@ from saq.modules.file_analysis import FileHashAnalysis
 from saq.error import report_exception
 from saq.modules import AnalysisModule
 from saq.constants import *
+from saq.vt_hash_cache import get_hash_type
 
 import requests
 
@@ -29,6 +30,9 @@ VT_KEY_SCANS = 'scans'
 
 KEY_DOWNLOADED = 'downloaded'
 
+# the default number of hashes sent in a single batch lookup
+VT_BATCH_SIZE = 500
+
 class VTHashFileDownloaderAnalysis(Analysis):
     """What is the binary content of the file with this hash?"""
 
@@ -289,6 +293,80 @@ class VTHashAnalyzer(AnalysisModule):
         else:
             self.ignored_vendors = set()
 
+        # hashes of the same type are looked up together (see AnalysisModule.get_batch)
+        self.batch_size = self.config.getint('batch_size', fallback=VT_BATCH_SIZE)
+
+    @property
+    def batch_lookup(self):
+        return self.config.getboolean('batch_lookup', fallback=False)
+
+    @property
+    def batch_query_url(self):
+        """The vt_hash_cache batch url (defaults to the batch url next to query_url.)"""
+        url = self.config.get('batch_query_url', fallback=None)
+        if url:
+            return url
+
+        return '{}/batch'.format(self.query_url.rsplit('/', 1)[0])
+
+    def batch_time(self, observable):
+        # vt results do not depend on when the hash was observed
+        return self.root.event_time_datetime
+
+    def get_batch_result(self, _hash):
+        """Returns the VT result for the given hash observable, or None if it needs to be looked up on its own.
+           The hashes of the same type in the root analysis that have not been analyzed yet are looked up at once
+           (see AnalysisModule.get_batch.)"""
+        if not self.batch_lookup:
+            return None
+
+        if _hash.id in self.batch_results:
+            logging.debug("using vt batch lookup result for {}".format(_hash))
+            return self.batch_results.pop(_hash.id)
+
+        # already looked up in an earlier batch and not found
+        if _hash.id in self.batch_searched:
+            return None
+
+        # the batch url rejects the entire request if any of the hashes are invalid
+        batch = [ target for target in self.get_batch(_hash)
+                  if get_hash_type(target.value) is not None
+                  and (target is _hash or target.get_analysis(VTHashAnalysis) is None) ]
+        if not batch:
+            return None
+
+        hashes = sorted(set([ target.value.lower() for target in batch ]))
+        results = None
+        try:
+            r = requests.post(self.batch_query_url, data={ 'h': hashes }, proxies=self.proxies, timeout=5, 
+                              verify=False)
+            if r.status_code != 200:
+                logging.warning("got invalid HTTP result for vt batch lookup {}: {}".format(r.status_code, r.reason))
+            else:
+                results = r.json()['results']
+        except Exception as e:
+            logging.warning("unable to perform vt batch lookup: {}".format(e))
+
+        if results is None:
+            # the other hashes can be looked up in the next batch
+            self.batch_searched.difference_update([ target.id for target in batch if target is not _hash ])
+            return None
+
+        logging.debug("vt batch lookup of {} hashes for {} found {}".format(len(hashes), self.root, len(results)))
+
+        result = None
+        for target in batch:
+            target_result = results.get(target.value.lower())
+            if target_result is None:
+                continue
+
+            if target is _hash:
+                result = target_result
+            else:
+                self.batch_results[target.id] = target_result
+
+        return result
+
     def execute_analysis(self, _hash):
 
         # it is possible that you are looking at an MD5 but you already have the analysis of the SHA1
@@ -315,26 +393,33 @@ class VTHashAnalyzer(AnalysisModule):
                             return False
 
 
-        logging.debug("looking up VT report for {}".format(_hash))
+        # was this hash looked up along with the rest of the hashes in the root?
+        details = self.get_batch_result(_hash)
 
-        try:
-            #r = requests.get(self.query_url, params={
-                #'resource': _hash.value,
-                #'apikey': self.api_key}, proxies=saq.PROXIES, timeout=5)
+        if details is None:
+            logging.debug("looking up VT report for {}".format(_hash))
 
-            r = requests.get(self.query_url, params={ 'h': _hash.value }, proxies=self.proxies, timeout=5, verify=False)
+            try:
+                #r = requests.get(self.query_url, params={
+                    #'resource': _hash.value,
+                    #'apikey': self.api_key}, proxies=saq.PROXIES, timeout=5)
 
-        except Exception as e:
-            logging.error("unable to query VT: {}".format(e))
-            return False
+                r = requests.get(self.query_url, params={ 'h': _hash.value }, proxies=self.proxies, timeout=5, 
+                                 verify=False)
 
-        if r.status_code == 403:
-            logging.error("invalid virus total api key!")
-            return False
+            except Exception as e:
+                logging.error("unable to query VT: {}".format(e))
+                return False
 
-        if r.status_code != 200:
-            logging.debug("got invalid HTTP result {}: {}".format(r.status_code, r.reason))
-            return False
+            if r.status_code == 403:
+                logging.error("invalid virus total api key!")
+                return False
+
+            if r.status_code != 200:
+                logging.debug("got invalid HTTP result {}: {}".format(r.status_code, r.reason))
+                return False
+
+            details = json.loads(r.content.decode())
 
         analysis = self.create_analysis(_hash)
 
@@ -342,7 +427,7 @@ class VTHashAnalyzer(AnalysisModule):
         # if they change their JSON structure we'll probably break
 
         logging.debug("got valid vt result for {}".format(_hash))
-        analysis.details = json.loads(r.content.decode())
+        analysis.details = details
         
         # 4/28/2016 - looks like they now return an array of results
         if isinstance(analysis.details, list):
@@ -22,7 +22,7 @@ from saq.constants import *
 from saq.error import report_exception
 from saq.modules import AnalysisModule
 from saq.modules.file_analysis import FileHashAnalysis
-from saq.modules.sandbox import SandboxAnalysisModule
+from saq.modules.sandbox import *
 
 import requests
 
@@ -318,6 +318,10 @@ class VxStreamAnalyzer(SandboxAnalysisModule):
     def environment_id(self):
         return saq.CONFIG['vxstream']['environmentid']
 
+    @property
+    def sandbox_name(self):
+        return 'vxstream'
+
     @property
     def threat_score_threshold(self):
         return self.config.getint('threat_score_threshold')
@@ -372,6 +376,15 @@ class VxStreamAnalyzer(SandboxAnalysisModule):
 
         return True
 
+    def get_sandbox_job_status(self, job):
+        status = self.vx.get_status(job.job_id or job.sha256, job.profile)
+        if status in [ VXSTREAM_STATUS_IN_PROGRESS, VXSTREAM_STATUS_IN_QUEUE ]:
+            return SANDBOX_JOB_STATUS_PENDING
+        elif status == VXSTREAM_STATUS_SUCCESS:
+            return SANDBOX_JOB_STATUS_COMPLETE
+
+        return SANDBOX_JOB_STATUS_FAILED
+
     def execute_vxstream_analysis(self, target, analysis):
 
         # at this point we should definitely have a sha256 value
@@ -386,13 +399,15 @@ class VxStreamAnalyzer(SandboxAnalysisModule):
 
         if analysis.status == VXSTREAM_STATUS_IN_PROGRESS or analysis.status == VXSTREAM_STATUS_IN_QUEUE:
             logging.debug("waiting for completion of {}".format(target))
-            return self.delay_analysis(target, analysis, seconds=self.frequency, timeout_minutes=self.timeout)
+            return self.wait_for_sandbox_job(target, analysis, analysis.sha256, analysis.environment_id, 
+                                             seconds=self.frequency, timeout_minutes=self.timeout)
 
         # something go wrong?
         if analysis.status == VXSTREAM_STATUS_ERROR or analysis.status == VXSTREAM_STATUS_UNKNOWN:
             logging.debug("detected error status {} for {} sha256 {} env {}".format(
                 analysis.status, target, analysis.sha256, analysis.environment_id))
             analysis.fail_date = datetime.datetime.now()
+            self.record_submission(analysis.sha256, analysis.environment_id, SANDBOX_JOB_STATUS_FAILED)
             return True
 
         if analysis.status != VXSTREAM_STATUS_SUCCESS:
@@ -401,6 +416,7 @@ class VxStreamAnalyzer(SandboxAnalysisModule):
 
         # the analysis is assumed to be complete here
         analysis.complete_date = datetime.datetime.now()
+        self.record_submission(analysis.sha256, analysis.environment_id, SANDBOX_JOB_STATUS_COMPLETE)
 
         # attempt to download the results
         vxstream_dir = os.path.join(self.root.storage_dir, '{}.vxstream'.format(target.value))
@@ -612,20 +628,36 @@ class VxStreamFileAnalyzer(VxStreamAnalyzer):
                 return False
 
             analysis = self.create_analysis(target)
+            analysis.submit_date = datetime.datetime.now()
+
+            # has another analysis already submitted this sample?
+            sha256 = self.get_sample_sha256(local_path)
+            claimed, job = self.claim_submission(sha256, self.environment_id)
+            if not claimed:
+                logging.info("using existing {} for {}".format(job, target))
+                analysis.sha256 = job.job_id if job is not None and job.job_id else sha256
+                analysis.environment_id = self.environment_id
+                if job is None or job.status == SANDBOX_JOB_STATUS_SUBMITTING:
+                    return self.wait_for_sandbox_job(target, analysis, sha256, self.environment_id,
+                                                     seconds=self.frequency, timeout_minutes=self.timeout)
+
+                return self.execute_vxstream_analysis(target, analysis)
 
             # this sample needs to be submitted
             submission = self.vx.submit(local_path, self.environment_id)
             if submission is None:
                 logging.error("submission of {} failed".format(local_path))
+                self.record_submission(sha256, self.environment_id, SANDBOX_JOB_STATUS_FAILED)
                 return False
 
             if not submission.sha256:
                 logging.error("submission of {} failed to return sha256".format(target))
+                self.record_submission(sha256, self.environment_id, SANDBOX_JOB_STATUS_FAILED)
                 return False
 
             analysis.sha256 = submission.sha256
             analysis.environment_id = submission.environment_id
-            analysis.submit_date = datetime.datetime.now()
+            self.record_submission(sha256, self.environment_id, SANDBOX_JOB_STATUS_PENDING, job_id=submission.sha256)
 
         # at this point we have analysis for a file that has been submitted
         return self.execute_vxstream_analysis(target, analysis)
@@ -856,6 +888,10 @@ class FalconAnalyzer(SandboxAnalysisModule):
     def environment_id(self, value):
         self.vx.env_id = value
 
+    @property
+    def sandbox_name(self):
+        return 'falcon'
+
     @property
     def ssl_verification(self):
         """Set ssl verification. In the config, this should be set to the path to CA cert, True (default), 
@@ -1063,6 +1099,16 @@ class FalconAnalyzer(SandboxAnalysisModule):
             return result
         return False
 
+    def get_sandbox_job_status(self, job):
+        status = self.vx._request("/report/{}/state".format(job.job_id)).json()
+        status = status.get('state')
+        if status == VXSTREAM_STATUS_SUCCESS:
+            return SANDBOX_JOB_STATUS_COMPLETE
+        elif status == VXSTREAM_STATUS_ERROR:
+            return SANDBOX_JOB_STATUS_FAILED
+
+        return SANDBOX_JOB_STATUS_PENDING
+
     def execute_vxstream_analysis(self, target, analysis):
 
         if target.type == F_SHA1 or target.type == F_MD5:
@@ -1076,6 +1122,14 @@ class FalconAnalyzer(SandboxAnalysisModule):
                 return False
 
         logging.debug("Working on '{}'".format(target))
+
+        # has this sample been submitted by another analysis?
+        if analysis.job_id is None and analysis.sha256 is not None and self.use_job_registry:
+            job = get_sandbox_job(analysis.sha256, self.sandbox_name, self.environment_id)
+            if job is not None and job.job_id is not None:
+                logging.debug("using existing {} for {}".format(job, target))
+                analysis.job_id = job.job_id
+
         if analysis.job_id is None:
             target_hash = target.value
             if target.type == F_FILE:
@@ -1115,13 +1169,16 @@ class FalconAnalyzer(SandboxAnalysisModule):
 
         if analysis.status == VXSTREAM_STATUS_IN_PROGRESS or analysis.status == VXSTREAM_STATUS_IN_QUEUE:
             logging.debug("waiting for completion of {}".format(target))
-            return self.delay_analysis(target, analysis, seconds=self.frequency, timeout_minutes=self.timeout)
+            return self.wait_for_sandbox_job(target, analysis, analysis.sha256, self.environment_id,
+                                             seconds=self.frequency, timeout_minutes=self.timeout)
 
         # something go wrong?
         if analysis.status == VXSTREAM_STATUS_ERROR or analysis.status == VXSTREAM_STATUS_UNKNOWN:
             logging.debug("detected error status {} for {} sha256 {} env {}".format(
                 analysis.status, target, analysis.sha256, analysis.environment_id))
             analysis.fail_date = datetime.datetime.now()
+            if analysis.sha256 is not None:
+                self.record_submission(analysis.sha256, self.environment_id, SANDBOX_JOB_STATUS_FAILED)
             return True
 
         if analysis.status != VXSTREAM_STATUS_SUCCESS:
@@ -1130,6 +1187,8 @@ class FalconAnalyzer(SandboxAnalysisModule):
 
         # the analysis is assumed to be complete here
         analysis.complete_date = datetime.datetime.now()
+        if analysis.sha256 is not None:
+            self.record_submission(analysis.sha256, self.environment_id, SANDBOX_JOB_STATUS_COMPLETE)
 
         # attempt to download the results
         vxstream_dir = os.path.join(self.root.storage_dir, '{}.vxstream'.format(target.value))
@@ -1370,6 +1429,19 @@ class FalconFileAnalyzer(FalconAnalyzer):
                 return False
 
             analysis = self.create_analysis(target)
+            analysis.sha256 = self.get_sample_sha256(local_path)
+            analysis.submit_date = datetime.datetime.now()
+
+            # has another analysis already submitted this sample?
+            claimed, job = self.claim_submission(analysis.sha256, self.environment_id)
+            if not claimed:
+                logging.info("using existing {} for {}".format(job, target))
+                if job is None or job.job_id is None:
+                    return self.wait_for_sandbox_job(target, analysis, analysis.sha256, self.environment_id,
+                                                     seconds=self.frequency, timeout_minutes=self.timeout)
+
+                analysis.job_id = job.job_id
+                return self.execute_vxstream_analysis(target, analysis)
 
             # this sample needs to be submitted
             job_id = None
@@ -1377,12 +1449,13 @@ class FalconFileAnalyzer(FalconAnalyzer):
                 job_id = self.vx.analyze(fp, target.value)
             if job_id is None:
                 logging.error("submission of {} failed".format(local_path))
+                self.record_submission(analysis.sha256, self.environment_id, SANDBOX_JOB_STATUS_FAILED)
                 return False
             # should be a string 
             assert isinstance(job_id, str)
 
             analysis.job_id = job_id 
-            analysis.submit_date = datetime.datetime.now()
+            self.record_submission(analysis.sha256, self.environment_id, SANDBOX_JOB_STATUS_PENDING, job_id=job_id)
 
         else:
             logging.info("FalconFileAnalysis exists with status {} for target: {}".format(analysis.status, target))
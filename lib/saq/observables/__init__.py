@@ -2,7 +2,6 @@
 
 import base64
 import hashlib
-import io
 import ipaddress
 import logging
 import os.path
@@ -10,14 +9,14 @@ import pickle
 import re
 import unicodedata
 
-from subprocess import Popen, PIPE
-
 import saq
 from saq.analysis import Observable, DetectionPoint
 from saq.constants import *
 from saq.email import normalize_email_address
 from saq.error import report_exception
+from saq.file_type import get_mime_type
 from saq.gui import *
+from saq.hashing import get_file_hashes, HASH_MD5, HASH_SHA1, HASH_SHA256
 from saq.intel import query_sip_indicator
 from saq.remediation import RemediationTarget
 from saq.remediation.constants import *
@@ -101,14 +100,7 @@ class IPv4Observable(Observable):
         """Returns True if this IP address is listed as part of a managed network, False otherwide."""
         # see [network_configuration]
         # these are initialized in the global initialization function
-        for cidr in saq.MANAGED_NETWORKS:
-            try:
-                if self.value in cidr:
-                    return True
-            except:
-                return False
-
-        return False
+        return self.value in saq.MANAGED_NETWORKS
 
     def matches(self, value):
         # is this CIDR notation?
@@ -318,29 +310,17 @@ class FileObservable(Observable):
             logging.error("compute_hashes was called before root.storage_dir was set for {}".format(self))
             return False
         
-        md5_hasher = hashlib.md5()
-        sha1_hasher = hashlib.sha1()
-        sha256_hasher = hashlib.sha256()
-    
         try:
-            with open(self.path, 'rb') as fp:
-                while True:
-                    data = fp.read(io.DEFAULT_BUFFER_SIZE)
-                    if data == b'':
-                        break
-
-                    md5_hasher.update(data)
-                    sha1_hasher.update(data)
-                    sha256_hasher.update(data)
-
+            # hashes are computed with a single read of the file and cached locally
+            hashes = get_file_hashes(self.path)
         except Exception as e:
             # this will happen if a F_FILE observable refers to a file that no longer (or never did) exists
             logging.debug(f"unable to compute hashes of {self.value}: {e}")
             return False
         
-        md5_hash = md5_hasher.hexdigest()
-        sha1_hash = sha1_hasher.hexdigest()
-        sha256_hash = sha256_hasher.hexdigest()
+        md5_hash = hashes[HASH_MD5]
+        sha1_hash = hashes[HASH_SHA1]
+        sha256_hash = hashes[HASH_SHA256]
         logging.debug("file {} has md5 {} sha1 {} sha256 {}".format(self.path, md5_hash, sha1_hash, sha256_hash))
 
         self._md5_hash = md5_hash
@@ -349,6 +329,13 @@ class FileObservable(Observable):
 
         return True
 
+    def set_hashes(self, hashes):
+        """Sets the hashes of the file when they are already known (see saq.hashing.compute_file_hashes)
+           so that compute_hashes does not read the file again."""
+        self._md5_hash = hashes[HASH_MD5]
+        self._sha1_hash = hashes[HASH_SHA1]
+        self._sha256_hash = hashes[HASH_SHA256]
+
     @property
     def display_preview(self):
         with open(self.path, 'rb') as fp:
@@ -363,13 +350,7 @@ class FileObservable(Observable):
         if self._mime_type:
             return self._mime_type
 
-        p = Popen(['file', '-b', '--mime-type', '-L', self.path], stdout=PIPE, stderr=PIPE)
-        stdout, stderr = p.communicate()
-
-        if len(stderr) > 0:
-            logging.warning("file command returned error output for {}".format(self.path))
-
-        self._mime_type = stdout.decode(errors='ignore').strip()
+        self._mime_type = get_mime_type(self.path, self._sha256_hash)
         #logging.info("MARKER: {} mime type {}".format(self.path, self._mime_type))
         return self._mime_type
 
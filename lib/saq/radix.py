@@ -0,0 +1,146 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# ipv4 prefix (radix) tree
+#
+# maps ipv4 networks (CIDR) to names and arbitrary data
+# lookups walk at most 32 nodes regardless of how many networks are in the tree
+#
+
+import ipaddress
+
+# node layout (lists are used instead of objects to keep the walk fast)
+_NODE_ZERO = 0
+_NODE_ONE = 1
+_NODE_ENTRIES = 2
+
+def _new_node():
+    return [ None, None, None ]
+
+def ipv4_to_int(value):
+    """Returns the integer value of the given ipv4 address (which can be a str, int or IPv4Address.)
+       Raises ValueError if the value is not a valid ipv4 address."""
+    if isinstance(value, int):
+        if value < 0 or value > 0xFFFFFFFF:
+            raise ValueError("{} is not a valid ipv4 address".format(value))
+
+        return value
+
+    return int(ipaddress.IPv4Address(value))
+
+class NetworkEntry(object):
+    """A network stored in a NetworkTree."""
+
+    __slots__ = [ 'network', 'name', 'data', 'sequence' ]
+
+    def __init__(self, network, name, data, sequence):
+        # the ipaddress.IPv4Network
+        self.network = network
+        # optional name of the network
+        self.name = name
+        # optional data associated to the network
+        self.data = data
+        # the order in which it was added to the tree
+        self.sequence = sequence
+
+    def __str__(self):
+        if self.name is None:
+            return str(self.network)
+
+        return "{} ({})".format(self.network, self.name)
+
+    def __repr__(self):
+        return "NetworkEntry({})".format(self)
+
+class NetworkTree(object):
+    """A prefix tree of ipv4 networks."""
+
+    def __init__(self, networks=None):
+        """networks is an optional list of CIDR values (or (cidr, name) or (cidr, name, data) tuples) to add."""
+        self.root = _new_node()
+        self.count = 0
+
+        if networks:
+            for network in networks:
+                if isinstance(network, tuple):
+                    self.add(*network)
+                else:
+                    self.add(network)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """Iterates over the NetworkEntry objects in the order they were added."""
+        entries = []
+        stack = [ self.root ]
+        while stack:
+            node = stack.pop()
+            if node[_NODE_ENTRIES]:
+                entries.extend(node[_NODE_ENTRIES])
+            for child in node[_NODE_ZERO], node[_NODE_ONE]:
+                if child is not None:
+                    stack.append(child)
+
+        return iter(sorted(entries, key=lambda entry: entry.sequence))
+
+    def __contains__(self, value):
+        """Returns True if the given ipv4 is in any network in the tree. Invalid ipv4 addresses are not."""
+        try:
+            return self.longest_match(value) is not None
+        except ValueError:
+            return False
+
+    def add(self, cidr, name=None, data=None):
+        """Adds the given network (a CIDR string or IPv4Network) to the tree with an optional name and data.
+           Host bits are ignored. Raises ValueError if the network is not valid. Returns the new NetworkEntry."""
+        network = cidr if isinstance(cidr, ipaddress.IPv4Network) else \
+                  ipaddress.IPv4Network(cidr.strip(), strict=False)
+
+        value = int(network.network_address)
+        node = self.root
+        for bit in range(network.prefixlen):
+            branch = (value >> (31 - bit)) & 1
+            if node[branch] is None:
+                node[branch] = _new_node()
+            node = node[branch]
+
+        entry = NetworkEntry(network, name, data, self.count)
+        if node[_NODE_ENTRIES] is None:
+            node[_NODE_ENTRIES] = []
+
+        node[_NODE_ENTRIES].append(entry)
+        self.count += 1
+        return entry
+
+    def _walk(self, value):
+        """Yields the list of entries for each node along the path of the given ipv4 (shortest prefix first.)"""
+        value = ipv4_to_int(value)
+        node = self.root
+        bit = 31
+        while node is not None:
+            if node[_NODE_ENTRIES]:
+                yield node[_NODE_ENTRIES]
+            if bit < 0:
+                break
+            node = node[(value >> bit) & 1]
+            bit -= 1
+
+    def longest_match(self, value):
+        """Returns the NetworkEntry of the most specific network that contains the given ipv4, or None.
+           If the same network was added more than once then the first one added is returned.
+           Raises ValueError if the value is not a valid ipv4."""
+        result = None
+        for entries in self._walk(value):
+            result = entries[0]
+
+        return result
+
+    def matches(self, value):
+        """Returns the list of all NetworkEntry objects that contain the given ipv4, in the order they were added.
+           Raises ValueError if the value is not a valid ipv4."""
+        result = []
+        for entries in self._walk(value):
+            result.extend(entries)
+
+        result.sort(key=lambda entry: entry.sequence)
+        return result
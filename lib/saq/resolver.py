@@ -0,0 +1,212 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# asynchronous dns resolution with a node-local cache
+#
+# all the names given to DNSResolver.resolve are resolved concurrently on an asyncio event loop
+# results are cached in memcached (which is local to the node and shared by all the workers)
+# for the ttl of the answer and names that do not exist are cached for negative_ttl seconds
+#
+# dnspython does not use the hosts file (or nsswitch) like socket.gethostbyname_ex does
+# so when no nameservers are configured names in the hosts file are answered from there first
+#
+
+import asyncio
+import hashlib
+import ipaddress
+import json
+import logging
+import os
+import time
+
+import saq
+from saq.vt_hash_cache import get_memcache_client
+
+import dns.asyncresolver
+import dns.exception
+import dns.rdatatype
+import dns.resolver
+
+CACHE_KEY_PREFIX = 'dns:'
+
+HOSTS_PATH = '/etc/hosts'
+
+def normalize_name(name):
+    """Returns the given name in lower case without the trailing dot."""
+    return name.lower().rstrip('.')
+
+def load_hosts_file(path):
+    """Returns a dict of (normalized) name -> list of ipv4 addresses for the given hosts file."""
+    result = {}
+    with open(path, 'r', errors='ignore') as fp:
+        for line in fp:
+            fields = line.split('#', 1)[0].split()
+            if len(fields) < 2:
+                continue
+
+            try:
+                if ipaddress.ip_address(fields[0]).version != 4:
+                    continue
+            except ValueError:
+                continue
+
+            for name in fields[1:]:
+                addresses = result.setdefault(normalize_name(name), [])
+                if fields[0] not in addresses:
+                    addresses.append(fields[0])
+
+    return result
+
+def get_cache_key(name):
+    # memcached keys are limited to 250 characters and cannot contain whitespace or control characters
+    return '{}{}'.format(CACHE_KEY_PREFIX, hashlib.md5(name.encode('utf8', errors='ignore')).hexdigest())
+
+def get_cached_resolutions(client, names):
+    """Returns a tuple of (results, misses) for the given list of (normalized) names where results is a dict of
+       name -> (aliaslist, ipaddrlist) of the names found in memcached and misses is the list of the others."""
+    keys = { get_cache_key(name): name for name in names }
+    cached = client.get_multi(list(keys.keys()))
+
+    results = {}
+    for key, value in cached.items():
+        if value:
+            value = json.loads(value)
+            results[keys[key]] = (value['aliases'], value['addresses'])
+
+    return results, [ name for name in names if name not in results ]
+
+def cache_resolutions(client, resolutions):
+    """Caches the given dict of name -> (aliaslist, ipaddrlist, ttl) in memcached.
+       Resolutions with a ttl of 0 are not cached."""
+    by_ttl = {}
+    for name, (aliases, addresses, ttl) in resolutions.items():
+        if ttl > 0:
+            by_ttl.setdefault(ttl, {})[get_cache_key(name)] = json.dumps({ 'aliases': aliases,
+                                                                          'addresses': addresses })
+
+    for ttl, mapping in by_ttl.items():
+        client.set_multi(mapping, time=ttl)
+
+class DNSResolver(object):
+    """Resolves the A records of many names at once. See resolve()."""
+
+    def __init__(self, nameservers=None, port=53, timeout=2.0, lifetime=5.0, concurrency=16,
+                 use_cache=True, max_ttl=3600, negative_ttl=300, cache_client=None, hosts_path=HOSTS_PATH):
+        # the nameservers to use (defaults to the system configuration)
+        self.nameservers = nameservers
+        self.port = port
+        # how long to wait for a response from a single nameserver
+        self.timeout = timeout
+        # the total amount of time to spend resolving a single name
+        self.lifetime = lifetime
+        # the maximum number of names to resolve at the same time
+        self.concurrency = concurrency
+        self.use_cache = use_cache
+        # the maximum amount of time a resolution is cached for
+        self.max_ttl = max_ttl
+        # how long a name that does not exist is cached for
+        self.negative_ttl = negative_ttl
+        self._cache_client = cache_client
+        # the hosts file checked before querying the system nameservers
+        self.hosts_path = hosts_path
+        self._hosts = {}
+        self._hosts_mtime = None
+
+    @property
+    def cache_client(self):
+        if self._cache_client is None:
+            self._cache_client = get_memcache_client()
+
+        return self._cache_client
+
+    @property
+    def hosts(self):
+        """Returns the dict of name -> ipv4 addresses in the hosts file (reloaded when the file changes.)
+           The hosts file is only used with the system nameservers."""
+        if self.nameservers or not self.hosts_path:
+            return {}
+
+        try:
+            mtime = os.path.getmtime(self.hosts_path)
+            if mtime != self._hosts_mtime:
+                self._hosts = load_hosts_file(self.hosts_path)
+                self._hosts_mtime = mtime
+        except Exception as e:
+            logging.warning("unable to load {}: {}".format(self.hosts_path, e))
+
+        return self._hosts
+
+    def create_resolver(self):
+        resolver = dns.asyncresolver.Resolver(configure=not self.nameservers)
+        if self.nameservers:
+            resolver.nameservers = self.nameservers
+            resolver.port = self.port
+
+        resolver.timeout = self.timeout
+        resolver.lifetime = self.lifetime
+        return resolver
+
+    async def resolve_name(self, resolver, semaphore, name):
+        """Returns (aliaslist, ipaddrlist, ttl) for the given name, or None if the name could not be resolved."""
+        async with semaphore:
+            try:
+                answer = await resolver.resolve(name, dns.rdatatype.A, search=False)
+            except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+                logging.debug("{} does not exist".format(name))
+                return [], [], self.negative_ttl
+            except dns.exception.DNSException as e:
+                logging.warning("unable to resolve {}: {}".format(name, e))
+                return None
+
+        # like socket.gethostbyname_ex the aliases are the names in the CNAME chain
+        aliases = [ normalize_name(rrset.name.to_text()) for rrset in answer.response.answer
+                    if rrset.rdtype == dns.rdatatype.CNAME ]
+        addresses = [ rdata.address for rdata in answer ]
+        # the expiration of the answer accounts for every record in the CNAME chain
+        ttl = max(0, min(self.max_ttl, int(answer.expiration - time.time())))
+        return aliases, addresses, ttl
+
+    async def resolve_names(self, names):
+        resolver = self.create_resolver()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(*[ self.resolve_name(resolver, semaphore, name) for name in names ])
+        return { name: result for name, result in zip(names, results) if result is not None }
+
+    def resolve(self, names):
+        """Returns a dict of name -> (aliaslist, ipaddrlist) for the given list of names.
+           The ipaddrlist is empty for names that do not exist.
+           Names that could not be resolved (timeouts, server failures, etc...) are not included.
+           The names in the result are normalized (see normalize_name.)"""
+        names = list(dict.fromkeys([ normalize_name(_) for _ in names ]))
+        if not names:
+            return {}
+
+        # names in the hosts file are not looked up in dns (or cached)
+        hosts = self.hosts
+        results = { name: ([], list(hosts[name])) for name in names if name in hosts }
+        misses = [ name for name in names if name not in results ]
+        if not misses:
+            return results
+
+        if self.use_cache:
+            cached, misses = get_cached_resolutions(self.cache_client, misses)
+            results.update(cached)
+            if not misses:
+                return results
+
+        start = time.time()
+        loop = asyncio.new_event_loop()
+        try:
+            resolutions = loop.run_until_complete(self.resolve_names(misses))
+        finally:
+            loop.close()
+
+        logging.debug("resolved {} names ({} cached) in {:.2f} seconds".format(
+                      len(names), len(names) - len(misses), time.time() - start))
+
+        if self.use_cache:
+            cache_resolutions(self.cache_client, resolutions)
+
+        for name, (aliases, addresses, ttl) in resolutions.items():
+            results[name] = (aliases, addresses)
+
+        return results
@@ -0,0 +1,100 @@
+# vim: sw=4:ts=4:et
+#
+# ACE service that checks the status of the sandbox jobs analysis is waiting on
+# a single poller runs per node instead of every delayed analysis checking on its own sample
+#
+
+import logging
+
+import saq
+from saq.database import resume_delayed_analysis_request
+from saq.engine import load_module
+from saq.error import report_exception
+from saq.modules.sandbox import *
+from saq.service import *
+
+class SandboxJobPollerService(ACEService):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(service_config=saq.CONFIG['service_sandbox_poller'],
+                         *args, **kwargs)
+
+        # key = analysis module config section, value = loaded AnalysisModule (or None if it failed to load)
+        self.analysis_modules = {}
+
+    @property
+    def frequency(self):
+        return self.service_config.getint('frequency', fallback=5)
+
+    @property
+    def waiter_timeout(self):
+        return self.service_config.getint('waiter_timeout', fallback=86400)
+
+    def execute_service(self):
+        while not self.is_service_shutdown:
+            try:
+                self.poll()
+            except Exception as e:
+                logging.error("unable to poll sandbox jobs: {}".format(e))
+                report_exception()
+
+            self.sleep(self.frequency)
+
+    def get_analysis_module(self, section):
+        """Returns the analysis module loaded from the given config section, or None if it cannot be loaded."""
+        if section not in self.analysis_modules:
+            self.analysis_modules[section] = load_module(section) if section in saq.CONFIG else None
+
+        return self.analysis_modules[section]
+
+    def get_job_status(self, job, waiters):
+        """Returns the current status of the given SandboxJob as reported by the sandbox,
+           or None if the status could not be determined."""
+        # any of the analysis modules waiting on the job can check on it
+        for uuid, observable_uuid, analysis_module in waiters:
+            module = self.get_analysis_module(analysis_module)
+            if module is None:
+                continue
+
+            try:
+                return module.get_sandbox_job_status(job)
+            except NotImplementedError:
+                continue
+            except Exception as e:
+                logging.warning("unable to get the status of {}: {}".format(job, e))
+                return None
+
+        return None
+
+    def poll(self):
+        """Checks the status of every sandbox job the analysis on this node is waiting on
+           and resumes the analysis waiting on the jobs that have finished.
+           Returns the number of delayed analysis requests that were resumed."""
+        clear_expired_sandbox_job_waiters(saq.SAQ_NODE_ID, self.waiter_timeout)
+
+        resumed = 0
+        for job, waiters in get_waiting_sandbox_jobs(saq.SAQ_NODE_ID):
+            # the job may have already been finished by the poller of another node
+            if not job.finished:
+                # wait until the sample has been submitted
+                if job.status == SANDBOX_JOB_STATUS_SUBMITTING:
+                    continue
+
+                status = self.get_job_status(job, waiters)
+                if status not in [ SANDBOX_JOB_STATUS_COMPLETE, SANDBOX_JOB_STATUS_FAILED ]:
+                    continue
+
+                job.status = status
+                update_sandbox_job(job.sha256, job.sandbox, job.profile, status)
+                logging.info("{} finished".format(job))
+
+            for uuid, observable_uuid, analysis_module in waiters:
+                resume_delayed_analysis_request(uuid, observable_uuid, analysis_module)
+                remove_sandbox_job_waiter(job.sha256, job.sandbox, job.profile,
+                                          uuid, observable_uuid, analysis_module)
+                resumed += 1
+
+        if resumed:
+            logging.debug("resumed {} delayed analysis requests waiting on sandbox jobs".format(resumed))
+
+        return resumed
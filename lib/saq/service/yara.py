@@ -10,6 +10,7 @@ from yara_scanner import YaraScannerServer
 import saq
 from saq.service import *
 from saq.util import *
+from saq.yara_batch import YaraBatchScanServer
 
 class YSSService(ACEService):
 
@@ -25,10 +26,17 @@ class YSSService(ACEService):
     def signature_dir(self):
         return abs_path(self.service_config['signature_dir'])
 
+    @property
+    def batch_socket(self):
+        return os.path.join(saq.DATA_DIR, self.service_config['batch_socket'])
+
     def initialize_service_environment(self):
         if not os.path.isdir(self.socket_dir):
             create_directory(self.socket_dir)
 
+        if not os.path.isdir(os.path.dirname(self.batch_socket)):
+            create_directory(os.path.dirname(self.batch_socket))
+
     def execute_service(self):
         self.yss_server = YaraScannerServer(
             base_dir=saq.SAQ_HOME,
@@ -37,9 +45,22 @@ class YSSService(ACEService):
             update_frequency=self.service_config.getint('update_frequency'),
             backlog=self.service_config.getint('backlog'))
 
+        # files submitted in batches are scanned by a separate server in this process
+        self.batch_server = None
+        if self.service_config.getboolean('batch_enabled', fallback=False):
+            self.batch_server = YaraBatchScanServer(
+                signature_dir=self.signature_dir,
+                socket_path=self.batch_socket,
+                compiled_dir=os.path.join(saq.DATA_DIR, self.service_config['compiled_rules_dir']),
+                worker_count=self.service_config.getint('batch_workers', fallback=1),
+                update_frequency=self.service_config.getint('update_frequency'))
+            self.batch_server.start()
+
         self.yss_server.start()
         self.yss_server.wait()
 
     def stop_service(self, *args, **kwargs):
         super().stop_service(*args, **kwargs)
         self.yss_server.stop()
+        if self.batch_server is not None:
+            self.batch_server.stop()
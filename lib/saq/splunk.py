@@ -5,6 +5,7 @@ import json
 import logging
 import re
 import requests
+import threading
 import time
 import traceback
 import warnings
@@ -29,6 +30,106 @@ def create_timedelta(timespec):
 
     return datetime.timedelta(days=days, seconds=seconds, minutes=minutes, hours=hours)
 
+class SplunkSession(object):
+    """A logged in splunk session shared by everything in this process that talks to the same splunk server as the
+       same user. The session key is obtained once and then used until splunk rejects it (or it gets old), at which
+       point we log in again. The underlying http connections are kept alive between requests."""
+
+    def __init__(self, uri, username, password, network_timeout=30, session_lifetime="00:50:00"):
+        self.uri = uri
+        self.username = username
+        self.password = password
+        self.network_timeout = network_timeout
+
+        # splunk expires idle sessions (1 hour by default) so we log in again before that happens
+        self.session_lifetime = create_timedelta(session_lifetime)
+
+        self.session_key = None
+        self.session_key_expiration = None
+        self.lock = threading.Lock()
+
+        self.http = requests.Session()
+        self.http.verify = False # XXX take this out!
+
+    def login(self):
+        """Logs into splunk and returns the new session key. Raises an exception on failure."""
+        logging.debug("logging into {0} as user {1}".format(self.uri, self.username))
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            r = self.http.post(
+                #'{0}/servicesNS/admin/search/auth/login'.format(self.uri),
+                '{0}/services/auth/login'.format(self.uri),
+                data = { 'username': self.username, 'password': self.password },
+                timeout = self.network_timeout )
+
+        if r.status_code != 200:
+            raise RuntimeError("unable to log into splunk: response code {0} reason {1}".format(
+                               r.status_code, r.reason))
+
+        root = ET.fromstring(r.text)
+        self.session_key = root.find('sessionKey').text
+        self.session_key_expiration = datetime.datetime.now() + self.session_lifetime
+        logging.debug("got session key {0}".format(self.session_key))
+        return self.session_key
+
+    def get_session_key(self):
+        """Returns the current session key, logging in if we don't have one or the one we have is too old."""
+        with self.lock:
+            if self.session_key is None or datetime.datetime.now() >= self.session_key_expiration:
+                return self.login()
+
+            return self.session_key
+
+    def invalidate(self, session_key):
+        """Discards the given session key so that the next request logs in again."""
+        with self.lock:
+            # another thread may have already logged in again
+            if self.session_key == session_key:
+                self.session_key = None
+
+    def request(self, method, path, **kwargs):
+        """Makes an authenticated request to splunk and returns the requests.Response object.
+           If splunk rejects the session key then we log in again and retry the request once."""
+        for attempt in range(2):
+            session_key = self.get_session_key()
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                r = self.http.request(method, '{0}{1}'.format(self.uri, path),
+                                      headers = { 'Authorization': 'Splunk {0}'.format(session_key) },
+                                      timeout = self.network_timeout,
+                                      **kwargs)
+
+            if r.status_code == 401 and attempt == 0:
+                logging.info("splunk session for {0} on {1} expired".format(self.username, self.uri))
+                self.invalidate(session_key)
+                continue
+
+            # the session timeout on the splunk side is reset every time we use it
+            with self.lock:
+                if self.session_key == session_key:
+                    self.session_key_expiration = datetime.datetime.now() + self.session_lifetime
+
+            return r
+
+# key = (uri, username), value = SplunkSession
+_splunk_sessions = {}
+_splunk_sessions_lock = threading.Lock()
+
+def get_splunk_session(uri, username, password, network_timeout=30):
+    """Returns the shared SplunkSession for the given splunk server and user."""
+    with _splunk_sessions_lock:
+        session = _splunk_sessions.get((uri, username))
+        if session is None or session.password != password:
+            session = SplunkSession(uri, username, password, network_timeout=network_timeout)
+            _splunk_sessions[(uri, username)] = session
+
+        return session
+
+def clear_splunk_sessions():
+    """Discards all the cached splunk sessions."""
+    with _splunk_sessions_lock:
+        _splunk_sessions.clear()
+
 class SplunkQueryObject(object):
     """Basic query functionality for splunk."""
     
@@ -41,6 +142,9 @@ class SplunkQueryObject(object):
         relative_duration_after="00:00:05",
         query_timeout="00:30:00",
         network_timeout=30,
+        poll_interval_min=0.1,
+        poll_interval_max=5.0,
+        page_size=1000,
         *args, **kwargs):
 
         super(SplunkQueryObject, self).__init__(*args, **kwargs)
@@ -60,6 +164,16 @@ class SplunkQueryObject(object):
         # how long until a network request times out
         self.network_timeout = network_timeout
 
+        # how often we ask splunk if the search has completed
+        # we start at poll_interval_min and double the wait each time up to poll_interval_max
+        # so quick searches return quickly and long searches don't hammer the server
+        self.poll_interval_min = poll_interval_min
+        self.poll_interval_max = poll_interval_max
+
+        # the number of results to download per request
+        self.page_size = page_size
+
+        self.session = None # shared SplunkSession
         self.session_key = None # temp authentication token
         self.search_id = None # search id
 
@@ -149,10 +263,14 @@ class SplunkQueryObject(object):
 
         return self.query(query)
 
-    def query(self, query):
+    def query(self, query, download=True):
+        """Executes the query and waits for it to complete. Returns True if the query completed, False otherwise.
+           If download is True then the results are downloaded into search_results (see json().)
+           Otherwise the results can be streamed with iter_results()."""
         assert isinstance(query, str)
 
         timeout_date = datetime.datetime.now() + create_timedelta(self.query_timeout)
+        self.search_results = None
 
         # log into splunk and get the token
         if not self.authenticate():
@@ -163,6 +281,7 @@ class SplunkQueryObject(object):
             return False
 
         self.query_start_time = datetime.datetime.now()
+        poll_interval = self.poll_interval_min
         
         # keep asking splunk if the query is done
         while not self.query_cancelled:
@@ -179,10 +298,11 @@ class SplunkQueryObject(object):
                 logging.error("splunk query {0} timed out".format(query))
                 return False
 
-            time.sleep(1)
+            time.sleep(min(poll_interval, max((timeout_date - datetime.datetime.now()).total_seconds(), 0)))
+            poll_interval = min(poll_interval * 2, self.poll_interval_max)
 
         # download the results of the query
-        if not self.query_cancelled:
+        if download and not self.query_cancelled:
             self.download_search_results()
         # delete the search from splunk TODO
 
@@ -190,25 +310,9 @@ class SplunkQueryObject(object):
 
     def authenticate(self):
         try:
-            logging.debug("logging into {0} as user {1}".format(self.uri, self.username))
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                r = requests.post(
-                    #'{0}/servicesNS/admin/search/auth/login'.format(self.uri),
-                    '{0}/services/auth/login'.format(self.uri),
-                    data = { 'username': self.username, 'password': self.password },
-                    verify = False, # XXX take this out!
-                    timeout = self.network_timeout )
-            if r.status_code != 200:
-                logging.fatal("unable to log into slunk: response code {0} reason {1}".format(
-                    r.status_code, r.reason))
-                return False
-
-            root = ET.fromstring(r.text)
-            self.session_key = root.find('sessionKey').text
-
-            logging.debug("got session key {0}".format(self.session_key))
-            # TODO cache this and use it again until it times out
+            self.session = get_splunk_session(self.uri, self.username, self.password, 
+                                              network_timeout=self.network_timeout)
+            self.session_key = self.session.get_session_key()
             return True
 
         except Exception as e:
@@ -224,22 +328,14 @@ class SplunkQueryObject(object):
 
             logging.debug("performing splunk query [{0}] against {1}".format(query, self.uri))
 
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                r = requests.post(
-                    '{0}/services/search/jobs'.format(self.uri),
-                    verify = False, # XXX take this out!
-                    headers = {
-                        'Authorization': 'Splunk {0}'.format(self.session_key)
-                    },
-                    data = {
-                        'search': query,
-                        #'output_mode': 'csv',
-                        'max_count': str(self.max_result_count),
-                        #'earliest_time': splunk_time_start,
-                        #'latest_time': splunk_time_end
-                    },
-                    timeout = self.network_timeout)
+            r = self.session.request('POST', '/services/search/jobs',
+                data = {
+                    'search': query,
+                    #'output_mode': 'csv',
+                    'max_count': str(self.max_result_count),
+                    #'earliest_time': splunk_time_start,
+                    #'latest_time': splunk_time_end
+                })
 
             if r.status_code != 201:
                 logging.error("splunk search failed: response code {0} reason {1}".format(
@@ -261,16 +357,7 @@ class SplunkQueryObject(object):
     def is_job_completed(self):
         try:
             logging.debug("querying status of search job {0}".format(self.search_id))
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                r = requests.get(
-                    '{0}/services/search/jobs/{1}'.format(self.uri, self.search_id),
-                    headers = {
-                        'Authorization': 'Splunk {0}'.format(self.session_key)
-                    }, 
-                    verify = False, # XXX take this out!
-                    timeout = self.network_timeout
-                )
+            r = self.session.request('GET', '/services/search/jobs/{0}'.format(self.search_id))
 
             if r.status_code != 200:
                 logging.error("unable to get status of search job {0}: response code {1} reason {2}".format(
@@ -296,43 +383,75 @@ class SplunkQueryObject(object):
                 self.search_id, str(e)))
             return None
 
+    def iter_result_pages(self):
+        """Downloads the results of the search one page at a time.
+           Yields a tuple of (fields, rows) for each page. Raises an exception on failure."""
+        offset = 0
+        while not self.query_cancelled:
+            logging.debug("downloading search results for job {0} offset {1}".format(self.search_id, offset))
+            r = self.session.request('GET', '/services/search/jobs/{0}/results'.format(self.search_id),
+                params = {
+                    'count': str(self.page_size),
+                    'offset': str(offset),
+                    'output_mode': 'json_rows' # get the results in json format
+                })
+
+            if r.status_code != 200:
+                raise RuntimeError("unable to download results for search job {0}: "
+                                   "response code {1} reason {2}".format(self.search_id, r.status_code, r.reason))
+
+            page = json.loads(r.text)
+            rows = page.get('rows', [])
+            if rows:
+                yield page.get('fields', []), rows
+
+            if len(rows) < self.page_size:
+                break
+
+            offset += len(rows)
+
+    def iter_results(self):
+        """Yields the results of the search as JSON objects as they are downloaded.
+           Raises an exception on failure."""
+        for fields, rows in self.iter_result_pages():
+            for row in rows:
+                yield dict(zip(fields, row))
+
     def download_search_results(self):
         try:
-            logging.debug("downloading search results for job {0}".format(self.search_id))
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                r = requests.get(
-                    '{0}/services/search/jobs/{1}/results'.format(self.uri, self.search_id),
-                    headers = {
-                        'Authorization': 'Splunk {0}'.format(self.session_key)
-                    }, 
-                    params = {
-                        'count': "0", # get all of the results
-                        'output_mode': 'json_rows' # get the results in json format
-                    },
-                    verify = False, # XXX take this out!
-                    timeout = self.network_timeout
-                )
+            fields = [] # the combined list of fields across all of the pages
+            field_index = {} # key = field, value = index into fields
+            rows = []
 
-            if r.status_code != 200:
-                logging.error("unable to download results for search job {0}: response code {1} reason {2}".format(
-                    self.search_id, r.status_code, r.reason))
-                return False
+            for page_fields, page_rows in self.iter_result_pages():
+                # the fields can be different for each page of results
+                mapping = []
+                for field in page_fields:
+                    if field not in field_index:
+                        field_index[field] = len(fields)
+                        fields.append(field)
 
-            try:
-                self.search_results = json.loads(r.text)
-                logging.debug("downloaded {0} rows of results".format(len(self.search_results['rows'])))
-            except Exception as e:
-                logging.error("unable to parse the json returned by splunk for search {0}: {1}".format(
-                    self.search_id, str(e)))
-                traceback.print_exc()
-                return False
+                    mapping.append(field_index[field])
+
+                if mapping == list(range(len(mapping))):
+                    rows.extend(page_rows)
+                    continue
+
+                for page_row in page_rows:
+                    row = [ None for _ in fields ]
+                    for index, value in zip(mapping, page_row):
+                        row[index] = value
 
+                    rows.append(row)
+
+            self.search_results = { 'fields': fields, 'rows': rows }
+            logging.debug("downloaded {0} rows of results".format(len(rows)))
             return True
 
         except Exception as e:
-            logging.debug("unable to download search results for job {0}: {1}".format(
+            logging.error("unable to download search results for job {0}: {1}".format(
                 self.search_id, str(e)))
+            return False
 
     def json(self):
         """Returns the search results as a list of JSON objects."""
@@ -343,7 +462,8 @@ class SplunkQueryObject(object):
         for row in self.search_results['rows']:
             obj = {}
             for index in range(0, len(self.search_results['fields'])):
-                obj[self.search_results['fields'][index]] = row[index]
+                # rows downloaded before a field first appeared are shorter
+                obj[self.search_results['fields'][index]] = row[index] if index < len(row) else None
             result.append(obj)
 
         return result
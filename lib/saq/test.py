@@ -456,6 +456,32 @@ class GUIServer(ServerProcess):
     def startup_condition(self):
         return self.saq_init > 1
 
+class FakeMemcacheClient(object):
+    """In-process stand in for memcache.Client that counts the requests made to it."""
+    def __init__(self):
+        self.data = {}
+        # key = memcache key, value = the expiration time the key was set with
+        self.times = {}
+        self.request_count = 0
+
+    def get(self, key):
+        self.request_count += 1
+        return self.data.get(key)
+
+    def get_multi(self, keys):
+        self.request_count += 1
+        return { key: self.data[key] for key in keys if key in self.data }
+
+    def set(self, key, value):
+        self.request_count += 1
+        self.data[key] = value
+
+    def set_multi(self, mapping, time=0):
+        self.request_count += 1
+        self.data.update(mapping)
+        self.times.update({ key: time for key in mapping.keys() })
+        return []
+
 class ACEBasicTestCase(TestCase):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -654,6 +680,10 @@ class ACEBasicTestCase(TestCase):
 
     @use_db(name='brocess')
     def reset_brocess(self, db, c):
+        # counts cached by this process are no longer valid
+        from saq.brocess import clear_brocess_cache
+        clear_brocess_cache()
+
         # clear the brocess db
         c.execute("""DELETE FROM httplog""")
         c.execute("""DELETE FROM smtplog""")
@@ -712,6 +742,7 @@ class ACEBasicTestCase(TestCase):
         c.execute("UPDATE nodes SET is_primary = 0")
         c.execute("DELETE FROM locks")
         c.execute("DELETE FROM delayed_analysis")
+        c.execute("DELETE FROM sandbox_jobs")
         c.execute("DELETE FROM users")
         c.execute("DELETE FROM malware")
 
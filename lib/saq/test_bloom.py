@@ -0,0 +1,32 @@
+# vim: sw=4:ts=4:et:cc=120
+
+from saq.bloom import BloomFilter
+from saq.test import *
+
+class BloomFilterTestCase(ACEBasicTestCase):
+    def test_membership(self):
+        bloom = BloomFilter(1000)
+        for i in range(1000):
+            bloom.add('value{}'.format(i))
+
+        self.assertEquals(len(bloom), 1000)
+        # there are no false negatives
+        for i in range(1000):
+            self.assertTrue('value{}'.format(i) in bloom)
+
+        # bytes and str values are the same
+        self.assertTrue(b'value1' in bloom)
+
+    def test_error_rate(self):
+        bloom = BloomFilter(10000, error_rate=0.01)
+        for i in range(10000):
+            bloom.add('value{}'.format(i))
+
+        false_positives = len([ _ for _ in range(100000) if 'other{}'.format(_) in bloom ])
+        self.assertLess(false_positives, 2000)
+
+    def test_empty(self):
+        bloom = BloomFilter(0)
+        self.assertFalse('value' in bloom)
+        bloom.add('value')
+        self.assertTrue('value' in bloom)
@@ -0,0 +1,84 @@
+# vim: sw=4:ts=4:et:cc=120
+
+import os, os.path
+
+import saq
+from saq.brocess import *
+from saq.database import use_db
+from saq.test import *
+
+class BrocessTestCase(ACEBasicTestCase):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.reset_brocess()
+        self.insert_smtplog()
+
+    @use_db(name='brocess')
+    def insert_smtplog(self, db, c):
+        c.execute("""INSERT INTO smtplog ( source, destination, numconnections, firstconnectdate )
+                     VALUES ( 'alice@local', 'bob@local', 3, UNIX_TIMESTAMP(NOW()) ),
+                            ( 'alice@local', 'carol@local', 2, UNIX_TIMESTAMP(NOW()) )""")
+        db.commit()
+
+    @use_db(name='brocess')
+    def insert_smtplog_conversation(self, source, destination, db, c):
+        c.execute("""UPDATE smtplog SET numconnections = numconnections + 1 WHERE source = %s AND destination = %s""",
+                  (source, destination))
+        db.commit()
+
+    def test_bulk_queries(self):
+        self.assertEquals(query_brocess_by_fqdns([ 'local', 'test1.local', 'unknown.local' ]),
+                          { 'local': 1000, 'test1.local': 70, 'unknown.local': 0 })
+        self.assertEquals(query_brocess_by_fqdn('TEST2.local'), 69)
+        self.assertEquals(query_brocess_by_source_emails([ 'alice@local', 'bob@local' ]),
+                          { 'alice@local': 5, 'bob@local': 0 })
+        self.assertEquals(query_brocess_by_email_conversations([ ('alice@local', 'bob@local'),
+                                                                 ('bob@local', 'alice@local') ]),
+                          { ('alice@local', 'bob@local'): 3, ('bob@local', 'alice@local'): 0 })
+        self.assertEquals(query_brocess_by_email_conversation('alice@local', 'carol@local'), 2)
+
+    def test_mixed_case_keys(self):
+        # keys that only differ by case get the same count
+        self.assertEquals(query_brocess_by_fqdns([ 'test1.local', 'TEST1.local', 'Test1.Local' ]),
+                          { 'test1.local': 70, 'TEST1.local': 70, 'Test1.Local': 70 })
+        self.assertEquals(query_brocess_by_source_emails([ 'alice@local', 'ALICE@local' ]),
+                          { 'alice@local': 5, 'ALICE@local': 5 })
+        self.assertEquals(query_brocess_by_email_conversations([ ('alice@local', 'bob@local'),
+                                                                 ('Alice@local', 'BOB@local') ]),
+                          { ('alice@local', 'bob@local'): 3, ('Alice@local', 'BOB@local'): 3 })
+
+    def test_cache(self):
+        record_brocess_metrics(force=True)
+        query_brocess_by_fqdns([ 'local', 'test1.local' ])
+        self.assertEquals(get_brocess_stats().query_count, 1)
+        self.assertEquals(get_brocess_stats().misses, 2)
+
+        # only the fqdn that is not cached is queried
+        self.assertEquals(query_brocess_by_fqdns([ 'LOCAL', 'test1.local', 'test2.local' ]),
+                          { 'LOCAL': 1000, 'test1.local': 70, 'test2.local': 69 })
+        self.assertEquals(get_brocess_stats().query_count, 2)
+        self.assertEquals(get_brocess_stats().hits, 2)
+        self.assertEquals(get_brocess_stats().misses, 3)
+
+        # and the count is cached for every case
+        clear_brocess_cache()
+        query_brocess_by_fqdns([ 'test2.local', 'TEST2.LOCAL' ])
+        self.assertEquals(query_brocess_by_fqdn('Test2.Local'), 69)
+        self.assertEquals(get_brocess_stats().query_count, 3)
+
+        # adding to the httplog invalidates the cached counts
+        add_httplog('test1.local')
+        self.assertEquals(query_brocess_by_fqdn('test1.local'), 71)
+
+        # and so does invalidating the smtplog counts after updating the smtplog
+        self.assertEquals(query_brocess_by_source_email('alice@local'), 5)
+        self.assertEquals(query_brocess_by_email_conversation('alice@local', 'bob@local'), 3)
+        self.insert_smtplog_conversation('alice@local', 'bob@local')
+        self.assertEquals(query_brocess_by_source_email('alice@local'), 5)
+        invalidate_smtplog('ALICE@local', [ 'bob@local' ])
+        self.assertEquals(query_brocess_by_source_email('alice@local'), 6)
+        self.assertEquals(query_brocess_by_email_conversation('alice@local', 'bob@local'), 4)
+
+        record_brocess_metrics(force=True)
+        self.assertTrue(os.path.exists(os.path.join(saq.DATA_DIR, 'stats', 'metrics', 'brocess_cache_hit_rate.csv')))
+        self.assertTrue(os.path.exists(os.path.join(saq.DATA_DIR, 'stats', 'metrics', 'brocess_query_latency.csv')))
@@ -0,0 +1,89 @@
+# vim: sw=4:ts=4:et:cc=120
+
+import multiprocessing
+import os, os.path
+import shutil
+import time
+
+import saq
+from saq.cloudphish import *
+from saq.test import *
+
+TEST_URL = 'http://localhost:8088/Payment_Advice.pdf'
+
+def _coalesced_submit(request_dir, request_log, queue):
+    coalescer = CloudphishRequestCoalescer(request_dir, pending_ttl=5, analyzed_ttl=60, lock_timeout=10)
+
+    def _submit():
+        with open(request_log, 'a') as fp:
+            fp.write('request\n')
+
+        # the request takes a while so the other processes are waiting on it
+        time.sleep(0.5)
+        return { KEY_RESULT: RESULT_OK, KEY_STATUS: STATUS_NEW, KEY_SHA256_URL: hash_url(TEST_URL) }
+
+    queue.put(coalescer.submit(TEST_URL, _submit))
+
+class CloudphishRequestCoalescerTestCase(ACEBasicTestCase):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.request_dir = os.path.join(saq.TEMP_DIR, 'cloudphish_requests')
+        if os.path.isdir(self.request_dir):
+            shutil.rmtree(self.request_dir)
+
+        self.requests = []
+
+    def submit_function(self, status):
+        def _submit():
+            self.requests.append(status)
+            return { KEY_RESULT: RESULT_OK, KEY_STATUS: status }
+
+        return _submit
+
+    def test_concurrent_submit(self):
+        request_log = os.path.join(saq.TEMP_DIR, 'cloudphish_request_log')
+        if os.path.exists(request_log):
+            os.remove(request_log)
+
+        queue = multiprocessing.Queue()
+        processes = [ multiprocessing.Process(target=_coalesced_submit, args=(self.request_dir, request_log, queue))
+                      for _ in range(4) ]
+        for p in processes:
+            p.start()
+
+        results = [ queue.get(timeout=30) for _ in processes ]
+        for p in processes:
+            p.join()
+
+        # only one of the processes made the request and they all got the same response
+        with open(request_log) as fp:
+            self.assertEqual(fp.read(), 'request\n')
+
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all([ _ == results[0] for _ in results ]))
+
+    def test_expiration(self):
+        coalescer = CloudphishRequestCoalescer(self.request_dir, pending_ttl=0, analyzed_ttl=60, lock_timeout=1)
+        # pending responses are not shared for longer than pending_ttl
+        coalescer.submit(TEST_URL, self.submit_function(STATUS_NEW))
+        coalescer.submit(TEST_URL, self.submit_function(STATUS_ANALYZED))
+        # analyzed responses are
+        self.assertEqual(coalescer.submit(TEST_URL, self.submit_function(STATUS_ANALYZED))[KEY_STATUS],
+                         STATUS_ANALYZED)
+        self.assertEqual(self.requests, [ STATUS_NEW, STATUS_ANALYZED ])
+        self.assertEqual(coalescer.request_count, 2)
+        self.assertEqual(coalescer.shared_count, 1)
+
+        # other urls are requested separately
+        coalescer.submit('http://localhost:8088/other.pdf', self.submit_function(STATUS_ANALYZED))
+        self.assertEqual(len(self.requests), 3)
+
+    def test_lock_timeout(self):
+        coalescer = CloudphishRequestCoalescer(self.request_dir, pending_ttl=60, analyzed_ttl=60, lock_timeout=0)
+        # if something else is holding the lock then the request is made anyways
+        def _submit():
+            return coalescer.submit(TEST_URL, self.submit_function(STATUS_NEW))
+
+        coalescer.submit(TEST_URL, _submit)
+        self.assertEqual(self.requests, [ STATUS_NEW ])
+        self.assertEqual(coalescer.request_count, 2)
@@ -125,3 +125,35 @@ class CrawlphishTestCase(ACEBasicTestCase):
         result = _filter.filter('http://test2.local')
         self.assertEquals(result.filtered, False)
         self.assertEquals(result.reason, REASON_OK)
+
+    def test_indicator_cache(self):
+        import sqlite3
+        from saq.crawlphish import IndicatorCache, CRITS_FQDN, CRITS_URL
+
+        cache_path = os.path.join(saq.TEMP_DIR, 'test_indicator_cache.db')
+        for suffix, indicators in [ ('.a', [ ('1', CRITS_FQDN, 'evil.com') ]),
+                                    ('.b', [ ('2', CRITS_URL, 'http://evil.com/index.html') ]) ]:
+            if os.path.exists(cache_path + suffix):
+                os.remove(cache_path + suffix)
+
+            db = sqlite3.connect(cache_path + suffix)
+            db.execute("CREATE TABLE indicators ( id TEXT PRIMARY KEY, type TEXT NOT NULL, value TEXT NOT NULL )")
+            db.executemany("INSERT INTO indicators ( id, type, value ) VALUES ( ?, ?, LOWER(?) )", indicators)
+            db.commit()
+            db.close()
+
+        if os.path.lexists(cache_path):
+            os.remove(cache_path)
+
+        os.symlink(cache_path + '.a', cache_path)
+        cache = IndicatorCache(cache_path)
+        self.assertEquals(cache.find([ (CRITS_FQDN, 'com'), (CRITS_FQDN, 'evil.com') ]), (CRITS_FQDN, 'evil.com', '1'))
+        self.assertIsNone(cache.find([ (CRITS_FQDN, 'good.com'), (CRITS_URL, 'http://evil.com/index.html') ]))
+
+        # the cache is updated by pointing the symlink to the other database
+        os.remove(cache_path)
+        os.symlink(cache_path + '.b', cache_path)
+        self.assertIsNone(cache.find([ (CRITS_FQDN, 'evil.com') ]))
+        self.assertEquals(cache.find([ (CRITS_URL, 'http://evil.com/index.html') ]),
+                          (CRITS_URL, 'http://evil.com/index.html', '2'))
+        cache.close()
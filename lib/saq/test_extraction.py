@@ -0,0 +1,301 @@
+# vim: sw=4:ts=4:et:cc=120
+
+import bz2
+import gzip
+import hashlib
+import io
+import lzma
+import os, os.path
+import shutil
+import tarfile
+import zipfile
+
+import saq
+from saq.extraction import *
+from saq.hashing import HASH_MD5, HASH_SHA256
+from saq.test import *
+
+class ExtractionTestCase(ACEBasicTestCase):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.temp_dir = os.path.join(saq.TEMP_DIR, 'extraction')
+        if os.path.isdir(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+        os.makedirs(self.temp_dir)
+        self.target_dir = os.path.join(self.temp_dir, 'archive.extracted')
+
+    def create_zip(self, name, members, compression=zipfile.ZIP_DEFLATED):
+        path = os.path.join(self.temp_dir, name)
+        with zipfile.ZipFile(path, 'w', compression=compression) as zfile:
+            for member_name, data in members:
+                zfile.writestr(member_name, data)
+
+        return path
+
+    def create_tar(self, name, members, mode='w:gz'):
+        path = os.path.join(self.temp_dir, name)
+        with tarfile.open(path, mode) as tar:
+            for member_name, data in members:
+                info = tarfile.TarInfo(member_name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+
+        return path
+
+    def extracted_files(self):
+        result = {}
+        for root, dirs, files in os.walk(self.target_dir):
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                with open(path, 'rb') as fp:
+                    result[os.path.relpath(path, self.target_dir)] = fp.read()
+
+        return result
+
+    def test_detect_archive_format(self):
+        path = self.create_zip('test.zip', [ ('a', b'a') ])
+        self.assertEquals(detect_archive_format(path), FORMAT_ZIP)
+        self.assertEquals(detect_archive_format(self.create_tar('test.tar', [ ('a', b'a') ], mode='w')), FORMAT_TAR)
+        self.assertEquals(detect_archive_format(self.create_tar('test.tgz', [ ('a', b'a') ])), FORMAT_GZIP)
+
+        path = os.path.join(self.temp_dir, 'test.txt')
+        with open(path, 'wb') as fp:
+            fp.write(b'test')
+
+        self.assertIsNone(detect_archive_format(path))
+        self.assertIsNone(open_archive(path))
+
+    def test_safe_member_path(self):
+        self.assertEquals(safe_member_path('a/b.txt'), os.path.join('a', 'b.txt'))
+        self.assertEquals(safe_member_path('../../etc/passwd'), os.path.join('etc', 'passwd'))
+        self.assertEquals(safe_member_path('/etc/passwd'), os.path.join('etc', 'passwd'))
+        self.assertEquals(safe_member_path('C:\\Windows\\evil.exe'), os.path.join('Windows', 'evil.exe'))
+        self.assertIsNone(safe_member_path('../'))
+
+    def test_get_archive_depth(self):
+        self.assertEquals(get_archive_depth('test.zip'), 0)
+        self.assertEquals(get_archive_depth('test.zip.extracted/a.zip'), 1)
+        self.assertEquals(get_archive_depth('test.zip.extracted/a.zip.extracted/b.zip.extracted/c'), 3)
+
+    def test_extract_zip(self):
+        path = self.create_zip('test.zip', [ ('a.txt', b'a'), ('dir/b.txt', b'b'), ('dir/', b''),
+                                             ('../evil.txt', b'evil') ])
+        archive = open_archive(path)
+        self.assertEquals(archive.format, FORMAT_ZIP)
+        self.assertEquals(archive.file_count, 3)
+        self.assertEquals(archive.names, [ 'a.txt', 'dir/b.txt', '../evil.txt' ])
+
+        extracted = archive.extract(self.target_dir)
+        self.assertEquals(len(extracted), 3)
+        self.assertEquals(self.extracted_files(), { 'a.txt': b'a', os.path.join('dir', 'b.txt'): b'b',
+                                                    'evil.txt': b'evil' })
+        self.assertEquals(extracted[0].hashes[HASH_MD5], hashlib.md5(b'a').hexdigest())
+        self.assertEquals(extracted[0].hashes[HASH_SHA256], hashlib.sha256(b'a').hexdigest())
+        self.assertEquals(archive.skipped, [])
+
+    def test_extract_zip_duplicates(self):
+        # duplicate content and duplicate names
+        path = self.create_zip('test.zip', [ ('a.txt', b'a'), ('b.txt', b'a'), ('c.txt', b'c'), ('c.txt', b'd') ])
+        archive = open_archive(path)
+        extracted = archive.extract(self.target_dir)
+        self.assertEquals([ _.name for _ in extracted ], [ 'a.txt', 'c.txt', 'c.txt' ])
+        self.assertEquals(archive.skipped, [ ('b.txt', SKIP_DUPLICATE) ])
+        self.assertEquals(self.extracted_files(), { 'a.txt': b'a', 'c.txt': b'c', 'c.txt_1': b'd' })
+
+    def test_extract_zip_exclude(self):
+        path = self.create_zip('test.xlsx', [ ('xl/activeX/activeX1.xml', b'a'), ('xl/workbook.xml', b'b') ])
+        archive = open_archive(path)
+        extracted = archive.extract(self.target_dir, exclude=[ 'xl/activeX/*' ])
+        self.assertEquals([ _.name for _ in extracted ], [ 'xl/workbook.xml' ])
+        self.assertEquals(archive.skipped, [ ('xl/activeX/activeX1.xml', SKIP_EXCLUDED) ])
+
+    def test_extract_zip_too_many_files(self):
+        path = self.create_zip('test.zip', [ ('{}.txt'.format(_), str(_).encode()) for _ in range(10) ])
+        with self.assertRaises(TooManyFiles):
+            open_archive(path).extract(self.target_dir, max_files=5)
+
+        self.assertEquals(self.extracted_files(), {})
+
+    def test_zip_bomb_ratio(self):
+        # 8MB of zeros compresses to about 8KB
+        path = self.create_zip('bomb.zip', [ ('bomb.bin', bytes(8 * 1024 * 1024)), ('ok.txt', b'ok') ])
+        archive = open_archive(path)
+        extracted = archive.extract(self.target_dir, ExtractionLimits(max_ratio=100))
+        self.assertEquals([ _.name for _ in extracted ], [ 'ok.txt' ])
+        self.assertEquals(archive.skipped, [ ('bomb.bin', SKIP_RATIO) ])
+
+    def test_zip_bomb_lying_header(self):
+        # a member that claims to be small in the headers never expands past the size it claims
+        path = self.create_zip('bomb.zip', [ ('bomb.bin', bytes(4 * 1024 * 1024)), ('ok.txt', b'ok') ])
+        archive = open_archive(path)
+        archive.zip_members[0].file_size = 1
+        extracted = archive.extract(self.target_dir, ExtractionLimits(max_file_size=1024 * 1024))
+        self.assertEquals([ _.name for _ in extracted ], [ 'ok.txt' ])
+        self.assertEquals(archive.skipped, [ ('bomb.bin', SKIP_CORRUPT) ])
+        self.assertEquals(self.extracted_files(), { 'ok.txt': b'ok' })
+
+        # and one that is honest about it is not decompressed at all
+        shutil.rmtree(self.target_dir)
+        archive = open_archive(path)
+        extracted = archive.extract(self.target_dir, ExtractionLimits(max_file_size=1024 * 1024))
+        self.assertEquals(archive.skipped, [ ('bomb.bin', SKIP_FILE_SIZE) ])
+
+    def test_zip_bomb_total_size(self):
+        # lots of members that are each small enough
+        members = [ ('{}.bin'.format(_), bytes([_]) * 1024 * 1024) for _ in range(10) ]
+        path = self.create_zip('bomb.zip', members)
+        archive = open_archive(path)
+        extracted = archive.extract(self.target_dir, ExtractionLimits(max_file_size=2 * 1024 * 1024,
+                                                                      max_total_size=4 * 1024 * 1024))
+        # extraction stops at the limit
+        self.assertEquals(len(extracted), 4)
+        self.assertEquals(archive.skipped, [ ('4.bin', SKIP_TOTAL_SIZE) ])
+        self.assertEquals(len(self.extracted_files()), 4)
+
+    def test_nested_zip_bomb(self):
+        # a zip of zips of zips (42.zip style) only extracts one level at a time
+        data = bytes(1024 * 1024)
+        for level in range(3):
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as zfile:
+                for index in range(4):
+                    zfile.writestr('{}_{}.zip'.format(level, index), data)
+
+            data = buffer.getvalue()
+
+        path = os.path.join(self.temp_dir, 'nested.zip')
+        with open(path, 'wb') as fp:
+            fp.write(data)
+
+        archive = open_archive(path)
+        extracted = archive.extract(self.target_dir)
+        # the members all have the same content
+        self.assertEquals(len(extracted), 1)
+        self.assertEquals(len(archive.skipped), 3)
+        self.assertEquals(get_archive_depth(extracted[0].path), 1)
+
+        nested_path = os.path.join(self.target_dir, extracted[0].path)
+        nested_target_dir = '{}.extracted'.format(nested_path)
+        nested_extracted = open_archive(nested_path).extract(nested_target_dir)
+        self.assertEquals(get_archive_depth(nested_extracted[0].path), 2)
+
+    def test_unsupported_zip(self):
+        path = self.create_zip('test.zip', [ ('a.txt', b'a') ], compression=zipfile.ZIP_STORED)
+        # change the compression method to deflate64 (which zipfile does not support)
+        with open(path, 'rb') as fp:
+            data = bytearray(fp.read())
+
+        for signature, offset in [ (b'PK\x03\x04', 8), (b'PK\x01\x02', 10) ]:
+            index = data.find(signature)
+            data[index + offset] = 9
+
+        with open(path, 'wb') as fp:
+            fp.write(data)
+
+        self.assertIsNone(open_archive(path))
+
+    def test_extract_tar(self):
+        for mode in [ 'w', 'w:gz', 'w:bz2', 'w:xz' ]:
+            if os.path.isdir(self.target_dir):
+                shutil.rmtree(self.target_dir)
+
+            path = self.create_tar('test.tar', [ ('a.txt', b'a'), ('dir/b.txt', b'b'), ('/abs.txt', b'abs'),
+                                                 ('c.txt', b'a') ], mode=mode)
+            archive = open_archive(path)
+            self.assertEquals(archive.format, FORMAT_TAR)
+            self.assertIsNone(archive.file_count)
+            extracted = archive.extract(self.target_dir)
+            self.assertEquals(archive.file_count, 4)
+            self.assertEquals(self.extracted_files(), { 'a.txt': b'a', os.path.join('dir', 'b.txt'): b'b',
+                                                        'abs.txt': b'abs' })
+            self.assertEquals(archive.skipped, [ ('c.txt', SKIP_DUPLICATE) ])
+
+    def test_extract_tar_links(self):
+        path = os.path.join(self.temp_dir, 'test.tar')
+        with tarfile.open(path, 'w') as tar:
+            info = tarfile.TarInfo('passwd')
+            info.type = tarfile.SYMTYPE
+            info.linkname = '/etc/passwd'
+            tar.addfile(info)
+            info = tarfile.TarInfo('a.txt')
+            info.size = 1
+            tar.addfile(info, io.BytesIO(b'a'))
+
+        archive = open_archive(path)
+        archive.extract(self.target_dir)
+        self.assertEquals(archive.file_count, 1)
+        self.assertEquals(self.extracted_files(), { 'a.txt': b'a' })
+
+    def test_tar_bomb(self):
+        path = self.create_tar('bomb.tar.gz', [ ('bomb.bin', bytes(8 * 1024 * 1024)), ('ok.txt', b'ok') ])
+        archive = open_archive(path)
+        extracted = archive.extract(self.target_dir, ExtractionLimits(max_ratio=100))
+        # the ratio of a stream is checked for the whole stream so nothing else is extracted
+        self.assertEquals(extracted, [])
+        self.assertEquals(archive.skipped, [ ('bomb.bin', SKIP_RATIO) ])
+        self.assertEquals(self.extracted_files(), {})
+
+        # files larger than the limit are skipped without writing anything
+        shutil.rmtree(self.target_dir)
+        archive = open_archive(path)
+        extracted = archive.extract(self.target_dir, ExtractionLimits(max_file_size=1024 * 1024))
+        self.assertEquals([ _.name for _ in extracted ], [ 'ok.txt' ])
+        self.assertEquals(archive.skipped, [ ('bomb.bin', SKIP_FILE_SIZE) ])
+
+    def test_extract_tar_too_many_files(self):
+        path = self.create_tar('test.tar.gz', [ ('{}.txt'.format(_), str(_).encode()) for _ in range(10) ])
+        with self.assertRaises(TooManyFiles):
+            open_archive(path).extract(self.target_dir, max_files=5)
+
+    def test_extract_streams(self):
+        for archive_format, name, opener in [ (FORMAT_GZIP, 'test.txt.gz', gzip.open),
+                                              (FORMAT_BZIP2, 'test.txt.bz2', bz2.open),
+                                              (FORMAT_XZ, 'test.txt.xz', lzma.open) ]:
+            if os.path.isdir(self.target_dir):
+                shutil.rmtree(self.target_dir)
+
+            path = os.path.join(self.temp_dir, name)
+            with opener(path, 'wb') as fp:
+                fp.write(b'test')
+
+            archive = open_archive(path)
+            self.assertEquals(archive.format, archive_format)
+            extracted = archive.extract(self.target_dir)
+            self.assertEquals(archive.file_count, 1)
+            self.assertEquals(self.extracted_files(), { 'test.txt': b'test' })
+            self.assertEquals(extracted[0].hashes[HASH_SHA256], hashlib.sha256(b'test').hexdigest())
+
+    def test_gzip_original_name(self):
+        path = os.path.join(self.temp_dir, 'renamed.gz')
+        with open(path, 'wb') as fp:
+            with gzip.GzipFile('invoice.exe', 'wb', fileobj=fp) as gzip_fp:
+                gzip_fp.write(b'test')
+
+        open_archive(path).extract(self.target_dir)
+        self.assertEquals(self.extracted_files(), { 'invoice.exe': b'test' })
+
+    def test_gzip_bomb(self):
+        path = os.path.join(self.temp_dir, 'bomb.gz')
+        with gzip.open(path, 'wb') as fp:
+            for _ in range(64):
+                fp.write(bytes(1024 * 1024))
+
+        archive = open_archive(path)
+        extracted = archive.extract(self.target_dir, ExtractionLimits(max_total_size=8 * 1024 * 1024))
+        self.assertEquals(extracted, [])
+        self.assertEquals(archive.skipped, [ ('bomb', SKIP_TOTAL_SIZE) ])
+        self.assertEquals(self.extracted_files(), {})
+
+    def test_corrupt_stream(self):
+        path = os.path.join(self.temp_dir, 'test.gz')
+        with gzip.open(path, 'wb') as fp:
+            fp.write(os.urandom(1024 * 1024))
+
+        # truncate it
+        with open(path, 'r+b') as fp:
+            fp.truncate(1024)
+
+        archive = open_archive(path)
+        self.assertEquals(archive.extract(self.target_dir), [])
+        self.assertEquals(archive.skipped, [ ('test', SKIP_CORRUPT) ])
@@ -0,0 +1,64 @@
+# vim: sw=4:ts=4:et:cc=120
+
+import os, os.path
+import shutil
+import subprocess
+
+import saq
+import saq.file_type
+from saq.file_type import get_file_type, get_mime_type
+from saq.test import *
+
+SAMPLE_FILES = [ 'test_data/pdf/Payment_Advice.pdf', 'test_data/sample.jar', 'test_data/invalid.exe',
+                 'test_data/live_browser.000.html' ]
+
+def file_command(path, *options):
+    return subprocess.run(['file', '-b'] + list(options) + ['-L', path], stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE).stdout.decode(errors='ignore').strip()
+
+class FileTypeTestCase(ACEBasicTestCase):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        saq.file_type._file_type_cache.clear()
+        self.temp_dir = os.path.join(saq.TEMP_DIR, 'file_type')
+        if os.path.isdir(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+        os.makedirs(self.temp_dir)
+
+    def tearDown(self, *args, **kwargs):
+        super().tearDown(*args, **kwargs)
+        saq.file_type._file_type_cache.clear()
+        saq.file_type._magic_handles = saq.file_type._magic_handles_pid = None
+
+    def sample_files(self):
+        # empty files and symlinks are special cases
+        empty_path = os.path.join(self.temp_dir, 'empty')
+        with open(empty_path, 'wb') as fp:
+            pass
+
+        link_path = os.path.join(self.temp_dir, 'link')
+        os.symlink(os.path.join(saq.SAQ_HOME, SAMPLE_FILES[0]), link_path)
+        return [ os.path.join(saq.SAQ_HOME, _) for _ in SAMPLE_FILES ] + [ empty_path, link_path ]
+
+    def test_get_file_type(self):
+        for path in self.sample_files():
+            self.assertEquals(get_file_type(path), (file_command(path), file_command(path, '--mime-type')))
+            self.assertEquals(get_mime_type(path), file_command(path, '--mime-type'))
+
+    def test_file_command_fallback(self):
+        saq.file_type._magic_handles = None
+        saq.file_type._magic_handles_pid = os.getpid()
+        for path in self.sample_files():
+            self.assertEquals(get_file_type(path), (file_command(path), file_command(path, '--mime-type')))
+
+    def test_memoized(self):
+        path = os.path.join(saq.SAQ_HOME, SAMPLE_FILES[0])
+        result = get_file_type(path, sha256='test')
+        self.assertEquals(result[1], 'application/pdf')
+        # results are looked up by the sha256
+        self.assertEquals(get_file_type(os.path.join(saq.SAQ_HOME, SAMPLE_FILES[1]), sha256='test'), result)
+        self.assertEquals(get_mime_type(os.path.join(saq.SAQ_HOME, SAMPLE_FILES[1]), sha256='test'),
+                          'application/pdf')
+        # but only when the sha256 is known
+        self.assertNotEquals(get_file_type(os.path.join(saq.SAQ_HOME, SAMPLE_FILES[1])), result)
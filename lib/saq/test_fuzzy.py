@@ -0,0 +1,129 @@
+# vim: sw=4:ts=4:et:cc=120
+
+import os, os.path
+import random
+import shutil
+
+import saq
+import saq.fuzzy
+from saq.fuzzy import SsdeepIndex, fuzzy_compare, eliminate_sequences, open_ssdeep_index, parse_hash, \
+                      write_ssdeep_index
+from saq.test import *
+
+# generated with the ssdeep library from a random 20K buffer and modified copies of it
+HASH_BASE = '384:bZAZbnb/PutCDhX1qEpJ75Xk8u4OwiShEDrwugi3xgziKajs52fkyOvW1d:bKzTutCDhX1z75U80w+rwWTjW2fky5'
+HASH_NULLED = '384:bZAZbnb/PutCDhX1qWJ75Xk8u4OwiShEDrwugi3xgziKajs52fkyOvW1d:bKzTutCDhX1z75U80w+rwWTjW2fky5'
+HASH_REPLACED = '384:b3B0/M9fPZ9I/G63+apV7UOOWUOyPNiLvPl2wiShEDrwugi3xgziKajs52fkyOvI:b3B0KHZ9IV3jpVIWUOWcAw+rwWTjW2ft'
+HASH_OTHER = '384:gl0f+rr6QG+eT/mknS7vWiZjtccqHf/YXULflovZIWBGLqutD92UGcpjrNQJb3Eu:gWfMe+eT/mJWiyHf/IUpovZiLquDA6ji'
+HASH_DOUBLED = '768:bKzTutCDhX1z75U80w+rwWTjW2fkytKzTutCDhX1z75U80w+rwWTjW2fky5:bySt8hJ5+w+rwWTjWkrtySt8hJ5+w+rR'
+
+class FuzzyTestCase(ACEBasicTestCase):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        # always test the python implementation
+        self.libfuzzy = saq.fuzzy._libfuzzy
+        self.libfuzzy_loaded = saq.fuzzy._libfuzzy_loaded
+        saq.fuzzy._libfuzzy = None
+        saq.fuzzy._libfuzzy_loaded = True
+
+    def tearDown(self, *args, **kwargs):
+        super().tearDown(*args, **kwargs)
+        saq.fuzzy._libfuzzy = self.libfuzzy
+        saq.fuzzy._libfuzzy_loaded = self.libfuzzy_loaded
+
+    def test_parse_hash(self):
+        self.assertEquals(parse_hash('3:abc:de,"file name"'), (3, 'abc', 'de'))
+        with self.assertRaises(ValueError):
+            parse_hash('invalid')
+
+    def test_eliminate_sequences(self):
+        self.assertEquals(eliminate_sequences('aaaaabcccd'), 'aaabcccd')
+        self.assertEquals(eliminate_sequences('ab'), 'ab')
+
+    def test_fuzzy_compare(self):
+        # expected values are from the ssdeep library
+        self.assertEquals(fuzzy_compare(HASH_BASE, HASH_BASE), 100)
+        self.assertEquals(fuzzy_compare(HASH_BASE, HASH_NULLED), 100)
+        self.assertEquals(fuzzy_compare(HASH_BASE, HASH_REPLACED), 55)
+        self.assertEquals(fuzzy_compare(HASH_BASE, HASH_OTHER), 0)
+        self.assertEquals(fuzzy_compare(HASH_BASE, HASH_DOUBLED), 69)
+        self.assertEquals(fuzzy_compare(HASH_DOUBLED, HASH_BASE), 69)
+        # block sizes too far apart
+        self.assertEquals(fuzzy_compare(HASH_BASE, HASH_BASE.replace('384:', '1536:')), 0)
+
+    def create_hashes(self, hashes):
+        """Writes the given list of (hash, file_name) to a hash file and returns the path to it."""
+        self.temp_dir = os.path.join(saq.TEMP_DIR, 'fuzzy')
+        if os.path.isdir(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+        os.makedirs(self.temp_dir)
+        path = os.path.join(self.temp_dir, 'ssdeep_hashes')
+        with open(path, 'w') as fp:
+            fp.write('ssdeep,1.1--blocksize:hash:hash,filename\n')
+            for _hash, file_name in hashes:
+                fp.write('{},{}\n'.format(_hash, file_name))
+
+        return path
+
+    def test_index(self):
+        hashes_path = self.create_hashes([ (HASH_NULLED, '"/samples/nulled"'), (HASH_REPLACED, '"/samples/replaced"'),
+                                           ('invalid line', ''), (HASH_OTHER, '"/samples/other"'),
+                                           (HASH_DOUBLED, 'id_1234') ])
+        index_path = os.path.join(self.temp_dir, 'ssdeep_hashes.index')
+        write_ssdeep_index(index_path, hashes_path)
+
+        index = SsdeepIndex(index_path)
+        self.assertEquals(len(index), 4)
+        self.assertEquals(index.get_entry(3), (HASH_DOUBLED, 'id_1234'))
+        self.assertEquals(index.matches(HASH_BASE), [ ('/samples/nulled', 100), ('/samples/replaced', 55),
+                                                      ('id_1234', 69) ])
+        self.assertEquals(index.matches(HASH_BASE, 60), [ ('/samples/nulled', 100), ('id_1234', 69) ])
+        # the unrelated hash is never compared
+        self.assertFalse(2 in index.candidates(HASH_BASE))
+        # short hashes only match if they are identical
+        self.assertEquals(index.matches('3:abc:d'), [])
+        index.close()
+
+    def test_open_ssdeep_index(self):
+        hashes_path = self.create_hashes([ (HASH_NULLED, '"/samples/nulled"') ])
+        index_path = os.path.join(self.temp_dir, 'ssdeep_hashes.index')
+        index = open_ssdeep_index(index_path, hashes_path)
+        self.assertEquals(index.matches(HASH_BASE), [ ('/samples/nulled', 100) ])
+        self.assertTrue(open_ssdeep_index(index_path, hashes_path, current=index) is index)
+
+        with open(hashes_path, 'a') as fp:
+            fp.write('{},"/samples/doubled"\n'.format(HASH_DOUBLED))
+
+        # make sure the change is detected even if it happens within the same mtime tick
+        index_mtime = os.path.getmtime(index_path)
+        os.utime(hashes_path, (index_mtime + 1, index_mtime + 1))
+
+        new_index = open_ssdeep_index(index_path, hashes_path, current=index)
+        self.assertFalse(new_index is index)
+        self.assertEquals(new_index.matches(HASH_BASE), [ ('/samples/nulled', 100), ('/samples/doubled', 69) ])
+        new_index.close()
+
+    def test_index_matches_linear_compare(self):
+        # random hashes that share pieces with each other
+        random.seed(0)
+        alphabet = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+        pieces = [ ''.join(random.choice(alphabet) for _ in range(8)) for _ in range(20) ]
+        hashes = []
+        for _ in range(100):
+            block_size = random.choice([ 3, 6, 12, 24, 48, 96 ])
+            chunk = ''.join(random.choice(pieces) for _ in range(random.randint(0, 8)))[:64]
+            double_chunk = ''.join(random.choice(pieces) for _ in range(random.randint(0, 4)))[:32]
+            hashes.append('{}:{}:{}'.format(block_size, chunk, double_chunk))
+
+        hashes_path = self.create_hashes([ (_hash, str(file_index)) for file_index, _hash in enumerate(hashes) ])
+        index_path = os.path.join(self.temp_dir, 'ssdeep_hashes.index')
+        write_ssdeep_index(index_path, hashes_path)
+        index = SsdeepIndex(index_path)
+
+        for _hash in hashes:
+            scores = [ fuzzy_compare(_hash, known_hash) for known_hash in hashes ]
+            expected = [ (str(file_index), score) for file_index, score in enumerate(scores) if score > 0 ]
+            self.assertEquals(index.matches(_hash), expected)
+
+        index.close()
@@ -0,0 +1,124 @@
+# vim: sw=4:ts=4:et:cc=120
+
+import hashlib
+import os, os.path
+import shutil
+
+import saq
+import saq.hashing
+from saq.fuzzy import FuzzyHasher
+from saq.hashing import HashCache, compute_file_hashes, get_file_hashes, _update_parallel, \
+                        HASH_MD5, HASH_SHA1, HASH_SHA256, HASH_SSDEEP
+from saq.test import *
+
+class HashingTestCase(ACEBasicTestCase):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.temp_dir = os.path.join(saq.TEMP_DIR, 'hashing')
+        if os.path.isdir(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+        os.makedirs(self.temp_dir)
+
+    def create_file(self, name, data):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, 'wb') as fp:
+            fp.write(data)
+
+        return path
+
+    def test_compute_file_hashes(self):
+        # sizes around the buffer size
+        for size in [ 0, 1, 15, 16, 17, 100 ]:
+            data = os.urandom(size)
+            path = self.create_file('test_{}'.format(size), data)
+            self.assertEquals(compute_file_hashes(path, buffer_size=16), {
+                HASH_MD5: hashlib.md5(data).hexdigest(),
+                HASH_SHA1: hashlib.sha1(data).hexdigest(),
+                HASH_SHA256: hashlib.sha256(data).hexdigest() })
+
+        with self.assertRaises(OSError):
+            compute_file_hashes(os.path.join(self.temp_dir, 'missing'))
+
+    def test_update_parallel(self):
+        data = os.urandom(100)
+        path = self.create_file('test', data)
+        hashers = [ hashlib.md5(), hashlib.sha1(), hashlib.sha256() ]
+        with open(path, 'rb', buffering=0) as fp:
+            _update_parallel(fp, [ _.update for _ in hashers ], 16)
+
+        self.assertEquals([ _.hexdigest() for _ in hashers ],
+                          [ hashlib.md5(data).hexdigest(), hashlib.sha1(data).hexdigest(),
+                            hashlib.sha256(data).hexdigest() ])
+
+    def test_hash_cache(self):
+        path = self.create_file('test', b'test')
+        cache = HashCache(os.path.join(self.temp_dir, 'hash_cache.db'))
+        st = os.stat(path)
+        self.assertIsNone(cache.get(st))
+
+        hashes = compute_file_hashes(path)
+        cache.put(st, hashes)
+        self.assertEquals(cache.get(st), hashes)
+        # the ssdeep hash was not stored
+        self.assertIsNone(cache.get(st, ssdeep=True)[HASH_SSDEEP])
+        cache.update_ssdeep(st, '3:updated:updated')
+        self.assertEquals(cache.get(st, ssdeep=True)[HASH_SSDEEP], '3:updated:updated')
+        self.assertEquals(cache.get(st), hashes)
+
+        hashes[HASH_SSDEEP] = '3:test:test'
+        cache.put(st, hashes)
+        self.assertEquals(cache.get(st, ssdeep=True), hashes)
+        self.assertEquals(len(cache), 1)
+
+        # a modified file is a different file
+        with open(path, 'ab') as fp:
+            fp.write(b'more')
+
+        self.assertIsNone(cache.get(os.stat(path)))
+
+        cache.expire(-1)
+        self.assertEquals(len(cache), 0)
+        cache.close()
+
+    def test_get_file_hashes(self):
+        config = dict(saq.CONFIG['hash_cache'])
+        saq.CONFIG['hash_cache']['enabled'] = 'yes'
+        saq.CONFIG['hash_cache']['path'] = os.path.join(self.temp_dir, 'hash_cache.db')
+        saq.CONFIG['hash_cache']['minimum_size'] = '4'
+        saq.hashing._hash_cache = saq.hashing._hash_cache_pid = None
+
+        try:
+            path = self.create_file('test', b'test')
+            hashes = get_file_hashes(path)
+            self.assertEquals(hashes[HASH_MD5], hashlib.md5(b'test').hexdigest())
+            cache = saq.hashing.get_hash_cache()
+            self.assertEquals(cache.get(os.stat(path)), hashes)
+
+            # the second call uses the cache
+            cache.put(os.stat(path), { HASH_MD5: 'cached', HASH_SHA1: 'cached', HASH_SHA256: 'cached' })
+            self.assertEquals(get_file_hashes(path)[HASH_MD5], 'cached')
+
+            # only the ssdeep hash is computed when the other hashes are already cached
+            if FuzzyHasher.available() or shutil.which('ssdeep'):
+                hashes = get_file_hashes(path, ssdeep=True)
+                self.assertEquals(hashes[HASH_MD5], 'cached')
+                self.assertEquals(hashes[HASH_SSDEEP], compute_file_hashes(path, ssdeep=True)[HASH_SSDEEP])
+                self.assertEquals(cache.get(os.stat(path), ssdeep=True), hashes)
+
+            # small files are not cached
+            path = self.create_file('small', b'abc')
+            get_file_hashes(path)
+            self.assertIsNone(cache.get(os.stat(path)))
+
+            with self.assertRaises(OSError):
+                get_file_hashes(os.path.join(self.temp_dir, 'missing'))
+
+        finally:
+            for key, value in config.items():
+                saq.CONFIG['hash_cache'][key] = value
+
+            if saq.hashing._hash_cache is not None:
+                saq.hashing._hash_cache.close()
+
+            saq.hashing._hash_cache = saq.hashing._hash_cache_pid = None
@@ -0,0 +1,113 @@
+# vim: sw=4:ts=4:et:cc=120
+
+import os, os.path
+import shutil
+import sys
+import time
+
+import saq
+from saq.helper_pool import HelperPool
+from saq.test import *
+
+TEST_SCRIPT = """
+import logging, sys
+logging.basicConfig(level=logging.DEBUG, format='%(levelname)s %(message)s')
+logging.debug('arguments %s', sys.argv[1:])
+print('stdout from ' + __name__)
+sys.stderr.write('stderr\\n')
+if sys.argv[1] == 'exit':
+    sys.exit(int(sys.argv[2]))
+if sys.argv[1] == 'raise':
+    raise ValueError('test')
+if sys.argv[1] == 'crash':
+    sys.stdout.flush()
+    import os
+    os._exit(3)
+if sys.argv[1] == 'sleep':
+    import time
+    time.sleep(10)
+if sys.argv[1] == 'memory':
+    data = bytearray(1024 * 1024 * 1024)
+"""
+
+class HelperPoolTestCase(ACEBasicTestCase):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.temp_dir = os.path.join(saq.TEMP_DIR, 'helper_pool')
+        if os.path.isdir(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+        os.makedirs(self.temp_dir)
+        self.script = os.path.join(self.temp_dir, 'script.py')
+        with open(self.script, 'w') as fp:
+            fp.write(TEST_SCRIPT)
+
+        self.pool = HelperPool(sys.executable, max_jobs=3, memory_limit=512 * 1024 * 1024)
+
+    def tearDown(self, *args, **kwargs):
+        super().tearDown(*args, **kwargs)
+        self.pool.close()
+
+    def assertSameResult(self, argv, **kwargs):
+        expected = self.pool.run_process(argv, **kwargs)
+        result = self.pool.run(argv, **kwargs)
+        self.assertEquals(result.returncode, expected.returncode)
+        self.assertEquals(result.stdout, expected.stdout)
+        self.assertEquals(result.stderr, expected.stderr)
+        return result
+
+    def test_same_output(self):
+        result = self.assertSameResult([ self.script, 'ok' ])
+        self.assertEquals(result.returncode, 0)
+        self.assertEquals(result.stdout, b'stdout from __main__\n')
+        self.assertEquals(result.stderr_text, "DEBUG arguments ['ok']\nstderr\n")
+
+        self.assertEquals(self.assertSameResult([ self.script, 'exit', '4' ]).returncode, 4)
+        self.assertEquals(self.assertSameResult([ self.script, 'raise' ]).returncode, 1)
+
+        # relative paths and stdout written to a file
+        stdout_path = os.path.join(self.temp_dir, 'stdout')
+        result = self.pool.run([ 'script.py', 'ok' ], stdout_path=stdout_path, cwd=self.temp_dir)
+        self.assertIsNone(result.stdout)
+        with open(stdout_path, 'rb') as fp:
+            self.assertEquals(fp.read(), b'stdout from __main__\n')
+
+    def test_pdf_parser(self):
+        pdf_parser = os.path.join(saq.SAQ_HOME, 'bin', 'pdf-parser.py')
+        pdf_path = os.path.join(saq.SAQ_HOME, 'test_data', 'pdf', 'Payment_Advice.pdf')
+        for _ in range(2):
+            self.assertSameResult([ pdf_parser, '-f', '-w', '-v', '-c', '--debug', pdf_path ])
+
+    def test_recycle(self):
+        self.pool.run([ self.script, 'ok' ])
+        helper = self.pool.idle[0]
+        self.pool.run([ self.script, 'ok' ])
+        self.assertTrue(self.pool.idle[0] is helper)
+        self.pool.run([ self.script, 'ok' ])
+        # replaced after max_jobs
+        self.assertEquals(self.pool.idle, [])
+        self.assertEquals(self.pool.helper_count, 0)
+        helper.process.wait(timeout=5)
+
+    def test_crash(self):
+        # the job is executed again in a new process
+        result = self.assertSameResult([ self.script, 'crash' ])
+        self.assertEquals(result.returncode, 3)
+        self.assertEquals(self.pool.helper_count, 0)
+
+        # missing scripts fail the same way they do from the command line
+        self.assertSameResult([ os.path.join(self.temp_dir, 'missing.py') ])
+
+    def test_timeout(self):
+        start = time.time()
+        result = self.pool.run([ self.script, 'sleep' ], timeout=1)
+        self.assertTrue(time.time() - start < 5)
+        self.assertTrue(result.timed_out)
+        self.assertEquals(self.pool.helper_count, 0)
+
+    def test_memory_limit(self):
+        result = self.pool.run([ self.script, 'memory' ])
+        self.assertEquals(result.returncode, 1)
+        self.assertTrue(b'MemoryError' in result.stderr)
+        self.assertEquals(self.pool.helper_count, 0)
+        self.assertEquals(self.pool.run([ self.script, 'ok' ]).returncode, 0)
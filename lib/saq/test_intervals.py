@@ -0,0 +1,101 @@
+# vim: sw=4:ts=4:et:cc=120
+
+import os, os.path
+import shutil
+import time
+
+import saq
+from saq.intervals import IntervalTable, compile_segments, open_interval_table, write_interval_table
+from saq.test import *
+
+class IntervalTableTestCase(ACEBasicTestCase):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+
+        self.temp_dir = os.path.join(saq.TEMP_DIR, 'intervals')
+        if os.path.isdir(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+        os.makedirs(self.temp_dir)
+        self.table_path = os.path.join(self.temp_dir, 'test.table')
+
+    def test_compile_segments(self):
+        # disjoint
+        self.assertEquals(compile_segments([ (0, 9, 0), (20, 29, 1) ]), [ (0, 9, 0, 9, 0), (20, 29, 20, 29, 1) ])
+        # nested intervals are split so that the smallest interval wins
+        self.assertEquals(compile_segments([ (0, 99, 0), (10, 19, 1) ]),
+                          [ (0, 9, 0, 99, 0), (10, 19, 10, 19, 1), (20, 99, 0, 99, 0) ])
+        # same interval listed twice, the last one wins
+        self.assertEquals(compile_segments([ (0, 9, 0), (0, 9, 1) ]), [ (0, 9, 0, 9, 1) ])
+        # partial overlap
+        self.assertEquals(compile_segments([ (0, 9, 0), (5, 24, 1) ]),
+                          [ (0, 9, 0, 9, 0), (10, 24, 5, 24, 1) ])
+
+    def test_lookup(self):
+        write_interval_table(self.table_path, [ (0, 99, 0), (10, 19, 1), (200, 200, 0) ], [ b'wide', b'narrow' ])
+        table = IntervalTable(self.table_path)
+        self.assertEquals(table.lookup(0), (0, 99, b'wide'))
+        self.assertEquals(table.lookup(15), (10, 19, b'narrow'))
+        self.assertEquals(table.lookup(99), (0, 99, b'wide'))
+        self.assertIsNone(table.lookup(100))
+        self.assertEquals(table.lookup(200), (200, 200, b'wide'))
+        self.assertIsNone(table.lookup(201))
+        self.assertIsNone(table.lookup(0xFFFFFFFF))
+        table.close()
+
+    def test_empty_table(self):
+        write_interval_table(self.table_path, [], [])
+        table = IntervalTable(self.table_path)
+        self.assertEquals(len(table), 0)
+        self.assertIsNone(table.lookup(1))
+        table.close()
+
+    def test_open_interval_table(self):
+        source_path = os.path.join(self.temp_dir, 'source')
+        with open(source_path, 'w') as fp:
+            fp.write('0 9 first\n')
+
+        build_count = 0
+        def _build(path):
+            nonlocal build_count
+            build_count += 1
+            intervals = []
+            records = []
+            with open(source_path, 'r') as fp:
+                for line in fp:
+                    start, end, record = line.split()
+                    intervals.append((int(start), int(end), len(records)))
+                    records.append(record.encode())
+
+            write_interval_table(path, intervals, records)
+
+        table = open_interval_table(self.table_path, [ source_path ], _build)
+        self.assertEquals(build_count, 1)
+        self.assertEquals(table.lookup(5)[2], b'first')
+
+        # nothing changed
+        self.assertTrue(open_interval_table(self.table_path, [ source_path ], _build, current=table) is table)
+        self.assertEquals(build_count, 1)
+
+        # another process would open the same file without compiling it
+        other_table = open_interval_table(self.table_path, [ source_path ], _build)
+        self.assertEquals(build_count, 1)
+
+        # change the source file
+        time.sleep(0.01)
+        with open(source_path, 'w') as fp:
+            fp.write('0 9 second\n')
+
+        new_table = open_interval_table(self.table_path, [ source_path ], _build, current=table)
+        self.assertEquals(build_count, 2)
+        self.assertFalse(new_table is table)
+        self.assertEquals(new_table.lookup(5)[2], b'second')
+
+        # the other process sees that the file was replaced and reloads it
+        self.assertTrue(other_table.replaced)
+        other_table = open_interval_table(self.table_path, [ source_path ], _build, current=other_table)
+        self.assertEquals(build_count, 2)
+        self.assertEquals(other_table.lookup(5)[2], b'second')
+
+        new_table.close()
+        other_table.close()
@@ -0,0 +1,86 @@
+# vim: sw=4:ts=4:et:cc=120
+
+import saq
+from saq.constants import *
+from saq.radix import NetworkTree
+from saq.test import *
+
+class NetworkTreeTestCase(ACEBasicTestCase):
+    def test_longest_match(self):
+        tree = NetworkTree([ ('10.0.0.0/8', 'corporate'),
+                             ('10.1.0.0/16', 'datacenter', { 'site': 'dc1' }),
+                             ('10.1.2.0/24', 'servers'),
+                             ('10.1.2.3/32', 'mail server') ])
+
+        self.assertEquals(len(tree), 4)
+        self.assertEquals(tree.longest_match('10.1.2.3').name, 'mail server')
+        self.assertEquals(tree.longest_match('10.1.2.4').name, 'servers')
+        entry = tree.longest_match('10.1.3.4')
+        self.assertEquals(entry.name, 'datacenter')
+        self.assertEquals(entry.data, { 'site': 'dc1' })
+        self.assertEquals(str(entry.network), '10.1.0.0/16')
+        self.assertEquals(tree.longest_match('10.2.0.1').name, 'corporate')
+        self.assertIsNone(tree.longest_match('11.0.0.1'))
+
+        with self.assertRaises(ValueError):
+            tree.longest_match('not an ip')
+
+    def test_contains(self):
+        tree = NetworkTree([ '10.0.0.0/8', '192.168.0.0/16', '172.16.0.0/12' ])
+        self.assertTrue('10.255.255.255' in tree)
+        self.assertTrue('172.31.0.1' in tree)
+        self.assertFalse('172.32.0.1' in tree)
+        self.assertFalse('8.8.8.8' in tree)
+        # invalid ip addresses are not in the tree
+        self.assertFalse('www.google.com' in tree)
+        self.assertFalse(None in tree)
+
+        # the default route matches everything
+        tree.add('0.0.0.0/0', 'everything')
+        self.assertTrue('8.8.8.8' in tree)
+
+    def test_matches(self):
+        tree = NetworkTree()
+        tree.add('10.1.2.0/24', 'servers')
+        tree.add('10.0.0.0/8', 'corporate')
+        tree.add('10.1.2.0/24', 'web servers')
+        tree.add('10.1.2.5', 'host')
+
+        # in the order they were added
+        self.assertEquals([ _.name for _ in tree.matches('10.1.2.5') ],
+                          [ 'servers', 'corporate', 'web servers', 'host' ])
+        self.assertEquals([ _.name for _ in tree.matches('10.1.3.5') ], [ 'corporate' ])
+        self.assertEquals(tree.matches('11.0.0.1'), [])
+        # the first one added wins when the same network is listed more than once
+        self.assertEquals(tree.longest_match('10.1.2.6').name, 'servers')
+        self.assertEquals([ _.name for _ in tree ], [ 'servers', 'corporate', 'web servers', 'host' ])
+
+    def test_host_bits(self):
+        tree = NetworkTree([ '10.1.2.3/24' ])
+        self.assertEquals(str(tree.longest_match('10.1.2.200').network), '10.1.2.0/24')
+
+        with self.assertRaises(ValueError):
+            tree.add('10.1.2.0/33')
+
+    def test_is_managed(self):
+        managed_networks = saq.CONFIG['network_configuration']['managed_networks']
+        saq.CONFIG['network_configuration']['managed_networks'] = '10.0.0.0/8, 192.168.0.0/16,, invalid'
+        try:
+            saq.initialize_managed_networks()
+            self.assertEquals(len(saq.MANAGED_NETWORKS), 2)
+
+            root = create_root_analysis()
+            self.assertTrue(root.add_observable(F_IPV4, '10.1.1.1').is_managed())
+            self.assertTrue(root.add_observable(F_IPV4, '192.168.1.1').is_managed())
+            self.assertFalse(root.add_observable(F_IPV4, '8.8.8.8').is_managed())
+        finally:
+            saq.CONFIG['network_configuration']['managed_networks'] = managed_networks
+            saq.initialize_managed_networks()
+
+    def test_managed_networks_reload(self):
+        saq.MANAGED_NETWORKS = NetworkTree([ '1.2.3.0/24' ])
+        # reloading the configuration rebuilds the tree from it
+        saq.load_configuration()
+        self.assertFalse('1.2.3.4' in saq.MANAGED_NETWORKS)
+        self.assertEquals(len(saq.MANAGED_NETWORKS), len([ _ for _ in saq.CONFIG['network_configuration']
+                                                           ['managed_networks'].split(',') if _.strip() ]))
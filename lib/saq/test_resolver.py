@@ -0,0 +1,216 @@
+# vim: sw=4:ts=4:et:cc=120
+
+import os, os.path
+import socket
+import threading
+import time
+
+import saq
+from saq.constants import *
+from saq.resolver import *
+from saq.test import *
+
+import dns.message
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+
+# name -> (ttl, addresses) or (ttl, CNAME target)
+STUB_RECORDS = {
+    'www.example.test.': (120, [ '10.0.0.1', '10.0.0.2' ]),
+    'alias.example.test.': (60, 'www.example.test.'),
+    'long.example.test.': (86400, [ '10.0.0.3' ]),
+}
+
+# queries for these names are never answered
+STUB_SLOW_PREFIX = 'slow'
+
+class StubDNSServer(object):
+    """Answers A queries over UDP for the names in STUB_RECORDS."""
+
+    def __init__(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.settimeout(0.1)
+        self.port = self.socket.getsockname()[1]
+        self.shutdown_event = threading.Event()
+        self.thread = None
+        # key = query name, value = number of times it was queried
+        self.query_count = {}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.loop, name="Stub DNS Server")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown_event.set()
+        self.thread.join()
+        self.socket.close()
+
+    def loop(self):
+        while not self.shutdown_event.is_set():
+            try:
+                data, address = self.socket.recvfrom(4096)
+            except socket.timeout:
+                continue
+
+            query = dns.message.from_wire(data)
+            name = query.question[0].name.to_text()
+            self.query_count[name] = self.query_count.get(name, 0) + 1
+            if name.startswith(STUB_SLOW_PREFIX):
+                continue
+
+            response = dns.message.make_response(query)
+            while name in STUB_RECORDS:
+                ttl, value = STUB_RECORDS[name]
+                if isinstance(value, str):
+                    response.answer.append(dns.rrset.from_text(name, ttl, 'IN', 'CNAME', value))
+                    name = value
+                    continue
+
+                response.answer.append(dns.rrset.from_text_list(name, ttl, 'IN', 'A', value))
+                break
+            else:
+                response.set_rcode(dns.rcode.NXDOMAIN)
+
+            self.socket.sendto(response.to_wire(), address)
+
+def sort_results(results):
+    # the order of the addresses in an answer is not defined
+    return { name: (aliases, sorted(addresses)) for name, (aliases, addresses) in results.items() }
+
+class DNSResolverTestCase(ACEBasicTestCase):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.server = StubDNSServer()
+        self.server.start()
+        self.client = FakeMemcacheClient()
+
+    def tearDown(self, *args, **kwargs):
+        self.server.stop()
+        super().tearDown(*args, **kwargs)
+
+    def create_resolver(self, **kwargs):
+        kwargs.setdefault('timeout', 1.0)
+        kwargs.setdefault('lifetime', 1.0)
+        return DNSResolver(nameservers=[ '127.0.0.1' ], port=self.server.port, cache_client=self.client, **kwargs)
+
+    def test_resolve(self):
+        resolver = self.create_resolver()
+        results = resolver.resolve([ 'www.example.test', 'WWW.example.test.', 'alias.example.test',
+                                     'missing.example.test' ])
+        self.assertEqual(sort_results(results), {
+            'www.example.test': ([], [ '10.0.0.1', '10.0.0.2' ]),
+            'alias.example.test': ([ 'alias.example.test' ], [ '10.0.0.1', '10.0.0.2' ]),
+            'missing.example.test': ([], []) })
+
+        # the same name is only queried once
+        self.assertEqual(self.server.query_count['www.example.test.'], 1)
+
+    def test_cache(self):
+        resolver = self.create_resolver(max_ttl=3600, negative_ttl=30)
+        names = [ 'www.example.test', 'alias.example.test', 'long.example.test', 'missing.example.test' ]
+        results = resolver.resolve(names)
+        self.assertEqual(len(self.server.query_count), 4)
+
+        # the ttl of the answers is respected
+        self.assertTrue(119 <= self.client.times[get_cache_key('www.example.test')] <= 120)
+        # the ttl of a CNAME chain is the smallest ttl in the chain
+        self.assertTrue(59 <= self.client.times[get_cache_key('alias.example.test')] <= 60)
+        self.assertEqual(self.client.times[get_cache_key('long.example.test')], 3600)
+        self.assertEqual(self.client.times[get_cache_key('missing.example.test')], 30)
+
+        # everything is answered from the cache now (including the names that do not exist)
+        self.assertEqual(resolver.resolve(names), results)
+        self.assertTrue(all([ _ == 1 for _ in self.server.query_count.values() ]))
+
+        # the cache is not used if disabled
+        resolver = self.create_resolver(use_cache=False)
+        self.assertEqual(sort_results(resolver.resolve([ 'www.example.test' ])),
+                         sort_results({ 'www.example.test': results['www.example.test'] }))
+        self.assertEqual(self.server.query_count['www.example.test.'], 2)
+
+    def test_timeout(self):
+        resolver = self.create_resolver(timeout=1.0, lifetime=1.0, concurrency=8)
+        start = time.time()
+        results = resolver.resolve([ 'slow{}.example.test'.format(_) for _ in range(4) ] + [ 'www.example.test' ])
+        # all the names are resolved at the same time
+        self.assertLess(time.time() - start, 3)
+
+        # names that time out are not included and not cached
+        self.assertEqual(list(results.keys()), [ 'www.example.test' ])
+        self.assertNotIn(get_cache_key('slow0.example.test'), self.client.data)
+
+    def test_concurrency(self):
+        resolver = self.create_resolver(timeout=0.5, lifetime=0.5, concurrency=1)
+        start = time.time()
+        self.assertEqual(resolver.resolve([ 'slow0.example.test', 'slow1.example.test' ]), {})
+        # only one name is resolved at a time
+        self.assertGreaterEqual(time.time() - start, 1)
+
+    def test_fqdn_analyzer(self):
+        from saq.modules.dns import FQDNAnalyzer
+        saq.CONFIG['analysis_module_fqdn_analyzer']['nameservers'] = '127.0.0.1'
+        saq.CONFIG['analysis_module_fqdn_analyzer']['port'] = str(self.server.port)
+        saq.CONFIG['analysis_module_fqdn_analyzer']['use_cache'] = 'no'
+
+        root = create_root_analysis()
+        root.add_observable(F_FQDN, 'www.example.test')
+        root.add_observable(F_FQDN, 'missing.example.test')
+        root.add_observable(F_FQDN, 'alias.example.test')
+
+        m = FQDNAnalyzer('analysis_module_fqdn_analyzer')
+        m.root = root
+        aliases, addresses = m.resolve('alias.example.test')
+        self.assertEqual(aliases, [ 'alias.example.test' ])
+        self.assertEqual(sorted(addresses), [ '10.0.0.1', '10.0.0.2' ])
+        # every fqdn in the root was resolved by the first request
+        self.assertEqual(len(self.server.query_count), 3)
+        self.assertEqual(m.resolve('missing.example.test'), ([], []))
+        self.assertEqual(sorted(m.resolve('www.example.test')[1]), [ '10.0.0.1', '10.0.0.2' ])
+        self.assertEqual(len(self.server.query_count), 3)
+        self.assertTrue(all([ _ == 1 for _ in self.server.query_count.values() ]))
+
+    def test_fqdn_analyzer_batch_size(self):
+        from saq.modules.dns import FQDNAnalyzer
+        saq.CONFIG['analysis_module_fqdn_analyzer']['nameservers'] = '127.0.0.1'
+        saq.CONFIG['analysis_module_fqdn_analyzer']['port'] = str(self.server.port)
+        saq.CONFIG['analysis_module_fqdn_analyzer']['use_cache'] = 'no'
+        saq.CONFIG['analysis_module_fqdn_analyzer']['batch_size'] = '2'
+
+        root = create_root_analysis()
+        root.add_observable(F_FQDN, 'www.example.test')
+        root.add_observable(F_FQDN, 'missing.example.test')
+        root.add_observable(F_FQDN, 'long.example.test')
+
+        m = FQDNAnalyzer('analysis_module_fqdn_analyzer')
+        m.root = root
+        # only batch_size fqdns are resolved at once
+        self.assertEqual(m.resolve('long.example.test'), ([], [ '10.0.0.3' ]))
+        self.assertEqual(len(self.server.query_count), 2)
+        self.assertEqual(m.resolve('missing.example.test'), ([], []))
+        self.assertEqual(len(self.server.query_count), 3)
+        self.assertEqual(sorted(m.resolve('www.example.test')[1]), [ '10.0.0.1', '10.0.0.2' ])
+        self.assertEqual(len(self.server.query_count), 3)
+
+    def test_hosts_file(self):
+        hosts_path = os.path.join(saq.TEMP_DIR, 'hosts')
+        with open(hosts_path, 'w') as fp:
+            fp.write('# comment\n127.0.0.1 localhost\n10.1.1.1 Sinkhole.example.test other.example.test # sinkhole\n'
+                     '::1 localhost ip6-localhost\n')
+
+        self.assertEqual(load_hosts_file(hosts_path), { 'localhost': [ '127.0.0.1' ],
+                                                        'sinkhole.example.test': [ '10.1.1.1' ],
+                                                        'other.example.test': [ '10.1.1.1' ] })
+
+        # names in the hosts file are answered without dns when the system nameservers are used
+        resolver = DNSResolver(cache_client=self.client, hosts_path=hosts_path)
+        self.assertEqual(resolver.resolve([ 'sinkhole.example.test.' ]),
+                         { 'sinkhole.example.test': ([], [ '10.1.1.1' ]) })
+        self.assertEqual(self.client.data, {})
+
+        # but not when nameservers are configured
+        resolver = self.create_resolver(hosts_path=hosts_path)
+        self.assertEqual(resolver.resolve([ 'sinkhole.example.test' ]), { 'sinkhole.example.test': ([], []) })
+        self.assertEqual(self.server.query_count['sinkhole.example.test.'], 1)
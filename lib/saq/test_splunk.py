@@ -0,0 +1,225 @@
+# vim: sw=4:ts=4:et:cc=120
+
+import datetime
+import http.server
+import json
+import threading
+import time
+import urllib.parse
+
+import saq
+from saq.splunk import SplunkQueryObject, get_splunk_session, clear_splunk_sessions
+from saq.test import *
+
+class FakeSplunkServer(object):
+    """A local http server that implements enough of the splunk REST API to execute searches.
+       Searches take job_latency seconds to complete and return the rows assigned to the results attribute.
+       The results can be either a list of rows (using the fields attribute) or a callable that takes
+       the search string and returns a tuple of (fields, rows)."""
+
+    def __init__(self, job_latency=0.5):
+        self.job_latency = job_latency
+        self.fields = [ 'src_ip', 'dst_ip' ]
+        self.results = []
+
+        # key = session key
+        self.session_keys = set()
+        # key = sid, value = dict of job information
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+        # statistics
+        self.login_count = 0
+        self.status_count = 0
+        self.results_count = 0
+        self.searches = []
+
+        fake = self
+        class _handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, *args, **kwargs):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+                fake.handle(self, 'POST', urllib.parse.parse_qs(body))
+
+            def do_GET(self):
+                fake.handle(self, 'GET', urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query))
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def uri(self):
+        return 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="Fake Splunk Server")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def expire_sessions(self):
+        with self.lock:
+            self.session_keys.clear()
+
+    def respond(self, handler, status, body, content_type='text/xml'):
+        body = body.encode()
+        handler.send_response(status)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def handle(self, handler, method, params):
+        path = urllib.parse.urlparse(handler.path).path
+        if method == 'POST' and path == '/services/auth/login':
+            with self.lock:
+                self.login_count += 1
+                session_key = 'session_{}'.format(self.login_count)
+                self.session_keys.add(session_key)
+
+            return self.respond(handler, 200, '<response><sessionKey>{}</sessionKey></response>'.format(session_key))
+
+        with self.lock:
+            authorization = handler.headers.get('Authorization', '')
+            if not authorization.startswith('Splunk ') or authorization[len('Splunk '):] not in self.session_keys:
+                return self.respond(handler, 401, '<response><messages><msg type="WARN">call not properly '
+                                                  'authenticated</msg></messages></response>')
+
+        if method == 'POST' and path == '/services/search/jobs':
+            search = params['search'][0]
+            with self.lock:
+                self.searches.append(search)
+                sid = str(len(self.searches))
+                if callable(self.results):
+                    fields, rows = self.results(search)
+                else:
+                    fields, rows = self.fields, self.results
+
+                rows = rows[:int(params['max_count'][0])]
+                self.jobs[sid] = { 'done_time': time.time() + self.job_latency, 'fields': fields, 'rows': rows }
+
+            return self.respond(handler, 201, '<response><sid>{}</sid></response>'.format(sid))
+
+        parts = path.split('/')
+        if method == 'GET' and len(parts) >= 5 and parts[1:4] == [ 'services', 'search', 'jobs' ]:
+            job = self.jobs.get(parts[4])
+            if job is None:
+                return self.respond(handler, 404, '<response></response>')
+
+            if len(parts) == 5:
+                with self.lock:
+                    self.status_count += 1
+
+                is_done = '1' if time.time() >= job['done_time'] else '0'
+                return self.respond(handler, 200, '<entry><content><s:dict><s:key name="isDone">{}</s:key>'
+                                                  '</s:dict></content></entry>'.format(is_done))
+
+            if len(parts) == 6 and parts[5] == 'results':
+                with self.lock:
+                    self.results_count += 1
+
+                count = int(params['count'][0])
+                offset = int(params['offset'][0])
+                rows = job['rows'][offset:offset + count] if count else job['rows'][offset:]
+                return self.respond(handler, 200, json.dumps({ 'fields': job['fields'], 'rows': rows }),
+                                    content_type='application/json')
+
+        return self.respond(handler, 404, '<response></response>')
+
+class SplunkTestCase(ACEBasicTestCase):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        clear_splunk_sessions()
+        self.server = FakeSplunkServer()
+        self.server.start()
+
+    def tearDown(self, *args, **kwargs):
+        super().tearDown(*args, **kwargs)
+        self.server.stop()
+        clear_splunk_sessions()
+
+    def create_query_object(self, **kwargs):
+        return SplunkQueryObject(uri=self.server.uri, username='test', password='test', **kwargs)
+
+    def test_query(self):
+        self.server.results = [ [ '1.1.1.1', '2.2.2.2' ], [ '1.1.1.1', '3.3.3.3' ] ]
+        searcher = self.create_query_object()
+        self.assertTrue(searcher.query('index=test'))
+        self.assertEquals(self.server.searches, [ 'search index=test' ])
+        self.assertEquals(searcher.json(), [ { 'src_ip': '1.1.1.1', 'dst_ip': '2.2.2.2' },
+                                             { 'src_ip': '1.1.1.1', 'dst_ip': '3.3.3.3' } ])
+
+    def test_session_reuse(self):
+        for _ in range(3):
+            self.assertTrue(self.create_query_object().query('index=test'))
+
+        # we only log in once
+        self.assertEquals(self.server.login_count, 1)
+
+    def test_session_refresh(self):
+        self.assertTrue(self.create_query_object().query('index=test'))
+        # splunk expires the session
+        self.server.expire_sessions()
+        self.assertTrue(self.create_query_object().query('index=test'))
+        self.assertEquals(self.server.login_count, 2)
+
+    def test_session_lifetime(self):
+        self.assertTrue(self.create_query_object().query('index=test'))
+        # the session key gets too old
+        session = get_splunk_session(self.server.uri, 'test', 'test')
+        session.session_key_expiration = datetime.datetime.now() - datetime.timedelta(seconds=1)
+        self.assertTrue(self.create_query_object().query('index=test'))
+        self.assertEquals(self.server.login_count, 2)
+
+    def test_polling_backoff(self):
+        self.server.job_latency = 1.5
+        searcher = self.create_query_object(poll_interval_min=0.1, poll_interval_max=5.0)
+        self.assertTrue(searcher.query('index=test'))
+        # 0.1 + 0.2 + 0.4 + 0.8 (instead of once a second, or 15 times at the minimum interval)
+        self.assertTrue(self.server.status_count <= 6)
+
+    def test_query_timeout(self):
+        self.server.job_latency = 10
+        searcher = self.create_query_object(query_timeout="00:00:01")
+        start = time.time()
+        self.assertFalse(searcher.query('index=test'))
+        self.assertTrue(time.time() - start < 3)
+
+    def test_streaming(self):
+        self.server.job_latency = 0
+        self.server.results = [ [ str(index), str(index) ] for index in range(25) ]
+        searcher = self.create_query_object(page_size=10)
+        self.assertTrue(searcher.query('index=test', download=False))
+        self.assertIsNone(searcher.search_results)
+        self.assertEquals(self.server.results_count, 0)
+
+        results = searcher.iter_results()
+        self.assertEquals(next(results), { 'src_ip': '0', 'dst_ip': '0' })
+        # only the first page has been downloaded
+        self.assertEquals(self.server.results_count, 1)
+        self.assertEquals(len(list(results)), 24)
+        self.assertEquals(self.server.results_count, 3)
+
+    def test_paged_download(self):
+        # the fields can be different on each page of results
+        def _results(search):
+            return [ 'src_ip', 'dst_ip' ], [ [ '1.1.1.1', '2.2.2.2' ] for _ in range(15) ]
+
+        self.server.job_latency = 0
+        self.server.results = _results
+        searcher = self.create_query_object(page_size=10)
+        self.assertTrue(searcher.query('index=test'))
+        self.assertEquals(self.server.results_count, 2)
+        self.assertEquals(len(searcher.json()), 15)
+
+        pages = iter([ ([ 'a' ], [ [ '1' ] ]), ([ 'b', 'a' ], [ [ '2', '3' ] ]) ])
+        searcher.iter_result_pages = lambda: pages
+        self.assertTrue(searcher.download_search_results())
+        self.assertEquals(searcher.json(), [ { 'a': '1', 'b': None }, { 'a': '3', 'b': '2' } ])
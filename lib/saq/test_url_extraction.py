@@ -0,0 +1,117 @@
+# vim: sw=4:ts=4:et:cc=120
+
+import io
+import os, os.path
+import random
+import shutil
+
+import saq
+import saq.url_extraction
+from saq.test import *
+from saq.url_extraction import find_urls_in_file, get_registered_domain, iterate_chunks
+
+from urlfinderlib import find_urls
+
+def generate_text(size, seed=0):
+    """Returns about size bytes of text with URLs in it."""
+    rng = random.Random(seed)
+    words = [ b'the', b'invoice', b'is', b'attached', b'please', b'review', b'and', b'confirm' ]
+    result = []
+    length = 0
+    while length < size:
+        if rng.random() < 0.05:
+            word = 'https://host{}.example{}.com/path/{}?id={}'.format(
+                   rng.randint(0, 50), rng.randint(0, 5), rng.randint(0, 1000), rng.randint(0, 1000)).encode()
+        else:
+            word = rng.choice(words)
+
+        result.append(word)
+        length += len(word) + 1
+        if rng.random() < 0.1:
+            result.append(b'\n')
+
+    return b' '.join(result)
+
+def generate_html(size, seed=0):
+    """Returns about size bytes of html with links in it."""
+    rng = random.Random(seed)
+    result = [ b'<html><head><title>test</title></head><body>' ]
+    length = 0
+    while length < size:
+        line = '<p>paragraph {}</p><a href="http://link{}.example.org/{}">link</a><img src="http://img{}.example.net/i.png">'.format(
+               rng.randint(0, 1000), rng.randint(0, 50), rng.randint(0, 1000), rng.randint(0, 20)).encode()
+        result.append(line)
+        length += len(line)
+
+    result.append(b'</body></html>')
+    return b''.join(result)
+
+class URLExtractionTestCase(ACEBasicTestCase):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        saq.url_extraction._registered_domain_cache.clear()
+        self.temp_dir = os.path.join(saq.TEMP_DIR, 'url_extraction')
+        if os.path.isdir(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+        os.makedirs(self.temp_dir)
+
+    def create_file(self, name, data):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, 'wb') as fp:
+            fp.write(data)
+
+        return path
+
+    def test_iterate_chunks(self):
+        # cut at the last delimiter
+        self.assertEquals(list(iterate_chunks(io.BytesIO(b'aaa bbb ccc'), chunk_size=5, overlap=4)),
+                          [ b'aaa ', b'bbb ', b'ccc' ])
+        # newlines are preferred
+        self.assertEquals(list(iterate_chunks(io.BytesIO(b'aa\na bbbbbb'), chunk_size=6, overlap=6)),
+                          [ b'aa\n', b'a bbbbbb' ])
+        # no delimiter means the end of the chunk is repeated
+        self.assertEquals(list(iterate_chunks(io.BytesIO(b'aaaaaaaaaa'), chunk_size=4, overlap=2)),
+                          [ b'aaaa', b'aaaaaa', b'aaaa' ])
+        self.assertEquals(list(iterate_chunks(io.BytesIO(b''), chunk_size=4, overlap=2)), [])
+
+        # nothing is lost
+        data = generate_text(100000)
+        chunks = list(iterate_chunks(io.BytesIO(data), chunk_size=4096, overlap=256))
+        self.assertEquals(b''.join(chunks), data)
+        self.assertTrue(all([ len(_) <= 4096 + 256 for _ in chunks ]))
+
+    def test_find_urls_in_file_text(self):
+        data = generate_text(512 * 1024)
+        path = self.create_file('test.txt', data)
+        expected = find_urls(data)
+        self.assertTrue(len(expected) > 100)
+        self.assertEquals(find_urls_in_file(path, chunk_size=16 * 1024), expected)
+        self.assertEquals(find_urls_in_file(path), expected)
+
+    def test_find_urls_in_file_html(self):
+        data = generate_html(512 * 1024)
+        path = self.create_file('test.html', data)
+        expected = find_urls(data, base_url='http://base.example.com/')
+        self.assertTrue(len(expected) > 100)
+        self.assertEquals(find_urls_in_file(path, base_url='http://base.example.com/', chunk_size=16 * 1024), expected)
+
+    def test_find_urls_in_file_unstreamable(self):
+        # xml is parsed as a whole
+        data = b'<?xml version="1.0"?>\n<root xmlns="http://schemas.example.com/">' + \
+               b''.join([ '<item url="http://item{}.example.com/"/>\n'.format(_).encode() for _ in range(2000) ]) + \
+               b'</root>'
+        path = self.create_file('test.xml', data)
+        self.assertEquals(find_urls_in_file(path, chunk_size=4096), find_urls(data))
+
+    def test_get_registered_domain(self):
+        self.assertEquals(get_registered_domain('http://www.google.co.uk/test.png'), ('google', 'co.uk'))
+        self.assertEquals(get_registered_domain('https://a.b.example.com:8080/'), ('example', 'com'))
+        self.assertIsNone(get_registered_domain('http://1.2.3.4/'))
+        self.assertIsNone(get_registered_domain('http://host.invalidtld/'))
+        self.assertIsNone(get_registered_domain('not a url'))
+        self.assertIsNone(get_registered_domain('http://[invalid/'))
+
+        # memoized by host name
+        saq.url_extraction._registered_domain_cache['www.google.co.uk'] = ('cached', 'com')
+        self.assertEquals(get_registered_domain('http://www.google.co.uk/other'), ('cached', 'com'))
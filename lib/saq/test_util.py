@@ -2,7 +2,7 @@
 
 import saq
 from saq.test import *
-from saq.util import parse_event_time
+from saq.util import parse_event_time, is_subdomain, iterate_fqdn_parts, DomainTrie, TTLCache
 
 class ACEUtilTestCase(ACEBasicTestCase):
     def test_util_000_date_parsing(self):
@@ -61,3 +61,46 @@ class ACEUtilTestCase(ACEBasicTestCase):
         self.assertEquals(result.second, 49)
         self.assertIsNotNone(result.tzinfo)
         self.assertEquals(int(result.tzinfo.utcoffset(None).total_seconds()), -(5 * 60 * 60))
+
+    def test_util_001_domain_trie(self):
+        domains = [ 'schemas.microsoft.com', 'www.w3.org', 'purl.org', 'Example.COM' ]
+        trie = DomainTrie(domains)
+        for hostname in [ 'schemas.microsoft.com', 'a.schemas.microsoft.com', 'microsoft.com', 'w3.org', 'www.w3.org',
+                          'purl.org', 'x.y.purl.org', 'notpurl.org', 'example.com', 'WWW.EXAMPLE.COM', 'com', '' ]:
+            self.assertEquals(trie.matches(hostname), any([ is_subdomain(hostname, _) for _ in domains ]))
+
+        self.assertFalse(DomainTrie().matches('example.com'))
+        self.assertEquals(trie.find('x.y.PURL.org'), 'purl.org')
+        self.assertEquals(trie.find('www.example.com'), 'example.com')
+        self.assertIsNone(trie.find('w3.org'))
+        trie.add('y.purl.org')
+        self.assertEquals(trie.find_all('x.Y.purl.org'), [ 'purl.org', 'y.purl.org' ])
+        self.assertEquals(trie.find_all('w3.org'), [])
+
+    def test_util_002_iterate_fqdn_parts(self):
+        self.assertEquals(list(iterate_fqdn_parts('a.b.c')), [ 'c', 'b.c', 'a.b.c' ])
+
+    def test_util_003_ttl_cache(self):
+        cache = TTLCache(2, 60)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', 1)
+        cache.put('b', 0)
+        self.assertEquals(cache.get('a'), 1)
+        self.assertEquals(cache.get('b'), 0)
+        # a is the least recently used
+        cache.get('b')
+        cache.put('c', 2)
+        self.assertFalse('a' in cache)
+        self.assertTrue('b' in cache)
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.hits, 3)
+        self.assertEquals(cache.misses, 1)
+
+        cache.discard('b')
+        self.assertFalse('b' in cache)
+
+        # entries expire
+        cache = TTLCache(2, 0)
+        cache.put('a', 1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEquals(len(cache), 0)
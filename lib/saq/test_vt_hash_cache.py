@@ -0,0 +1,108 @@
+# vim: sw=4:ts=4:et:cc=120
+
+import json
+import threading
+import urllib.parse
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import saq
+from saq.constants import *
+from saq.test import *
+from saq.vt_hash_cache import *
+
+MD5 = 'd41d8cd98f00b204e9800998ecf8427e'
+SHA1 = 'da39a3ee5e6b4b0d3255bfef95601890afd80709'
+SHA2 = 'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855'
+
+class FakeBatchRequestHandler(BaseHTTPRequestHandler):
+    """Implements /vthc/batch for the hashes in the results of the server."""
+    def log_message(self, *args, **kwargs):
+        pass
+
+    def do_POST(self):
+        data = urllib.parse.parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        hashes = data['h']
+        self.server.requests.append(hashes)
+        # like the real thing the entire request fails if any hash is invalid
+        if any([ get_hash_type(_) is None for _ in hashes ]):
+            self.send_error(400)
+            return
+
+        content = json.dumps({ 'results': { _: self.server.results[_] for _ in hashes if _ in self.server.results },
+                               'misses': [ _ for _ in hashes if _ not in self.server.results ] }).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+class VTHashCacheTestCase(ACEBasicTestCase):
+    def test_hash_type(self):
+        self.assertEqual(get_hash_type(MD5), HASH_TYPE_MD5)
+        self.assertEqual(get_hash_type(SHA1), HASH_TYPE_SHA1)
+        self.assertEqual(get_hash_type(SHA2), HASH_TYPE_SHA2)
+        self.assertIsNone(get_hash_type('abc'))
+
+    def test_memcache_client(self):
+        self.assertIs(get_memcache_client(), get_memcache_client())
+
+    def test_cached_results(self):
+        client = FakeMemcacheClient()
+        cache_result(client, 1, '{"response_code": 1}', md5_hash=MD5, sha1_hash=SHA1, sha2_hash=SHA2)
+        self.assertEqual(client.data[MD5], '1')
+        self.assertEqual(client.data['1'], '{"response_code": 1}')
+
+        client.request_count = 0
+        results, misses = get_cached_results(client, [ MD5, SHA2, 'f' * 64 ])
+        self.assertEqual(results, { MD5: '{"response_code": 1}', SHA2: '{"response_code": 1}' })
+        self.assertEqual(misses, [ 'f' * 64 ])
+        # all of the hashes are looked up with two requests
+        self.assertEqual(client.request_count, 2)
+
+    def test_lookup_hashes(self):
+        client = FakeMemcacheClient()
+        cache_result(client, 1, '{"response_code": 1}', md5_hash=MD5, sha1_hash=SHA1)
+        # everything is cached so the database is not used
+        results, misses = lookup_hashes([ MD5.upper(), SHA1, MD5 ], client=client)
+        self.assertEqual(results, { MD5: '{"response_code": 1}', SHA1: '{"response_code": 1}' })
+        self.assertEqual(misses, [])
+
+    def test_analyzer_batch(self):
+        from saq.modules.vt import VTHashAnalyzer
+        server = HTTPServer(('127.0.0.1', 0), FakeBatchRequestHandler)
+        server.requests = []
+        server.results = { MD5: { 'response_code': 1, 'md5': MD5 }, SHA1: { 'response_code': 1, 'sha1': SHA1 } }
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+        try:
+            saq.CONFIG['analysis_module_vt_hash_analyzer']['query_url'] = 'http://{}:{}/vthc/query'.format(
+                                                                          *server.server_address)
+            saq.CONFIG['analysis_module_vt_hash_analyzer']['use_proxy'] = 'no'
+            saq.CONFIG['analysis_module_vt_hash_analyzer']['batch_lookup'] = 'yes'
+
+            root = create_root_analysis()
+            md5 = root.add_observable(F_MD5, MD5.upper())
+            missing = root.add_observable(F_MD5, 'f' * 32)
+            invalid = root.add_observable(F_MD5, 'abc')
+            sha1 = root.add_observable(F_SHA1, SHA1)
+
+            m = VTHashAnalyzer('analysis_module_vt_hash_analyzer')
+            m.root = root
+            self.assertEqual(m.get_batch_result(md5), server.results[MD5])
+            # the hashes of the same type are looked up together and the invalid hash is not sent
+            self.assertEqual(server.requests, [ [ MD5, 'f' * 32 ] ])
+            self.assertIsNone(m.get_batch_result(missing))
+            self.assertIsNone(m.get_batch_result(invalid))
+            self.assertEqual(len(server.requests), 1)
+            self.assertEqual(m.get_batch_result(sha1), server.results[SHA1])
+            self.assertEqual(len(server.requests), 2)
+
+            # the results are looked up again after a reset
+            m.reset()
+            m.root = root
+            self.assertEqual(m.get_batch_result(md5), server.results[MD5])
+            self.assertEqual(len(server.requests), 3)
+        finally:
+            server.shutdown()
+            server.server_close()
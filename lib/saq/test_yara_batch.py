@@ -0,0 +1,201 @@
+# vim: sw=4:ts=4:et:cc=120
+
+import os, os.path
+import shutil
+import subprocess
+import sys
+import time
+
+import saq
+from saq.constants import *
+from saq.test import *
+from saq.yara_batch import YaraResultCache, scan_files
+from saq.yara_rules import get_rules_version
+
+TEST_RULE = """
+rule {name} {{
+    strings:
+        $a = "{string}"
+    condition:
+        $a
+}}
+"""
+
+# runs the batch scanner in a separate process (checking for rule changes every second)
+SERVER_SCRIPT = """
+import logging, sys
+logging.basicConfig(level=logging.DEBUG)
+from saq.yara_batch import YaraBatchScanServer
+server = YaraBatchScanServer(sys.argv[1], sys.argv[2], sys.argv[3], worker_count=2, update_frequency=1)
+server.serve_forever()
+"""
+
+class YaraBatchTestCase(ACEBasicTestCase):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.temp_dir = os.path.join(saq.TEMP_DIR, 'yara_batch')
+        if os.path.isdir(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+        self.signature_dir = os.path.join(self.temp_dir, 'signatures')
+        os.makedirs(os.path.join(self.signature_dir, 'test'))
+        self.write_rule('test_rule', 'hello world')
+
+        self.socket_path = os.path.join(self.temp_dir, 'batch.socket')
+        self.server = None
+
+    def tearDown(self, *args, **kwargs):
+        if self.server is not None:
+            self.server.kill()
+            self.server.wait()
+
+        super().tearDown(*args, **kwargs)
+
+    def write_rule(self, name, string):
+        with open(os.path.join(self.signature_dir, 'test', 'test.yar'), 'w') as fp:
+            fp.write(TEST_RULE.format(name=name, string=string))
+
+    def write_file(self, name, data):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, 'wb') as fp:
+            fp.write(data)
+
+        return path
+
+    def start_server(self):
+        env = os.environ.copy()
+        env['PYTHONPATH'] = os.path.join(saq.SAQ_HOME, 'lib')
+        self.server = subprocess.Popen([sys.executable, '-c', SERVER_SCRIPT, self.signature_dir, self.socket_path,
+                                        os.path.join(self.temp_dir, 'compiled')],
+                                       env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        # wait for the server to start listening
+        for _ in range(100):
+            if os.path.exists(self.socket_path):
+                return
+
+            time.sleep(0.1)
+
+        self.fail("batch scanner did not start")
+
+    def test_batch_scan(self):
+        self.start_server()
+        matching = [ self.write_file('match_{}'.format(i), b'say hello world') for i in range(5) ]
+        clean = [ self.write_file('clean_{}'.format(i), b'nothing to see') for i in range(5) ]
+        missing = os.path.join(self.temp_dir, 'missing')
+
+        results = {}
+        versions = set()
+        for path, rules_version, result in scan_files(matching + clean + [ missing ], self.socket_path, timeout=30):
+            results[path] = result
+            versions.add(rules_version)
+
+        self.assertEqual(len(results), 11)
+        self.assertEqual(versions, { get_rules_version(self.signature_dir) })
+        for path in matching:
+            self.assertEqual(len(results[path]), 1)
+            self.assertEqual(results[path][0]['rule'], 'test_rule')
+            self.assertEqual(results[path][0]['target'], path)
+
+        for path in clean:
+            self.assertEqual(results[path], [])
+
+        self.assertTrue(isinstance(results[missing], Exception))
+
+    def test_streaming(self):
+        self.start_server()
+        paths = [ self.write_file('file_{}'.format(i), b'hello world') for i in range(20) ]
+        # the first result arrives before the client has read the rest of them
+        results = scan_files(paths, self.socket_path, timeout=30)
+        path, rules_version, result = next(results)
+        self.assertTrue(path in paths)
+        self.assertEqual(len(list(results)), 19)
+
+    def test_server_unavailable(self):
+        with self.assertRaises(OSError):
+            list(scan_files([ self.write_file('test', b'hello world') ], self.socket_path, timeout=5))
+
+    def test_rules_reload(self):
+        self.start_server()
+        path = self.write_file('test', b'hello world')
+        ((_, old_version, result),) = list(scan_files([ path ], self.socket_path, timeout=30))
+        self.assertEqual(result[0]['rule'], 'test_rule')
+
+        self.write_rule('other_rule', 'hello')
+        # the server checks for changes every second
+        time.sleep(1.5)
+        ((_, new_version, result),) = list(scan_files([ path ], self.socket_path, timeout=30))
+        self.assertNotEqual(new_version, old_version)
+        self.assertEqual(new_version, get_rules_version(self.signature_dir))
+        self.assertEqual(result[0]['rule'], 'other_rule')
+
+    def test_result_cache(self):
+        cache = YaraResultCache(os.path.join(self.temp_dir, 'cache.db'))
+        self.assertIsNone(cache.get('abc', '/a/test.exe', 'v1'))
+        cache.put('abc', '/a/test.exe', 'v1', [ { 'rule': 'test_rule' } ])
+        cache.put('abc', '/a/test.exe', 'v2', [])
+        self.assertEqual(cache.get('abc', '/a/test.exe', 'v1'), [ { 'rule': 'test_rule' } ])
+        self.assertEqual(cache.get('abc', '/a/test.exe', 'v2'), [])
+        # rules can match on the name and the full path of the file
+        self.assertIsNone(cache.get('abc', '/a/test.doc', 'v1'))
+        self.assertIsNone(cache.get('abc', '/b/test.exe', 'v1'))
+        self.assertEqual(len(cache), 2)
+        cache.expire(-1)
+        self.assertEqual(len(cache), 0)
+        cache.close()
+
+    def test_analyzer(self):
+        from saq.modules.file_analysis import YaraScanner_v3_4, YaraScanResults_v3_4
+        saq.CONFIG['service_yara']['signature_dir'] = self.signature_dir
+        saq.CONFIG['service_yara']['batch_socket'] = self.socket_path
+        saq.CONFIG['analysis_module_yara_scanner_v3_4']['batch_enabled'] = 'yes'
+        saq.CONFIG['analysis_module_yara_scanner_v3_4']['result_cache_path'] = os.path.join(self.temp_dir, 'cache.db')
+        self.start_server()
+
+        def create_root(uuid):
+            root = create_root_analysis(uuid=uuid, storage_dir=os.path.join(self.temp_dir, uuid))
+            root.initialize_storage()
+            files = []
+            for file_name, data in [ ('match.txt', b'say hello world'), ('clean.txt', b'nothing to see') ]:
+                with open(os.path.join(root.storage_dir, file_name), 'wb') as fp:
+                    fp.write(data)
+
+                files.append(root.add_observable(F_FILE, file_name))
+
+            return root, files
+
+        root, (match, clean) = create_root('root_1')
+        m = YaraScanner_v3_4('analysis_module_yara_scanner_v3_4')
+        m.root = root
+        self.assertTrue(m.execute_analysis(match))
+        analysis = match.get_analysis(YaraScanResults_v3_4)
+        self.assertIsNotNone(analysis)
+        self.assertEqual([ _['rule'] for _ in analysis.details ], [ 'test_rule' ])
+        self.assertIsNotNone(analysis.find_observable(lambda o: o.type == F_YARA_RULE and o.value == 'test_rule'))
+
+        # the other file was scanned in the same batch
+        self.server.kill()
+        self.server.wait()
+        self.server = None
+        self.assertTrue(m.execute_analysis(clean))
+        self.assertIsNone(clean.get_analysis(YaraScanResults_v3_4))
+
+        # the same files analyzed again are answered from the result cache
+        root, (match, clean) = create_root('root_1')
+        m.reset()
+        m.root = root
+        self.assertTrue(m.execute_analysis(match))
+        analysis = match.get_analysis(YaraScanResults_v3_4)
+        self.assertEqual([ _['rule'] for _ in analysis.details ], [ 'test_rule' ])
+        self.assertEqual(analysis.details[0]['target'], os.path.abspath(os.path.join(root.storage_dir, 'match.txt')))
+        self.assertTrue(m.execute_analysis(clean))
+        self.assertIsNone(clean.get_analysis(YaraScanResults_v3_4))
+        # yss and the local scanner were never used
+        self.assertIsNone(m.scanner)
+
+        # but the same files somewhere else are not (rules can filter on the full path)
+        root, (match, clean) = create_root('root_2')
+        m.reset()
+        m.root = root
+        self.assertIsNone(m.get_cached_scan_results(os.path.abspath(os.path.join(root.storage_dir, 'match.txt')),
+                                                    m.rules_version))
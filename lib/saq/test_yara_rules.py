@@ -0,0 +1,155 @@
+# vim: sw=4:ts=4:et:cc=120
+
+import glob
+import multiprocessing
+import os, os.path
+import shutil
+
+import saq
+from saq.test import *
+from saq.yara_rules import COMPILED_RULES_EXTENSION, COMPILED_RULES_HISTORY, CompiledRules, \
+                           compile_rules, find_rule_files, get_rules_version
+
+TEST_RULE = """
+rule {name} {{
+    strings:
+        $a = "{string}"
+    condition:
+        $a
+}}
+"""
+
+def _compile_in_process(signature_dir, compiled_dir, queue):
+    queue.put(compile_rules(find_rule_files(signature_dir), compiled_dir))
+
+class YaraRulesTestCase(ACEBasicTestCase):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.temp_dir = os.path.join(saq.TEMP_DIR, 'yara_rules')
+        if os.path.isdir(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+        self.signature_dir = os.path.join(self.temp_dir, 'signatures')
+        os.makedirs(os.path.join(self.signature_dir, 'test'))
+        self.compiled_dir = os.path.join(self.temp_dir, 'compiled')
+        self.write_rule('test.yar', TEST_RULE.format(name='test_rule', string='hello world'))
+
+        self.target = os.path.join(self.temp_dir, 'target.txt')
+        with open(self.target, 'w') as fp:
+            fp.write('say hello world')
+
+    def write_rule(self, name, source):
+        with open(os.path.join(self.signature_dir, 'test', name), 'w') as fp:
+            fp.write(source)
+
+    def compiled_files(self):
+        return glob.glob(os.path.join(self.compiled_dir, '*{}'.format(COMPILED_RULES_EXTENSION)))
+
+    def test_find_rule_files(self):
+        self.write_rule('readme.txt', 'not a rule')
+        self.assertEqual(find_rule_files(self.signature_dir),
+                         { os.path.join('test', 'test.yar'): os.path.join(self.signature_dir, 'test', 'test.yar') })
+
+    def test_rules_version(self):
+        version = get_rules_version(self.signature_dir)
+        self.assertEqual(get_rules_version(self.signature_dir), version)
+        # only the contents matter
+        os.utime(os.path.join(self.signature_dir, 'test', 'test.yar'), ns=(0, 0))
+        self.assertEqual(get_rules_version(self.signature_dir), version)
+        self.write_rule('test.yar', TEST_RULE.format(name='test_rule', string='goodbye world'))
+        self.assertNotEqual(get_rules_version(self.signature_dir), version)
+
+    def test_compile_once(self):
+        version, path = compile_rules(find_rule_files(self.signature_dir), self.compiled_dir)
+        self.assertEqual(version, get_rules_version(self.signature_dir))
+        self.assertTrue(os.path.exists(path))
+        mtime = os.stat(path).st_mtime_ns
+
+        # the same version is not compiled again
+        self.assertEqual(compile_rules(find_rule_files(self.signature_dir), self.compiled_dir), (version, path))
+        self.assertEqual(os.stat(path).st_mtime_ns, mtime)
+
+    def test_compile_concurrent(self):
+        queue = multiprocessing.Queue()
+        processes = [ multiprocessing.Process(target=_compile_in_process,
+                                              args=(self.signature_dir, self.compiled_dir, queue)) for _ in range(4) ]
+        for p in processes:
+            p.start()
+
+        results = [ queue.get(timeout=30) for _ in processes ]
+        for p in processes:
+            p.join()
+
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(len(self.compiled_files()), 1)
+        self.assertEqual(glob.glob(os.path.join(self.compiled_dir, '*.tmp')), [])
+
+    def test_compile_error_isolation(self):
+        self.write_rule('bad.yar', 'rule bad_rule {\n condition: undefined_thing and\n}\n')
+        self.write_rule('other.yar', TEST_RULE.format(name='other_rule', string='hello'))
+        rules = CompiledRules(self.signature_dir, self.compiled_dir)
+        rules.load()
+        version, results = rules.match(self.target)
+        self.assertEqual(sorted([ _['rule'] for _ in results ]), [ 'other_rule', 'test_rule' ])
+
+    def test_externals(self):
+        self.write_rule('ext.yar', 'rule ext_rule { condition: extension == "txt" }')
+        rules = CompiledRules(self.signature_dir, self.compiled_dir)
+        rules.load()
+        version, results = rules.match(self.target)
+        self.assertEqual(sorted([ _['rule'] for _ in results ]), [ 'ext_rule', 'test_rule' ])
+        self.assertEqual(results[0]['target'], self.target)
+
+    def test_meta_filters(self):
+        self.write_rule('filters.yar', """
+rule txt_rule { meta: file_ext = "doc,TXT" condition: true }
+rule not_txt_rule { meta: file_ext = "!txt" condition: true }
+rule name_rule { meta: file_name = "re:^target[.]" condition: true }
+rule path_rule { meta: full_path = "sub:yara_rules" condition: true }
+rule other_path_rule { meta: full_path = "sub:other" condition: true }
+rule mime_rule { meta: mime_type = "text/plain" condition: true }
+rule other_mime_rule { meta: mime_type = "application/pdf" condition: true }
+""")
+        rules = CompiledRules(self.signature_dir, self.compiled_dir)
+        rules.load()
+        version, results = rules.match(self.target)
+        self.assertEqual(sorted([ _['rule'] for _ in results ]),
+                         [ 'mime_rule', 'name_rule', 'path_rule', 'test_rule', 'txt_rule' ])
+
+    def test_max_bytes(self):
+        with open(self.target, 'w') as fp:
+            fp.write('{} hello world'.format('x' * 1024))
+
+        rules = CompiledRules(self.signature_dir, self.compiled_dir, max_bytes=1024)
+        rules.load()
+        self.assertEqual(rules.match(self.target)[1], [])
+        rules.max_bytes = 2048
+        self.assertEqual(rules.match(self.target)[1][0]['rule'], 'test_rule')
+
+    def test_refresh(self):
+        rules = CompiledRules(self.signature_dir, self.compiled_dir, update_frequency=0)
+        self.assertTrue(rules.refresh())
+        old_version, old_rules = rules.current
+        self.assertFalse(rules.refresh())
+        self.assertIs(rules.rules, old_rules)
+
+        self.write_rule('test.yar', TEST_RULE.format(name='new_rule', string='hello'))
+        self.assertTrue(rules.refresh())
+        self.assertNotEqual(rules.version, old_version)
+        self.assertEqual(rules.match(self.target)[1][0]['rule'], 'new_rule')
+        # the old rules still work for anything that is still using them
+        self.assertEqual(old_rules.match(self.target)[0].rule, 'test_rule')
+
+        # the current rules are kept if the new ones cannot be loaded
+        current = rules.current
+        rules.compiled_dir = self.target
+        self.write_rule('test.yar', TEST_RULE.format(name='another_rule', string='hello'))
+        self.assertFalse(rules.refresh())
+        self.assertIs(rules.current, current)
+
+    def test_history(self):
+        for i in range(COMPILED_RULES_HISTORY + 3):
+            self.write_rule('test.yar', TEST_RULE.format(name='rule_{}'.format(i), string='hello'))
+            compile_rules(find_rule_files(self.signature_dir), self.compiled_dir)
+
+        self.assertEqual(len(self.compiled_files()), COMPILED_RULES_HISTORY + 1)
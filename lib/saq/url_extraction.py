@@ -0,0 +1,133 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# URL extraction from files
+#
+# find_urls_in_file passes large text and html files to urlfinderlib a chunk at a time instead of reading the
+# entire file into memory
+# chunks are cut at a line break, tag or whitespace near the end of the chunk so that URLs are not split between
+# chunks (if there is no place to cut then the end of the chunk is repeated at the start of the next one)
+#
+# get_registered_domain memoizes the (domain, tld) lookups of the host names of the extracted URLs
+#
+
+import collections
+import logging
+
+import magic
+
+from tld import get_tld
+from urlfinderlib import find_urls
+from urllib.parse import urlsplit
+
+# files larger than this are read a chunk at a time
+URL_EXTRACTION_CHUNK_SIZE = 8 * 1024 * 1024
+
+# the end of each chunk that is searched for a place to cut it
+URL_EXTRACTION_OVERLAP = 64 * 1024
+
+# where a chunk can be cut, in the order of preference (and if the cut goes before or after it)
+CHUNK_DELIMITERS = [ (b'\n', 1), (b'<', 0), (b' ', 1), (b'\t', 1), (b'\r', 1) ]
+
+# urlfinderlib parses these types of files as a whole
+UNSTREAMABLE_FILE_TYPES = [ 'utf-16', 'xml', 'rfc 822', 'mail', 'vcalendar', 'icalendar' ]
+
+# maximum number of host names remembered by get_registered_domain
+REGISTERED_DOMAIN_CACHE_SIZE = 16384
+
+# key = host name, value = (domain, tld) or None if the host name does not have a known tld
+_registered_domain_cache = collections.OrderedDict()
+
+def iterate_chunks(fp, chunk_size=URL_EXTRACTION_CHUNK_SIZE, overlap=URL_EXTRACTION_OVERLAP):
+    """Yields the contents of the given binary file object in chunks of about chunk_size bytes.
+       Each chunk ends at a delimiter (see CHUNK_DELIMITERS) in the last overlap bytes of the chunk and the rest
+       is carried over to the next chunk. If there is no delimiter then the last overlap bytes are included in
+       both chunks."""
+    carry = b''
+    repeated = False
+    while True:
+        data = fp.read(chunk_size)
+        if not data:
+            if carry and not repeated:
+                yield carry
+
+            return
+
+        data = carry + data
+        tail_start = max(len(data) - overlap, 0)
+        for delimiter, offset in CHUNK_DELIMITERS:
+            index = data.rfind(delimiter, tail_start)
+            if index != -1 and index + offset > 0:
+                cut = index + offset
+                yield data[:cut]
+                carry = data[cut:]
+                repeated = False
+                break
+        else:
+            yield data
+            carry = data[tail_start:]
+            repeated = True
+
+def is_streamable(file_type, data):
+    """Returns True if a file of the given type (see magic.from_buffer) can be passed to urlfinderlib in chunks.
+       data is the start of the file. Types that are parsed as a whole document (xml, pdf, etc...) cannot."""
+    file_type = file_type.lower()
+    if 'html' not in file_type and 'text' not in file_type:
+        return False
+
+    if any([ _ in file_type for _ in UNSTREAMABLE_FILE_TYPES ]):
+        return False
+
+    return b'BEGIN:VCALENDAR' not in data[:256] and b'%PDF-' not in data[:1024]
+
+def find_urls_in_file(path, base_url=None, chunk_size=URL_EXTRACTION_CHUNK_SIZE):
+    """Returns the set of URLs urlfinderlib finds in the given file.
+       Text and html files larger than chunk_size are processed a chunk at a time."""
+    with open(path, 'rb') as fp:
+        data = fp.read(chunk_size + 1)
+        if len(data) <= chunk_size:
+            return find_urls(data, base_url=base_url)
+
+        # every chunk is treated as the same type of file
+        file_type = magic.from_buffer(data)
+        if not is_streamable(file_type, data):
+            logging.debug("reading all of {} ({}) to extract urls".format(path, file_type))
+            return find_urls(data + fp.read(), base_url=base_url)
+
+        logging.debug("extracting urls from {} ({}) in chunks of {} bytes".format(path, file_type, chunk_size))
+        fp.seek(0)
+        result = set()
+        for chunk in iterate_chunks(fp, chunk_size):
+            result |= find_urls(chunk, base_url=base_url, mimetype=file_type)
+
+        return result
+
+def get_registered_domain(url):
+    """Returns a tuple of (domain, tld) for the host name of the given URL (for example ('google', 'co.uk') for
+       http://www.google.co.uk/) or None if it cannot be determined. The results are memoized by host name."""
+    try:
+        parsed_url = urlsplit(url)
+        hostname = parsed_url.hostname
+    except ValueError:
+        return None
+
+    if not hostname:
+        return None
+
+    try:
+        _registered_domain_cache.move_to_end(hostname)
+        return _registered_domain_cache[hostname]
+    except KeyError:
+        pass
+
+    try:
+        res = get_tld(parsed_url, as_object=True)
+        result = str(res.domain), str(res)
+    except Exception as e:
+        logging.debug("unable to get tld of {}: {}".format(hostname, e))
+        result = None
+
+    _registered_domain_cache[hostname] = result
+    if len(_registered_domain_cache) > REGISTERED_DOMAIN_CACHE_SIZE:
+        _registered_domain_cache.popitem(last=False)
+
+    return result
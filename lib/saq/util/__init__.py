@@ -12,6 +12,7 @@ import os, os.path
 import re
 import signal
 import tempfile
+import time
 import urllib
 
 import saq
@@ -64,6 +65,106 @@ def is_subdomain(src, dst):
 
     return True
 
+class DomainTrie(object):
+    """Matches host names against a list of domains the same way is_subdomain does.
+       The domains are stored as a trie of their reversed labels so a lookup only walks the labels of the
+       host name no matter how many domains there are."""
+
+    def __init__(self, domains=[]):
+        # key = label, value = dict of the next labels
+        # the key None marks the end of a domain
+        self.root = {}
+        for domain in domains:
+            self.add(domain)
+
+    def add(self, domain):
+        node = self.root
+        for label in reversed(domain.lower().split('.')):
+            node = node.setdefault(label, {})
+
+        node[None] = domain.lower()
+
+    def find(self, hostname):
+        """Returns the (shortest) domain that hostname is equal to or a subdomain of, or None."""
+        node = self.root
+        for label in reversed(hostname.lower().split('.')):
+            if None in node:
+                return node[None]
+
+            node = node.get(label)
+            if node is None:
+                return None
+
+        return node.get(None)
+
+    def find_all(self, hostname):
+        """Returns the list of all the domains that hostname is equal to or a subdomain of (shortest first.)"""
+        result = []
+        node = self.root
+        for label in reversed(hostname.lower().split('.')):
+            node = node.get(label)
+            if node is None:
+                break
+
+            if None in node:
+                result.append(node[None])
+
+        return result
+
+    def matches(self, hostname):
+        """Returns True if hostname is equal to or a subdomain of any of the domains."""
+        return self.find(hostname) is not None
+
+class TTLCache(object):
+    """A least recently used cache of at most max_size entries that expire ttl seconds after they are added.
+       Keeps count of the hits and misses."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        # key = key, value = (expiration time, value)
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        try:
+            return self.entries[key][0] > time.monotonic()
+        except KeyError:
+            return False
+
+    def get(self, key, default=None):
+        """Returns the value of the given key, or default if it is not in the cache or it expired."""
+        try:
+            expiration, value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        if expiration <= time.monotonic():
+            del self.entries[key]
+            self.misses += 1
+            return default
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def discard(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
 def is_url(value):
     if isinstance(value, str):
         if URL_REGEX_STR.match(value):
@@ -86,8 +187,6 @@ def iterate_fqdn_parts(fqdn, reverse=False):
         partial_fqdn = '.'.join(partial_fqdn)
         yield partial_fqdn
 
-    raise StopIteration()
-
 def human_readable_size(size):
     from math import log2
 
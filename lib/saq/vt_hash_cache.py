@@ -0,0 +1,134 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# vt hash cache lookups
+#
+# virus total results are stored in the result_cache table of the vt_hash_cache database
+# and cached in memcached as hash -> result_id and result_id -> result (the json string returned by virus total)
+#
+
+import logging
+import os, os.path
+
+import saq
+from saq.database import get_db_connection
+
+import memcache
+
+HASH_TYPE_MD5 = 'MD5'
+HASH_TYPE_SHA1 = 'SHA1'
+HASH_TYPE_SHA2 = 'SHA2'
+
+# maps the hash type to the column in the result_cache table
+HASH_TYPE_COLUMNS = {
+    HASH_TYPE_MD5: 'md5',
+    HASH_TYPE_SHA1: 'sha1',
+    HASH_TYPE_SHA2: 'sha2',
+}
+
+# the maximum number of hashes that can be looked up at once
+MAX_BATCH_SIZE = 1000
+
+# the memcache client is created once per process
+# (the connections of the client are kept per thread)
+_memcache_client = None
+_memcache_client_pid = None
+
+def get_memcache_client():
+    """Returns the memcache.Client for this process."""
+    global _memcache_client, _memcache_client_pid
+
+    if _memcache_client_pid != os.getpid():
+        client_address = saq.CONFIG['memcached']['client_address']
+
+        # see if we are using a unix socket with a relative path
+        if client_address.startswith('unix:'):
+            address = client_address[len('unix:'):]
+            if not os.path.isabs(address):
+                client_address = 'unix:{}/{}'.format(saq.SAQ_HOME, address)
+
+        _memcache_client = memcache.Client([client_address], debug=0)
+        _memcache_client_pid = os.getpid()
+
+    return _memcache_client
+
+def get_hash_type(_hash):
+    """Returns the HASH_TYPE_* of the given hash (determined by the length) or None if it is not a valid hash."""
+    if len(_hash) == 32:
+        return HASH_TYPE_MD5
+    elif len(_hash) == 40:
+        return HASH_TYPE_SHA1
+    elif len(_hash) == 64:
+        return HASH_TYPE_SHA2
+
+    return None
+
+def get_cached_results(client, hashes):
+    """Returns a tuple of (results, misses) for the given list of (lower case) hashes where results is a dict of
+       hash -> vt result (json string) of the hashes found in memcached and misses is the list of the others."""
+    result_ids = client.get_multi(hashes)
+    vt_results = client.get_multi(list(set([ str(_) for _ in result_ids.values() if _ ])))
+
+    results = {}
+    misses = []
+    for _hash in hashes:
+        vt_result = vt_results.get(str(result_ids.get(_hash)))
+        if vt_result:
+            results[_hash] = vt_result
+        else:
+            misses.append(_hash)
+
+    return results, misses
+
+def cache_result(client, result_id, vt_result, md5_hash=None, sha1_hash=None, sha2_hash=None):
+    """Caches the given result in memcached under each of the given hashes."""
+    mapping = { _: str(result_id) for _ in [ md5_hash, sha1_hash, sha2_hash ] if _ }
+    mapping[str(result_id)] = vt_result
+    client.set_multi(mapping)
+
+def get_database_results(hashes):
+    """Returns a dict of hash -> (result_id, vt_result, md5, sha1, sha2) of the latest result in the database for
+       each of the given (lower case) hashes. Hashes that are not in the database are not included."""
+    by_column = {}
+    for _hash in hashes:
+        hash_type = get_hash_type(_hash)
+        if hash_type is not None:
+            by_column.setdefault(HASH_TYPE_COLUMNS[hash_type], []).append(_hash)
+
+    results = {}
+    with get_db_connection('vt_hash_cache') as db:
+        c = db.cursor()
+        for column, column_hashes in by_column.items():
+            # there could potentionally be multiple rows for a hash
+            # the latest result is the first one
+            c.execute("""SELECT result_id, result, md5, sha1, sha2 FROM result_cache WHERE {} IN ({})
+                         ORDER BY insert_date DESC""".format(column, ','.join([ '%s' ] * len(column_hashes))),
+                      tuple(column_hashes))
+
+            for result_id, vt_result, md5_hash, sha1_hash, sha2_hash in c:
+                _hash = { 'md5': md5_hash, 'sha1': sha1_hash, 'sha2': sha2_hash }[column]
+                if _hash is not None and _hash.lower() not in results:
+                    results[_hash.lower()] = (result_id, vt_result, md5_hash, sha1_hash, sha2_hash)
+
+    return results
+
+def lookup_hashes(hashes, client=None):
+    """Returns a tuple of (results, misses) for the given list of hashes where results is a dict of
+       hash -> vt result (json string) of the hashes available in memcached or the database and misses is the list
+       of hashes that need to be looked up with virus total. The hashes are compared in lower case."""
+    if client is None:
+        client = get_memcache_client()
+
+    hashes = list(dict.fromkeys([ _.lower() for _ in hashes ]))
+    results, misses = get_cached_results(client, hashes)
+    if not misses:
+        return results, misses
+
+    database_results = get_database_results(misses)
+    for _hash, (result_id, vt_result, md5_hash, sha1_hash, sha2_hash) in database_results.items():
+        results[_hash] = vt_result
+        cache_result(client, result_id, vt_result, md5_hash, sha1_hash, sha2_hash)
+
+    logging.info("vt hash cache lookup of {} hashes: {} cache hits {} db hits {} misses".format(
+                 len(hashes), len(hashes) - len(misses), len(database_results), len(misses) - len(database_results)))
+
+    return results, [ _ for _ in misses if _ not in database_results ]
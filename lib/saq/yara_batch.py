@@ -0,0 +1,206 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# batched yara scanning
+#
+# the yara scanner server (yss) takes a single file per connection and the client blocks until it is scanned
+# YaraBatchScanServer takes a list of files per connection and sends the result of each file back as soon as
+# it is scanned, so a client can submit every file of an analysis at once
+#
+# protocol (unix socket, every message is a 4 byte big endian length followed by a pickled object)
+# client --> server : list of absolute file paths
+# server --> client : (path, rules_version, results) for each file in the order they finish
+#                     results is the list of yara_scanner.YaraScanner.scan_results or an Exception if the scan failed
+# server --> client : None after the last file
+#
+# results are stored in YaraResultCache keyed by the sha256 and full path of the file and the version of the rules
+# (see saq.yara_rules.get_rules_version) so any change to the rules invalidates the cached results
+#
+
+import logging
+import os, os.path
+import pickle
+import socket
+import sqlite3
+import struct
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from saq.yara_rules import CompiledRules
+
+LENGTH = struct.Struct('>I')
+
+def _recv_exact(sock, count):
+    result = b''
+    while len(result) < count:
+        data = sock.recv(count - len(result))
+        if not data:
+            raise ConnectionError("connection closed")
+
+        result += data
+
+    return result
+
+def send_message(sock, message):
+    data = pickle.dumps(message)
+    sock.sendall(LENGTH.pack(len(data)) + data)
+
+def read_message(sock):
+    return pickle.loads(_recv_exact(sock, LENGTH.unpack(_recv_exact(sock, LENGTH.size))[0]))
+
+class YaraBatchScanServer(object):
+    """Scans batches of files submitted over a unix socket with precompiled yara rules (see saq.yara_rules.)"""
+
+    def __init__(self, signature_dir, socket_path, compiled_dir, worker_count=1, update_frequency=60):
+        # directory that contains sub directories of yara rules
+        self.signature_dir = signature_dir
+        self.socket_path = socket_path
+        # the number of files scanned at the same time (they all share the same compiled rules)
+        self.worker_count = worker_count
+        # the rules are checked for changes every update_frequency seconds
+        self.rules = CompiledRules(signature_dir, compiled_dir, update_frequency=update_frequency)
+        self.rules_lock = threading.Lock()
+
+        self.server_socket = None
+        self.shutdown_event = threading.Event()
+        self.server_thread = None
+
+    def check_rules(self):
+        """Loads the new version of the rules if they have changed."""
+        with self.rules_lock:
+            self.rules.refresh()
+
+    def scan(self, path):
+        """Scans the given file. Returns a tuple of (rules_version, results or the Exception if it failed.)"""
+        version, rules = self.rules.current
+        try:
+            return self.rules.match(path)
+        except Exception as e:
+            logging.info("scan of {} failed: {}".format(path, e))
+            return version, e
+
+    def process_client(self, client_socket):
+        try:
+            paths = read_message(client_socket)
+            self.check_rules()
+            logging.debug("scanning {} files".format(len(paths)))
+            with ThreadPoolExecutor(max_workers=self.worker_count) as executor:
+                futures = { executor.submit(self.scan, path): path for path in paths }
+                for future in as_completed(futures):
+                    rules_version, result = future.result()
+                    send_message(client_socket, (futures[future], rules_version, result))
+
+            send_message(client_socket, None)
+
+        except Exception as e:
+            logging.info("unable to process client request: {}".format(e))
+
+        finally:
+            client_socket.close()
+
+    def initialize_server_socket(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        self.server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server_socket.settimeout(0.1)
+        self.server_socket.bind(self.socket_path)
+        self.server_socket.listen(50)
+
+    def serve_forever(self):
+        self.check_rules()
+        self.initialize_server_socket()
+        logging.info("yara batch scanner listening on {}".format(self.socket_path))
+        try:
+            while not self.shutdown_event.is_set():
+                try:
+                    client_socket, _ = self.server_socket.accept()
+                except socket.timeout:
+                    continue
+
+                client_socket.settimeout(None)
+                threading.Thread(target=self.process_client, args=(client_socket,), daemon=True).start()
+
+        finally:
+            self.server_socket.close()
+            try:
+                os.remove(self.socket_path)
+            except OSError:
+                pass
+
+    def start(self):
+        self.server_thread = threading.Thread(target=self.serve_forever, name="Yara Batch Scanner", daemon=True)
+        self.server_thread.start()
+
+    def stop(self):
+        self.shutdown_event.set()
+        if self.server_thread is not None:
+            self.server_thread.join()
+
+def scan_files(paths, socket_path, timeout=None):
+    """Submits the given (absolute) file paths to the YaraBatchScanServer listening on socket_path.
+       Yields a tuple of (path, rules_version, results) as each file is scanned (see the protocol above.)
+       Raises OSError if the server is not available."""
+    client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client_socket.settimeout(timeout)
+        client_socket.connect(socket_path)
+        send_message(client_socket, list(paths))
+        while True:
+            message = read_message(client_socket)
+            if message is None:
+                break
+
+            yield message
+    finally:
+        client_socket.close()
+
+class YaraResultCache(object):
+    """Caches yara scan results in a sqlite database by (sha256, path, rules version.)
+       The full path of the file is part of the key because rules can filter on it (and on the name of the file.)"""
+
+    def __init__(self, path, max_age=None):
+        """Opens (or creates) the cache database at the given path.
+           If max_age (in seconds) is given then entries older than that are removed."""
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+CREATE TABLE IF NOT EXISTS yara_results (
+    sha256 TEXT NOT NULL,
+    path TEXT NOT NULL,
+    rules_version TEXT NOT NULL,
+    results BLOB NOT NULL,
+    insert_time INTEGER NOT NULL,
+    PRIMARY KEY (sha256, path, rules_version))""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS idx_yara_results_insert_time ON yara_results(insert_time)")
+
+        if max_age is not None:
+            self.expire(max_age)
+
+    def close(self):
+        self.db.close()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM yara_results").fetchone()[0]
+
+    def get(self, sha256, path, rules_version):
+        """Returns the cached results (see yara_scanner.YaraScanner.scan_results) or None."""
+        row = self.db.execute("""SELECT results FROM yara_results
+                                 WHERE sha256 = ? AND path = ? AND rules_version = ?""",
+                              (sha256, path, rules_version)).fetchone()
+        if row is None:
+            return None
+
+        return pickle.loads(row[0])
+
+    def put(self, sha256, path, rules_version, results):
+        self.db.execute("""INSERT OR REPLACE INTO yara_results ( sha256, path, rules_version, results, insert_time )
+                           VALUES ( ?, ?, ?, ?, ? )""",
+                        (sha256, path, rules_version, pickle.dumps(results), int(time.time())))
+
+    def expire(self, max_age):
+        """Removes the entries older than max_age seconds."""
+        self.db.execute("DELETE FROM yara_results WHERE insert_time < ?", (int(time.time() - max_age),))
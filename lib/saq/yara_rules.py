@@ -0,0 +1,300 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# precompiled yara rules
+#
+# compile_rules compiles a set of yara rule files once into a compiled rules file named after a hash of the rule
+# sources (see get_rules_version) so every process that uses the same rules loads the compiled file with yara.load
+# instead of compiling the sources again
+# the first process to see a new version of the rules compiles it while the others wait for it (and then load it)
+#
+# a rule file that fails to compile is left out of the compiled rules (and logged) instead of failing the whole set
+#
+# CompiledRules keeps the current version of the rules loaded and swaps in the new version when the sources change
+# scans that are in progress finish with the version they started with
+#
+
+import fcntl
+import glob
+import hashlib
+import logging
+import os, os.path
+import re
+import time
+
+import yara
+
+# the extension of compiled rule files
+COMPILED_RULES_EXTENSION = '.yarc'
+
+# the extensions of yara rule source files in a signature directory
+RULE_FILE_EXTENSIONS = [ '.yar', '.yara' ]
+
+# external variables the rules can use (see yara_scanner)
+DEFAULT_YARA_EXTERNALS = { 'filename': '', 'filepath': '', 'extension': '', 'filetype': '' }
+
+# the number of older versions of the compiled rules that are kept around for processes that still use them
+COMPILED_RULES_HISTORY = 2
+
+# compile errors start with the path and line number of the rule file that failed
+RE_COMPILE_ERROR = re.compile(r'^(.+)\(\d+\): ')
+
+# only the first max_bytes of larger files are scanned (same as yara_scanner)
+DEFAULT_MAX_BYTES = 100 * 1024 * 1024 # 100 MB
+
+# rule meta directives that limit what files a rule applies to (same as yara_scanner)
+META_FILTER_FILE_EXT = 'file_ext'
+META_FILTER_FILE_NAME = 'file_name'
+META_FILTER_FULL_PATH = 'full_path'
+META_FILTER_MIME_TYPE = 'mime_type'
+META_FILTERS = [ META_FILTER_FILE_EXT, META_FILTER_FILE_NAME, META_FILTER_FULL_PATH, META_FILTER_MIME_TYPE ]
+
+def find_rule_files(signature_dir):
+    """Returns a dict of namespace -> path of the yara rule files in the sub directories of signature_dir.
+       The namespace is the path of the file relative to signature_dir."""
+    result = {}
+    for root, dirs, files in os.walk(signature_dir):
+        for file_name in files:
+            if os.path.splitext(file_name)[1].lower() not in RULE_FILE_EXTENSIONS:
+                continue
+
+            path = os.path.join(root, file_name)
+            result[os.path.relpath(path, signature_dir)] = path
+
+    return result
+
+def get_rules_version(rule_files):
+    """Returns a hash of the names and contents of the given rule files (see find_rule_files.)
+       rule_files can also be a path to a signature directory."""
+    if isinstance(rule_files, str):
+        rule_files = find_rule_files(rule_files)
+
+    h = hashlib.sha256()
+    for namespace in sorted(rule_files.keys()):
+        h.update(namespace.encode('utf8', errors='surrogateescape'))
+        h.update(b'\x00')
+        try:
+            with open(rule_files[namespace], 'rb') as fp:
+                h.update(hashlib.sha256(fp.read()).digest())
+        except OSError as e:
+            logging.warning("unable to read yara rule file {}: {}".format(rule_files[namespace], e))
+
+    return h.hexdigest()
+
+def filter_check(meta, path, get_mime_type):
+    """Returns True if a rule with the given meta applies to the given file, using the same meta directives
+       yara_scanner uses to filter its results (see META_FILTERS.) The value of a directive is a comma separated
+       list of values to compare against (case insensitive) that can be inverted by starting it with ! and can
+       start with re: to use regular expressions or sub: to use substring matching.
+       get_mime_type is called (with no arguments) to get the mime type of the file only if it's needed."""
+    for directive in META_FILTERS:
+        value = meta.get(directive)
+        if not isinstance(value, str):
+            continue
+
+        inverted = False
+        if value.startswith('!'):
+            value = value[1:]
+            inverted = True
+
+        compare_function = lambda user_supplied, target: user_supplied == target.lower()
+        if value.startswith('re:'):
+            value = value[3:]
+            compare_function = lambda user_supplied, target: re.search(user_supplied, target, re.IGNORECASE)
+        elif value.startswith('sub:'):
+            value = value[4:]
+            compare_function = lambda user_supplied, target: user_supplied in target.lower()
+
+        if directive == META_FILTER_FILE_EXT:
+            compare_target = path.rsplit('.', maxsplit=1)[1] if '.' in path else ''
+        elif directive == META_FILTER_FILE_NAME:
+            compare_target = os.path.basename(path)
+        elif directive == META_FILTER_FULL_PATH:
+            compare_target = path
+        else:
+            compare_target = get_mime_type() or ''
+
+        matches = any([ compare_function(_.strip(), compare_target) for _ in value.lower().split(',') ])
+        if matches == inverted:
+            return False
+
+    return True
+
+def _compile(rule_files, externals):
+    """Compiles the given rule files, leaving out the ones that fail to compile.
+       Returns a tuple of (yara.Rules, dict of namespace -> error message for the files that were left out.)"""
+    rule_files = dict(rule_files)
+    errors = {}
+    while True:
+        try:
+            return yara.compile(filepaths=rule_files, externals=externals), errors
+        except yara.Error as e:
+            # find the file that failed from the error message
+            failed_namespace = None
+            m = RE_COMPILE_ERROR.match(str(e))
+            if m:
+                for namespace, path in rule_files.items():
+                    if path == m.group(1):
+                        failed_namespace = namespace
+                        break
+
+            # otherwise compile them one at a time to find the ones that fail
+            if failed_namespace is None:
+                for namespace, path in list(rule_files.items()):
+                    try:
+                        yara.compile(filepath=path, externals=externals)
+                    except yara.Error as file_error:
+                        logging.error("yara rule file {} failed to compile: {}".format(path, file_error))
+                        errors[namespace] = str(file_error)
+                        del rule_files[namespace]
+
+                # if they all compile on their own then they only fail together
+                if not errors:
+                    raise
+
+                continue
+
+            logging.error("yara rule file {} failed to compile: {}".format(rule_files[failed_namespace], e))
+            errors[failed_namespace] = str(e)
+            del rule_files[failed_namespace]
+
+def compile_rules(rule_files, compiled_dir, externals=DEFAULT_YARA_EXTERNALS):
+    """Compiles the given rule files (see find_rule_files) into a file in compiled_dir named after the version of
+       the rules (see get_rules_version) unless it already exists.
+       Returns a tuple of (version, path to the compiled rules file.)"""
+    version = get_rules_version(rule_files)
+    target_path = os.path.join(compiled_dir, '{}{}'.format(version, COMPILED_RULES_EXTENSION))
+    if os.path.exists(target_path):
+        return version, target_path
+
+    os.makedirs(compiled_dir, exist_ok=True)
+    # other processes that need the same rules wait here for them to be compiled
+    with open(os.path.join(compiled_dir, '.lock'), 'w') as lock_fp:
+        fcntl.flock(lock_fp, fcntl.LOCK_EX)
+        if os.path.exists(target_path):
+            return version, target_path
+
+        start = time.time()
+        rules, errors = _compile(rule_files, externals)
+        temp_path = '{}.{}.tmp'.format(target_path, os.getpid())
+        rules.save(temp_path)
+        # processes that check for the file see all of it or none of it
+        os.rename(temp_path, target_path)
+        logging.info("compiled {} yara rule files ({} failed) version {} in {:.2f} seconds".format(
+                     len(rule_files) - len(errors), len(errors), version, time.time() - start))
+
+        # remove older versions
+        compiled_files = sorted(glob.glob(os.path.join(compiled_dir, '*{}'.format(COMPILED_RULES_EXTENSION))),
+                                key=os.path.getmtime, reverse=True)
+        for path in compiled_files[COMPILED_RULES_HISTORY + 1:]:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logging.warning("unable to remove {}: {}".format(path, e))
+
+    return version, target_path
+
+class CompiledRules(object):
+    """Keeps the current version of a set of yara rules loaded from compiled rules files."""
+
+    def __init__(self, signature_dir, compiled_dir, update_frequency=60, rule_files=None,
+                 max_bytes=DEFAULT_MAX_BYTES):
+        # directory that contains sub directories of yara rules
+        self.signature_dir = signature_dir
+        # or a dict of namespace -> path of the rule files (see find_rule_files)
+        self.rule_files = rule_files
+        # directory the compiled rules are stored in
+        self.compiled_dir = compiled_dir
+        # how often (in seconds) to check the rules for changes
+        self.update_frequency = update_frequency
+        # the maximum number of bytes of a file that are scanned
+        self.max_bytes = max_bytes
+
+        # the loaded yara.Rules and their version
+        # these are replaced together as a tuple so that a reader never sees a mix of two versions
+        self.current = (None, None)
+        # path to the compiled rules file of the current version
+        self.path = None
+        self.next_check = None
+
+    @property
+    def version(self):
+        return self.current[0]
+
+    @property
+    def rules(self):
+        return self.current[1]
+
+    def get_rule_files(self):
+        if self.rule_files is not None:
+            return self.rule_files
+
+        return find_rule_files(self.signature_dir)
+
+    def load(self):
+        """Loads the current version of the rules (compiling them if needed.) Returns True if a new version was
+           loaded, False if the rules have not changed."""
+        self.next_check = time.time() + self.update_frequency
+        rule_files = self.get_rule_files()
+        if self.rules is not None and get_rules_version(rule_files) == self.version:
+            return False
+
+        version, path = compile_rules(rule_files, self.compiled_dir)
+        self.current = (version, yara.load(path))
+        self.path = path
+        logging.info("loaded yara rules version {} from {}".format(version, path))
+        return True
+
+    def refresh(self):
+        """Loads the rules if they have not been loaded or if it's time to check them for changes and they have
+           changed. Returns True if a new version was loaded. If the new version cannot be loaded then the current
+           one is kept."""
+        if self.rules is not None and time.time() < self.next_check:
+            return False
+
+        try:
+            return self.load()
+        except Exception as e:
+            if self.rules is None:
+                raise
+
+            logging.error("unable to load yara rules: {}".format(e))
+            return False
+
+    def match(self, path, timeout=None):
+        """Scans the given file with the current version of the rules.
+           Returns a tuple of (version, results) where results are in the format used by yara_scanner.
+           Like yara_scanner, only the first max_bytes of the file are scanned and matches of rules whose meta
+           directives exclude the file are dropped (see filter_check.)"""
+        version, rules = self.current
+        externals = {
+            'filename': os.path.basename(path),
+            'filepath': path,
+            'extension': path.rsplit('.', maxsplit=1)[1] if '.' in os.path.basename(path) else '',
+            'filetype': '' }
+
+        kwargs = { 'externals': externals }
+        if timeout:
+            kwargs['timeout'] = timeout
+
+        if os.path.getsize(path) > self.max_bytes:
+            logging.info("file {} too large -- using first {} bytes".format(path, self.max_bytes))
+            with open(path, 'rb') as fp:
+                kwargs['data'] = fp.read(self.max_bytes)
+        else:
+            kwargs['filepath'] = path
+
+        mime_type = []
+        def _get_mime_type():
+            if not mime_type:
+                from saq.file_type import get_mime_type
+                mime_type.append(get_mime_type(path))
+
+            return mime_type[0]
+
+        return version, [ { 'target': path,
+                            'meta': match.meta,
+                            'namespace': match.namespace,
+                            'rule': match.rule,
+                            'strings': match.strings,
+                            'tags': match.tags, } for match in rules.match(**kwargs)
+                          if filter_check(match.meta, path, _get_mime_type) ]
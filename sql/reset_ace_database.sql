@@ -7,6 +7,7 @@ DELETE FROM locks;
 DELETE FROM nodes;
 DELETE FROM observables;
 DELETE FROM remediation;
+DELETE FROM sandbox_jobs;
 DELETE FROM tags;
 DELETE FROM work_distribution_groups;
 DELETE FROM workload;
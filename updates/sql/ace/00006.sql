@@ -0,0 +1,27 @@
+CREATE TABLE `sandbox_jobs` (
+  `sha256` char(64) CHARACTER SET ascii NOT NULL COMMENT 'The (lower case) sha256 of the sample.',
+  `sandbox` varchar(64) CHARACTER SET ascii NOT NULL COMMENT 'The name of the sandbox the sample was submitted to.',
+  `profile` varchar(128) CHARACTER SET ascii NOT NULL COMMENT 'The environment, tags, etc... the sample was submitted with.',
+  `job_id` varchar(256) CHARACTER SET ascii DEFAULT NULL COMMENT 'The sandbox specific id of the job.',
+  `status` enum('SUBMITTING','PENDING','COMPLETE','FAILED') NOT NULL DEFAULT 'SUBMITTING' COMMENT 'SUBMITTING - the sample is being submitted\\\\nPENDING - the sample is being analyzed\\\\nCOMPLETE - the report is available\\\\nFAILED - the submission or analysis failed',
+  `details` text CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_520_ci COMMENT 'Sandbox specific data needed to check on the job (JSON.)',
+  `node_id` int(11) DEFAULT NULL COMMENT 'The node that submitted the sample.',
+  `insert_date` datetime NOT NULL COMMENT 'When the submission was claimed.',
+  `last_update` datetime NOT NULL,
+  PRIMARY KEY (`sha256`,`sandbox`,`profile`),
+  KEY `idx_status` (`status`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+CREATE TABLE `sandbox_job_waiters` (
+  `sha256` char(64) CHARACTER SET ascii NOT NULL,
+  `sandbox` varchar(64) CHARACTER SET ascii NOT NULL,
+  `profile` varchar(128) CHARACTER SET ascii NOT NULL,
+  `uuid` varchar(36) CHARACTER SET ascii NOT NULL COMMENT 'The uuid of the root analysis waiting on the job.',
+  `observable_uuid` char(36) CHARACTER SET ascii NOT NULL,
+  `analysis_module` varchar(128) CHARACTER SET ascii NOT NULL COMMENT 'The config section of the analysis module of the delayed analysis request.',
+  `node_id` int(11) NOT NULL COMMENT 'The node the delayed analysis request is on. The sandbox job poller of this node resumes the request.',
+  `insert_date` datetime NOT NULL,
+  PRIMARY KEY (`sha256`,`sandbox`,`profile`,`uuid`,`observable_uuid`,`analysis_module`),
+  KEY `idx_node` (`node_id`),
+  CONSTRAINT `fk_sandbox_job_waiters_job` FOREIGN KEY (`sha256`, `sandbox`, `profile`) REFERENCES `sandbox_jobs` (`sha256`, `sandbox`, `profile`) ON DELETE CASCADE ON UPDATE CASCADE,
+  CONSTRAINT `fk_sandbox_job_waiters_node_id` FOREIGN KEY (`node_id`) REFERENCES `nodes` (`id`) ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;